@@ -0,0 +1,236 @@
+"""Incremental follower for the xray access log (/var/log/x-ui/access.log).
+
+Instead of `tail -500` on every request, one background thread remembers the
+file offset and inode, reads only appended bytes and keeps a rolling window
+of who was seen recently:
+
+    email -> {ip: last_seen_ts}
+
+Rotation is handled both ways logrotate does it: rename + new file (inode
+changes — the rest of the old file is drained first) and copytruncate (file
+shrinks below our offset — start over from 0).
+
+Usage:
+    online = get_tailer().snapshot()   # {email: {"ips": {...}, "last_seen": ts}}
+"""
+import calendar
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+ACCESS_LOG_PATH = "/var/log/x-ui/access.log"
+ONLINE_WINDOW = 300          # секунд — кто виден за последние 5 минут
+POLL_INTERVAL = 2.0          # как часто дочитываем файл
+BOOTSTRAP_BYTES = 16 << 20   # при старте читаем хвост такого размера
+READ_CHUNK = 1 << 20
+
+
+def _parse_ts(s: str) -> float:
+    """'2024/05/01 12:00:00' -> unix ts (время в логе считаем UTC, как и раньше)."""
+    return float(calendar.timegm((
+        int(s[0:4]), int(s[5:7]), int(s[8:10]),
+        int(s[11:13]), int(s[14:16]), int(s[17:19]), 0, 0, 0,
+    )))
+
+
+def _parse_ip(line: str) -> str | None:
+    """IP источника из '... from tcp:1.2.3.4:5678 accepted ...'."""
+    i = line.find(" from ")
+    if i < 0:
+        return None
+    i += 6
+    j = line.find(" ", i)
+    addr = line[i:j] if j > 0 else line[i:]
+    if addr.startswith(("tcp:", "udp:")):
+        addr = addr[4:]
+    if addr.startswith("["):  # [2001:db8::1]:443
+        return addr[1:addr.find("]")]
+    return addr.rsplit(":", 1)[0] if ":" in addr else addr
+
+
+class AccessLogTailer:
+    """Follows one access log and keeps the rolling email -> IPs window."""
+
+    def __init__(self, path: str = ACCESS_LOG_PATH, window: float = ONLINE_WINDOW,
+                 bootstrap_bytes: int = BOOTSTRAP_BYTES):
+        self.path = path
+        self.window = window
+        self.bootstrap_bytes = bootstrap_bytes
+        self._fh = None
+        self._inode = None
+        self._offset = 0
+        self._partial = b""
+        self._seen: dict[str, dict[str, float]] = {}
+        self._lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._stop = threading.Event()
+        # Кэш разбора времени: строки одной секунды идут подряд
+        self._last_ts_str = ""
+        self._last_ts = 0.0
+        self.stats = {"lines": 0, "bytes": 0, "rotations": 0, "errors": 0}
+
+    # ── reading ─────────────────────────────────────────────────────────
+
+    def poll(self) -> int:
+        """Read whatever was appended since the last call. Returns lines parsed."""
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+
+        parsed = 0
+        if self._fh is None:
+            self._open(st, bootstrap=True)
+        elif st.st_ino != self._inode:
+            # Renamed by logrotate: дочитываем старый файл и переходим на новый
+            parsed += self._drain()
+            self._close()
+            self.stats["rotations"] += 1
+            self._open(st, bootstrap=False)
+        elif st.st_size < self._offset:
+            # copytruncate
+            self.stats["rotations"] += 1
+            self._fh.seek(0)
+            self._offset = 0
+            self._partial = b""
+
+        parsed += self._drain()
+        return parsed
+
+    def _open(self, st, bootstrap: bool):
+        self._fh = open(self.path, "rb")
+        self._inode = st.st_ino
+        self._partial = b""
+        self._offset = 0
+        if bootstrap and st.st_size > self.bootstrap_bytes:
+            self._offset = st.st_size - self.bootstrap_bytes
+            self._fh.seek(self._offset)
+            # Первая строка скорее всего обрезана
+            self._offset += len(self._fh.readline())
+
+    def _close(self):
+        try:
+            self._fh.close()
+        except Exception:
+            pass
+        self._fh = None
+
+    def _drain(self) -> int:
+        parsed = 0
+        while True:
+            chunk = self._fh.read(READ_CHUNK)
+            if not chunk:
+                return parsed
+            self._offset += len(chunk)
+            self.stats["bytes"] += len(chunk)
+            data = self._partial + chunk
+            cut = data.rfind(b"\n")
+            if cut < 0:
+                self._partial = data
+                continue
+            self._partial = data[cut + 1:]
+            parsed += self.feed(data[:cut].decode("utf-8", "replace").split("\n"))
+
+    def feed(self, lines) -> int:
+        """Parse complete log lines into the window. Returns lines consumed."""
+        cutoff = time.time() - self.window
+        updates: list[tuple[str, str, float]] = []
+        n = 0
+        for line in lines:
+            n += 1
+            k = line.rfind(" email: ")
+            if k < 0:
+                continue
+            ts_str = line[:19]
+            if ts_str != self._last_ts_str:
+                try:
+                    self._last_ts = _parse_ts(ts_str)
+                except ValueError:
+                    self.stats["errors"] += 1
+                    continue
+                self._last_ts_str = ts_str
+            ts = self._last_ts
+            if ts < cutoff:
+                continue
+            ip = _parse_ip(line[:k]) or "?"
+            if ip == "127.0.0.1":
+                continue
+            updates.append((line[k + 8:].strip(), ip, ts))
+
+        if updates:
+            with self._lock:
+                seen = self._seen
+                for email, ip, ts in updates:
+                    ips = seen.get(email)
+                    if ips is None:
+                        seen[email] = {ip: ts}
+                    elif ips.get(ip, 0.0) < ts:
+                        ips[ip] = ts
+        self.stats["lines"] += n
+        return n
+
+    # ── window ──────────────────────────────────────────────────────────
+
+    def snapshot(self, now: float | None = None) -> dict[str, dict]:
+        """{email: {"ips": set, "last_seen": ts}} for everyone seen within the window."""
+        cutoff = (now or time.time()) - self.window
+        result = {}
+        with self._lock:
+            for email in list(self._seen):
+                ips = self._seen[email]
+                fresh = {ip: ts for ip, ts in ips.items() if ts >= cutoff}
+                if not fresh:
+                    del self._seen[email]
+                    continue
+                if len(fresh) != len(ips):
+                    self._seen[email] = fresh
+                result[email] = {"ips": set(fresh), "last_seen": max(fresh.values())}
+        return result
+
+    # ── background thread ───────────────────────────────────────────────
+
+    def start(self, interval: float = POLL_INTERVAL):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,),
+                                        name="access-log-tailer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if self._fh is not None:
+            self._close()
+
+    def _run(self, interval: float):
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Access log tail error: {e}")
+                if self._fh is not None:
+                    self._close()  # переоткроем на следующем проходе
+            self._stop.wait(interval)
+
+
+_tailer: AccessLogTailer | None = None
+_tailer_lock = threading.Lock()
+
+
+def get_tailer() -> AccessLogTailer:
+    """Process-wide tailer of ACCESS_LOG_PATH, started on first use."""
+    global _tailer
+    if _tailer is None:
+        with _tailer_lock:
+            if _tailer is None:
+                t = AccessLogTailer(ACCESS_LOG_PATH)
+                t.poll()  # первый снимок синхронно, чтобы /online не был пустым
+                t.start()
+                _tailer = t
+    return _tailer
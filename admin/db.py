@@ -6,33 +6,108 @@ from awg_api.db import _get_conn
 logger = logging.getLogger(__name__)
 
 
-def list_users(search: str = None, limit: int = 100) -> list[dict]:
+# ── Keyset pages (admin/listing.py): ORDER BY <pk> DESC, next page = pk < last seen ──
+
+def _before(column: str, before_id: int | None) -> str:
+    return f"AND {column} < %s" if before_id is not None else ""
+
+
+def _params(before_id: int | None, limit: int) -> tuple:
+    return (before_id, limit) if before_id is not None else (limit,)
+
+
+_USER_LIST_COLUMNS = """
+    id, tg_id, COALESCE(NULLIF(first_name,''), NULLIF(old_first_name,'')) AS first_name,
+    old_first_name, last_name, subscription_until,
+    permanent_discount, referral_count, created_at,
+    test_awg_activated, test_vless_activated, web_token
+"""
+
+
+def list_users(limit: int = 100, before_id: int | None = None) -> list[dict]:
+    """Newest users first; keyset page: pass the last id of the previous page as before_id."""
     conn = _get_conn()
     cur = conn.cursor(dictionary=True)
-    if search:
-        cur.execute("""
-            SELECT id, tg_id, COALESCE(NULLIF(first_name,''), NULLIF(old_first_name,'')) AS first_name,
-                   old_first_name, last_name, subscription_until,
-                   permanent_discount, referral_count, created_at,
-                   test_awg_activated, test_vless_activated, web_token
-            FROM users
-            WHERE tg_id LIKE %s OR first_name LIKE %s OR last_name LIKE %s OR old_first_name LIKE %s
-            ORDER BY created_at DESC LIMIT %s
-        """, (f"%{search}%", f"%{search}%", f"%{search}%", f"%{search}%", limit))
-    else:
-        cur.execute("""
-            SELECT id, tg_id, COALESCE(NULLIF(first_name,''), NULLIF(old_first_name,'')) AS first_name,
-                   old_first_name, last_name, subscription_until,
-                   permanent_discount, referral_count, created_at,
-                   test_awg_activated, test_vless_activated, web_token
-            FROM users ORDER BY created_at DESC LIMIT %s
-        """, (limit,))
+    cur.execute(f"SELECT {_USER_LIST_COLUMNS} FROM users WHERE 1 {_before('id', before_id)} "
+                f"ORDER BY id DESC LIMIT %s", _params(before_id, limit))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+
+def users_by_ids(ids: list[int]) -> list[dict]:
+    """List rows for the given users.id, in the order of `ids`."""
+    if not ids:
+        return []
+    conn = _get_conn()
+    cur = conn.cursor(dictionary=True)
+    placeholders = ", ".join(["%s"] * len(ids))
+    cur.execute(f"SELECT {_USER_LIST_COLUMNS} FROM users WHERE id IN ({placeholders})", tuple(ids))
+    rows = {r["id"]: r for r in cur.fetchall()}
+    cur.close()
+    conn.close()
+    return [rows[i] for i in ids if i in rows]
+
+
+# ── User search (admin/search.py) ──
+
+def users_for_search(after_id: int = 0) -> list[dict]:
+    conn = _get_conn()
+    cur = conn.cursor(dictionary=True)
+    cur.execute("""
+        SELECT id, first_name, last_name, old_first_name, email
+        FROM users WHERE id > %s ORDER BY id
+    """, (after_id,))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows
+
+
+def client_names_for_search(after_id: int = 0) -> list[dict]:
+    """[{id, uid, client_name}] — vpn_keys mapped to users.id (TG keys by tg_id, web keys by user_id)."""
+    conn = _get_conn()
+    cur = conn.cursor(dictionary=True)
+    cur.execute("""
+        SELECT k.id, u.id AS uid, k.client_name
+        FROM vpn_keys k JOIN users u ON u.tg_id = k.tg_id
+        WHERE k.id > %s AND k.tg_id != 0 AND k.client_name IS NOT NULL
+        UNION ALL
+        SELECT k.id, k.user_id AS uid, k.client_name
+        FROM vpn_keys k
+        WHERE k.id > %s AND (k.tg_id = 0 OR k.tg_id IS NULL)
+          AND k.user_id IS NOT NULL AND k.client_name IS NOT NULL
+        ORDER BY id
+    """, (after_id, after_id))
     rows = cur.fetchall()
     cur.close()
     conn.close()
     return rows
 
 
+def exact_user_matches(term: str) -> list[int]:
+    """users.id whose id / tg_id / email / web_token / payment_id equals term (indexed lookups)."""
+    conn = _get_conn()
+    cur = conn.cursor(dictionary=True)
+    ids = []
+    if term.lstrip("-").isdigit():
+        n = int(term)
+        cur.execute("SELECT id FROM users WHERE tg_id = %s UNION SELECT id FROM users WHERE id = %s", (n, n))
+        ids += [r["id"] for r in cur.fetchall()]
+    else:
+        cur.execute("""
+            SELECT id FROM users WHERE email = %s
+            UNION SELECT id FROM users WHERE web_token = %s
+            UNION SELECT u.id FROM payments p JOIN users u ON u.tg_id = p.tg_id
+                  WHERE p.payment_id = %s AND p.tg_id != 0
+        """, (term, term, term))
+        ids += [r["id"] for r in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return list(dict.fromkeys(ids))
+
+
 def count_users() -> dict:
     conn = _get_conn()
     cur = conn.cursor(dictionary=True)
@@ -150,17 +225,17 @@ def new_users_today() -> list[dict]:
     return rows
 
 
-def list_winback_log(limit: int = 50) -> list[dict]:
+def list_winback_log(limit: int = 50, before_id: int | None = None) -> list[dict]:
     conn = _get_conn()
     cur = conn.cursor(dictionary=True)
-    cur.execute("""
+    cur.execute(f"""
         SELECT w.id, w.tg_id, w.scenario, w.sent_at,
                COALESCE(NULLIF(u.first_name,''), u.old_first_name) AS first_name, u.last_name
         FROM winback_log w
         LEFT JOIN users u ON w.tg_id = u.tg_id
-        WHERE w.sent_at >= NOW() - INTERVAL 6 DAY
-        ORDER BY w.sent_at DESC LIMIT %s
-    """, (limit,))
+        WHERE w.sent_at >= NOW() - INTERVAL 6 DAY {_before("w.id", before_id)}
+        ORDER BY w.id DESC LIMIT %s
+    """, _params(before_id, limit))
     rows = cur.fetchall()
     cur.close()
     conn.close()
@@ -220,43 +295,28 @@ def list_promocodes() -> list[dict]:
     return rows
 
 
-def payment_stats() -> dict:
+def autopay_failures(limit: int = 50, before_id: int | None = None) -> list[dict]:
     conn = _get_conn()
     cur = conn.cursor(dictionary=True)
-    cur.execute("""
-        SELECT
-            COUNT(*) as total,
-            SUM(CASE WHEN status='paid' AND is_test=0 THEN 1 ELSE 0 END) as paid,
-            SUM(CASE WHEN status='paid' AND is_test=0 THEN amount ELSE 0 END) as revenue
-        FROM payments
-    """)
-    row = cur.fetchone()
-    cur.close()
-    conn.close()
-    return row or {"total": 0, "paid": 0, "revenue": 0}
-
-
-def autopay_failures(limit: int = 50) -> list[dict]:
-    conn = _get_conn()
-    cur = conn.cursor(dictionary=True)
-    cur.execute("""
-        SELECT a.tg_id, a.user_id, a.tariff, a.amount, a.payment_id,
+    cur.execute(f"""
+        SELECT a.id, a.tg_id, a.user_id, a.tariff, a.amount, a.payment_id,
                a.status, a.error_message, a.created_at,
                COALESCE(NULLIF(u.first_name,''), u.old_first_name) AS first_name
         FROM autopay_log a
         LEFT JOIN users u ON a.user_id = u.id
-        ORDER BY a.created_at DESC LIMIT %s
-    """, (limit,))
+        WHERE 1 {_before("a.id", before_id)}
+        ORDER BY a.id DESC LIMIT %s
+    """, _params(before_id, limit))
     rows = cur.fetchall()
     cur.close()
     conn.close()
     return rows
 
 
-def referral_network(limit: int = 50) -> list[dict]:
+def referral_network(limit: int = 50, before_id: int | None = None) -> list[dict]:
     conn = _get_conn()
     cur = conn.cursor(dictionary=True)
-    cur.execute("""
+    cur.execute(f"""
         SELECT u.id, u.tg_id,
                COALESCE(NULLIF(u.first_name,''), u.old_first_name) AS first_name,
                u.referred_by, u.created_at,
@@ -264,8 +324,9 @@ def referral_network(limit: int = 50) -> list[dict]:
                r.tg_id AS referrer_tg_id
         FROM users u
         JOIN users r ON u.referred_by = r.id
-        ORDER BY u.created_at DESC LIMIT %s
-    """, (limit,))
+        WHERE 1 {_before("u.id", before_id)}
+        ORDER BY u.id DESC LIMIT %s
+    """, _params(before_id, limit))
     rows = cur.fetchall()
     cur.close()
     conn.close()
@@ -292,17 +353,17 @@ def protocol_breakdown() -> list[dict]:
     return [{"vpn_type": p, "count": result_map.get(p, 0)} for p in known_protocols]
 
 
-def failed_pending_payments(limit: int = 30) -> list[dict]:
+def failed_pending_payments(limit: int = 30, before_id: int | None = None) -> list[dict]:
     conn = _get_conn()
     cur = conn.cursor(dictionary=True)
-    cur.execute("""
-        SELECT p.payment_id, p.tg_id, p.tariff, p.amount, p.status, p.created_at,
+    cur.execute(f"""
+        SELECT p.id, p.payment_id, p.tg_id, p.tariff, p.amount, p.status, p.created_at,
                COALESCE(NULLIF(u.first_name,''), u.old_first_name) AS first_name
         FROM payments p
         LEFT JOIN users u ON p.tg_id = u.tg_id
-        WHERE p.status != 'paid'
-        ORDER BY p.created_at DESC LIMIT %s
-    """, (limit,))
+        WHERE p.status != 'paid' {_before("p.id", before_id)}
+        ORDER BY p.id DESC LIMIT %s
+    """, _params(before_id, limit))
     rows = cur.fetchall()
     cur.close()
     conn.close()
@@ -338,17 +399,18 @@ def autopay_summary() -> dict:
     return row or {"enabled": 0, "with_method": 0}
 
 
-def promo_usage_details(limit: int = 50) -> list[dict]:
+def promo_usage_details(limit: int = 50, before_id: int | None = None) -> list[dict]:
     conn = _get_conn()
     cur = conn.cursor(dictionary=True)
-    cur.execute("""
+    cur.execute(f"""
         SELECT pu.id, pu.tg_id, p.code, p.type, p.value, pu.used_at,
                COALESCE(NULLIF(u.first_name,''), u.old_first_name) AS first_name
         FROM promocode_usages pu
         JOIN promocodes p ON pu.promocode_id = p.id
         LEFT JOIN users u ON pu.tg_id = u.tg_id
-        ORDER BY pu.used_at DESC LIMIT %s
-    """, (limit,))
+        WHERE 1 {_before("pu.id", before_id)}
+        ORDER BY pu.id DESC LIMIT %s
+    """, _params(before_id, limit))
     rows = cur.fetchall()
     cur.close()
     conn.close()
@@ -0,0 +1,71 @@
+"""Paged admin lists.
+
+Every list endpoint returns {"items": [...], "next_cursor": str | None}; pass
+next_cursor back as ?cursor= for the next page. With ?format=ndjson the
+endpoint instead streams one JSON object per line, walking all pages from
+the given cursor, so the page can render rows as they arrive.
+
+Rows are encoded once by orjson (datetime/date natively, Decimal/bytes via
+_default) — no recursive _clean() pass over the result.
+"""
+import asyncio
+from decimal import Decimal
+from typing import Callable
+
+import orjson
+from fastapi.responses import Response, StreamingResponse
+
+NDJSON = "application/x-ndjson"
+
+# fetch(cursor) -> (rows, next_cursor); blocking, runs in a worker thread
+Fetch = Callable[[str | None], tuple[list[dict], str | None]]
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == int(obj) else float(obj)
+    if isinstance(obj, bytes):
+        return obj.decode("utf-8", errors="replace")
+    return str(obj)
+
+
+def dumps(obj) -> bytes:
+    return orjson.dumps(obj, default=_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def id_cursor(cursor: str | None) -> int | None:
+    return int(cursor) if cursor and cursor.isdigit() else None
+
+
+def by_id(fetch_rows: Callable[[int, int | None], list[dict]], limit: int, key: str = "id") -> Fetch:
+    """Adapt admin_db.f(limit, before_id) (ORDER BY key DESC) to a Fetch."""
+    def fetch(cursor):
+        rows = fetch_rows(limit, id_cursor(cursor))
+        return rows, (str(rows[-1][key]) if len(rows) == limit else None)
+    return fetch
+
+
+async def respond(fetch: Fetch, cursor: str | None = None, fmt: str = "json",
+                  transform: Callable[[dict], dict] | None = None) -> Response:
+    if fmt == "ndjson":
+        return StreamingResponse(_stream(fetch, cursor, transform), media_type=NDJSON)
+    rows, next_cursor = await asyncio.to_thread(fetch, cursor)
+    if transform:
+        rows = [transform(r) for r in rows]
+    return FastJSONResponse({"items": rows, "next_cursor": next_cursor})
+
+
+async def _stream(fetch: Fetch, cursor: str | None, transform):
+    while True:
+        rows, cursor = await asyncio.to_thread(fetch, cursor)
+        if rows:
+            yield b"".join(dumps(transform(r) if transform else r) + b"\n" for r in rows)
+        if cursor is None:
+            return
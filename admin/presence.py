@@ -0,0 +1,172 @@
+"""Shared online-presence engine for the admin panel.
+
+One background task recomputes who is online (access log, XUI traffic,
+`awg show`, SoftEther sessions, MySQL name resolution) on a fixed cadence and
+publishes versioned snapshots. /online, /offline, the SSE stream and the
+WebSocket broadcaster all read the same snapshot instead of recomputing it.
+
+Snapshots are never mutated after publication. Subscribers receive diffs:
+
+    {"version": 8, "base_version": 7,
+     "joined": [user, ...], "left": [key, ...], "changed": [user, ...]}
+
+Every user dict carries a stable "key" (tg:<id> / uid:<id> / name:<client>)
+so clients can apply diffs to their local copy.
+"""
+import asyncio
+import logging
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_INTERVAL = 10.0   # секунд между пересчётами
+SUBSCRIBER_QUEUE = 32      # сколько диффов держим для медленного подписчика
+
+
+def user_key(u: dict) -> str:
+    if u.get("tg_id"):
+        return f"tg:{u['tg_id']}"
+    if u.get("user_id"):
+        return f"uid:{u['user_id']}"
+    names = u.get("names") or [u.get("name", "")]
+    return f"name:{names[0]}"
+
+
+class PresenceSnapshot:
+    """Immutable result of one presence computation."""
+
+    __slots__ = ("version", "taken_at", "users", "identities", "by_key")
+
+    def __init__(self, version: int, users: list[dict], identities):
+        self.version = version
+        self.taken_at = time.monotonic()
+        for u in users:
+            u["key"] = user_key(u)
+        self.users = tuple(users)
+        self.identities = frozenset(identities)
+        self.by_key = {u["key"]: u for u in self.users}
+
+    def age(self) -> float:
+        return time.monotonic() - self.taken_at
+
+    def as_message(self) -> dict:
+        return {"type": "online", "version": self.version, "data": list(self.users)}
+
+
+def diff_snapshots(old: PresenceSnapshot | None, new: PresenceSnapshot) -> dict:
+    before = old.by_key if old else {}
+    after = new.by_key
+    return {
+        "type": "online_diff",
+        "version": new.version,
+        "base_version": old.version if old else 0,
+        "joined": [u for k, u in after.items() if k not in before],
+        "left": [k for k in before if k not in after],
+        "changed": [u for k, u in after.items() if k in before and before[k] != u],
+    }
+
+
+def is_empty_diff(diff: dict) -> bool:
+    return not (diff["joined"] or diff["left"] or diff["changed"])
+
+
+class PresenceEngine:
+    """Recomputes presence in a worker thread and fans snapshots out."""
+
+    def __init__(self, compute: Callable[[], tuple[list[dict], set]],
+                 interval: float = PRESENCE_INTERVAL):
+        self._compute = compute
+        self.interval = interval
+        self._snapshot: PresenceSnapshot | None = None
+        self._version = 0
+        self._refreshing: asyncio.Task | None = None
+        self._subscribers: set[asyncio.Queue] = set()
+        self._task: asyncio.Task | None = None
+        self.stats = {"refreshes": 0, "errors": 0, "diffs_sent": 0, "dropped": 0}
+
+    @property
+    def snapshot(self) -> PresenceSnapshot | None:
+        return self._snapshot
+
+    # ── refresh ─────────────────────────────────────────────────────────
+
+    async def refresh(self) -> PresenceSnapshot:
+        """Recompute now; concurrent callers share one computation."""
+        task = self._refreshing
+        if task is None or task.done() or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(self._do_refresh())
+            self._refreshing = task
+        return await asyncio.shield(task)
+
+    async def _do_refresh(self) -> PresenceSnapshot:
+        users, identities = await asyncio.to_thread(self._compute)
+        old = self._snapshot
+        new = PresenceSnapshot(self._version + 1, users, identities)
+        diff = diff_snapshots(old, new)
+        if old is not None and is_empty_diff(diff):
+            # Ничего не поменялось — версию не двигаем, иначе у клиента будет
+            # дыра в base_version и он уйдёт в resync
+            new = PresenceSnapshot(old.version, users, identities)
+        else:
+            self._version = new.version
+            if old is not None:
+                self._publish(diff)
+        self._snapshot = new
+        self.stats["refreshes"] += 1
+        return new
+
+    async def get(self) -> PresenceSnapshot:
+        """Current snapshot; recomputed only if older than the refresh interval."""
+        snap = self._snapshot
+        if snap is not None and snap.age() < self.interval:
+            return snap
+        return await self.refresh()
+
+    # ── subscribers ─────────────────────────────────────────────────────
+
+    def subscribe(self) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE)
+        self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q: asyncio.Queue):
+        self._subscribers.discard(q)
+
+    def _publish(self, diff: dict):
+        for q in list(self._subscribers):
+            try:
+                q.put_nowait(diff)
+                self.stats["diffs_sent"] += 1
+            except asyncio.QueueFull:
+                # Подписчик отстал: выкидываем очередь и просим полный снимок
+                self.stats["dropped"] += 1
+                while not q.empty():
+                    q.get_nowait()
+                q.put_nowait({"type": "resync", "version": diff["version"]})
+
+    # ── background loop ─────────────────────────────────────────────────
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self._subscribers:
+                continue  # никто не смотрит — не считаем
+            try:
+                await self.refresh()
+            except Exception as e:
+                self.stats["errors"] += 1
+                logger.warning(f"Presence refresh error: {e}")
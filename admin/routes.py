@@ -8,6 +8,7 @@ import subprocess
 import sys
 import time
 from datetime import datetime, timezone
+from functools import partial
 
 from fastapi import APIRouter, Depends, Query, Request, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse, HTMLResponse, FileResponse
@@ -18,6 +19,10 @@ sys.path.insert(0, "/home/alvik/vpn-service")
 
 from awg_api import db as awg_db
 from admin import db as admin_db
+from admin import listing
+from admin import access_log
+from admin.presence import PresenceEngine
+from awg_api import peer_stats
 from awg_api.config import (
     MYSQL_HOST, MYSQL_PORT, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE,
 )
@@ -237,35 +242,11 @@ def _get_online_users() -> tuple[list[dict], set]:
     vless_ips: dict[str, set[str]] = {}   # email -> set of IPs
     vless_ts: dict[str, str] = {}         # email -> latest timestamp
 
-    # VLESS: parse access.log for activity in last 5 minutes
-    access_log = "/var/log/x-ui/access.log"
+    # VLESS: who was seen in access.log during the last 5 minutes (background tailer)
     try:
-        cutoff = time.time() - 300  # 5 min ago
-        result = subprocess.run(
-            ["tail", "-500", access_log], capture_output=True, text=True, timeout=5
-        )
-        for line in result.stdout.strip().split("\n"):
-            if "email:" not in line or "127.0.0.1" in line.split("from ")[1][:15] if "from " in line else True:
-                continue
-            ts_match = re.match(r"(\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2})", line)
-            if not ts_match:
-                continue
-            try:
-                ts = datetime.strptime(ts_match.group(1), "%Y/%m/%d %H:%M:%S").replace(tzinfo=timezone.utc)
-                if ts.timestamp() < cutoff:
-                    continue
-            except Exception:
-                continue
-
-            ip_match = re.search(r"from (?:tcp:)?(\d+\.\d+\.\d+\.\d+)", line)
-            ip = ip_match.group(1) if ip_match else "?"
-
-            email_match = re.search(r"email: (.+)$", line)
-            if not email_match:
-                continue
-            email = email_match.group(1).strip()
-            vless_ips.setdefault(email, set()).add(ip)
-            vless_ts[email] = ts.strftime("%H:%M:%S")
+        for email, seen in access_log.get_tailer().snapshot().items():
+            vless_ips[email] = seen["ips"]
+            vless_ts[email] = datetime.fromtimestamp(seen["last_seen"], timezone.utc).strftime("%H:%M:%S")
 
         for email, ips in vless_ips.items():
             is_hysteria = email.endswith("_h")
@@ -295,24 +276,16 @@ def _get_online_users() -> tuple[list[dict], set]:
     except Exception as e:
         logger.warning(f"Traffic fetch error: {e}")
 
-    # AWG: check last handshake from awg show dump
+    # AWG: check last handshake from peer stats (UAPI socket)
     try:
         awg_clients = awg_db.list_clients()
         pub_to_name = {c["public_key"]: c["name"] for c in awg_clients}
-        result = subprocess.run(
-            ["awg", "show", "awg0", "dump"], capture_output=True, text=True, timeout=5
-        )
-        for line in result.stdout.strip().split("\n")[1:]:
-            parts = line.split("\t")
-            if len(parts) < 7:
-                continue
-            pub_key = parts[0]
-            last_handshake = int(parts[4]) if parts[4] != "0" else 0
+        for peer in peer_stats.read_peers():
+            pub_key = peer["public_key"]
+            last_handshake = peer["handshake_ts"]
             if last_handshake > 0 and (time.time() - last_handshake) < 300:
                 name = pub_to_name.get(pub_key, pub_key[:12])
-                rx = int(parts[5]) if parts[5].isdigit() else 0
-                tx = int(parts[6]) if parts[6].isdigit() else 0
-                speed = _calc_speed(name, "awg", rx + tx)
+                speed = _calc_speed(name, "awg", peer["rx"] + peer["tx"])
                 raw_entries.append({
                     "name": name,
                     "ip_count": 1,
@@ -402,22 +375,38 @@ def _get_online_users() -> tuple[list[dict], set]:
     return online, online_identities
 
 
+# Один пересчёт присутствия на всех: /online, /offline, SSE и WS
+presence = PresenceEngine(lambda: _get_online_users())
+
+
 @router.get("/online")
 async def online_users():
-    online, _ = _get_online_users()
-    return online
+    return list((await presence.get()).users)
 
 
 @router.get("/online/stream", dependencies=[Depends(_require_admin_session)])
 async def online_stream(request: Request):
-    """SSE stream — kept for backward compatibility. New clients use /ws."""
+    """SSE stream — kept for backward compatibility. New clients use /ws.
+    Sends one full "online" event, then "online_diff" events."""
     async def event_generator():
-        while True:
-            if await request.is_disconnected():
-                break
-            users, _ = _get_online_users()
-            yield {"event": "online", "data": json.dumps(users)}
-            await asyncio.sleep(10)
+        queue = presence.subscribe()
+        try:
+            snap = await presence.get()
+            yield {"event": "online", "data": json.dumps(list(snap.users), default=_serialize)}
+            while True:
+                if await request.is_disconnected():
+                    break
+                try:
+                    msg = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    continue
+                if msg["type"] == "resync":
+                    snap = await presence.get()
+                    yield {"event": "online", "data": json.dumps(list(snap.users), default=_serialize)}
+                else:
+                    yield {"event": "online_diff", "data": json.dumps(msg, default=_serialize)}
+        finally:
+            presence.unsubscribe(queue)
 
     return EventSourceResponse(event_generator())
 
@@ -426,56 +415,47 @@ async def online_stream(request: Request):
 async def offline_users():
     """Users with active VPN keys who are NOT currently online.
     All protocols merged into a single row per user (by tg_id/user_id)."""
-    _, online_identities = _get_online_users()
+    online_identities = (await presence.get()).identities
 
     # Collect raw entries: {name, type, last_seen, last_seen_ts}
     raw_entries = []
 
-    # ── VLESS: get clients + last_online directly from x-ui SQLite ──
+    # ── VLESS: clients + last_online from the x-ui SQLite mirror ──
     try:
-        import sqlite3 as _sqlite3
-        XUI_DB = "/etc/x-ui/x-ui.db"
+        from bot_xui import xui_db
         now_ms = int(time.time() * 1000)
+        snap = await asyncio.to_thread(xui_db.snapshot)
 
-        conn = _sqlite3.connect(f"file:{XUI_DB}?mode=ro", uri=True)
-        cur = conn.cursor()
-
-        cur.execute("SELECT email, last_online FROM client_traffics WHERE enable = 1")
-        last_online_map = {row[0]: row[1] for row in cur.fetchall()}
+        for _ib, c in snap.clients(protocol="vless"):
+            email = c.get("email", "").strip()
+            if not email:
+                continue
+            identity = ("vless", email)
+            if identity in online_identities:
+                continue
+            if not c.get("enable", True):
+                continue
+            expiry = c.get("expiryTime", 0)
+            if expiry and 0 < expiry < now_ms:
+                continue  # expired
 
-        cur.execute("SELECT settings FROM inbounds WHERE protocol = 'vless'")
-        for (settings_json,) in cur.fetchall():
-            clients = json.loads(settings_json).get("clients", [])
-            for c in clients:
-                email = c.get("email", "").strip()
-                if not email:
-                    continue
-                identity = ("vless", email)
-                if identity in online_identities:
-                    continue
-                if not c.get("enable", True):
-                    continue
-                expiry = c.get("expiryTime", 0)
-                if expiry and 0 < expiry < now_ms:
-                    continue  # expired
-
-                last_online = last_online_map.get(email, 0) or 0
-                last_str = ""
-                if last_online > 0:
-                    try:
-                        last_str = datetime.fromtimestamp(
-                            last_online / 1000, tz=timezone.utc
-                        ).strftime("%Y-%m-%d %H:%M")
-                    except Exception:
-                        pass
+            traffic = snap.traffic.get(email)
+            last_online = (traffic["last_online"] if traffic and traffic["enable"] else 0) or 0
+            last_str = ""
+            if last_online > 0:
+                try:
+                    last_str = datetime.fromtimestamp(
+                        last_online / 1000, tz=timezone.utc
+                    ).strftime("%Y-%m-%d %H:%M")
+                except Exception:
+                    pass
 
-                raw_entries.append({
-                    "name": email,
-                    "type": "vless",
-                    "last_seen": last_str,
-                    "last_seen_ts": last_online,
-                })
-        conn.close()
+            raw_entries.append({
+                "name": email,
+                "type": "vless",
+                "last_seen": last_str,
+                "last_seen_ts": last_online,
+            })
     except Exception as e:
         logger.warning(f"Offline VLESS error: {e}")
 
@@ -484,18 +464,11 @@ async def offline_users():
         awg_clients = awg_db.list_clients()
         pub_to_name = {c["public_key"]: c["name"] for c in awg_clients}
         enabled_names = {c["name"] for c in awg_clients if c.get("enabled", True)}
-        result = subprocess.run(
-            ["awg", "show", "awg0", "dump"], capture_output=True, text=True, timeout=5
-        )
-        for line in result.stdout.strip().split("\n")[1:]:
-            parts = line.split("\t")
-            if len(parts) < 7:
-                continue
-            pub_key = parts[0]
-            name = pub_to_name.get(pub_key)
+        for peer in peer_stats.read_peers(max_age=1.0):
+            name = pub_to_name.get(peer["public_key"])
             if not name or ("awg", name) in online_identities or name not in enabled_names:
                 continue
-            last_hs = int(parts[4]) if parts[4] != "0" else 0
+            last_hs = peer["handshake_ts"]
             last_str = ""
             last_ts = 0
             if last_hs > 0:
@@ -582,32 +555,22 @@ async def offline_users():
 async def finance():
     """Server financials: revenue, costs, profitability."""
     from datetime import datetime as dt
+    from api import rollups
 
-    conn = awg_db._get_conn()
-    cur = conn.cursor(dictionary=True)
+    snap = await asyncio.to_thread(rollups.snapshot, {"paid", "revenue"})
 
     # Total revenue
-    cur.execute("SELECT COALESCE(SUM(amount),0) as total FROM payments WHERE status='paid' AND is_test=0")
-    total_revenue = float(cur.fetchone()["total"])
+    total_revenue = float(snap.total("revenue"))
 
-    # First payment date (service start)
-    cur.execute("SELECT MIN(created_at) as d FROM payments WHERE status='paid' AND is_test=0")
-    row = cur.fetchone()
-    first_payment = row["d"] if row and row["d"] else None
+    # First payment date (service start), day precision (UTC+9)
+    first_day = snap.first_day("paid")
+    first_payment = dt.combine(first_day, dt.min.time()) if first_day else None
 
     # Monthly breakdown
-    fmt = "%Y-%m"
-    cur.execute(
-        "SELECT DATE_FORMAT(created_at, %s) as month,"
-        " COUNT(*) as payments, SUM(amount) as revenue"
-        " FROM payments WHERE status='paid' AND is_test=0"
-        " GROUP BY DATE_FORMAT(created_at, %s) ORDER BY month",
-        (fmt, fmt),
-    )
-    monthly = cur.fetchall()
-
-    cur.close()
-    conn.close()
+    paid_by_month = snap.by_month("paid")
+    revenue_by_month = snap.by_month("revenue")
+    monthly = [{"month": month, "payments": paid_by_month[month], "revenue": revenue_by_month.get(month, 0)}
+               for month in sorted(paid_by_month)]
 
     # Server cost
     server_cost = float(os.getenv("SERVER_MONTHLY_COST", "0"))
@@ -658,15 +621,12 @@ async def finance():
 
 @router.get("/dashboard")
 async def dashboard():
+    from api import rollups
+
     # AWG stats
     awg_clients = awg_db.list_clients()
     awg_enabled = sum(1 for c in awg_clients if c["enabled"])
-    awg_up = False
-    try:
-        r = subprocess.run(["awg", "show", "awg0"], capture_output=True, text=True)
-        awg_up = r.returncode == 0
-    except Exception:
-        pass
+    awg_up = await asyncio.to_thread(peer_stats.is_up)
 
     # XUI stats
     xui_data = {"inbounds": 0, "clients": 0, "up": 0, "down": 0, "running": False}
@@ -697,7 +657,7 @@ async def dashboard():
 
     # Bot stats
     user_stats = admin_db.count_users()
-    pay_stats = admin_db.payment_stats()
+    pay_snap = await asyncio.to_thread(rollups.snapshot, {"payments", "paid", "revenue"})
     recent = admin_db.recent_payments(10)
 
     # Extra dashboard data
@@ -751,9 +711,9 @@ async def dashboard():
             "active_subscribers": user_stats["active"],
         },
         "payments": {
-            "total": pay_stats["total"],
-            "paid": pay_stats["paid"],
-            "revenue": float(pay_stats["revenue"] or 0),
+            "total": pay_snap.total("payments"),
+            "paid": pay_snap.total("paid"),
+            "revenue": float(pay_snap.total("revenue")),
         },
         "recent_payments": _clean(recent),
         "protocol_breakdown": protocol_stats,
@@ -774,6 +734,52 @@ async def awg_server():
     return srv
 
 
+# ── DB pools ─────────────────────────────────────────────────────────────────
+
+@router.get("/db-pools")
+async def db_pools():
+    """Connection pool counters: checkout wait time, exhaustion, health checks."""
+    from db_pool import pool_stats
+    return {"pools": pool_stats()}
+
+
+# ── Subscription cache ───────────────────────────────────────────────────────
+
+# /sub/{token} обслуживает сервис вебхука (api.service), счётчики берём у него
+SUB_CACHE_STATS_URL = os.getenv("SUB_CACHE_STATS_URL", "http://127.0.0.1:8000/sub-cache/stats")
+
+
+@router.get("/sub-cache")
+async def sub_cache():
+    """Hit/miss/stale counters of the /sub/{token} response cache."""
+    import httpx
+    try:
+        async with httpx.AsyncClient(timeout=3) as client:
+            resp = await client.get(SUB_CACHE_STATS_URL)
+            resp.raise_for_status()
+            return resp.json()
+    except Exception as e:
+        logger.warning(f"Sub cache stats fetch error: {e}")
+        return JSONResponse({"error": "api service unavailable"}, status_code=502)
+
+
+SESSION_CACHE_STATS_URL = os.getenv("SESSION_CACHE_STATS_URL", "http://127.0.0.1:8000/api/auth/cache-stats")
+
+
+@router.get("/session-cache")
+async def session_cache():
+    """Hit/miss/invalidation counters of the web auth session cache."""
+    import httpx
+    try:
+        async with httpx.AsyncClient(timeout=3) as client:
+            resp = await client.get(SESSION_CACHE_STATS_URL)
+            resp.raise_for_status()
+            return resp.json()
+    except Exception as e:
+        logger.warning(f"Session cache stats fetch error: {e}")
+        return JSONResponse({"error": "api service unavailable"}, status_code=502)
+
+
 # ── XUI Inbounds ─────────────────────────────────────────────────────────────
 
 @router.get("/xui/inbounds")
@@ -811,111 +817,126 @@ async def xui_inbounds():
         return JSONResponse({"error": str(e)}, status_code=500)
 
 
-@router.get("/xui/inbounds/{inbound_id}/clients")
-async def xui_inbound_clients(inbound_id: int):
-    try:
-        xui = _get_xui()
-        inbounds = xui.get_inbounds()
-
-        # Build global stats map across ALL inbounds (email -> aggregated stats)
-        global_stats: dict[str, dict] = {}
-        for _ib in inbounds:
-            for cs in _ib.get("clientStats", []):
-                email = cs.get("email", "")
-                if email in global_stats:
-                    global_stats[email]["up"] += cs.get("up", 0)
-                    global_stats[email]["down"] += cs.get("down", 0)
-                else:
-                    global_stats[email] = {**cs}
-
-        # Enrich with last_online from SQLite (API doesn't return it)
+def _xui_client_page(inbounds: list[dict], clients: list[dict], limit: int,
+                     cursor: str | None) -> tuple[list[dict], str | None]:
+    """One page of inbound clients ordered by email (unique in x-ui); traffic,
+    last_online and names are looked up only for the emails on this page."""
+    clients = sorted((c for c in clients if cursor is None or c.get("email", "") > cursor),
+                     key=lambda c: c.get("email", ""))
+    page = clients[:limit]
+    next_cursor = page[-1].get("email", "") if len(clients) > limit else None
+    emails = [c.get("email", "") for c in page]
+    wanted = set(emails)
+
+    # Stats map across ALL inbounds (email -> aggregated stats)
+    global_stats: dict[str, dict] = {}
+    for _ib in inbounds:
+        for cs in _ib.get("clientStats") or []:
+            email = cs.get("email", "")
+            if email not in wanted:
+                continue
+            if email in global_stats:
+                global_stats[email]["up"] += cs.get("up", 0)
+                global_stats[email]["down"] += cs.get("down", 0)
+            else:
+                global_stats[email] = {**cs}
+
+    # Enrich with last_online from the x-ui SQLite mirror (API doesn't return it)
+    if emails:
         try:
-            import sqlite3 as _sqlite3
-            XUI_DB = "/home/alvik/vpn-service/docker/x-ui-data/x-ui.db"
-            _conn = _sqlite3.connect(f"file:{XUI_DB}?mode=ro", uri=True)
-            _cur = _conn.cursor()
-            _cur.execute("SELECT email, last_online FROM client_traffics")
-            for _email, _lo in _cur.fetchall():
+            from bot_xui import xui_db
+            traffic = xui_db.snapshot().traffic
+            for _email in emails:
+                if _email not in traffic:
+                    continue
+                _lo = traffic[_email]["last_online"]
                 if _email in global_stats:
-                    global_stats[_email]["last_online"] = _lo or 0
+                    global_stats[_email]["last_online"] = _lo
                 else:
-                    global_stats[_email] = {"last_online": _lo or 0, "up": 0, "down": 0}
-            _conn.close()
+                    global_stats[_email] = {"last_online": _lo, "up": 0, "down": 0}
         except Exception as e:
             logger.warning(f"SQLite last_online enrichment: {e}")
 
-        for ib in inbounds:
-            if ib["id"] != inbound_id:
-                continue
-            settings = json.loads(ib.get("settings", "{}"))
-            clients = settings.get("clients", [])
+    # Lookup first_name via vpn_keys → users
+    name_map: dict[str, str] = {}  # email -> first_name
+    tgid_map: dict[str, int] = {}  # email -> tg_id
+    token_map: dict[str, str] = {}  # email -> web_token
+    if emails:
+        try:
+            conn = awg_db._get_conn()
+            cur = conn.cursor(dictionary=True)
+            ph = ",".join(["%s"] * len(emails))
+            cur.execute(
+                f"SELECT k.client_name, u.first_name, u.tg_id, u.web_token "
+                f"FROM vpn_keys k JOIN users u ON k.tg_id = u.tg_id "
+                f"WHERE k.client_name IN ({ph})",
+                tuple(emails),
+            )
+            for r in cur.fetchall():
+                name_map[r["client_name"]] = r.get("first_name") or ""
+                tgid_map[r["client_name"]] = r.get("tg_id")
+                token_map[r["client_name"]] = r.get("web_token") or ""
+            cur.close()
+            conn.close()
+        except Exception as e:
+            logger.warning(f"VLESS first_name lookup: {e}")
+
+    result = []
+    for c in page:
+        email = c.get("email", "")
+        cs = global_stats.get(email, {})
+        expiry = c.get("expiryTime", 0)
+        expiry_str = ""
+        if expiry and expiry > 0:
+            try:
+                expiry_str = datetime.fromtimestamp(expiry / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+            except Exception:
+                pass
 
-            # Lookup first_name via vpn_keys → users
-            emails = [c.get("email", "") for c in clients]
-            name_map: dict[str, str] = {}  # email -> first_name
-            tgid_map: dict[str, int] = {}  # email -> tg_id
-            token_map: dict[str, str] = {}  # email -> web_token
-            if emails:
-                try:
-                    conn = awg_db._get_conn()
-                    cur = conn.cursor(dictionary=True)
-                    ph = ",".join(["%s"] * len(emails))
-                    cur.execute(
-                        f"SELECT k.client_name, u.first_name, u.tg_id, u.web_token "
-                        f"FROM vpn_keys k JOIN users u ON k.tg_id = u.tg_id "
-                        f"WHERE k.client_name IN ({ph})",
-                        tuple(emails),
-                    )
-                    for r in cur.fetchall():
-                        name_map[r["client_name"]] = r.get("first_name") or ""
-                        tgid_map[r["client_name"]] = r.get("tg_id")
-                        token_map[r["client_name"]] = r.get("web_token") or ""
-                    cur.close()
-                    conn.close()
-                except Exception as e:
-                    logger.warning(f"VLESS first_name lookup: {e}")
-
-            result = []
-            for c in clients:
-                email = c.get("email", "")
-                cs = global_stats.get(email, {})
-                expiry = c.get("expiryTime", 0)
-                expiry_str = ""
-                if expiry and expiry > 0:
-                    try:
-                        expiry_str = datetime.fromtimestamp(expiry / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
-                    except Exception:
-                        pass
-
-                last_online = cs.get("last_online", 0)
-                last_str = ""
-                if last_online and last_online > 0:
-                    try:
-                        last_str = datetime.fromtimestamp(last_online / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
-                    except Exception:
-                        pass
-
-                result.append({
-                    "email": email,
-                    "uuid": c.get("id", ""),
-                    "tgId": c.get("tgId", ""),
-                    "subId": c.get("subId", ""),
-                    "enable": c.get("enable", True),
-                    "flow": c.get("flow", ""),
-                    "up": cs.get("up", 0),
-                    "up_fmt": _fmt_bytes(cs.get("up", 0)),
-                    "down": cs.get("down", 0),
-                    "down_fmt": _fmt_bytes(cs.get("down", 0)),
-                    "expiry": expiry_str,
-                    "expiry_ts": expiry,
-                    "last_online": last_str,
-                    "limitIp": c.get("limitIp", 0),
-                    "first_name": name_map.get(email, ""),
-                    "tg_id_db": tgid_map.get(email),
-                    "web_token": token_map.get(email, ""),
-                })
-            return result
-        return JSONResponse({"error": "Inbound not found"}, status_code=404)
+        last_online = cs.get("last_online", 0)
+        last_str = ""
+        if last_online and last_online > 0:
+            try:
+                last_str = datetime.fromtimestamp(last_online / 1000, tz=timezone.utc).strftime("%Y-%m-%d %H:%M")
+            except Exception:
+                pass
+
+        result.append({
+            "email": email,
+            "uuid": c.get("id", ""),
+            "tgId": c.get("tgId", ""),
+            "subId": c.get("subId", ""),
+            "enable": c.get("enable", True),
+            "flow": c.get("flow", ""),
+            "up": cs.get("up", 0),
+            "up_fmt": _fmt_bytes(cs.get("up", 0)),
+            "down": cs.get("down", 0),
+            "down_fmt": _fmt_bytes(cs.get("down", 0)),
+            "expiry": expiry_str,
+            "expiry_ts": expiry,
+            "last_online": last_str,
+            "limitIp": c.get("limitIp", 0),
+            "first_name": name_map.get(email, ""),
+            "tg_id_db": tgid_map.get(email),
+            "web_token": token_map.get(email, ""),
+        })
+    return result, next_cursor
+
+
+@router.get("/xui/inbounds/{inbound_id}/clients")
+async def xui_inbound_clients(inbound_id: int, limit: int = Query(200, ge=1, le=500),
+                              cursor: str = Query(None),
+                              fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    """Clients of one inbound by email; cursor = last email of the previous page."""
+    try:
+        xui = _get_xui()
+        inbounds = await asyncio.to_thread(xui.get_inbounds)
+        ib = next((i for i in inbounds if i["id"] == inbound_id), None)
+        if ib is None:
+            return JSONResponse({"error": "Inbound not found"}, status_code=404)
+        clients = json.loads(ib.get("settings", "{}")).get("clients", [])
+        fetch = partial(_xui_client_page, inbounds, clients, limit)
+        return await listing.respond(fetch, cursor, fmt)
     except Exception as e:
         logger.error(f"XUI clients error: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
@@ -1035,12 +1056,10 @@ async def softether_create_user(request: Request):
         expiry = body.get("expiry", "").strip()  # YYYY/MM/DD
         if not username or not password:
             return JSONResponse({"error": "username and password required"}, status_code=400)
-        from bot_xui.softether import create_user, set_user_expiry
-        ok = create_user(username, password)
+        from bot_xui.softether import create_user
+        ok = create_user(username, password, expiry or None)
         if not ok:
             return JSONResponse({"error": "Failed to create user"}, status_code=500)
-        if expiry:
-            set_user_expiry(username, expiry)
         return {"status": "created", "username": username}
     except Exception as e:
         logger.error(f"SoftEther create error: {e}")
@@ -1250,28 +1269,20 @@ async def users_today():
     except Exception as e:
         logger.warning(f"VLESS traffic fetch for new users: {e}")
 
-    # Get AWG traffic from awg show dump
+    # Get AWG traffic from peer stats
     awg_traffic: dict[str, dict] = {}  # name -> {rx, tx}
     try:
         awg_clients = awg_db.list_clients()
         pub_to_name = {c["public_key"]: c["name"] for c in awg_clients}
-        result = subprocess.run(
-            ["awg", "show", "awg0", "dump"], capture_output=True, text=True, timeout=5
-        )
-        for line in result.stdout.strip().split("\n")[1:]:
-            parts = line.split("\t")
-            if len(parts) < 7:
-                continue
-            name = pub_to_name.get(parts[0], "")
+        for peer in peer_stats.read_peers(max_age=1.0):
+            name = pub_to_name.get(peer["public_key"], "")
             if name:
-                rx = int(parts[5]) if parts[5].isdigit() else 0
-                tx = int(parts[6]) if parts[6].isdigit() else 0
-                awg_traffic[name] = {"rx": rx, "tx": tx}
+                awg_traffic[name] = {"rx": peer["rx"], "tx": peer["tx"]}
     except Exception as e:
         logger.warning(f"AWG traffic fetch for new users: {e}")
 
     # Get online users for speed — build name->speed map from all protocol names
-    online, _ = _get_online_users()
+    online = (await presence.get()).users
     online_speed: dict[str, float] = {}
     for u in online:
         speed = u.get("speed_mbps", 0)
@@ -1309,37 +1320,18 @@ async def users_today():
 @router.get("/site-stats")
 async def site_stats():
     from api.db import execute_query
-    rows = execute_query(
-        "SELECT event_type, COUNT(*) AS cnt FROM site_events GROUP BY event_type",
-        fetch='all',
-    )
-    stats = {r["event_type"]: r["cnt"] for r in rows}
+    from api import rollups
+
+    snap = await asyncio.to_thread(rollups.snapshot, {"event", "unique_visitors"})
+    today_day = rollups.today()
 
+    stats = snap.by_dim("event")
     # Unique visitors = distinct visitor_id for 'visit' events
-    uv = execute_query(
-        "SELECT COUNT(DISTINCT visitor_id) AS cnt FROM site_events WHERE event_type='visit'",
-        fetch='one',
-    )
-    stats["unique_visitors"] = uv["cnt"] if uv else 0
+    stats["unique_visitors"] = snap.total("unique_visitors")
 
     # Today counts (UTC+9)
-    today_rows = execute_query(
-        """SELECT event_type, COUNT(*) AS cnt FROM site_events
-           WHERE DATE(CONVERT_TZ(created_at, '+00:00', '+09:00'))
-               = DATE(CONVERT_TZ(UTC_TIMESTAMP(), '+00:00', '+09:00'))
-           GROUP BY event_type""",
-        fetch='all',
-    )
-    today = {r["event_type"]: r["cnt"] for r in today_rows}
-
-    uv_today = execute_query(
-        """SELECT COUNT(DISTINCT visitor_id) AS cnt FROM site_events
-           WHERE event_type='visit'
-           AND DATE(CONVERT_TZ(created_at, '+00:00', '+09:00'))
-             = DATE(CONVERT_TZ(UTC_TIMESTAMP(), '+00:00', '+09:00'))""",
-        fetch='one',
-    )
-    today["unique_visitors"] = uv_today["cnt"] if uv_today else 0
+    today = snap.by_dim("event", day=today_day)
+    today["unique_visitors"] = snap.total("unique_visitors", day=today_day)
 
     # Email codes sent
     codes_total = execute_query(
@@ -1347,11 +1339,8 @@ async def site_stats():
         fetch='one',
     )
     codes_today = execute_query(
-        """SELECT COUNT(*) AS cnt FROM auth_codes
-           WHERE channel = 'email'
-           AND DATE(CONVERT_TZ(created_at, '+00:00', '+09:00'))
-             = DATE(CONVERT_TZ(UTC_TIMESTAMP(), '+00:00', '+09:00'))""",
-        fetch='one',
+        "SELECT COUNT(*) AS cnt FROM auth_codes WHERE channel = 'email' AND created_at >= %s",
+        (rollups.day_start_utc(today_day),), fetch='one',
     )
 
     return {
@@ -1366,7 +1355,7 @@ async def site_stats():
 
 @router.get("/email-stats")
 async def email_stats():
-    from api.db import execute_query
+    from api.db import execute_query, mail_outbox_stats
 
     # Total sent / opened from email_opens
     totals = execute_query(
@@ -1399,9 +1388,20 @@ async def email_stats():
         "total_opened": total_opened,
         "today_codes": today_support["cnt"] if today_support else 0,
         "recent": _clean(recent or []),
+        "outbox": mail_outbox_stats(),
     }
 
 
+@router.get("/email-outbox/{mail_id}")
+async def email_outbox_status(mail_id: int):
+    from api.db import get_mail_status
+
+    row = get_mail_status(mail_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Not found")
+    return _clean(row)
+
+
 # ── Winback Log ───────────────────────────────────────────────────────────────
 
 _WINBACK_MESSAGES = {
@@ -1418,13 +1418,16 @@ _WINBACK_MESSAGES = {
 }
 
 
+def _with_winback_message(row: dict) -> dict:
+    row["message"] = _WINBACK_MESSAGES.get(row.get("scenario", ""), "")
+    return row
+
+
 @router.get("/winback")
-async def winback_log():
-    rows = admin_db.list_winback_log()
-    cleaned = _clean(rows)
-    for r in cleaned:
-        r["message"] = _WINBACK_MESSAGES.get(r.get("scenario", ""), "")
-    return cleaned
+async def winback_log(limit: int = Query(50, ge=1, le=500), cursor: str = Query(None),
+                      fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    fetch = listing.by_id(admin_db.list_winback_log, limit)
+    return await listing.respond(fetch, cursor, fmt, transform=_with_winback_message)
 
 
 @router.get("/winback/effectiveness")
@@ -1444,29 +1447,33 @@ async def promocodes_list():
 # ── Autopay Failures ──────────────────────────────────────────────────────────
 
 @router.get("/autopay-failures")
-async def autopay_failures(limit: int = Query(50)):
-    return _clean(admin_db.autopay_failures(limit=limit))
+async def autopay_failures(limit: int = Query(50, ge=1, le=500), cursor: str = Query(None),
+                           fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    return await listing.respond(listing.by_id(admin_db.autopay_failures, limit), cursor, fmt)
 
 
 # ── Referral Network ─────────────────────────────────────────────────────────
 
 @router.get("/referral-network")
-async def referral_network(limit: int = Query(50)):
-    return _clean(admin_db.referral_network(limit=limit))
+async def referral_network(limit: int = Query(50, ge=1, le=500), cursor: str = Query(None),
+                           fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    return await listing.respond(listing.by_id(admin_db.referral_network, limit), cursor, fmt)
 
 
 # ── Failed Payments ──────────────────────────────────────────────────────────
 
 @router.get("/failed-payments")
-async def failed_payments(limit: int = Query(30)):
-    return _clean(admin_db.failed_pending_payments(limit=limit))
+async def failed_payments(limit: int = Query(30, ge=1, le=500), cursor: str = Query(None),
+                          fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    return await listing.respond(listing.by_id(admin_db.failed_pending_payments, limit), cursor, fmt)
 
 
 # ── Promo Usage Log ──────────────────────────────────────────────────────────
 
 @router.get("/promo-usages")
-async def promo_usages(limit: int = Query(50)):
-    return _clean(admin_db.promo_usage_details(limit=limit))
+async def promo_usages(limit: int = Query(50, ge=1, le=500), cursor: str = Query(None),
+                       fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    return await listing.respond(listing.by_id(admin_db.promo_usage_details, limit), cursor, fmt)
 
 
 # ── Test to Paid Conversion ──────────────────────────────────────────────────
@@ -1479,9 +1486,16 @@ async def test_conversion():
 # ── Users ────────────────────────────────────────────────────────────────────
 
 @router.get("/users")
-async def users_list(search: str = Query(None), limit: int = Query(100)):
-    rows = admin_db.list_users(search=search, limit=limit)
-    return _clean(rows)
+async def users_list(search: str = Query(None), limit: int = Query(100, ge=1, le=500),
+                     cursor: str = Query(None), fmt: str = Query("json", alias="format", pattern="^(json|ndjson)$")):
+    """Without search — newest first, cursor = last users.id;
+    with search — ranked by admin/search.py, cursor = "<score>:<id>"."""
+    if search and search.strip():
+        from admin import search as user_search
+        fetch = partial(user_search.search_users, search, limit)
+    else:
+        fetch = listing.by_id(admin_db.list_users, limit)
+    return await listing.respond(fetch, cursor, fmt)
 
 
 @router.get("/users/{tg_id}/keys")
@@ -1509,7 +1523,9 @@ async def user_autopay(tg_id: int):
 @router.get("/funnel")
 async def conversion_funnel():
     """Воронка конверсий: регистрация → тест → подключение → оплата → повторная."""
+    from datetime import timedelta
     from api.db import execute_query
+    from api import rollups
 
     total = execute_query("SELECT COUNT(*) AS n FROM users", fetch='one')['n']
 
@@ -1546,32 +1562,24 @@ async def conversion_funnel():
         fetch='one',
     )['n']
 
-    revenue_total = execute_query(
-        "SELECT COALESCE(SUM(amount), 0) AS n FROM payments WHERE status = 'paid' AND is_test = 0",
-        fetch='one',
-    )['n']
+    # Revenue, tariffs, registrations — из дневных агрегатов (UTC+9)
+    snap = await asyncio.to_thread(rollups.snapshot, {"paid", "revenue", "registrations"})
+    since_30d = rollups.today() - timedelta(days=29)
 
-    revenue_30d = execute_query(
-        "SELECT COALESCE(SUM(amount), 0) AS n FROM payments "
-        "WHERE status = 'paid' AND is_test = 0 AND created_at >= NOW() - INTERVAL 30 DAY",
-        fetch='one',
-    )['n']
+    revenue_total = snap.total("revenue")
+    revenue_30d = snap.total("revenue", since=since_30d)
 
     # Tariff popularity
-    tariff_stats = execute_query(
-        "SELECT tariff, COUNT(*) AS cnt, SUM(amount) AS revenue "
-        "FROM payments WHERE status = 'paid' AND is_test = 0 "
-        "GROUP BY tariff ORDER BY cnt DESC",
-        fetch='all',
+    tariff_revenue = snap.by_dim("revenue")
+    tariff_stats = sorted(
+        ({"tariff": tariff, "cnt": cnt, "revenue": tariff_revenue.get(tariff, 0)}
+         for tariff, cnt in snap.by_dim("paid").items()),
+        key=lambda t: t["cnt"], reverse=True,
     )
 
     # Daily registrations (last 30 days)
-    daily_regs = execute_query(
-        "SELECT DATE(created_at) AS day, COUNT(*) AS cnt FROM users "
-        "WHERE created_at >= NOW() - INTERVAL 30 DAY "
-        "GROUP BY DATE(created_at) ORDER BY day",
-        fetch='all',
-    )
+    daily_regs = [{"day": day, "cnt": cnt}
+                  for day, cnt in snap.by_day("registrations", since=since_30d).items()]
 
     return _clean({
         "funnel": {
@@ -0,0 +1,201 @@
+"""In-process user search index for the admin panel.
+
+/users?search= used to run `LIKE '%x%'` over four users columns (a full scan
+per keystroke) and could not find anyone by email or VPN client name.
+
+    exact   — id / tg_id / email / web_token / payment_id, looked up in MySQL
+              by equality (indexed), always ranked first;
+    index   — names, emails and vpn_keys.client_name held in memory:
+              trigram postings for substrings of 3+ chars, word-prefix
+              postings for 2-char queries.
+
+Multi-word queries are AND-ed. Score per term: whole field equal > word or
+field prefix > substring; ties go to the newer user. Pages are keyset
+cursors "<score>:<user id>".
+
+New users and keys are picked up incrementally (id > last seen) at most every
+SEARCH_REFRESH_S; renames and e-mail changes by a full rebuild every
+SEARCH_REBUILD_S, built off to the side and swapped in.
+"""
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+
+from admin import db as admin_db
+
+logger = logging.getLogger(__name__)
+
+SEARCH_REFRESH_S = 5.0
+SEARCH_REBUILD_S = 600.0
+MAX_CANDIDATES = 5000
+
+EXACT_SCORE = 1000
+FIELD_WEIGHT = {"name": 3, "email": 2, "client": 1}
+
+_WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    return " ".join((text or "").casefold().split())
+
+
+def trigrams(text: str) -> set[str]:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def words(text: str) -> list[str]:
+    return _WORD_RE.findall(text)
+
+
+class UserSearchIndex:
+    def __init__(self):
+        self._fields: dict[int, list[tuple[str, str]]] = defaultdict(list)  # uid → [(kind, text)]
+        self._grams: dict[str, set[int]] = defaultdict(set)
+        self._prefix2: dict[str, set[int]] = defaultdict(set)
+        self.marks = {"users": 0, "keys": 0}
+
+    def __len__(self):
+        return len(self._fields)
+
+    def add(self, uid: int, kind: str, text: str):
+        text = normalize(text)
+        if not text or (kind, text) in self._fields[uid]:
+            return
+        self._fields[uid].append((kind, text))
+        for gram in trigrams(text):
+            self._grams[gram].add(uid)
+        for word in {text, *words(text)}:
+            if len(word) >= 2:
+                self._prefix2[word[:2]].add(uid)
+
+    def add_user(self, row: dict):
+        uid = row["id"]
+        for col in ("first_name", "last_name", "old_first_name"):
+            self.add(uid, "name", row.get(col))
+        self.add(uid, "email", row.get("email"))
+        self.marks["users"] = max(self.marks["users"], uid)
+
+    def add_key(self, row: dict):
+        self.add(row["uid"], "client", row.get("client_name"))
+        self.marks["keys"] = max(self.marks["keys"], row["id"])
+
+    def _candidates(self, term: str) -> set[int]:
+        if len(term) >= 3:
+            postings = sorted((self._grams.get(g, set()) for g in trigrams(term)), key=len)
+            return set.intersection(*postings) if postings else set()
+        if len(term) == 2:
+            return set(self._prefix2.get(term, set()))
+        return set()
+
+    def _score(self, uid: int, term: str) -> int:
+        best = 0
+        for kind, text in self._fields.get(uid, ()):
+            if text == term:
+                score = 100
+            elif text.startswith(term) or any(w.startswith(term) for w in words(text)):
+                score = 60
+            elif len(term) >= 3 and term in text:
+                score = 20
+            else:
+                continue
+            best = max(best, score + FIELD_WEIGHT[kind])
+        return best
+
+    def search(self, query: str) -> list[tuple[int, int]]:
+        """[(score, uid)] best first."""
+        terms = normalize(query).split()
+        if not terms:
+            return []
+        candidates = None
+        for term in terms:
+            found = self._candidates(term)
+            candidates = found if candidates is None else candidates & found
+            if not candidates:
+                return []
+        if len(candidates) > MAX_CANDIDATES:
+            candidates = set(sorted(candidates, reverse=True)[:MAX_CANDIDATES])
+        ranked = []
+        for uid in candidates:
+            scores = [self._score(uid, term) for term in terms]
+            if all(scores):
+                ranked.append((sum(scores), uid))
+        ranked.sort(reverse=True)
+        return ranked
+
+
+# ─────────────────────────────────────────────
+#  Shared index
+# ─────────────────────────────────────────────
+
+_lock = threading.Lock()
+_index = UserSearchIndex()
+_built_at = float("-inf")
+_refreshed_at = float("-inf")
+
+
+def _build() -> UserSearchIndex:
+    index = UserSearchIndex()
+    for row in admin_db.users_for_search():
+        index.add_user(row)
+    for row in admin_db.client_names_for_search():
+        index.add_key(row)
+    return index
+
+
+def ensure_fresh():
+    """Blocking: call from a worker thread."""
+    global _index, _built_at, _refreshed_at
+    with _lock:
+        now = time.monotonic()
+        if now - _built_at > SEARCH_REBUILD_S:
+            t0 = time.monotonic()
+            _index = _build()
+            _built_at = _refreshed_at = time.monotonic()
+            logger.info(f"[SEARCH] index rebuilt: {len(_index)} users in {time.monotonic() - t0:.2f}s")
+        elif now - _refreshed_at > SEARCH_REFRESH_S:
+            for row in admin_db.users_for_search(_index.marks["users"]):
+                _index.add_user(row)
+            for row in admin_db.client_names_for_search(_index.marks["keys"]):
+                _index.add_key(row)
+            _refreshed_at = now
+
+
+def encode_cursor(score: int, uid: int) -> str:
+    return f"{score}:{uid}"
+
+
+def decode_cursor(cursor: str | None) -> tuple[int, int] | None:
+    if not cursor:
+        return None
+    try:
+        score, uid = cursor.split(":")
+        return int(score), int(uid)
+    except ValueError:
+        return None
+
+
+def search_users(query: str, limit: int = 50, cursor: str | None = None) -> tuple[list[dict], str | None]:
+    """Blocking. Returns (user rows with "score", next cursor or None)."""
+    ensure_fresh()
+    query = query.strip()
+    ranked = {}
+    for uid in admin_db.exact_user_matches(query):
+        ranked[uid] = EXACT_SCORE
+    with _lock:
+        hits = _index.search(query)
+    for score, uid in hits:
+        ranked.setdefault(uid, score)
+    ordered = sorted(((score, uid) for uid, score in ranked.items()), reverse=True)
+
+    after = decode_cursor(cursor)
+    if after is not None:
+        ordered = [item for item in ordered if item < after]
+    page = ordered[:limit]
+    rows = admin_db.users_by_ids([uid for _, uid in page])
+    scores = dict((uid, score) for score, uid in page)
+    for row in rows:
+        row["score"] = scores[row["id"]]
+    next_cursor = encode_cursor(*page[-1]) if len(ordered) > limit else None
+    return rows, next_cursor
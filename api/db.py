@@ -1,8 +1,15 @@
+import asyncio
+import json
 import logging
+import uuid
 from datetime import datetime, timezone, timedelta
-import mysql.connector
-from mysql.connector import pooling
-from config import MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE, REFERRAL_REWARD_DAYS, REFERRAL_NEWCOMER_DAYS
+import aiomysql
+from config import (
+    MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE, REFERRAL_REWARD_DAYS, REFERRAL_NEWCOMER_DAYS,
+    WEB_BUNDLE_CACHE_TTL, WEB_BUNDLE_CACHE_SIZE,
+)
+from db_pool import get_pool, PoolExhausted
+from api import session_cache
 
 TZ_TOKYO = timezone(timedelta(hours=9))
 
@@ -13,36 +20,37 @@ logger = logging.getLogger(__name__)
 #  Connection pool
 # ─────────────────────────────────────────────
 
-_pool = None
-
-
 def _get_pool():
-    global _pool
-    if _pool is None:
-        _pool = pooling.MySQLConnectionPool(
-            pool_name="vpn_api_pool",
-            pool_size=10,
-            pool_reset_session=True,
-            host=MYSQL_HOST,
-            user=MYSQL_USER,
-            password=MYSQL_PASSWORD,
-            database=MYSQL_DATABASE,
-        )
-        logger.info("MySQL connection pool created (size=10)")
-    return _pool
+    return get_pool(
+        "api",
+        host=MYSQL_HOST,
+        user=MYSQL_USER,
+        password=MYSQL_PASSWORD,
+        database=MYSQL_DATABASE,
+    )
 
 
 def get_db():
-    """Get a connection from pool, recreating pool if needed."""
-    global _pool
+    """Get a connection from the shared pool, dropping stale idle ones if needed."""
     try:
         return _get_pool().get_connection()
+    except PoolExhausted:
+        raise
     except Exception as e:
-        logger.warning(f"Pool connection failed, recreating pool: {e}")
-        _pool = None
+        logger.warning(f"Pool connection failed, clearing idle connections: {e}")
+        _get_pool().clear()
         return _get_pool().get_connection()
 
 
+def _is_transient_error(e: Exception) -> bool:
+    """Connection-level errors that are worth one retry on a fresh connection."""
+    err_msg = str(e).lower()
+    return any(s in err_msg for s in (
+        'lost connection', 'gone away', 'broken pipe',
+        'connection reset', 'can\'t connect',
+    ))
+
+
 def execute_query(sql: str, params: tuple = (), fetch: str = None, _retried: bool = False):
     """
     Universal query helper with auto-retry on transient failures.
@@ -61,18 +69,15 @@ def execute_query(sql: str, params: tuple = (), fetch: str = None, _retried: boo
         db.commit()
         return cursor.lastrowid
     except Exception as e:
-        err_msg = str(e).lower()
-        is_transient = any(s in err_msg for s in (
-            'lost connection', 'gone away', 'broken pipe',
-            'connection reset', 'can\'t connect',
-        ))
-        if is_transient and not _retried:
+        if _is_transient_error(e) and not _retried:
             logger.warning(f"Transient DB error, retrying: {e}")
             try:
                 cursor.close()
                 db.close()
             except Exception:
                 pass
+            # Idle connections were most likely cut by the same server restart
+            _get_pool().clear()
             return execute_query(sql, params, fetch, _retried=True)
         raise
     finally:
@@ -80,6 +85,110 @@ def execute_query(sql: str, params: tuple = (), fetch: str = None, _retried: boo
         db.close()
 
 
+# ─────────────────────────────────────────────
+#  Async connection pool (aiomysql)
+# ─────────────────────────────────────────────
+# FastAPI handlers are `async def`; calling execute_query() from them blocks
+# the event loop for the whole DB round-trip. The *_async helpers below run
+# the same SQL on an aiomysql pool so concurrent requests don't serialize.
+
+ASYNC_POOL_SIZE = 20
+
+_async_pool = None
+_async_pool_loop = None
+_async_pool_lock: asyncio.Lock | None = None
+
+
+async def _get_async_pool():
+    """Lazily create the aiomysql pool (one per running event loop)."""
+    global _async_pool, _async_pool_loop, _async_pool_lock
+    loop = asyncio.get_running_loop()
+    if _async_pool_loop is not loop:
+        # New event loop (worker restart, tests): the old pool is bound to the old loop
+        _async_pool, _async_pool_loop, _async_pool_lock = None, loop, asyncio.Lock()
+    if _async_pool is not None:
+        return _async_pool
+    async with _async_pool_lock:
+        if _async_pool is None:
+            _async_pool = await aiomysql.create_pool(
+                minsize=1,
+                maxsize=ASYNC_POOL_SIZE,
+                host=MYSQL_HOST,
+                user=MYSQL_USER,
+                password=MYSQL_PASSWORD,
+                db=MYSQL_DATABASE,
+                autocommit=True,
+                pool_recycle=3600,
+            )
+            logger.info(f"Async MySQL pool created (size={ASYNC_POOL_SIZE})")
+    return _async_pool
+
+
+async def close_async_pool():
+    """Close the aiomysql pool (call on application shutdown)."""
+    global _async_pool
+    pool, _async_pool = _async_pool, None
+    if pool is not None:
+        pool.close()
+        await pool.wait_closed()
+
+
+async def execute_query_async(sql: str, params: tuple = (), fetch: str = None, _retried: bool = False):
+    """
+    Async counterpart of execute_query() — same contract, same retry.
+    fetch=None   → INSERT / UPDATE / DELETE  (returns lastrowid)
+    fetch='one'  → fetchone() → dict | None
+    fetch='all'  → fetchall() → list[dict]
+    """
+    try:
+        pool = await _get_async_pool()
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cursor:
+                await cursor.execute(sql, params)
+                if fetch == 'one':
+                    return await cursor.fetchone()
+                if fetch == 'all':
+                    return list(await cursor.fetchall())
+                return cursor.lastrowid
+    except Exception as e:
+        if _is_transient_error(e) and not _retried:
+            logger.warning(f"Transient async DB error, retrying: {e}")
+            if _async_pool is not None:
+                # Drop idle connections that may share the same dead socket
+                await _async_pool.clear()
+            return await execute_query_async(sql, params, fetch, _retried=True)
+        raise
+
+
+def execute_many(sql: str, rows: list[tuple]) -> int:
+    """executemany() in one transaction (bulk INSERT / UPDATE). Returns rowcount."""
+    if not rows:
+        return 0
+    db = get_db()
+    cursor = db.cursor()
+    try:
+        cursor.executemany(sql, rows)
+        db.commit()
+        return cursor.rowcount
+    finally:
+        cursor.close()
+        db.close()
+
+
+def _chunks(items: list, size: int = 500):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def _update_rowcount_async(sql: str, params: tuple = ()) -> int:
+    """Async _update_rowcount(): execute UPDATE/INSERT and return rowcount."""
+    pool = await _get_async_pool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cursor:
+            await cursor.execute(sql, params)
+            return cursor.rowcount
+
+
 # ─────────────────────────────────────────────
 #  Users
 # ─────────────────────────────────────────────
@@ -128,6 +237,7 @@ def get_or_create_user(tg_id: int, first_name: str | None = None, last_name: str
             "UPDATE users SET first_name = %s, last_name = %s WHERE tg_id = %s",
             (first_name, last_name, tg_id)
         )
+        _invalidate_user(user['id'], tg_id)
         if not user.get('web_token'):
             execute_query(
                 "UPDATE users SET web_token = %s WHERE tg_id = %s",
@@ -158,6 +268,7 @@ def update_user_subscription_by_id(user_id: int, subscription_until):
         "UPDATE users SET subscription_until = %s WHERE id = %s",
         (subscription_until, user_id)
     )
+    _invalidate_user(user_id)
 
 
 def get_user_by_web_token(token: str) -> dict | None:
@@ -167,6 +278,13 @@ def get_user_by_web_token(token: str) -> dict | None:
     )
 
 
+async def get_user_by_web_token_async(token: str) -> dict | None:
+    return await execute_query_async(
+        "SELECT * FROM users WHERE web_token = %s",
+        (token,), fetch='one'
+    )
+
+
 def get_web_token(tg_id: int) -> str | None:
     row = execute_query(
         "SELECT web_token FROM users WHERE tg_id = %s",
@@ -207,6 +325,7 @@ def upsert_user_subscription(tg_id: int, subscription_until):
         """,
         (tg_id, subscription_until, subscription_until)
     )
+    _invalidate_user(tg_id=tg_id)
 
 
 # ─────────────────────────────────────────────
@@ -270,6 +389,14 @@ def is_vless_test_activated_by_id(user_id: int) -> bool:
     return bool(row['test_vless_activated']) if row else False
 
 
+async def is_vless_test_activated_by_id_async(user_id: int) -> bool:
+    row = await execute_query_async(
+        "SELECT test_vless_activated FROM users WHERE id = %s",
+        (user_id,), fetch='one'
+    )
+    return bool(row['test_vless_activated']) if row else False
+
+
 def set_vless_test_activated_by_id(user_id: int, activated: bool = True):
     execute_query(
         "UPDATE users SET test_vless_activated = %s WHERE id = %s",
@@ -327,6 +454,7 @@ def _round_subscription_eod(tg_id: int):
         "UPDATE users SET subscription_until = %s WHERE tg_id = %s",
         (new_until, tg_id)
     )
+    _invalidate_user(tg_id=tg_id)
 
 
 def reward_referrer(referrer_tg_id: int):
@@ -399,6 +527,7 @@ def _round_subscription_eod_by_id(user_id: int):
         "UPDATE users SET subscription_until = %s WHERE id = %s",
         (new_until, user_id)
     )
+    _invalidate_user(user_id)
 
 
 def reward_referrer_by_id(referrer_id: int):
@@ -549,6 +678,16 @@ def update_payment_status(payment_id: str, status: str):
         "UPDATE payments SET status = %s WHERE payment_id = %s",
         (status, payment_id)
     )
+    _resync_payment_rollup(payment_id)
+
+
+def _resync_payment_rollup(payment_id: str):
+    """Платёж уже свёрнут в analytics_daily (refund через сутки) — пересчитать его день."""
+    try:
+        from api.rollups import resync_payment
+        resync_payment(payment_id)
+    except Exception as e:
+        logger.warning(f"[ROLLUP] resync for payment {payment_id} failed: {e}")
 
 
 def claim_payment_for_processing(payment_id: str) -> bool:
@@ -579,6 +718,53 @@ def is_payment_processed(payment_id: str) -> bool:
     return row['status'] == 'paid' if row else False
 
 
+async def create_payment_async(payment_id: str, tg_id: int, tariff: str, amount, status: str = "pending", is_test: bool = False):
+    await execute_query_async(
+        "INSERT INTO payments (payment_id, tg_id, tariff, amount, status, is_test) VALUES (%s, %s, %s, %s, %s, %s)",
+        (payment_id, tg_id, tariff, amount, status, int(is_test))
+    )
+
+
+async def get_payment_by_id_async(payment_id: str) -> dict | None:
+    return await execute_query_async(
+        "SELECT * FROM payments WHERE payment_id = %s",
+        (payment_id,), fetch='one'
+    )
+
+
+async def get_payment_status_async(payment_id: str) -> str | None:
+    row = await execute_query_async(
+        "SELECT status FROM payments WHERE payment_id = %s",
+        (payment_id,), fetch='one'
+    )
+    return row['status'] if row else None
+
+
+async def update_payment_status_async(payment_id: str, status: str):
+    await execute_query_async(
+        "UPDATE payments SET status = %s WHERE payment_id = %s",
+        (status, payment_id)
+    )
+    await asyncio.to_thread(_resync_payment_rollup, payment_id)
+
+
+async def claim_payment_for_processing_async(payment_id: str) -> bool:
+    """Async claim_payment_for_processing(): only one concurrent caller wins."""
+    affected = await _update_rowcount_async(
+        "UPDATE payments SET status = 'paid' WHERE payment_id = %s AND status = 'pending'",
+        (payment_id,),
+    )
+    return affected > 0
+
+
+async def is_payment_processed_async(payment_id: str) -> bool:
+    row = await execute_query_async(
+        "SELECT status FROM payments WHERE payment_id = %s",
+        (payment_id,), fetch='one'
+    )
+    return row['status'] == 'paid' if row else False
+
+
 def get_last_paid_payment(tg_id: int) -> dict | None:
     """Возвращает последний оплаченный платёж пользователя"""
     return execute_query(
@@ -629,6 +815,7 @@ def create_vpn_key(
         """,
         (tg_id, payment_id, client_id, client_name, client_ip, client_public_key, vless_link, hysteria_link, expires_at, vpn_type, subscription_link, vpn_file, user_id)
     )
+    _invalidate_user(user_id, tg_id)
     logger.debug("create_vpn_key done")
 
 
@@ -674,6 +861,7 @@ def upsert_vpn_key(
             (payment_id, client_id, client_name, client_ip, client_public_key, 
              vless_link, hysteria_link, expires_at, subscription_link, vpn_file, existing['id'])
         )
+        _invalidate_user(user_id, tg_id)
         logger.info(f"Updated existing VPN key {existing['id']} for user {val}")
     else:
         create_vpn_key(tg_id, payment_id, client_id, client_name, client_ip, 
@@ -707,6 +895,79 @@ def get_keys_by_user_id(user_id: int) -> list[dict]:
     )
 
 
+async def get_hysteria_link_by_tg_id_async(tg_id: int) -> str | None:
+    row = await execute_query_async(
+        "SELECT hysteria_link FROM vpn_keys WHERE tg_id = %s AND hysteria_link IS NOT NULL ORDER BY expires_at DESC LIMIT 1",
+        (tg_id,), fetch='one'
+    )
+    return row['hysteria_link'] if row else None
+
+
+async def get_keys_by_tg_id_async(tg_id: int) -> list[dict]:
+    return await execute_query_async(
+        "SELECT * FROM vpn_keys WHERE tg_id = %s",
+        (tg_id,), fetch='all'
+    )
+
+
+async def get_keys_by_user_id_async(user_id: int) -> list[dict]:
+    return await execute_query_async(
+        "SELECT * FROM vpn_keys WHERE user_id = %s",
+        (user_id,), fetch='all'
+    )
+
+
+# ─────────────────────────────────────────────
+#  Web token → (user, keys) cache
+# ─────────────────────────────────────────────
+# /my/{token}, AWG-конфиги и /sub/{token} на каждый запрос читали
+# пользователя по web_token и его ключи (2–3 запроса). Инвалидация — из
+# функций ниже, меняющих users/vpn_keys этого процесса; остальное — по TTL.
+
+def _bundle_refs(bundle: tuple[dict, list[dict]]) -> set[tuple[str, int]]:
+    user, keys = bundle
+    refs = set(session_cache.user_refs(user))
+    for k in keys:
+        if k.get('user_id'):
+            refs.add(("id", k['user_id']))
+        if k.get('tg_id'):
+            refs.add(("tg", k['tg_id']))
+    return refs
+
+
+_web_bundles = session_cache.TokenCache(WEB_BUNDLE_CACHE_TTL, WEB_BUNDLE_CACHE_SIZE, refs=_bundle_refs)
+
+
+def _invalidate_user(user_id: int | None = None, tg_id: int | None = None):
+    """Drop cached sessions and web bundles of a user whose row or keys changed."""
+    session_cache.invalidate_user(user_id, tg_id)
+    _web_bundles.invalidate_user(user_id, tg_id)
+
+
+async def get_web_bundle_async(token: str) -> tuple[dict, list[dict]] | None:
+    """
+    (user, keys) by web_token, read-through cached. Keys by tg_id, falling
+    back to user_id for web-only users. The result is shared — do not mutate.
+    """
+    bundle = _web_bundles.get(token)
+    if bundle is not None:
+        return bundle
+    user = await get_user_by_web_token_async(token)
+    if not user:
+        return None
+    tg_id = user.get('tg_id')
+    keys = await get_keys_by_tg_id_async(tg_id) if tg_id else []
+    if not keys:
+        keys = await get_keys_by_user_id_async(user['id'])
+    bundle = (user, keys)
+    _web_bundles.put(token, bundle)
+    return bundle
+
+
+def web_bundle_cache_stats() -> dict:
+    return _web_bundles.stats()
+
+
 def get_used_client_ips() -> set[str]:
     rows = execute_query(
         "SELECT client_ip FROM vpn_keys WHERE expires_at > NOW()",
@@ -736,10 +997,16 @@ def get_user_email(tg_id: int, payment_id: str | None = None) -> str | None:
 
 def deactivate_key_by_payment(payment_id: str):
     """Деактивирует ключ по payment_id"""
+    owners = execute_query(
+        "SELECT tg_id, user_id FROM vpn_keys WHERE payment_id = %s",
+        (payment_id,), fetch='all'
+    )
     execute_query(
         "UPDATE vpn_keys SET expires_at = NOW() WHERE payment_id = %s",
         (payment_id,)
     )
+    for row in owners or ():
+        _invalidate_user(row['user_id'], row['tg_id'])
 
 def sync_expiry(tg_id: int, expires_at_utc: datetime):
     """Sync expiry across users.subscription_until and all active vpn_keys.expires_at."""
@@ -751,6 +1018,7 @@ def sync_expiry(tg_id: int, expires_at_utc: datetime):
         "UPDATE vpn_keys SET expires_at = %s WHERE tg_id = %s AND expires_at > NOW()",
         (expires_at_utc, tg_id)
     )
+    _invalidate_user(tg_id=tg_id)
     logger.info(f"Synced expiry for tg_id={tg_id} to {expires_at_utc}")
 
 
@@ -762,10 +1030,12 @@ def sync_expiry_by_user_id(user_id: int, expires_at_utc: datetime):
         "UPDATE users SET subscription_until = %s WHERE id = %s",
         (expires_at_utc, user_id)
     )
+    _invalidate_user(user_id)
     execute_query(
         "UPDATE vpn_keys SET expires_at = %s WHERE user_id = %s AND expires_at > NOW()",
         (expires_at_utc, user_id)
     )
+    _invalidate_user(user_id)
     logger.info(f"Synced expiry for user_id={user_id} to {expires_at_utc}")
 
 
@@ -775,6 +1045,7 @@ def update_vless_link(tg_id: int, vless_link: str):
         "UPDATE vpn_keys SET vless_link = %s WHERE tg_id = %s AND vpn_type = 'vless'",
         (vless_link, tg_id)
     )
+    _invalidate_user(tg_id=tg_id)
 
 
 def get_users_expiring_in_days(days: int) -> list[dict]:
@@ -789,6 +1060,39 @@ def get_users_expiring_in_days(days: int) -> list[dict]:
     )
 
 
+def get_expiry_notification_candidates() -> list[dict]:
+    """Все кандидаты на уведомление об окончании подписки одним запросом.
+
+    days_left = DATEDIFF(subscription_until, NOW()) (3 / 1 / 0 — предупреждения),
+    expired_yesterday — подписка кончилась 1–2 суток назад. Условие по диапазону,
+    чтобы работал индекс по subscription_until.
+    """
+    return execute_query(
+        """
+        SELECT tg_id, email, subscription_until, autopay_enabled, payment_method_id, autopay_tariff,
+               DATEDIFF(subscription_until, NOW()) AS days_left,
+               subscription_until <= NOW() - INTERVAL 1 DAY AS expired_yesterday
+        FROM users
+        WHERE subscription_until >= NOW() - INTERVAL 2 DAY
+          AND subscription_until < CURDATE() + INTERVAL 4 DAY
+        """,
+        fetch='all'
+    ) or []
+
+
+def set_bot_blocked(tg_ids: list[int], blocked: bool):
+    """Bulk users.bot_blocked update (Forbidden / successful delivery)."""
+    for chunk in _chunks(list(tg_ids)):
+        marks = ", ".join(["%s"] * len(chunk))
+        if blocked:
+            execute_query(f"UPDATE users SET bot_blocked = 1 WHERE tg_id IN ({marks})", tuple(chunk))
+        else:
+            execute_query(
+                f"UPDATE users SET bot_blocked = 0 WHERE bot_blocked = 1 AND tg_id IN ({marks})",
+                tuple(chunk),
+            )
+
+
 # ─────────────────────────────────────────────
 #  Promocodes
 # ─────────────────────────────────────────────
@@ -953,10 +1257,394 @@ def log_autopay(tg_id: int, user_id: int, tariff: str, amount: float,
     )
 
 
+AUTOPAY_ATTEMPTS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS autopay_attempts (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        user_id INT NOT NULL,
+        cycle DATE NOT NULL,
+        phase TINYINT NOT NULL,
+        idempotence_key CHAR(36) NOT NULL,
+        tariff VARCHAR(32),
+        amount DECIMAL(10, 2),
+        status VARCHAR(8) NOT NULL DEFAULT 'pending',
+        payment_id VARCHAR(64),
+        tries INT NOT NULL DEFAULT 0,
+        error VARCHAR(500),
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        UNIQUE KEY uq_user_cycle (user_id, cycle)
+    )
+"""
+_autopay_attempts_ready = False
+
+
+def claim_autopay_attempt(user_id: int, cycle, phase: int, tariff: str, amount) -> dict | None:
+    """Reserve the charge for one billing cycle (= DATE(subscription_until)) before
+    calling the gateway.
+
+    Returns the attempt row (with idempotence_key) to charge with, or None if this
+    cycle already has a payment. A 'pending' row means a previous run died around the
+    gateway call — its key is reused, so YooKassa returns the same payment instead of
+    charging twice. A failed or canceled attempt gets a fresh key.
+    """
+    global _autopay_attempts_ready
+    if not _autopay_attempts_ready:
+        execute_query(AUTOPAY_ATTEMPTS_SCHEMA)
+        _autopay_attempts_ready = True
+
+    inserted = _update_rowcount(
+        "INSERT IGNORE INTO autopay_attempts (user_id, cycle, phase, idempotence_key, tariff, amount) "
+        "VALUES (%s, %s, %s, %s, %s, %s)",
+        (user_id, cycle, phase, str(uuid.uuid4()), tariff, amount),
+    )
+    row = execute_query(
+        "SELECT a.*, p.status AS payment_status FROM autopay_attempts a "
+        "LEFT JOIN payments p ON p.payment_id = a.payment_id "
+        "WHERE a.user_id = %s AND a.cycle = %s",
+        (user_id, cycle), fetch='one',
+    )
+    if not row:
+        return None
+    if row['status'] == 'pending':
+        return {**row, 'resumed': not inserted}
+    if row['status'] == 'failed' or row.get('payment_status') == 'canceled':
+        key = str(uuid.uuid4())
+        taken = _update_rowcount(
+            "UPDATE autopay_attempts SET status = 'pending', idempotence_key = %s, phase = %s, "
+            "tariff = %s, amount = %s, payment_id = NULL, error = NULL "
+            "WHERE id = %s AND idempotence_key = %s",
+            (key, phase, tariff, amount, row['id'], row['idempotence_key']),
+        )
+        if taken:
+            return {**row, 'status': 'pending', 'idempotence_key': key, 'phase': phase,
+                    'payment_id': None, 'error': None, 'resumed': False}
+    return None
+
+
+def finish_autopay_attempt(attempt_id: int, status: str, payment_id: str | None = None,
+                           error: str | None = None, tries: int = 1):
+    """status: 'created' (gateway accepted the payment) or 'failed'."""
+    execute_query(
+        "UPDATE autopay_attempts SET status = %s, payment_id = %s, error = %s, tries = tries + %s "
+        "WHERE id = %s",
+        (status, payment_id, error[:500] if error else None, tries, attempt_id),
+    )
+
+
 def cleanup_expired_sessions():
     """Remove expired web auth sessions."""
     deleted = _update_rowcount(
         "DELETE FROM auth_sessions WHERE expires_at <= NOW()",
     )
     if deleted:
-        logger.info(f"[SESSION_CLEANUP] Removed {deleted} expired sessions")
\ No newline at end of file
+        logger.info(f"[SESSION_CLEANUP] Removed {deleted} expired sessions")
+
+# ─────────────────────────────────────────────
+#  Broadcasts
+# ─────────────────────────────────────────────
+
+BROADCAST_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_jobs (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        kind VARCHAR(32) NOT NULL,
+        text MEDIUMTEXT,
+        parse_mode VARCHAR(16),
+        status VARCHAR(16) NOT NULL DEFAULT 'running',
+        total INT NOT NULL DEFAULT 0,
+        sent INT NOT NULL DEFAULT 0,
+        failed INT NOT NULL DEFAULT 0,
+        blocked INT NOT NULL DEFAULT 0,
+        report_chat_id BIGINT,
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished_at DATETIME,
+        KEY idx_status (status)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        job_id INT NOT NULL,
+        tg_id BIGINT NOT NULL,
+        text MEDIUMTEXT,
+        status VARCHAR(8) NOT NULL DEFAULT 'pending',
+        PRIMARY KEY (job_id, tg_id),
+        KEY idx_job_status (job_id, status)
+    )
+    """,
+)
+_broadcast_schema_ready = False
+
+
+def ensure_broadcast_tables():
+    global _broadcast_schema_ready
+    if _broadcast_schema_ready:
+        return
+    for stmt in BROADCAST_SCHEMA:
+        execute_query(stmt)
+    _broadcast_schema_ready = True
+
+
+def create_broadcast_job(kind: str, text: str | None, parse_mode: str | None,
+                         recipients: list[tuple[int, str | None]],
+                         report_chat_id: int | None = None) -> int:
+    """recipients: [(tg_id, personal_text | None)] — None means the job text."""
+    ensure_broadcast_tables()
+    unique = list({tg_id: (tg_id, personal) for tg_id, personal in recipients}.values())
+    job_id = execute_query(
+        "INSERT INTO broadcast_jobs (kind, text, parse_mode, total, report_chat_id) "
+        "VALUES (%s, %s, %s, %s, %s)",
+        (kind, text, parse_mode, len(unique), report_chat_id),
+    )
+    for chunk in _chunks(unique, 1000):
+        execute_many(
+            "INSERT INTO broadcast_recipients (job_id, tg_id, text) VALUES (%s, %s, %s)",
+            [(job_id, tg_id, personal) for tg_id, personal in chunk],
+        )
+    return job_id
+
+
+def get_broadcast_job(job_id: int) -> dict | None:
+    return execute_query("SELECT * FROM broadcast_jobs WHERE id = %s", (job_id,), fetch='one')
+
+
+def get_unfinished_broadcast_jobs(kind: str | None = None) -> list[dict]:
+    ensure_broadcast_tables()
+    if kind:
+        return execute_query(
+            "SELECT * FROM broadcast_jobs WHERE status = 'running' AND kind = %s ORDER BY id",
+            (kind,), fetch='all',
+        ) or []
+    return execute_query(
+        "SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id", fetch='all',
+    ) or []
+
+
+def get_pending_broadcast_recipients(job_id: int) -> list[dict]:
+    return execute_query(
+        "SELECT tg_id, text FROM broadcast_recipients "
+        "WHERE job_id = %s AND status = 'pending' ORDER BY tg_id",
+        (job_id,), fetch='all',
+    ) or []
+
+
+def record_broadcast_results(job_id: int, results: list[tuple[int, str]]):
+    """Bulk-apply [(tg_id, 'sent' | 'failed' | 'blocked')] to recipients, job counters
+    and users.bot_blocked."""
+    by_status: dict[str, list[int]] = {}
+    for tg_id, status in results:
+        by_status.setdefault(status, []).append(tg_id)
+    for status, ids in by_status.items():
+        for chunk in _chunks(ids):
+            marks = ", ".join(["%s"] * len(chunk))
+            execute_query(
+                f"UPDATE broadcast_recipients SET status = %s "
+                f"WHERE job_id = %s AND tg_id IN ({marks})",
+                (status, job_id, *chunk),
+            )
+    execute_query(
+        "UPDATE broadcast_jobs SET sent = sent + %s, failed = failed + %s, blocked = blocked + %s "
+        "WHERE id = %s",
+        (len(by_status.get("sent", [])), len(by_status.get("failed", [])),
+         len(by_status.get("blocked", [])), job_id),
+    )
+    set_bot_blocked(by_status.get("blocked", []), True)
+    set_bot_blocked(by_status.get("sent", []), False)
+
+
+def finish_broadcast_job(job_id: int, status: str = "done"):
+    execute_query(
+        "UPDATE broadcast_jobs SET status = %s, finished_at = NOW() WHERE id = %s",
+        (status, job_id),
+    )
+
+
+# ─────────────────────────────────────────────
+#  Scheduled job runs
+# ─────────────────────────────────────────────
+
+JOB_RUNS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS job_runs (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        job VARCHAR(32) NOT NULL,
+        started_at DATETIME NOT NULL,
+        duration_ms INT NOT NULL,
+        stats JSON,
+        KEY idx_job_started (job, started_at)
+    )
+"""
+_job_runs_ready = False
+
+
+def record_job_run(job: str, started_at: datetime, duration_ms: int, stats: dict):
+    """Timing + counters of one scheduler run (notifier, autopay, ...)."""
+    global _job_runs_ready
+    if not _job_runs_ready:
+        execute_query(JOB_RUNS_SCHEMA)
+        _job_runs_ready = True
+    execute_query(
+        "INSERT INTO job_runs (job, started_at, duration_ms, stats) VALUES (%s, %s, %s, %s)",
+        (job, started_at, duration_ms, json.dumps(stats)),
+    )
+
+
+
+# ─────────────────────────────────────────────
+#  Mail outbox
+# ─────────────────────────────────────────────
+
+MAIL_OUTBOX_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS mail_outbox (
+        id BIGINT AUTO_INCREMENT PRIMARY KEY,
+        kind VARCHAR(32) NOT NULL,
+        priority TINYINT NOT NULL DEFAULT 0,
+        to_addr VARCHAR(255) NOT NULL,
+        subject VARCHAR(255) NOT NULL,
+        message MEDIUMTEXT NOT NULL,
+        status VARCHAR(8) NOT NULL DEFAULT 'queued',
+        attempts INT NOT NULL DEFAULT 0,
+        next_attempt_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        discard_after DATETIME,
+        claimed_by VARCHAR(64),
+        claimed_at DATETIME,
+        last_error VARCHAR(500),
+        created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        sent_at DATETIME,
+        KEY idx_due (status, priority, next_attempt_at),
+        KEY idx_claim (claimed_by, status)
+    )
+"""
+_mail_outbox_ready = False
+
+
+def ensure_mail_outbox():
+    global _mail_outbox_ready
+    if not _mail_outbox_ready:
+        execute_query(MAIL_OUTBOX_SCHEMA)
+        _mail_outbox_ready = True
+
+
+def enqueue_mail(rows: list[tuple]) -> int | None:
+    """
+    rows: [(kind, priority, to_addr, subject, message, ttl_seconds | None)].
+    A message still queued after ttl_seconds is dropped as 'expired'.
+    Returns the id of a single queued row (None for bulk inserts).
+    """
+    ensure_mail_outbox()
+    sql = ("INSERT INTO mail_outbox (kind, priority, to_addr, subject, message, discard_after) "
+           "VALUES (%s, %s, %s, %s, %s, NOW() + INTERVAL %s SECOND)")
+    if len(rows) == 1:
+        return execute_query(sql, rows[0])
+    for chunk in _chunks(rows, 500):
+        execute_many(sql, chunk)
+    return None
+
+
+def claim_mail(worker: str, limit: int) -> list[dict]:
+    """Atomically take up to `limit` due messages for this worker (highest priority first)."""
+    ensure_mail_outbox()
+    claimed = _update_rowcount(
+        "UPDATE mail_outbox SET status = 'sending', claimed_by = %s, claimed_at = NOW() "
+        "WHERE status = 'queued' AND next_attempt_at <= NOW() "
+        "ORDER BY priority DESC, id LIMIT %s",
+        (worker, limit),
+    )
+    if not claimed:
+        return []
+    return execute_query(
+        "SELECT id, kind, to_addr, subject, message, attempts, "
+        "COALESCE(discard_after <= NOW(), 0) AS stale FROM mail_outbox "
+        "WHERE claimed_by = %s AND status = 'sending' ORDER BY priority DESC, id",
+        (worker,), fetch='all',
+    ) or []
+
+
+def finish_mail(results: list[tuple]):
+    """results: [(id, status, attempts, retry_in_seconds | None, error | None)]."""
+    sent = [(attempts, mail_id) for mail_id, status, attempts, _, _ in results if status == 'sent']
+    if sent:
+        execute_many(
+            "UPDATE mail_outbox SET status = 'sent', attempts = %s, sent_at = NOW(), "
+            "last_error = NULL, claimed_by = NULL WHERE id = %s",
+            sent,
+        )
+    other = [
+        (status, attempts, retry_in or 0, (error or '')[:500] or None, mail_id)
+        for mail_id, status, attempts, retry_in, error in results if status != 'sent'
+    ]
+    if other:
+        execute_many(
+            "UPDATE mail_outbox SET status = %s, attempts = %s, "
+            "next_attempt_at = NOW() + INTERVAL %s SECOND, last_error = %s, claimed_by = NULL "
+            "WHERE id = %s",
+            other,
+        )
+
+
+def requeue_stale_mail(older_than_s: int) -> int:
+    """Return rows stuck in 'sending' (worker died mid-batch) to the queue."""
+    ensure_mail_outbox()
+    return _update_rowcount(
+        "UPDATE mail_outbox SET status = 'queued', claimed_by = NULL "
+        "WHERE status = 'sending' AND claimed_at < NOW() - INTERVAL %s SECOND",
+        (older_than_s,),
+    )
+
+
+def get_mail_status(mail_id: int) -> dict | None:
+    ensure_mail_outbox()
+    return execute_query(
+        "SELECT id, kind, to_addr, status, attempts, last_error, created_at, sent_at "
+        "FROM mail_outbox WHERE id = %s",
+        (mail_id,), fetch='one',
+    )
+
+
+def mail_outbox_stats() -> dict:
+    """Counts by status for the last 24 hours."""
+    ensure_mail_outbox()
+    rows = execute_query(
+        "SELECT status, COUNT(*) AS cnt FROM mail_outbox "
+        "WHERE created_at > NOW() - INTERVAL 1 DAY GROUP BY status",
+        fetch='all',
+    ) or []
+    return {r['status']: r['cnt'] for r in rows}
+
+
+# ─────────────────────────────────────────────
+#  Site events / email opens (write-behind, see api/event_buffer.py)
+# ─────────────────────────────────────────────
+
+def known_visitors(visitor_ids: list[str]) -> set[str]:
+    """visitor_ids that already have a 'visit' row."""
+    found = set()
+    for chunk in _chunks(list(visitor_ids)):
+        marks = ", ".join(["%s"] * len(chunk))
+        rows = execute_query(
+            f"SELECT DISTINCT visitor_id FROM site_events "
+            f"WHERE event_type = 'visit' AND visitor_id IN ({marks})",
+            tuple(chunk), fetch='all',
+        ) or []
+        found.update(r['visitor_id'] for r in rows)
+    return found
+
+
+def insert_site_events(rows: list[tuple]) -> int:
+    """rows: [(event_type, visitor_id, ip)] — multi-row INSERT."""
+    inserted = 0
+    for chunk in _chunks(rows):
+        inserted += execute_many(
+            "INSERT INTO site_events (event_type, visitor_id, ip) VALUES (%s, %s, %s)", chunk,
+        )
+    return inserted
+
+
+def mark_emails_opened(track_ids: list[str]) -> int:
+    """Set opened_at for the first open of each track_id."""
+    updated = 0
+    for chunk in _chunks(list(track_ids)):
+        marks = ", ".join(["%s"] * len(chunk))
+        updated += _update_rowcount(
+            f"UPDATE email_opens SET opened_at = NOW() WHERE opened_at IS NULL AND track_id IN ({marks})",
+            tuple(chunk),
+        )
+    return updated
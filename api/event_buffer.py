@@ -0,0 +1,221 @@
+"""
+Write-behind buffer for site analytics beacons and email open pixels.
+
+/api/web/event and /t/{track_id}.gif only append to in-memory lists and
+return; a background task flushes every EVENT_FLUSH_MS (or as soon as
+EVENT_FLUSH_BATCH items are pending) with:
+
+    SELECT ... visitor_id IN (...)                — one dedup query per flush
+    INSERT INTO site_events VALUES (...), (...)   — multi-row
+    UPDATE email_opens ... track_id IN (...)      — coalesced opens
+
+'visit' is recorded once per visitor_id. Visitors already written are kept in
+a bounded LRU set, so repeat visits are dropped without touching MySQL; for
+anyone not in the set (evicted, other worker, before restart) the flush-time
+SELECT still filters out existing rows.
+
+The buffer is drained on shutdown (api lifespan). If MySQL is unavailable the
+batch goes back into the buffer; whatever exceeds EVENT_MAX_PENDING is
+dropped and counted.
+
+All methods run on the event loop thread; only the DB writes go to a worker
+thread.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+
+from api.db import known_visitors, insert_site_events, mark_emails_opened
+
+logger = logging.getLogger(__name__)
+
+EVENT_FLUSH_MS = int(os.getenv("EVENT_FLUSH_MS", "500"))
+EVENT_FLUSH_BATCH = int(os.getenv("EVENT_FLUSH_BATCH", "200"))
+EVENT_MAX_PENDING = int(os.getenv("EVENT_MAX_PENDING", "20000"))
+SEEN_VISITORS_MAX = int(os.getenv("SEEN_VISITORS_MAX", "100000"))
+
+
+class EventBuffer:
+    def __init__(self, flush_interval: float = EVENT_FLUSH_MS / 1000,
+                 flush_batch: int = EVENT_FLUSH_BATCH,
+                 max_pending: int = EVENT_MAX_PENDING,
+                 seen_max: int = SEEN_VISITORS_MAX):
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.max_pending = max_pending
+        self.seen_max = seen_max
+        self._events: list[tuple] = []          # (event_type, visitor_id, ip), кроме visit
+        self._visits: dict[str, str] = {}       # visitor_id → ip, ещё не записанные
+        self._opens: set[str] = set()
+        self._seen: OrderedDict = OrderedDict()  # visitor_id, у которых visit уже в БД
+        self._task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._flush_lock: asyncio.Lock | None = None
+        self._stats = dict.fromkeys((
+            "accepted", "dup_visits", "dropped", "flushes", "flush_errors",
+            "flushed_events", "flushed_visits", "flushed_opens",
+        ), 0)
+
+    def pending(self) -> int:
+        return len(self._events) + len(self._visits) + len(self._opens)
+
+    # ── ingest (hot path, no I/O) ──
+
+    def add_event(self, event: str, visitor_id: str, ip: str) -> bool:
+        """False if this is a repeat 'visit' from a visitor already recorded."""
+        if event == "visit":
+            if visitor_id in self._seen or visitor_id in self._visits:
+                if visitor_id in self._seen:
+                    self._seen.move_to_end(visitor_id)
+                self._stats["dup_visits"] += 1
+                return False
+            if self._full():
+                return True
+            self._visits[visitor_id] = ip
+        else:
+            if self._full():
+                return True
+            self._events.append((event, visitor_id, ip))
+        self._accepted()
+        return True
+
+    def add_open(self, track_id: str):
+        if track_id in self._opens or self._full():
+            return
+        self._opens.add(track_id)
+        self._accepted()
+
+    def _full(self) -> bool:
+        if self.pending() >= self.max_pending:
+            self._stats["dropped"] += 1
+            return True
+        return False
+
+    def _accepted(self):
+        self._stats["accepted"] += 1
+        if self.pending() >= self.flush_batch and self._wakeup is not None:
+            self._wakeup.set()
+
+    # ── flush ──
+
+    async def flush(self) -> int:
+        """Write everything pending; returns the number of rows written."""
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+        async with self._flush_lock:
+            events, self._events = self._events, []
+            visits, self._visits = self._visits, {}
+            opens, self._opens = self._opens, set()
+            if not (events or visits or opens):
+                return 0
+            self._stats["flushes"] += 1
+            written = 0
+
+            if events or visits:
+                try:
+                    fresh = await asyncio.to_thread(self._write_events, events, visits)
+                except Exception as e:
+                    logger.warning(f"[EVENTS] site_events flush failed ({len(events) + len(visits)} rows): {e}")
+                    self._stats["flush_errors"] += 1
+                    self._restore(events, visits, set())
+                else:
+                    self._remember(visits)
+                    self._stats["flushed_events"] += len(events)
+                    self._stats["flushed_visits"] += fresh
+                    written += len(events) + fresh
+
+            if opens:
+                try:
+                    await asyncio.to_thread(mark_emails_opened, list(opens))
+                except Exception as e:
+                    logger.warning(f"[EVENTS] email_opens flush failed ({len(opens)} ids): {e}")
+                    self._stats["flush_errors"] += 1
+                    self._restore([], {}, opens)
+                else:
+                    self._stats["flushed_opens"] += len(opens)
+                    written += len(opens)
+            return written
+
+    @staticmethod
+    def _write_events(events: list[tuple], visits: dict[str, str]) -> int:
+        """Worker thread. Returns how many of `visits` were new."""
+        rows = list(events)
+        fresh = 0
+        if visits:
+            known = known_visitors(list(visits))
+            for visitor_id, ip in visits.items():
+                if visitor_id not in known:
+                    rows.append(("visit", visitor_id, ip))
+                    fresh += 1
+        insert_site_events(rows)
+        return fresh
+
+    def _remember(self, visitor_ids):
+        for visitor_id in visitor_ids:
+            self._seen[visitor_id] = None
+            self._seen.move_to_end(visitor_id)
+        while len(self._seen) > self.seen_max:
+            self._seen.popitem(last=False)
+
+    def _restore(self, events: list[tuple], visits: dict[str, str], opens: set[str]):
+        """Put a failed batch back in front of newer items, up to max_pending."""
+        room = self.max_pending - self.pending()
+        kept_events = events[:max(room, 0)]
+        room -= len(kept_events)
+        kept_visits = dict(list(visits.items())[:max(room, 0)])
+        room -= len(kept_visits)
+        kept_opens = set(list(opens)[:max(room, 0)])
+        lost = len(events) + len(visits) + len(opens) - len(kept_events) - len(kept_visits) - len(kept_opens)
+        self._events = kept_events + self._events
+        self._visits = {**kept_visits, **self._visits}
+        self._opens |= kept_opens
+        if lost:
+            self._stats["dropped"] += lost
+            logger.error(f"[EVENTS] Buffer full, dropped {lost} items")
+
+    # ── lifecycle ──
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception(f"[EVENTS] Flush loop error: {e}")
+
+    async def stop(self):
+        """Stop the timer and drain what is left."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self.pending():
+            self._stats["dropped"] += self.pending()
+            logger.error(f"[EVENTS] {self.pending()} items lost on shutdown")
+
+    def stats(self) -> dict:
+        return {**self._stats, "pending": self.pending(), "seen_visitors": len(self._seen)}
+
+
+_BUFFER = EventBuffer()
+
+add_event = _BUFFER.add_event
+add_open = _BUFFER.add_open
+flush = _BUFFER.flush
+start = _BUFFER.start
+stop = _BUFFER.stop
+stats = _BUFFER.stats
@@ -0,0 +1,18 @@
+"""Guard for internal service endpoints (cache/buffer counters for the admin panel).
+
+They are served only to direct requests from localhost: anything that came
+through nginx carries X-Real-IP / X-Forwarded-For and gets a 404, as does any
+other client address.
+
+    @router.get("/x-stats", include_in_schema=False, dependencies=[Depends(require_localhost)])
+"""
+from fastapi import HTTPException, Request
+
+LOCAL_HOSTS = ("127.0.0.1", "::1")
+
+
+def require_localhost(request: Request):
+    client_host = request.client.host if request.client else ""
+    proxied = request.headers.get("x-real-ip") or request.headers.get("x-forwarded-for")
+    if proxied or client_host not in LOCAL_HOSTS:
+        raise HTTPException(status_code=404, detail="Not found")
@@ -0,0 +1,239 @@
+"""
+Durable outbound mail queue (MySQL table mail_outbox) and its background sender.
+
+Request handlers only INSERT a ready RFC 822 message (api.notifications builds
+it) and return; nothing talks to SMTP on the request path. Any process may
+enqueue — the bot, scripts, every uvicorn worker.
+
+MailSender runs in the api service lifespan. It claims due rows in batches
+(UPDATE ... ORDER BY priority DESC, id LIMIT n, tagged with its worker id, so
+several senders never take the same row) and delivers them over a small pool
+of logged-in SMTP connections, each used by one worker thread at a time.
+
+    queued → sending → sent
+                     → queued again (4xx, disconnect, timeout: backoff 30s·2ⁿ, ≤ 1h)
+                     → failed  (5xx rejection, or MAX_ATTEMPTS used up)
+                     → expired (auth codes that were not sent within their TTL)
+
+Rows left in 'sending' by a crashed worker go back to the queue after
+STALE_CLAIM_S.
+"""
+import asyncio
+import logging
+import os
+import smtplib
+import socket
+import time
+import uuid
+
+from api.db import enqueue_mail, claim_mail, finish_mail, requeue_stale_mail
+
+logger = logging.getLogger(__name__)
+
+MAIL_SMTP_POOL = int(os.getenv("MAIL_SMTP_POOL", "3"))  # одновременных SMTP-сессий на процесс
+BATCH_SIZE = 50
+POLL_INTERVAL = 5.0     # секунд между опросами пустой очереди (enqueue в этом же процессе будит сразу)
+IDLE_CLOSE = 60.0       # закрыть SMTP-сессии после стольких секунд простоя
+MAX_ATTEMPTS = 6
+RETRY_BASE = 30
+RETRY_MAX = 3600
+STALE_CLAIM_S = 600
+
+PRIORITY_AUTH = 10
+PRIORITY_TRANSACTIONAL = 5
+PRIORITY_BULK = 0
+
+SENT, FAILED, EXPIRED, QUEUED = "sent", "failed", "expired", "queued"
+
+_sender: "MailSender | None" = None
+
+
+# ─────────────────────────────────────────────
+#  Enqueue
+# ─────────────────────────────────────────────
+
+def enqueue(to: str, subject: str, message: str, kind: str,
+            priority: int = PRIORITY_TRANSACTIONAL, ttl: int | None = None) -> int:
+    """Queue one message; returns its mail_outbox id."""
+    mail_id = enqueue_mail([(kind, priority, to, subject[:255], message, ttl)])
+    _wake()
+    return mail_id
+
+
+def enqueue_many(messages: list[tuple[str, str, str]], kind: str,
+                 priority: int = PRIORITY_BULK, ttl: int | None = None) -> int:
+    """messages: [(to, subject, message)]. Bulk INSERT; returns how many were queued."""
+    enqueue_mail([(kind, priority, to, subject[:255], message, ttl) for to, subject, message in messages])
+    _wake()
+    return len(messages)
+
+
+def _wake():
+    sender = _sender
+    if sender is not None:
+        sender.wake()
+
+
+# ─────────────────────────────────────────────
+#  Delivery
+# ─────────────────────────────────────────────
+
+def _is_permanent(e: Exception) -> bool:
+    """5xx for this message/recipient. Auth and sender errors are our config — keep retrying."""
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        # {addr: (code, msg)} — 4xx (greylisting, mailbox busy) стоит повторить
+        return all(code >= 500 for code, _ in e.recipients.values())
+    if isinstance(e, (smtplib.SMTPAuthenticationError, smtplib.SMTPSenderRefused)):
+        return False
+    code = getattr(e, "smtp_code", None)
+    return isinstance(code, int) and 500 <= code < 600
+
+
+def retry_delay(attempts: int) -> int:
+    return min(RETRY_MAX, RETRY_BASE * 2 ** (attempts - 1))
+
+
+def _default_connection():
+    from api.notifications import SMTPConnection
+    return SMTPConnection()
+
+
+class MailSender:
+    def __init__(self, pool_size: int = MAIL_SMTP_POOL, connect=_default_connection,
+                 batch_size: int = BATCH_SIZE):
+        self.worker = f"{socket.gethostname()[:40]}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.batch_size = batch_size
+        self._connect = connect
+        self._pool_size = pool_size
+        self._pool: asyncio.Queue | None = None
+        self._conns: list = []
+        self._task: asyncio.Task | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._last_busy = time.monotonic()
+        self._stats = dict.fromkeys((SENT, FAILED, EXPIRED, "retried", "batches"), 0)
+
+    # ── lifecycle ──
+
+    def start(self):
+        global _sender
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        _sender = self
+        logger.info(f"[MAIL] Sender {self.worker} started, {self._pool_size} SMTP connections")
+
+    async def stop(self):
+        global _sender
+        if _sender is self:
+            _sender = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await asyncio.to_thread(self._close_connections)
+
+    def wake(self):
+        """Thread-safe: a new message is waiting."""
+        loop, event = self._loop, self._wakeup
+        if loop is None or event is None or loop.is_closed():
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            event.set()
+        else:
+            loop.call_soon_threadsafe(event.set)
+
+    # ── loop ──
+
+    async def _run(self):
+        next_stale_check = 0.0
+        while True:
+            try:
+                if time.monotonic() >= next_stale_check:
+                    next_stale_check = time.monotonic() + STALE_CLAIM_S / 2
+                    requeued = await asyncio.to_thread(requeue_stale_mail, STALE_CLAIM_S)
+                    if requeued:
+                        logger.warning(f"[MAIL] Requeued {requeued} stale messages")
+                if await self.run_once():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"[MAIL] Sender loop error: {e}")
+            if self._conns and time.monotonic() - self._last_busy > IDLE_CLOSE:
+                await asyncio.to_thread(self._close_connections)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self) -> int:
+        """Claim and deliver one batch; returns the number of messages processed."""
+        batch = await asyncio.to_thread(claim_mail, self.worker, self.batch_size)
+        if not batch:
+            return 0
+        self._last_busy = time.monotonic()
+        results = await asyncio.gather(*(self._deliver(row) for row in batch))
+        await asyncio.to_thread(finish_mail, results)
+        self._stats["batches"] += 1
+        self._last_busy = time.monotonic()
+        return len(batch)
+
+    async def _deliver(self, row: dict) -> tuple:
+        mail_id, attempts = row['id'], row['attempts'] + 1
+        if row.get('stale'):
+            self._stats[EXPIRED] += 1
+            return mail_id, EXPIRED, row['attempts'], None, "not sent before TTL"
+        conn = await self._acquire()
+        try:
+            await asyncio.to_thread(conn.sendmail, row['to_addr'], row['message'])
+        except Exception as e:
+            # соединение в неизвестном состоянии — следующая отправка переподключится
+            await asyncio.to_thread(conn.close)
+            error = f"{type(e).__name__}: {e}"
+            if _is_permanent(e) or attempts >= MAX_ATTEMPTS:
+                logger.error(f"[MAIL] #{mail_id} to {row['to_addr']} failed permanently: {error}")
+                self._stats[FAILED] += 1
+                return mail_id, FAILED, attempts, None, error
+            delay = retry_delay(attempts)
+            logger.warning(f"[MAIL] #{mail_id} to {row['to_addr']} attempt {attempts} failed, "
+                           f"retry in {delay}s: {error}")
+            self._stats["retried"] += 1
+            return mail_id, QUEUED, attempts, delay, error
+        finally:
+            self._pool.put_nowait(conn)
+        self._stats[SENT] += 1
+        logger.info(f"[MAIL] #{mail_id} ({row['kind']}) sent to {row['to_addr']}")
+        return mail_id, SENT, attempts, None, None
+
+    async def _acquire(self):
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+        if self._pool.empty() and len(self._conns) < self._pool_size:
+            conn = self._connect()
+            self._conns.append(conn)
+            return conn
+        return await self._pool.get()
+
+    def _close_connections(self):
+        for conn in self._conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        return {**self._stats, "worker": self.worker, "connections": len(self._conns)}
+
+
+def sender_stats() -> dict | None:
+    sender = _sender
+    return sender.stats() if sender is not None else None
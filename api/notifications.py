@@ -1,6 +1,9 @@
 """
 Notification service: email/SMS auth codes.
 Generates codes, stores in auth_codes table, sends via SMTP (or SMS in future).
+
+Emails are not sent inline: they go to the mail_outbox queue (api.mail_queue)
+and the api service's MailSender delivers them.
 """
 import logging
 import random
@@ -11,6 +14,7 @@ from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 
 from api.db import execute_query
+from api import mail_queue
 #!/usr/bin/env python3
 import sys
 import logging
@@ -66,7 +70,7 @@ def create_auth_code(destination: str, channel: str = "email") -> str | None:
         logger.error(f"Failed to send code to {destination} via {channel}")
         return None
 
-    logger.info(f"Auth code sent to {destination} via {channel}")
+    logger.info(f"Auth code queued for {destination} via {channel}")
     return code
 
 
@@ -109,16 +113,8 @@ def _send(destination: str, code: str, channel: str) -> bool:
 
 
 def _send_email(to: str, code: str) -> bool:
-    if not all([SMTP_HOST, SMTP_USER, SMTP_PASSWORD]):
-        logger.error("SMTP not configured")
-        return False
-
-    msg = MIMEMultipart("alternative")
-    msg["Subject"] = f"Код подтверждения: {code}"
-    msg["From"] = f"TIIN <{SMTP_FROM or SMTP_USER}>"
-    msg["To"] = to
-    msg["Reply-To"] = "support@tiinservice.ru"
-
+    """Queue the code email at top priority; it expires with the code itself."""
+    subject = f"Код подтверждения: {code}"
     text = f"Ваш код подтверждения: {code}\nКод действителен {CODE_TTL_MINUTES} минут."
     html = f"""\
 <html>
@@ -134,25 +130,8 @@ def _send_email(to: str, code: str) -> bool:
   </div>
 </body>
 </html>"""
-
-    msg.attach(MIMEText(text, "plain", "utf-8"))
-    msg.attach(MIMEText(html, "html", "utf-8"))
-
-    try:
-        port = int(SMTP_PORT or 587)
-        if port == 465:
-            with smtplib.SMTP_SSL(SMTP_HOST, port) as server:
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.sendmail(SMTP_FROM or SMTP_USER, to, msg.as_string())
-        else:
-            with smtplib.SMTP(SMTP_HOST, port) as server:
-                server.starttls()
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.sendmail(SMTP_FROM or SMTP_USER, to, msg.as_string())
-        return True
-    except Exception as e:
-        logger.exception(f"SMTP send failed: {e}")
-        return False
+    return _queue_html_email(to, subject, text, html, kind="auth_code",
+                             priority=mail_queue.PRIORITY_AUTH, ttl=CODE_TTL_MINUTES * 60)
 
 
 def _send_sms(to: str, code: str) -> bool:
@@ -190,12 +169,62 @@ def _branded_html(body_content: str) -> str:
 #  Transactional emails (payment, expiry)
 # ─────────────────────────────────────────────
 
-def _send_html_email(to: str, subject: str, text: str, html: str) -> bool:
-    """Generic HTML email sender."""
+class SMTPConnection:
+    """One SMTP login reused for a batch of emails; reconnects if the server drops it.
+
+    Not thread-safe — use one connection per worker thread.
+    """
+
+    def __init__(self):
+        self._server = None
+
+    def _connect(self):
+        port = int(SMTP_PORT or 587)
+        if port == 465:
+            server = smtplib.SMTP_SSL(SMTP_HOST, port)
+        else:
+            server = smtplib.SMTP(SMTP_HOST, port)
+            server.starttls()
+        server.login(SMTP_USER, SMTP_PASSWORD)
+        return server
+
+    def sendmail(self, to: str, message: str):
+        for attempt in (1, 2):
+            if self._server is None:
+                self._server = self._connect()
+            try:
+                self._server.sendmail(SMTP_FROM or SMTP_USER, to, message)
+                return
+            except smtplib.SMTPServerDisconnected:
+                # сервер закрыл простаивающее соединение — переподключаемся один раз
+                self._server = None
+                if attempt == 2:
+                    raise
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def _smtp_configured() -> bool:
     if not all([SMTP_HOST, SMTP_USER, SMTP_PASSWORD]):
         logger.error("SMTP not configured")
         return False
+    return True
+
 
+def _build_message(to: str, subject: str, text: str, html: str) -> str:
     msg = MIMEMultipart("alternative")
     msg["Subject"] = subject
     msg["From"] = f"TIIN <{SMTP_FROM or SMTP_USER}>"
@@ -204,18 +233,38 @@ def _send_html_email(to: str, subject: str, text: str, html: str) -> bool:
 
     msg.attach(MIMEText(text, "plain", "utf-8"))
     msg.attach(MIMEText(html, "html", "utf-8"))
+    return msg.as_string()
+
 
+def _queue_html_email(to: str, subject: str, text: str, html: str, kind: str,
+                      priority: int = mail_queue.PRIORITY_TRANSACTIONAL,
+                      ttl: int | None = None) -> bool:
+    """Put an email into mail_outbox. True means queued, not yet delivered."""
+    if not _smtp_configured():
+        return False
     try:
-        port = int(SMTP_PORT or 587)
-        if port == 465:
-            with smtplib.SMTP_SSL(SMTP_HOST, port) as server:
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.sendmail(SMTP_FROM or SMTP_USER, to, msg.as_string())
+        mail_id = mail_queue.enqueue(to, subject, _build_message(to, subject, text, html),
+                                     kind=kind, priority=priority, ttl=ttl)
+    except Exception as e:
+        logger.exception(f"Failed to queue {kind} email to {to}: {e}")
+        return False
+    logger.info(f"Email #{mail_id} queued for {to}: {subject}")
+    return True
+
+
+def _send_html_email(to: str, subject: str, text: str, html: str,
+                     smtp: SMTPConnection | None = None) -> bool:
+    """Send right now, bypassing the queue (CLI scripts). Pass `smtp` to reuse one connection."""
+    if not _smtp_configured():
+        return False
+
+    message = _build_message(to, subject, text, html)
+    try:
+        if smtp is not None:
+            smtp.sendmail(to, message)
         else:
-            with smtplib.SMTP(SMTP_HOST, port) as server:
-                server.starttls()
-                server.login(SMTP_USER, SMTP_PASSWORD)
-                server.sendmail(SMTP_FROM or SMTP_USER, to, msg.as_string())
+            with SMTPConnection() as conn:
+                conn.sendmail(to, message)
         logger.info(f"Email sent to {to}: {subject}")
         return True
     except Exception as e:
@@ -262,11 +311,11 @@ def send_payment_success_email(to: str, tariff_name: str, period: str, portal_ur
     </div>"""
 
     html = _branded_html(body)
-    return _send_html_email(to, subject, text, html)
+    return _queue_html_email(to, subject, text, html, kind="payment_success")
 
 
-def send_expiry_warning_email(to: str, days_left: int, expiry_date: str) -> bool:
-    """Send subscription expiry warning email."""
+def expiry_warning_email(days_left: int, expiry_date: str) -> tuple[str, str, str]:
+    """(subject, text, html) of the subscription expiry warning."""
     if days_left == 1:
         label = "1 день"
     elif days_left in (2, 3, 4):
@@ -305,8 +354,14 @@ def send_expiry_warning_email(to: str, days_left: int, expiry_date: str) -> bool
       </a>
     </div>"""
 
-    html = _branded_html(body)
-    return _send_html_email(to, subject, text, html)
+    return subject, text, _branded_html(body)
+
+
+def send_expiry_warning_email(to: str, days_left: int, expiry_date: str) -> bool:
+    """Queue subscription expiry warning email."""
+    subject, text, html = expiry_warning_email(days_left, expiry_date)
+    return _queue_html_email(to, subject, text, html, kind="expiry_warning",
+                             priority=mail_queue.PRIORITY_BULK)
 
 
 def send_support_autoreply(to: str) -> bool:
@@ -331,7 +386,7 @@ def send_support_autoreply(to: str) -> bool:
     </div>"""
 
     html = _branded_html(body)
-    return _send_html_email(to, subject, text, html)
+    return _queue_html_email(to, subject, text, html, kind="support_autoreply")
 
 
 def send_support_message_to_team(from_email: str, message: str) -> bool:
@@ -355,4 +410,4 @@ def send_support_message_to_team(from_email: str, message: str) -> bool:
     </div>"""
 
     html = _branded_html(body)
-    return _send_html_email("support@tiinservice.ru", subject, text, html)
+    return _queue_html_email("support@tiinservice.ru", subject, text, html, kind="support_team")
@@ -0,0 +1,189 @@
+"""
+IP rate limiter for the API middleware: sliding-window counters, O(1) per key.
+
+Each (rule, ip) keeps three numbers — the current fixed window index, its
+count and the previous window's count. The sliding estimate is
+    prev * (1 - elapsed_fraction) + cur
+which tracks "N requests per window" without storing timestamps.
+
+Paths are matched once against a precompiled regex of the rule prefixes
+(in declaration order, like the old `startswith` loop); paths outside the
+rules' common prefix (e.g. /sub/...) are rejected by a single startswith.
+
+Backends:
+  MemoryBackend  — per process, lock-striped dicts ordered by window, so
+                   stale keys are expired a few at a time from the front;
+  SQLiteBackend  — one file shared by all uvicorn workers on the host
+                   (RATE_LIMIT_DB), WAL + one UPSERT transaction per hit.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+STRIPES = 16
+EXPIRE_PER_HIT = 2        # сколько устаревших ключей чистить за один запрос
+SQLITE_PURGE_EVERY = 1000  # запросов между чистками SQLite-таблицы
+
+
+class Rule(NamedTuple):
+    prefix: str
+    limit: int
+    window: int
+
+
+class PathMatcher:
+    """First rule whose prefix the path starts with; one regex match per request."""
+
+    def __init__(self, rules: list[Rule]):
+        self.rules = {r.prefix: r for r in rules}
+        self._common = os.path.commonprefix(list(self.rules)) if rules else ""
+        self._regex = re.compile("|".join(re.escape(r.prefix) for r in rules)) if rules else None
+
+    def match(self, path: str) -> Rule | None:
+        if self._regex is None or not path.startswith(self._common):
+            return None
+        m = self._regex.match(path)
+        return self.rules[m.group(0)] if m else None
+
+
+def _allow(state: list, limit: int, window: int, now: float) -> bool:
+    """Sliding-window check on state = [window_idx, cur, prev]; counts the hit if allowed."""
+    pos = now / window
+    idx = int(pos)
+    if state[0] != idx:
+        state[2] = state[1] if state[0] == idx - 1 else 0
+        state[1] = 0
+        state[0] = idx
+    if state[2] * (1 - (pos - idx)) + state[1] >= limit:
+        return False
+    state[1] += 1
+    return True
+
+
+class MemoryBackend:
+    def __init__(self, stripes: int = STRIPES):
+        self._stripes = stripes
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        # rule prefix -> per stripe OrderedDict key -> [window_idx, cur, prev]
+        # (OrderedDict, а не dict: у dict next(iter()) после удалений с начала — O(n))
+        self._tables: dict[str, list[OrderedDict]] = {}
+
+    def hit(self, rule: Rule, key: str, now: float) -> bool:
+        tables = self._tables.get(rule.prefix)
+        if tables is None:
+            tables = self._tables.setdefault(rule.prefix, [OrderedDict() for _ in range(self._stripes)])
+        i = hash(key) % self._stripes
+        table = tables[i]
+        with self._locks[i]:
+            state = table.get(key)
+            if state is None:
+                state = table[key] = [int(now / rule.window), 0, 0]
+            elif state[0] != int(now / rule.window):
+                # переставляем в конец: таблица остаётся отсортирована по окну
+                table.move_to_end(key)
+            else:
+                return _allow(state, rule.limit, rule.window, now)
+            allowed = _allow(state, rule.limit, rule.window, now)
+            self._expire(table, state[0])
+            return allowed
+
+    @staticmethod
+    def _expire(table: OrderedDict, idx: int):
+        # Ключ без хитов за последние два окна ничего не ограничивает.
+        # Чистим только при вставке/перестановке — таблица растёт только тогда же.
+        for _ in range(EXPIRE_PER_HIT):
+            oldest = next(iter(table.values()))  # не пусто: только что вставленный ключ — в конце
+            if oldest[0] >= idx - 1:
+                return
+            table.popitem(last=False)
+
+    def __len__(self):
+        return sum(len(t) for tables in self._tables.values() for t in tables)
+
+
+class SQLiteBackend:
+    """Shared counters for several worker processes on one host."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._hits = 0
+        conn = self._conn()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            " key TEXT PRIMARY KEY, win INTEGER NOT NULL, cur INTEGER NOT NULL, prev INTEGER NOT NULL,"
+            " expires REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_rate_limits_expires ON rate_limits (expires)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+        return conn
+
+    def hit(self, rule: Rule, key: str, now: float) -> bool:
+        conn = self._conn()
+        db_key = f"{rule.prefix}|{key}"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT win, cur, prev FROM rate_limits WHERE key = ?", (db_key,)).fetchone()
+            state = list(row) if row else [int(now / rule.window), 0, 0]
+            allowed = _allow(state, rule.limit, rule.window, now)
+            conn.execute(
+                "INSERT INTO rate_limits (key, win, cur, prev, expires) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET win = excluded.win, cur = excluded.cur, "
+                "prev = excluded.prev, expires = excluded.expires",
+                (db_key, *state, (state[0] + 2) * rule.window),
+            )
+            self._hits += 1
+            if self._hits % SQLITE_PURGE_EVERY == 0:
+                conn.execute(
+                    "DELETE FROM rate_limits WHERE rowid IN ("
+                    " SELECT rowid FROM rate_limits WHERE expires < ? LIMIT 500)",
+                    (now,),
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return allowed
+
+
+class RateLimiter:
+    def __init__(self, rules: dict[str, tuple[int, int]], backend=None):
+        self.matcher = PathMatcher([Rule(p, limit, window) for p, (limit, window) in rules.items()])
+        self.backend = backend if backend is not None else MemoryBackend()
+
+    def check(self, ip: str, path: str, now: float | None = None) -> bool:
+        """True if the request is allowed, False if rate-limited."""
+        rule = self.matcher.match(path)
+        if rule is None:
+            return True
+        try:
+            return self.backend.hit(rule, ip, time.time() if now is None else now)
+        except sqlite3.Error as e:
+            # Общее хранилище недоступно (locked и т.п.) — не блокируем пользователей
+            logger.warning(f"[RATE] backend error, allowing request: {e}")
+            return True
+
+
+def make_backend(path: str = ""):
+    """SQLiteBackend if a path is configured, otherwise per-process memory."""
+    if not path:
+        return MemoryBackend()
+    try:
+        return SQLiteBackend(path)
+    except sqlite3.Error as e:
+        logger.error(f"[RATE] cannot open {path}: {e}; falling back to in-memory limits")
+        return MemoryBackend()
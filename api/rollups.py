@@ -0,0 +1,455 @@
+"""
+Daily (UTC+9) analytics rollups for the admin panel.
+
+analytics_daily holds one row per (day, metric, dim):
+
+    event            dim = event_type   site_events rows
+    unique_visitors                     visitors whose first 'visit' was that day
+    registrations                       new users
+    payments         dim = tariff       all payment rows
+    paid             dim = tariff       status='paid' AND is_test=0
+    revenue          dim = tariff       SUM(amount) of the above
+
+Each source table is folded in by primary key: analytics_watermarks.last_id
+is the last id already counted, so refresh() reads only rows added since the
+previous run (a PK range scan) and adds them to the daily rows in the same
+transaction that moves the watermark. A row is only folded in once it is
+ROLLUP_SETTLE_SECONDS old: AUTO_INCREMENT ids can commit out of order (several
+workers, event_buffer bulk inserts, users from both bot and API), and a lower
+id committing after the watermark passed it would never be counted. Payments
+wait PAYMENT_SETTLE_HOURS, because their status changes after INSERT; a later
+change (refund) goes through api.db.update_payment_status*, which calls
+resync_payment() to recount that payment's day.
+
+snapshot() returns rollups + the same aggregation run live over the rows past
+the watermark, so numbers include today's partial and do not depend on how
+recently refresh() ran.
+
+    refresh()   — bot scheduler, every ROLLUP_INTERVAL_MIN
+    resync_payment(payment_id) — status changed behind the watermark
+    rebuild()   — backfill from scratch (scripts/rollup_analytics.py --backfill)
+    check(days) — compare with the raw GROUP BY queries (--check)
+"""
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+from api.db import execute_query, get_db, record_job_run
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_SETTLE_HOURS = int(os.getenv("ROLLUP_PAYMENT_SETTLE_HOURS", "24"))
+ROLLUP_SETTLE_SECONDS = int(os.getenv("ROLLUP_SETTLE_SECONDS", "60"))
+REFRESH_CHUNK = 50_000      # id за одну транзакцию
+ROLLUP_INTERVAL_MIN = 15
+JOB_NAME = "analytics_rollup"
+
+TZ_OFFSET = timedelta(hours=9)
+DAY = "DATE(CONVERT_TZ(created_at, '+00:00', '+09:00'))"
+MONEY_METRICS = {"revenue"}
+
+ROLLUP_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS analytics_daily (
+        day DATE NOT NULL,
+        metric VARCHAR(32) NOT NULL,
+        dim VARCHAR(64) NOT NULL DEFAULT '',
+        value DECIMAL(16, 2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, metric, dim),
+        KEY idx_metric_day (metric, day)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_watermarks (
+        source VARCHAR(32) PRIMARY KEY,
+        last_id BIGINT NOT NULL DEFAULT 0,
+        updated_at DATETIME
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS site_visitors (
+        visitor_id VARCHAR(64) PRIMARY KEY,
+        first_day DATE NOT NULL,
+        KEY idx_first_day (first_day)
+    )
+    """,
+)
+_ready = False
+
+
+def ensure_rollup_tables():
+    global _ready
+    if not _ready:
+        for sql in ROLLUP_SCHEMA:
+            execute_query(sql)
+        _ready = True
+
+
+def today() -> date:
+    return (datetime.now(timezone.utc) + TZ_OFFSET).date()
+
+
+def day_start_utc(day: date) -> datetime:
+    """Naive UTC datetime of 00:00 UTC+9 on `day` (for sargable created_at >= %s)."""
+    return datetime(day.year, day.month, day.day) - TZ_OFFSET
+
+
+# ─────────────────────────────────────────────
+#  Sources
+# ─────────────────────────────────────────────
+
+def _id_range(lo: int, hi: int | None) -> tuple[str, tuple]:
+    if hi is None:
+        return "id > %s", (lo,)
+    return "id > %s AND id <= %s", (lo, hi)
+
+
+def _site_events_rows(query, lo: int, hi: int | None) -> list[tuple]:
+    cond, params = _id_range(lo, hi)
+    rows = query(
+        f"SELECT {DAY} AS day, event_type, COUNT(*) AS n FROM site_events "
+        f"WHERE {cond} GROUP BY day, event_type",
+        params,
+    )
+    return [(r['day'], "event", r['event_type'], r['n']) for r in rows]
+
+
+def _users_rows(query, lo: int, hi: int | None) -> list[tuple]:
+    cond, params = _id_range(lo, hi)
+    rows = query(f"SELECT {DAY} AS day, COUNT(*) AS n FROM users WHERE {cond} GROUP BY day", params)
+    return [(r['day'], "registrations", "", r['n']) for r in rows]
+
+
+def _payments_rows(query, lo: int, hi: int | None, day: date | None = None) -> list[tuple]:
+    cond, params = _id_range(lo, hi)
+    if day is not None:
+        cond += " AND created_at >= %s AND created_at < %s"
+        params += (day_start_utc(day), day_start_utc(day + timedelta(days=1)))
+    rows = query(
+        f"SELECT {DAY} AS day, COALESCE(tariff, '') AS tariff, COUNT(*) AS n, "
+        f"SUM(status = 'paid' AND is_test = 0) AS paid, "
+        f"COALESCE(SUM(CASE WHEN status = 'paid' AND is_test = 0 THEN amount END), 0) AS revenue "
+        f"FROM payments WHERE {cond} GROUP BY day, tariff",
+        params,
+    )
+    out = []
+    for r in rows:
+        out.append((r['day'], "payments", r['tariff'], r['n']))
+        if r['paid']:
+            out.append((r['day'], "paid", r['tariff'], r['paid']))
+            out.append((r['day'], "revenue", r['tariff'], r['revenue']))
+    return out
+
+
+# source → (aggregate, settle_seconds, metrics)
+SOURCES = {
+    "site_events": (_site_events_rows, ROLLUP_SETTLE_SECONDS, {"event", "unique_visitors"}),
+    "users": (_users_rows, ROLLUP_SETTLE_SECONDS, {"registrations"}),
+    "payments": (_payments_rows, PAYMENT_SETTLE_HOURS * 3600, {"payments", "paid", "revenue"}),
+}
+
+_UPSERT = (
+    "INSERT INTO analytics_daily (day, metric, dim, value) VALUES (%s, %s, %s, %s) "
+    "ON DUPLICATE KEY UPDATE value = value + VALUES(value)"
+)
+
+
+# ─────────────────────────────────────────────
+#  Refresh
+# ─────────────────────────────────────────────
+
+def _refresh_visitors(cur, lo: int, hi: int):
+    """First-visit day per visitor; unique_visitors is recounted for the touched days."""
+    cur.execute(
+        f"INSERT IGNORE INTO site_visitors (visitor_id, first_day) "
+        f"SELECT visitor_id, MIN({DAY}) FROM site_events "
+        f"WHERE id > %s AND id <= %s AND event_type = 'visit' GROUP BY visitor_id",
+        (lo, hi),
+    )
+    cur.execute(
+        f"SELECT DISTINCT {DAY} AS day FROM site_events "
+        f"WHERE id > %s AND id <= %s AND event_type = 'visit'",
+        (lo, hi),
+    )
+    days = [r['day'] for r in cur.fetchall()]
+    if not days:
+        return
+    marks = ", ".join(["%s"] * len(days))
+    cur.execute(
+        f"REPLACE INTO analytics_daily (day, metric, dim, value) "
+        f"SELECT first_day, 'unique_visitors', '', COUNT(*) FROM site_visitors "
+        f"WHERE first_day IN ({marks}) GROUP BY first_day",
+        tuple(days),
+    )
+
+
+def _refresh_source(source: str, chunk: int = REFRESH_CHUNK) -> int:
+    """Fold the next `chunk` settled `source` rows into analytics_daily. Returns rows folded."""
+    aggregate, settle_seconds, _ = SOURCES[source]
+    db = get_db()
+    cur = db.cursor(dictionary=True)
+
+    def query(sql, params):
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    try:
+        cur.execute("INSERT IGNORE INTO analytics_watermarks (source) VALUES (%s)", (source,))
+        # FOR UPDATE: два одновременных refresh не посчитают одни и те же строки дважды
+        cur.execute("SELECT last_id FROM analytics_watermarks WHERE source = %s FOR UPDATE", (source,))
+        lo = cur.fetchone()['last_id']
+        # Водяной знак не обгоняет ещё не «осевшие» строки: меньший id может закоммититься позже.
+        # Берём chunk строк, а не диапазон id — дыра в AUTO_INCREMENT больше chunk не застопорит знак
+        cur.execute(
+            f"SELECT MAX(id) AS hi, COUNT(*) AS n FROM ("
+            f"  SELECT id FROM {source} WHERE id > %s AND created_at < NOW() - INTERVAL %s SECOND"
+            f"  ORDER BY id LIMIT %s"
+            f") t",
+            (lo, settle_seconds, chunk),
+        )
+        row = cur.fetchone()
+        hi = row['hi']
+        if not hi:
+            db.rollback()
+            return 0
+        rows = aggregate(query, lo, hi)
+        if rows:
+            cur.executemany(_UPSERT, rows)
+        if source == "site_events":
+            _refresh_visitors(cur, lo, hi)
+        cur.execute(
+            "UPDATE analytics_watermarks SET last_id = %s, updated_at = NOW() WHERE source = %s",
+            (hi, source),
+        )
+        db.commit()
+        return row['n']
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+        db.close()
+
+
+def resync_payment(payment_id: str) -> bool:
+    """Recount the payments/paid/revenue rows of this payment's day if it is
+    already behind the watermark (status changed after folding, e.g. refund)."""
+    ensure_rollup_tables()
+    db = get_db()
+    cur = db.cursor(dictionary=True)
+
+    def query(sql, params):
+        cur.execute(sql, params)
+        return cur.fetchall()
+
+    try:
+        # Та же блокировка, что у _refresh_source: не пересекаемся с параллельной свёрткой
+        cur.execute("SELECT last_id FROM analytics_watermarks WHERE source = 'payments' FOR UPDATE")
+        mark = cur.fetchone()
+        cur.execute("SELECT id, created_at FROM payments WHERE payment_id = %s", (payment_id,))
+        payment = cur.fetchone()
+        if not mark or not payment or payment['id'] > mark['last_id']:
+            db.rollback()
+            return False  # ещё в live-хвосте snapshot() — пересчитывать нечего
+        day = (payment['created_at'] + TZ_OFFSET).date()
+        rows = _payments_rows(query, 0, mark['last_id'], day=day)
+        cur.execute(
+            "DELETE FROM analytics_daily WHERE day = %s AND metric IN ('payments', 'paid', 'revenue')",
+            (day,),
+        )
+        if rows:
+            cur.executemany(_UPSERT, rows)
+        db.commit()
+        logger.info(f"[ROLLUP] payments recounted for {day} after {payment_id} changed")
+        return True
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        cur.close()
+        db.close()
+
+
+def refresh() -> dict:
+    """Catch every source up to its newest (settled) row."""
+    ensure_rollup_tables()
+    stats = {}
+    for source in SOURCES:
+        folded = 0
+        while True:
+            step = _refresh_source(source)
+            folded += step
+            if step < REFRESH_CHUNK:
+                break
+        stats[source] = folded
+    return stats
+
+
+def refresh_job():
+    """Scheduler entry point: refresh() + a job_runs record."""
+    started_at = datetime.now()
+    t0 = time.monotonic()
+    try:
+        stats = refresh()
+    except Exception as e:
+        logger.exception(f"[ROLLUP] refresh failed: {e}")
+        return
+    duration_ms = int((time.monotonic() - t0) * 1000)
+    logger.info(f"[ROLLUP] refresh finished in {duration_ms} ms: {stats}")
+    try:
+        record_job_run(JOB_NAME, started_at, duration_ms, stats)
+    except Exception as e:
+        logger.warning(f"[ROLLUP] job_runs insert failed: {e}")
+
+
+def rebuild() -> dict:
+    """Drop all rollups and recompute them from the raw tables."""
+    ensure_rollup_tables()
+    execute_query("DELETE FROM analytics_daily")
+    execute_query("DELETE FROM site_visitors")
+    execute_query("UPDATE analytics_watermarks SET last_id = 0, updated_at = NOW()")
+    return refresh()
+
+
+# ─────────────────────────────────────────────
+#  Read: rollups + live tail
+# ─────────────────────────────────────────────
+
+class Snapshot:
+    def __init__(self):
+        self._data: dict[tuple, float | int] = defaultdict(int)
+
+    def add(self, day, metric: str, dim: str, value):
+        value = float(value) if metric in MONEY_METRICS else int(value)
+        self._data[(day, metric, dim or "")] += value
+
+    def total(self, metric: str, since: date | None = None, day: date | None = None):
+        return sum(v for (d, m, _), v in self._data.items()
+                   if m == metric and (since is None or d >= since) and (day is None or d == day))
+
+    def by_dim(self, metric: str, day: date | None = None) -> dict:
+        out = defaultdict(int)
+        for (d, m, dim), v in self._data.items():
+            if m == metric and (day is None or d == day):
+                out[dim] += v
+        return dict(out)
+
+    def by_day(self, metric: str, since: date | None = None) -> dict:
+        out = defaultdict(int)
+        for (d, m, _), v in self._data.items():
+            if m == metric and (since is None or d >= since):
+                out[d] += v
+        return dict(sorted(out.items()))
+
+    def by_month(self, metric: str) -> dict:
+        out = defaultdict(int)
+        for d, v in self.by_day(metric).items():
+            out[d.strftime("%Y-%m")] += v
+        return dict(out)
+
+    def first_day(self, metric: str) -> date | None:
+        days = [d for (d, m, _), v in self._data.items() if m == metric and v]
+        return min(days) if days else None
+
+
+def _live_visitors(lo: int) -> list[tuple]:
+    rows = execute_query(
+        f"SELECT day, COUNT(*) AS n FROM ("
+        f"  SELECT e.visitor_id, MIN(DATE(CONVERT_TZ(e.created_at, '+00:00', '+09:00'))) AS day "
+        f"  FROM site_events e LEFT JOIN site_visitors v ON v.visitor_id = e.visitor_id "
+        f"  WHERE e.id > %s AND e.event_type = 'visit' AND v.visitor_id IS NULL "
+        f"  GROUP BY e.visitor_id"
+        f") t GROUP BY day",
+        (lo,), fetch='all',
+    ) or []
+    return [(r['day'], "unique_visitors", "", r['n']) for r in rows]
+
+
+def snapshot(metrics: set[str] | None = None) -> Snapshot:
+    """Rollups plus rows past the watermark (today's partial, unsettled payments)."""
+    ensure_rollup_tables()
+    snap = Snapshot()
+    if metrics is None:
+        rows = execute_query("SELECT day, metric, dim, value FROM analytics_daily", fetch='all')
+    else:
+        marks = ", ".join(["%s"] * len(metrics))
+        rows = execute_query(
+            f"SELECT day, metric, dim, value FROM analytics_daily WHERE metric IN ({marks})",
+            tuple(sorted(metrics)), fetch='all',
+        )
+    for r in rows or []:
+        snap.add(r['day'], r['metric'], r['dim'], r['value'])
+
+    marks = {r['source']: r['last_id'] for r in
+             execute_query("SELECT source, last_id FROM analytics_watermarks", fetch='all') or []}
+
+    def query(sql, params):
+        return execute_query(sql, params, fetch='all') or []
+
+    for source, (aggregate, _, produces) in SOURCES.items():
+        if metrics is not None and not metrics & produces:
+            continue
+        lo = marks.get(source, 0)
+        live = aggregate(query, lo, None)
+        if source == "site_events" and (metrics is None or "unique_visitors" in metrics):
+            live += _live_visitors(lo)
+        for day, metric, dim, value in live:
+            if metrics is None or metric in metrics:
+                snap.add(day, metric, dim, value)
+    return snap
+
+
+# ─────────────────────────────────────────────
+#  Consistency check
+# ─────────────────────────────────────────────
+
+def _raw(since: date) -> Snapshot:
+    """The same numbers straight from the raw tables (slow — for check() only)."""
+    snap = Snapshot()
+    start = day_start_utc(since)
+    for r in execute_query(
+        f"SELECT {DAY} AS day, event_type, COUNT(*) AS n FROM site_events "
+        f"WHERE created_at >= %s GROUP BY day, event_type", (start,), fetch='all',
+    ) or []:
+        snap.add(r['day'], "event", r['event_type'], r['n'])
+    for r in execute_query(
+        f"SELECT {DAY} AS day, COUNT(DISTINCT visitor_id) AS n FROM site_events "
+        f"WHERE event_type = 'visit' AND created_at >= %s GROUP BY day", (start,), fetch='all',
+    ) or []:
+        snap.add(r['day'], "unique_visitors", "", r['n'])
+    for r in execute_query(
+        f"SELECT {DAY} AS day, COUNT(*) AS n FROM users WHERE created_at >= %s GROUP BY day",
+        (start,), fetch='all',
+    ) or []:
+        snap.add(r['day'], "registrations", "", r['n'])
+    for r in execute_query(
+        f"SELECT {DAY} AS day, COALESCE(tariff, '') AS tariff, COUNT(*) AS n, "
+        f"SUM(status = 'paid' AND is_test = 0) AS paid, "
+        f"COALESCE(SUM(CASE WHEN status = 'paid' AND is_test = 0 THEN amount END), 0) AS revenue "
+        f"FROM payments WHERE created_at >= %s GROUP BY day, tariff", (start,), fetch='all',
+    ) or []:
+        snap.add(r['day'], "payments", r['tariff'], r['n'])
+        if r['paid']:
+            snap.add(r['day'], "paid", r['tariff'], r['paid'])
+            snap.add(r['day'], "revenue", r['tariff'], r['revenue'])
+    return snap
+
+
+def compare(rollup: Snapshot, raw: Snapshot, since: date) -> list[dict]:
+    keys = {k for k in (*rollup._data, *raw._data) if k[0] >= since}
+    mismatches = []
+    for day, metric, dim in sorted(keys):
+        a = rollup._data.get((day, metric, dim), 0)
+        b = raw._data.get((day, metric, dim), 0)
+        if abs(a - b) > 0.005:
+            mismatches.append({"day": day.isoformat(), "metric": metric, "dim": dim,
+                               "rollup": a, "raw": b})
+    return mismatches
+
+
+def check(days: int = 7) -> list[dict]:
+    """Per-day differences between snapshot() and the raw queries for the last `days` days."""
+    since = today() - timedelta(days=days - 1)
+    return compare(snapshot(), _raw(since), since)
@@ -0,0 +1,144 @@
+"""
+In-process cache of web sessions: token → user row.
+
+TokenCache is also used by api.db for the web_token → (user, keys) bundle.
+
+The SPA polls /api/auth/me and friends, and every call used to cost two
+MySQL queries. Entries are keyed by sha256(token) (raw tokens are never
+kept), live at most SESSION_CACHE_TTL seconds and never past the session's
+own expires_at. Logout drops the token; user mutations in api.db drop every
+cached session of that user (by id or tg_id). The bot runs in another
+process, so its changes are picked up within SESSION_CACHE_TTL.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "30"))
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "10000"))
+
+
+def token_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def user_refs(user: dict) -> list[tuple[str, int]]:
+    refs = [("id", user["id"])]
+    if user.get("tg_id"):
+        refs.append(("tg", user["tg_id"]))
+    return refs
+
+
+class TokenCache:
+    """TTL + LRU cache keyed by sha256(token), invalidated by user id / tg_id.
+
+    `refs(value)` returns the ("id", users.id) / ("tg", tg_id) pairs a value
+    belongs to. Values are returned as stored: callers must not mutate them.
+    """
+
+    def __init__(self, ttl: float, max_entries: int, refs=user_refs):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._refs = refs
+        self._lock = threading.Lock()
+        # key -> (deadline monotonic, value)
+        self._entries: OrderedDict[str, tuple[float, object]] = OrderedDict()
+        # user id / tg_id -> keys, для инвалидации по пользователю
+        self._by_user: dict[tuple[str, int], set[str]] = {}
+        self._stats = dict.fromkeys(("hits", "misses", "expired", "invalidations", "evictions"), 0)
+
+    def get(self, token: str):
+        key = token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            if entry[0] <= time.monotonic():
+                self._drop(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+
+    def put(self, token: str, value, expires_at: datetime | None = None):
+        ttl = self.ttl
+        if expires_at is not None:
+            ttl = min(ttl, (expires_at - datetime.now()).total_seconds())
+        if ttl <= 0:
+            return
+        key = token_key(token)
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (time.monotonic() + ttl, value)
+            for ref in self._refs(value):
+                self._by_user.setdefault(ref, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate_token(self, token: str):
+        with self._lock:
+            if self._drop(token_key(token)):
+                self._stats["invalidations"] += 1
+
+    def invalidate_user(self, user_id: int | None = None, tg_id: int | None = None):
+        refs = []
+        if user_id:
+            refs.append(("id", user_id))
+        if tg_id:
+            refs.append(("tg", tg_id))
+        with self._lock:
+            for ref in refs:
+                for key in list(self._by_user.get(ref, ())):
+                    if self._drop(key):
+                        self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            s = dict(self._stats)
+            size = len(self._entries)
+        lookups = s["hits"] + s["misses"]
+        s.update(size=size, max_entries=self.max_entries, ttl=self.ttl,
+                 hit_ratio=round(s["hits"] / lookups, 4) if lookups else 0.0)
+        return s
+
+    def _drop(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        for ref in self._refs(entry[1]):
+            keys = self._by_user.get(ref)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_user[ref]
+        return True
+
+
+_CACHE = TokenCache(SESSION_CACHE_TTL, SESSION_CACHE_MAX_ENTRIES)
+
+
+def get(token: str) -> dict | None:
+    user = _CACHE.get(token)
+    return dict(user) if user is not None else None
+
+
+def put(token: str, user: dict, expires_at: datetime | None = None):
+    _CACHE.put(token, dict(user), expires_at)
+
+
+invalidate_token = _CACHE.invalidate_token
+invalidate_user = _CACHE.invalidate_user
+clear = _CACHE.clear
+stats = _CACHE.stats
@@ -1,34 +1,45 @@
 """
-Прокси-эндпоинт для VLESS-подписок: фетчит оригинал с XUI и отдаёт как есть.
-Никаких переписываний remark'ов и портов.
+Прокси-эндпоинт для VLESS-подписок: фетчит оригинал с XUI, дописывает
+Hysteria-ссылку и единый remark.
+
+Готовые ответы лежат в ограниченном LRU-кэше с TTL:
+  - свежая запись отдаётся без обращений к БД и XUI;
+  - протухшая, но не старше SUB_CACHE_STALE, отдаётся сразу, а обновление
+    идёт в фоне (stale-while-revalidate);
+  - параллельные промахи по одному токену ждут одну и ту же загрузку
+    (single-flight), разные токены друг друга не блокируют;
+  - ETag/If-None-Match: неизменившаяся подписка отдаётся как 304 без тела.
 """
 import asyncio
 import base64
+import hashlib
 import logging
+import os
 import time
+from collections import OrderedDict
 from datetime import datetime
+from typing import Annotated
 
 import httpx
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
 from fastapi.responses import Response
 
 from api.db import (
-    get_user_by_web_token,
-    get_keys_by_tg_id,
-    get_keys_by_user_id,
-    get_hysteria_link_by_tg_id,
+    get_web_bundle_async,
+    get_hysteria_link_by_tg_id_async,
+    web_bundle_cache_stats,
 )
+from api.internal import require_localhost
 
 logger = logging.getLogger(__name__)
-sub_router = APIRouter(); print("DEBUG: sub_router initialized")
+sub_router = APIRouter()
 
-SUB_CACHE_TTL = 60  # секунд
+SUB_CACHE_TTL = 60  # секунд — запись считается свежей
+SUB_CACHE_STALE = int(os.getenv("SUB_CACHE_STALE", "600"))  # ещё столько отдаём протухшую, обновляя в фоне
+SUB_CACHE_MAX_ENTRIES = int(os.getenv("SUB_CACHE_MAX_ENTRIES", "20000"))
 SUB_PROFILE_TITLE = "🐿 TIIN VPN"
 SUB_UPDATE_INTERVAL_HOURS = 12
 
-_CACHE: dict[str, tuple[float, bytes, dict[str, str]]] = {}
-_CACHE_LOCK = asyncio.Lock()
-
 
 def _build_headers(expires_at: datetime | None) -> dict[str, str]:
     expire_ts = int(expires_at.timestamp()) if expires_at else 0
@@ -42,13 +53,152 @@ def _build_headers(expires_at: datetime | None) -> dict[str, str]:
     }
 
 
-def _pick_vless_key(user: dict) -> dict | None:
-    """Выбирает VLESS-ключ с непустым subscription_link."""
-    tg_id = user.get("tg_id")
-    keys = get_keys_by_tg_id(tg_id) if tg_id else []
-    if not keys:
-        keys = get_keys_by_user_id(user["id"])
+# ─────────────────────────────────────────────
+#  Кэш готовых ответов
+# ─────────────────────────────────────────────
+
+class _SubEntry:
+    __slots__ = ("body", "headers", "etag", "created")
+
+    def __init__(self, body: bytes, headers: dict[str, str]):
+        self.body = body
+        self.headers = headers
+        # expire входит в хэш: продление без смены ссылок тоже меняет ETag
+        digest = hashlib.sha1(body)
+        digest.update(headers.get("subscription-userinfo", "").encode())
+        self.etag = f'"{digest.hexdigest()}"'
+        self.headers["ETag"] = self.etag
+        self.created = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+
+class _SubCache:
+    """LRU + TTL кэш подписок с single-flight загрузкой по токену."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, _SubEntry] = OrderedDict()
+        self._inflight: dict[str, asyncio.Task] = {}
+        self._stats = dict.fromkeys(
+            ("hits", "misses", "stale", "not_modified", "coalesced",
+             "refreshes", "load_errors", "served_on_error", "evictions"),
+            0,
+        )
+
+    def get(self, token: str) -> _SubEntry | None:
+        entry = self._entries.get(token)
+        if entry is not None:
+            self._entries.move_to_end(token)
+        return entry
+
+    def put(self, token: str, entry: _SubEntry):
+        self._entries[token] = entry
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def count(self, name: str):
+        self._stats[name] += 1
+
+    async def load(self, token: str, build) -> _SubEntry:
+        """Загрузить запись; параллельные вызовы по одному токену делят одну загрузку."""
+        task = self._inflight.get(token)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            self._stats["coalesced"] += 1
+        else:
+            task = asyncio.ensure_future(self._run(token, build))
+            self._inflight[token] = task
+            task.add_done_callback(lambda t: self._done(token, t))
+        # shield: отменённый клиент не отменяет загрузку для остальных
+        return await asyncio.shield(task)
+
+    def refresh(self, token: str, build):
+        """Фоновое обновление протухшей записи (если ещё не идёт)."""
+        if token in self._inflight:
+            return
+        self._stats["refreshes"] += 1
+        task = asyncio.ensure_future(self._run(token, build))
+        self._inflight[token] = task
+        task.add_done_callback(lambda t: self._done(token, t))
+
+    async def _run(self, token: str, build) -> _SubEntry:
+        entry = await build(token)
+        self.put(token, entry)
+        return entry
+
+    def _done(self, token: str, task: asyncio.Task):
+        if self._inflight.get(token) is task:
+            del self._inflight[token]
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if isinstance(exc, HTTPException):
+            # Токен удалён или ключ пропал — не отдаём больше старую подписку
+            self._entries.pop(token, None)
+        elif exc is not None:
+            self._stats["load_errors"] += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._inflight.clear()
+
+    def stats(self) -> dict:
+        s = dict(self._stats)
+        lookups = s["hits"] + s["stale"] + s["misses"]
+        s.update(
+            size=len(self._entries),
+            max_entries=self.max_entries,
+            inflight=len(self._inflight),
+            ttl=SUB_CACHE_TTL,
+            stale_ttl=SUB_CACHE_STALE,
+            hit_ratio=round((s["hits"] + s["stale"]) / lookups, 4) if lookups else 0.0,
+        )
+        return s
+
+
+_CACHE = _SubCache(SUB_CACHE_MAX_ENTRIES)
+
+
+def cache_stats() -> dict:
+    """Счётчики кэша подписок (для админки)."""
+    return _CACHE.stats()
+
+
+# ─────────────────────────────────────────────
+#  Загрузка подписки
+# ─────────────────────────────────────────────
+
+_http: httpx.AsyncClient | None = None
+_http_loop = None
 
+
+def _get_http() -> httpx.AsyncClient:
+    """Общий keep-alive клиент к XUI (один на event loop)."""
+    global _http, _http_loop
+    loop = asyncio.get_running_loop()
+    if _http is None or _http_loop is not loop or _http.is_closed:
+        _http = httpx.AsyncClient(
+            timeout=10,
+            verify=False,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        )
+        _http_loop = loop
+    return _http
+
+
+async def close_http_client():
+    """Закрыть HTTP-клиент к XUI (call on application shutdown)."""
+    global _http
+    client, _http = _http, None
+    if client is not None:
+        await client.aclose()
+
+
+def _pick_vless_key(keys: list[dict]) -> dict | None:
+    """Выбирает VLESS-ключ с непустым subscription_link."""
     vless_keys = [
         k for k in keys
         if k.get("vpn_type") == "vless" and k.get("subscription_link")
@@ -64,76 +214,105 @@ def _pick_vless_key(user: dict) -> dict | None:
 
 async def _fetch_xui(url: str) -> bytes:
     """Получает подписку из XUI."""
-    async with httpx.AsyncClient(timeout=10, verify=False) as client:
-        resp = await client.get(url)
-        resp.raise_for_status()
-        return resp.content
+    resp = await _get_http().get(url)
+    resp.raise_for_status()
+    return resp.content
 
 
-@sub_router.get("/sub/{token}")
-async def proxy_subscription(token: str):
-    """Эндпоинт подписки – проксирует ответ от XUI и склеивает с Hysteria."""
-    user = get_user_by_web_token(token)
-    if not user:
+def _render(raw_body: bytes, h_link: str | None, expires_at: datetime | None) -> bytes:
+    """Склейка с Hysteria и единый remark для всех строк."""
+    try:
+        decoded_sub = base64.b64decode(raw_body).decode('utf-8')
+    except Exception:
+        decoded_sub = raw_body.decode('utf-8')
+
+    if h_link:
+        decoded_sub += "\n" + h_link
+
+    now_dt = datetime.utcnow()
+    status = "✅Active" if expires_at and expires_at > now_dt else "❌Ended"
+    remark = f"🐿️ TIIN vpn | {status}"
+
+    new_lines = []
+    for line in decoded_sub.splitlines():
+        if '#' in line:
+            parts = line.split('#')
+            new_lines.append(f"{'#'.join(parts[:-1])}#{remark}")
+        else:
+            new_lines.append(line)
+    return base64.b64encode("\n".join(new_lines).encode('utf-8'))
+
+
+async def _build_entry(token: str) -> _SubEntry:
+    """БД → XUI → готовый ответ. HTTPException(404) для неизвестных токенов."""
+    bundle = await get_web_bundle_async(token)
+    if not bundle:
         raise HTTPException(status_code=404, detail="Not found")
+    user, keys = bundle
 
-    key = _pick_vless_key(user)
+    key = _pick_vless_key(keys)
     if not key:
         raise HTTPException(status_code=404, detail="No active subscription")
 
-    xui_url = key["subscription_link"]
-    xui_url = key["subscription_link"]
     expires_at = key.get("expires_at")
+    raw_body = await _fetch_xui(key["subscription_link"])
+    h_link = await get_hysteria_link_by_tg_id_async(user['tg_id'])
+    return _SubEntry(_render(raw_body, h_link, expires_at), _build_headers(expires_at))
 
-    headers = _build_headers(expires_at)
-    now = time.time()
-    async with _CACHE_LOCK:
-        cached = _CACHE.get(token)
-        if cached:
-            # cached entry is: (timestamp_float, body, headers)
-            ts = cached[0].timestamp() if isinstance(cached[0], datetime) else cached[0]
-            if (now - ts) < SUB_CACHE_TTL:
-                return Response(content=cached[1], headers=cached[2])
 
-    try:
-        raw_body = await _fetch_xui(xui_url)
-
-        # Store in cache with current timestamp
-        async with _CACHE_LOCK:
-            _CACHE[token] = (now, raw_body, headers)
-
-        # Склейка с Hysteria
-        try:
-            decoded_sub = base64.b64decode(raw_body).decode('utf-8')
-        except:
-            decoded_sub = raw_body.decode('utf-8')
-
-        h_link = get_hysteria_link_by_tg_id(user['tg_id'])
-        if h_link:
-            decoded_sub += "\n" + h_link
-        
-        # Переписываем remark'и
-        now_dt = datetime.utcnow()
-        status = "✅Active" if expires_at and expires_at > now_dt else "❌Ended"
-        remark = f"🐿️ TIIN vpn | {status}"
-        
-        new_lines = []
-        for line in decoded_sub.splitlines():
-            if '#' in line:
-                parts = line.split('#')
-                new_lines.append(f"{'#'.join(parts[:-1])}#{remark}")
-            else:
-                new_lines.append(line)
-        decoded_sub = "\n".join(new_lines)
-        
-        raw_body = base64.b64encode(decoded_sub.encode('utf-8'))
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _respond(entry: _SubEntry, if_none_match: str | None) -> Response:
+    if _etag_matches(if_none_match, entry.etag):
+        _CACHE.count("not_modified")
+        return Response(status_code=304, headers={
+            "ETag": entry.etag,
+            "Cache-Control": entry.headers["Cache-Control"],
+        })
+    return Response(content=entry.body, headers=entry.headers)
+
 
+@sub_router.get("/sub/{token}")
+async def proxy_subscription(
+    token: str,
+    if_none_match: Annotated[str | None, Header()] = None,
+):
+    """Эндпоинт подписки – проксирует ответ от XUI и склеивает с Hysteria."""
+    cached = _CACHE.get(token)
+    if cached is not None:
+        age = cached.age()
+        if age < SUB_CACHE_TTL:
+            _CACHE.count("hits")
+            return _respond(cached, if_none_match)
+        if age < SUB_CACHE_TTL + SUB_CACHE_STALE:
+            _CACHE.count("stale")
+            _CACHE.refresh(token, _build_entry)
+            return _respond(cached, if_none_match)
+
+    _CACHE.count("misses")
+    try:
+        entry = await _CACHE.load(token, _build_entry)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"sub_proxy: XUI fetch failed for {token[:8]}…: {e}")
-        async with _CACHE_LOCK:
-            cached = _CACHE.get(token)
-            if cached:
-                return Response(content=cached[1], headers=cached[2])
+        if cached is not None:
+            _CACHE.count("served_on_error")
+            return _respond(cached, if_none_match)
         raise HTTPException(status_code=503, detail="Upstream unavailable")
 
-    return Response(content=raw_body, headers=headers)
+    return _respond(entry, if_none_match)
+
+
+@sub_router.get("/sub-cache/stats", include_in_schema=False, dependencies=[Depends(require_localhost)])
+async def sub_cache_stats():
+    """Счётчики кэша подписок для админки."""
+    return {**cache_stats(), "web_bundles": web_bundle_cache_stats()}
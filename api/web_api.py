@@ -7,7 +7,7 @@ import secrets
 import uuid
 
 from datetime import datetime
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, EmailStr
 from yookassa import Configuration, Payment
@@ -19,6 +19,8 @@ from config import (
 )
 from bot_xui.tariffs import TARIFFS
 from api.db import execute_query, get_user_by_web_token, get_keys_by_tg_id
+from api import event_buffer
+from api.internal import require_localhost
 
 logger = logging.getLogger(__name__)
 web_api_router = APIRouter(prefix="/api/web")
@@ -304,7 +306,7 @@ async def activate_test(req: TestActivateRequest):
     from api.db import (
         create_vpn_key, update_user_subscription_by_id,
     )
-    from bot_xui.utils import XUIClient, generate_vless_link
+    from bot_xui.utils import AsyncXUIClient, generate_vless_link
     from config import (
         VLESS_DOMAIN, VLESS_PORT, VLESS_PATH,
         VLESS_PBK, VLESS_SID, VLESS_SNI, VLESS_INBOUND_ID,
@@ -347,10 +349,10 @@ async def activate_test(req: TestActivateRequest):
     inbound_id = int(VLESS_INBOUND_ID)
 
     try:
-        xui = XUIClient(XUI_HOST, XUI_USERNAME, XUI_PASSWORD)
+        xui = AsyncXUIClient(XUI_HOST, XUI_USERNAME, XUI_PASSWORD)
         
         # 1. Register VLESS
-        success = xui.add_client(
+        success = await xui.add_client(
             inbound_id=inbound_id,
             email=client_email,
             tg_id=0,
@@ -363,8 +365,8 @@ async def activate_test(req: TestActivateRequest):
             raise RuntimeError("add_vless_client returned False")
         
         # 2. Register Hysteria v2
-        hysteria_inbound_id = xui.get_hysteria_inbound_id()
-        xui.add_client(
+        hysteria_inbound_id = await xui.get_hysteria_inbound_id()
+        await xui.add_client(
             inbound_id=hysteria_inbound_id,
             email=f"{client_email}_h",
             tg_id=0,
@@ -490,22 +492,18 @@ async def track_event(body: SiteEvent, request: Request):
 
     ip = request.headers.get("x-real-ip", request.client.host)
 
-    # For 'visit' — only record once per visitor_id
-    if body.event == "visit":
-        existing = execute_query(
-            "SELECT id FROM site_events WHERE visitor_id=%s AND event_type='visit' LIMIT 1",
-            (body.visitor_id,), fetch='one',
-        )
-        if existing:
-            return {"ok": True, "dup": True}
-
-    execute_query(
-        "INSERT INTO site_events (event_type, visitor_id, ip) VALUES (%s, %s, %s)",
-        (body.event, body.visitor_id, ip),
-    )
+    # For 'visit' — only record once per visitor_id (deduped in event_buffer)
+    if not event_buffer.add_event(body.event, body.visitor_id, ip):
+        return {"ok": True, "dup": True}
     return {"ok": True}
 
 
+@web_api_router.get("/event-stats", include_in_schema=False, dependencies=[Depends(require_localhost)])
+async def event_stats():
+    """Счётчики буфера событий для админки."""
+    return event_buffer.stats()
+
+
 # ─────────────────────────────────────────────
 #  Support contact form
 # ─────────────────────────────────────────────
@@ -13,6 +13,8 @@ from api.db import (
     get_user_by_web_token,
 )
 from api.notifications import create_auth_code, verify_code
+from api import session_cache
+from api.internal import require_localhost
 
 logger = logging.getLogger(__name__)
 auth_router = APIRouter(prefix="/api/auth")
@@ -106,21 +108,22 @@ def _get_current_user(request: Request) -> dict:
         logger.warning(f"Auth failed: missing token from {request.client.host}")
         raise HTTPException(401, "Необходима авторизация")
 
-    session = execute_query(
-        "SELECT user_id FROM auth_sessions WHERE token = %s AND expires_at > NOW()",
-        (token,), fetch='one',
-    )
-    if not session:
-        logger.warning(f"Auth failed: session expired or invalid for token {token[:8]}... from {request.client.host}")
-        raise HTTPException(401, "Сессия истекла")
+    user = session_cache.get(token)
+    if user is not None:
+        return user
 
+    # Сессия и пользователь одним запросом
     user = execute_query(
-        "SELECT * FROM users WHERE id = %s",
-        (session['user_id'],), fetch='one',
+        "SELECT u.*, s.expires_at AS session_expires_at FROM auth_sessions s "
+        "JOIN users u ON u.id = s.user_id "
+        "WHERE s.token = %s AND s.expires_at > NOW()",
+        (token,), fetch='one',
     )
     if not user:
-        logger.error(f"Auth failed: user not found for session user_id={session['user_id']} from {request.client.host}")
-        raise HTTPException(401, "Пользователь не найден")
+        logger.warning(f"Auth failed: session expired or invalid for token {token[:8]}... from {request.client.host}")
+        raise HTTPException(401, "Сессия истекла")
+    session_expires_at = user.pop('session_expires_at', None)
+    session_cache.put(token, user, session_expires_at)
     return user
 
 
@@ -167,6 +170,7 @@ async def verify(req: VerifyRequest, response: Response):
         "ORDER BY created_at DESC LIMIT 9) t)",
         (user['id'], user['id']),
     )
+    session_cache.invalidate_user(user['id'])
 
     # Create session token (30 days)
     session_token = secrets.token_urlsafe(32)
@@ -220,5 +224,12 @@ async def logout(request: Request, response: Response):
             "DELETE FROM auth_sessions WHERE token = %s",
             (token,),
         )
+        session_cache.invalidate_token(token)
         response.delete_cookie("session_token")
     return AuthResponse(ok=True, message="Вы вышли из системы")
+
+
+@auth_router.get("/cache-stats", include_in_schema=False, dependencies=[Depends(require_localhost)])
+async def cache_stats():
+    """Счётчики кэша сессий для админки."""
+    return session_cache.stats()
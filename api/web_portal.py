@@ -9,16 +9,17 @@ import logging
 import struct
 import zlib
 from datetime import datetime
-from io import BytesIO
 
-
-import qrcode
 from fastapi import APIRouter
 from fastapi.responses import HTMLResponse, Response
+import qr_cache
 from config import MTPROTO_SERVER, MTPROTO_PORT, MTPROTO_SECRET
 from awg_api.config import SERVER_ENDPOINT as AWG_SERVER_HOST, LISTEN_PORT as AWG_LISTEN_PORT
 
-from api.db import get_user_by_web_token, get_keys_by_tg_id, get_keys_by_user_id, is_vless_test_activated_by_id
+from api.db import (
+    get_web_bundle_async,
+    is_vless_test_activated_by_id_async,
+)
 from bot_xui.helpers import get_user_sub_url
 
 
@@ -60,12 +61,7 @@ def _conf_to_vpn_link(conf_text: str) -> str:
 
 
 def _generate_qr_base64(data: str) -> str:
-    bio = BytesIO()
-    qr = qrcode.QRCode(version=1, box_size=8, border=4)
-    qr.add_data(data)
-    qr.make(fit=True)
-    qr.make_image(fill_color="black", back_color="white").save(bio, "PNG")
-    return base64.b64encode(bio.getvalue()).decode()
+    return qr_cache.png_base64(data, box_size=8, border=4)
 
 
 def _format_date(dt):
@@ -150,19 +146,14 @@ async def happ_routing_redirect():
 
 @web_router.get("/my/{token}", response_class=HTMLResponse)
 async def personal_page(token: str):
-    user = get_user_by_web_token(token)
-    if not user:
+    bundle = await get_web_bundle_async(token)
+    if not bundle:
         return HTMLResponse(_page_not_found(), status_code=404)
+    user, keys = bundle
 
-    tg_id = user['tg_id']
-    users_id = user['id']
     sub_until = user.get('subscription_until')
     now = datetime.now()
 
-    keys = get_keys_by_tg_id(tg_id) if tg_id else get_keys_by_user_id(users_id)
-
-    if not keys:
-        keys = get_keys_by_user_id(user['id'])
     vless_keys = [k for k in keys if k['vpn_type'] == 'vless' and k.get('subscription_link')]
     active_vless = [k for k in vless_keys if k['expires_at'] and k['expires_at'] > now]
 
@@ -186,7 +177,7 @@ async def personal_page(token: str):
     # sub_url = get_user_sub_url(tg_id, users_id) if active_vless else ""
     # qr_b64 = _generate_qr_base64(sub_url) if sub_url else ""
 
-    test_used = is_vless_test_activated_by_id(user['id'])
+    test_used = await is_vless_test_activated_by_id_async(user['id'])
 
     # AmneziaWG доступен через мастер настройки, если есть активный AWG-ключ
     awg_link = ""
@@ -220,15 +211,12 @@ async def download_awg_config_test(token: str, client_id: str):
 @web_router.get("/my/{token}/awg/{client_id}")
 async def download_awg_config(token: str, client_id: str, full_tunnel: bool = False):
     """Download AmneziaWG .conf file for the given client_id, if it belongs to the user."""
-    user = get_user_by_web_token(token)
-    if not user:
+    bundle = await get_web_bundle_async(token)
+    if not bundle:
         return HTMLResponse(_page_not_found(), status_code=404)
 
     # Verify client_id belongs to this user and get config from DB
-    tg_id = user.get('tg_id')
-    keys = get_keys_by_tg_id(tg_id) if tg_id else []
-    if not keys:
-        keys = get_keys_by_user_id(user['id'])
+    user, keys = bundle
     awg_key = next(
         (k for k in keys if k['vpn_type'] == 'awg' and k.get('client_id') == client_id),
         None,
@@ -262,14 +250,10 @@ async def download_awg_config(token: str, client_id: str, full_tunnel: bool = Fa
 @web_router.get("/my/{token}/awg/{client_id}/download")
 async def download_awg_conf_file(token: str, client_id: str):
     """Download AmneziaWG .conf file for manual import."""
-    user = get_user_by_web_token(token)
-    if not user:
+    bundle = await get_web_bundle_async(token)
+    if not bundle:
         return HTMLResponse(_page_not_found(), status_code=404)
-
-    tg_id = user.get('tg_id')
-    keys = get_keys_by_tg_id(tg_id) if tg_id else []
-    if not keys:
-        keys = get_keys_by_user_id(user['id'])
+    user, keys = bundle
     awg_key = next(
         (k for k in keys if k['vpn_type'] == 'awg' and k.get('client_id') == client_id),
         None,
@@ -5,13 +5,12 @@ import sys
 import httpx
 import logging
 import time
-import sqlite3
+from contextlib import asynccontextmanager
 from ipaddress import ip_address, ip_network
 from datetime import datetime, timezone, timedelta
 from io import BytesIO
 
-import qrcode
-
+import qr_cache
 from config import (
     XUI_HOST, XUI_USERNAME, XUI_PASSWORD, XUI_SUB_PATH,
     VLESS_DOMAIN, VLESS_PORT, VLESS_PATH,
@@ -22,10 +21,7 @@ from config import (
 )
 from api.subscriptions import activate_subscription
 from api.db import (
-    update_payment_status,
     is_payment_processed,
-    claim_payment_for_processing,
-    get_payment_status,
     get_payment_by_id,
     get_or_create_user,
     create_vpn_key,
@@ -33,23 +29,28 @@ from api.db import (
     get_subscription_until,
     get_user_email,
     deactivate_key_by_payment,
-    get_user_by_web_token,
     sync_expiry,
+    get_payment_status_async,
+    get_payment_by_id_async,
+    claim_payment_for_processing_async,
+    update_payment_status_async,
+    get_user_by_web_token_async,
+    close_async_pool,
 )
 from api.wireguard import AmneziaWGClient
 from bot_xui.tariffs import TARIFFS
-from bot_xui.utils import XUIClient, generate_hysteria2_link
+from bot_xui.utils import AsyncXUIClient, generate_hysteria2_link
+from bot_xui import xui_db
 
 logger = logging.getLogger(__name__)
 
 # ─────────────────────────────────────────────
-#  IP rate limiter (in-memory, per-endpoint)
+#  IP rate limiter (per-endpoint, see api/rate_limit.py)
 # ─────────────────────────────────────────────
-from collections import defaultdict
-import threading
-
-_rate_lock = threading.Lock()
-_rate_buckets: dict[str, dict[str, list[float]]] = defaultdict(lambda: defaultdict(list))
+from api.rate_limit import RateLimiter, make_backend
+from api.mail_queue import MailSender
+from api import event_buffer
+from config import RATE_LIMIT_DB
 
 RATE_LIMITS = {
     "/api/auth/send-code": (5, 300),      # 5 requests per 5 min
@@ -61,45 +62,28 @@ RATE_LIMITS = {
     "/api/web/event": (30, 60),           # 30 per minute — prevent DB flooding
 }
 
+_rate_limiter = RateLimiter(RATE_LIMITS, make_backend(RATE_LIMIT_DB))
 
-_rate_last_purge = 0.0
 
 def _check_rate_limit(ip: str, path: str) -> bool:
     """Returns True if request is allowed, False if rate-limited."""
-    limit_cfg = None
-    for prefix, cfg in RATE_LIMITS.items():
-        if path == prefix or path.startswith(prefix):
-            limit_cfg = cfg
-            break
-    if not limit_cfg:
-        return True
+    return _rate_limiter.check(ip, path)
 
-    max_req, window = limit_cfg
-    now = time.time()
-    with _rate_lock:
-        # Periodically purge stale IPs (every 10 minutes)
-        global _rate_last_purge
-        if now - _rate_last_purge > 600:
-            _rate_last_purge = now
-            max_window = max(w for _, w in RATE_LIMITS.values())
-            for p in list(_rate_buckets.keys()):
-                for k in list(_rate_buckets[p].keys()):
-                    _rate_buckets[p][k] = [t for t in _rate_buckets[p][k] if now - t < max_window]
-                    if not _rate_buckets[p][k]:
-                        del _rate_buckets[p][k]
-                if not _rate_buckets[p]:
-                    del _rate_buckets[p]
-
-        bucket = _rate_buckets[path][ip]
-        # Purge old entries
-        _rate_buckets[path][ip] = bucket = [t for t in bucket if now - t < window]
-        if len(bucket) >= max_req:
-            return False
-        bucket.append(now)
-    return True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    mail_sender = MailSender()
+    mail_sender.start()
+    event_buffer.start()
+    yield
+    # Shutdown
+    await event_buffer.stop()
+    await mail_sender.stop()
+    await close_async_pool()
+    await close_sub_http_client()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 
 @app.middleware("http")
@@ -127,7 +111,7 @@ app.add_middleware(
 from api.web_portal import web_router
 from api.web_api import web_api_router
 from api.web_auth import auth_router
-from api.sub_proxy import sub_router
+from api.sub_proxy import sub_router, close_http_client as close_sub_http_client
 app.include_router(web_router)
 app.include_router(web_api_router)
 app.include_router(auth_router)
@@ -152,8 +136,8 @@ _PIXEL = _b64.b64decode("R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA
 
 @app.get("/t/{track_id}.gif")
 async def email_open_track(track_id: str):
-    from api.db import execute_query as _eq
-    _eq("UPDATE email_opens SET opened_at = NOW() WHERE track_id = %s AND opened_at IS NULL", (track_id,))
+    if len(track_id) <= 64:
+        event_buffer.add_open(track_id)
     return Response(content=_PIXEL, media_type="image/gif", headers={"Cache-Control": "no-store"})
 
 # ===== Белые IP ЮKassa =====
@@ -225,30 +209,25 @@ async def amnezia_get_config(client: httpx.AsyncClient, client_id: str) -> str:
     r.raise_for_status()
     return r.text
 
-def deactivate_xui_client(client_name: str) -> bool:
+async def deactivate_xui_client(client_name: str) -> bool:
     """Деактивирует клиента в 3x-ui по email (client_name)."""
     try:
-        xui = XUIClient(XUI_HOST, XUI_USERNAME, XUI_PASSWORD)
-        info = xui.get_client_by_email(client_name)
+        xui = AsyncXUIClient(XUI_HOST, XUI_USERNAME, XUI_PASSWORD)
+        info = await xui.get_client_by_email(client_name)
         if not info:
             logger.warning(f"XUI client not found: {client_name}")
             return False
-        return xui.deactivate_client(info['inbound_id'], info['client'])
+        return await xui.deactivate_client(info['inbound_id'], info['client'])
     except Exception as e:
         logger.error(f"Error deactivating XUI client {client_name}: {e}")
         return False
 
 
 def get_subid_from_xui_db(client_email: str) -> str | None:
-    """Получает subId клиента из базы данных 3x-ui."""
-    db_path = "/etc/x-ui/x-ui.db"
+    """Получает subId клиента из базы данных 3x-ui (read-only зеркало, индекс по email)."""
     try:
-        conn = sqlite3.connect(db_path)
-        cur = conn.cursor()
-        cur.execute("SELECT subId FROM client_traffics WHERE email = ?", (client_email,))
-        row = cur.fetchone()
-        conn.close()
-        return row[0] if row else None
+        client = xui_db.snapshot(fresh=True).client(client_email)
+        return (client or {}).get("subId") or None
     except Exception as e:
         logger.error(f"Failed to get subId from DB: {e}")
         return None
@@ -269,7 +248,7 @@ async def process_refund(payment_id: str) -> bool:
             return False
 
         # Деактивируем в XUI
-        xui_success = deactivate_xui_client(client_name)
+        xui_success = await deactivate_xui_client(client_name)
         if not xui_success:
             logger.error(f"Failed to deactivate XUI client: {client_name}")
             return False
@@ -340,10 +319,10 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
             logger.info("🟢 Creating VLESS config via 3x-ui")
             
             import uuid
-            from bot_xui.utils import XUIClient, generate_vless_link
+            from bot_xui.utils import generate_vless_link
             
             # Инициализируем 3x-ui клиент
-            xui = XUIClient(
+            xui = AsyncXUIClient(
                 XUI_HOST,
                 XUI_USERNAME,
                 XUI_PASSWORD
@@ -352,8 +331,8 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
             # Генерируем UUID для клиента
             client_id = str(uuid.uuid4())
             
-            inbound_id = xui.get_vless_reality_inbound_id(fallback_id=int(VLESS_INBOUND_ID))
-            hysteria_inbound_id = xui.get_hysteria_inbound_id()
+            inbound_id = await xui.get_vless_reality_inbound_id(fallback_id=int(VLESS_INBOUND_ID))
+            hysteria_inbound_id = await xui.get_hysteria_inbound_id()
             
             # Время истечения — 23:59:59 Tokyo последнего дня
             duration_days = TARIFFS[tariff_key].get('days', 30)
@@ -365,7 +344,7 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
             # ===== Создаем/продлеваем клиента в 3x-ui (VLESS) =====
             sub_id = None
             if tg_id and tg_id != 0:
-                existing = xui.get_client_by_tg_id(tg_id)
+                existing = await xui.get_client_by_tg_id(tg_id)
                 if existing:
                     client_id = existing['client']['id']
                     sub_id = existing['client'].get('subId')
@@ -375,7 +354,7 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
                 now_ms = int(_time.time() * 1000)
                 duration_ms = duration_days * 86400 * 1000
                 extend_ms = duration_ms if existing else None
-                res_vless = xui.add_or_extend_client(
+                res_vless = await xui.add_or_extend_client(
                     inbound_id=inbound_id,
                     email=client_name,
                     tg_id=tg_id,
@@ -389,11 +368,11 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
                 success = bool(res_vless)
                 if not sub_id:
                     # After add, try to find sub_id
-                    updated = xui.get_client_by_tg_id(tg_id)
+                    updated = await xui.get_client_by_tg_id(tg_id)
                     sub_id = updated['client'].get('subId') if updated else None
             else:
                 # Web user without tg_id — check for existing client by email
-                existing_web = xui.get_client_by_email(client_name)
+                existing_web = await xui.get_client_by_email(client_name)
                 if existing_web:
                     client_id = existing_web['client']['id']
                     sub_id = existing_web['client'].get('subId')
@@ -401,14 +380,14 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
                     import time as _time
                     now_ms = int(_time.time() * 1000)
                     duration_ms = expiry_time - now_ms
-                    success = bool(xui.extend_client_expiry(
+                    success = bool(await xui.extend_client_expiry(
                         existing_web['inbound_id'],
                         existing_web['client'],
                         duration_ms,
                     ))
                 else:
                     logger.info(f"Web user (no tg_id), creating new VLESS client")
-                    res_add = xui.add_client(
+                    res_add = await xui.add_client(
                         inbound_id=inbound_id,
                         email=client_name,
                         tg_id=0,
@@ -427,13 +406,13 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
             # Мы используем тот же client_id (UUID) и sub_id
             # Используем суффикс _h для уникальности email
             hysteria_email = f"{client_name}_h"
-            existing_hysteria = xui.get_client_by_email(hysteria_email)
+            existing_hysteria = await xui.get_client_by_email(hysteria_email)
             
             if existing_hysteria and existing_hysteria['inbound_id'] == hysteria_inbound_id:
                 import time as _time
                 now_ms = int(_time.time() * 1000)
                 duration_ms = duration_days * 86400 * 1000
-                hyst_result = xui.extend_client_expiry(
+                hyst_result = await xui.extend_client_expiry(
                     hysteria_inbound_id,
                     existing_hysteria['client'],
                     duration_ms
@@ -442,7 +421,7 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
                     raise RuntimeError(f"Failed to extend Hysteria client {hysteria_email}")
                 logger.info(f"Hysteria client {hysteria_email} extended to {hyst_result}")
             else:
-                hyst_add = xui.add_client(
+                hyst_add = await xui.add_client(
                     inbound_id=hysteria_inbound_id,
                     email=hysteria_email,
                     tg_id=tg_id,
@@ -507,14 +486,7 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
                 # user_sub_url = sub_url
 
             # Создаем QR код из прокси-URL
-            qr = qrcode.QRCode(version=1, box_size=10, border=5)
-            qr.add_data(user_sub_url)
-            qr.make(fit=True)
-            img = qr.make_image(fill_color="black", back_color="white")
-
-            bio = BytesIO()
-            img.save(bio, 'PNG')
-            bio.seek(0)            
+            bio = qr_cache.png_io(user_sub_url, box_size=10, border=5)
             
         elif vpn_type == "softether":
             # ========== SoftEther ==========
@@ -612,7 +584,7 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
         # single source of truth and re-sync 3x-ui.
         if vpn_type == "vless" and subscription_until and tg_id and tg_id != 0:
             sub_until_ms = int(subscription_until.replace(tzinfo=timezone.utc).timestamp() * 1000) if subscription_until.tzinfo is None else int(subscription_until.timestamp() * 1000)
-            existing_xui = xui.get_client_by_tg_id(tg_id)
+            existing_xui = await xui.get_client_by_tg_id(tg_id)
             if existing_xui:
                 updated_client = {**existing_xui['client'], 'expiryTime': sub_until_ms}
                 if not updated_client.get('flow'):
@@ -622,12 +594,13 @@ async def process_successful_payment(payment_id: str, payment_data: dict, vpn_ty
                     "id": existing_xui['inbound_id'],
                     "settings": _json.dumps({"clients": [updated_client]})
                 }
-                xui._request(
+                await xui._request(
                     "POST",
                     f"{xui.host}/XhU5cXVfMCyHzAXlrT/api/inbounds/updateClient/{existing_xui['client']['id']}",
                     json=payload,
                     headers={"Content-Type": "application/json"}
                 )
+                xui.invalidate_inbounds()
                 logger.info(f"Re-synced 3x-ui expiry to {subscription_until}")
 
         # ===== 7. Сохранение в БД (UPSERT: обновляем существующий ключ или создаём новый) =====
@@ -925,7 +898,7 @@ async def yookassa_webhook(request: Request):
         logger.info(f"💸 Refund received: {payment_id}, amount: {amount_value} {amount_currency}")
         
         # Обновляем статус платежа в БД
-        update_payment_status(payment_id, "refunded")
+        await update_payment_status_async(payment_id, "refunded")
         
         # Деактивируем VPN конфиг пользователя
         success = await process_refund(payment_id)
@@ -944,7 +917,7 @@ async def yookassa_webhook(request: Request):
         return Response(status_code=200)
     
     # ===== 4. Проверка существования платежа =====
-    current_status = get_payment_status(payment_id)
+    current_status = await get_payment_status_async(payment_id)
     if not current_status:
         logger.warning(f"⚠️ Unknown payment_id: {payment_id}")
         return {"status": "ignored"}
@@ -968,7 +941,7 @@ async def yookassa_webhook(request: Request):
         return {"status": "no_change"}
     
     # ===== 8. Получение данных платежа =====
-    payment_data = get_payment_by_id(payment_id)
+    payment_data = await get_payment_by_id_async(payment_id)
     if not payment_data:
         logger.error(f"❌ Payment data not found: {payment_id}")
         return Response(status_code=404)
@@ -976,7 +949,7 @@ async def yookassa_webhook(request: Request):
     # ===== 9. ⭐ ОБРАБОТКА УСПЕШНОГО ПЛАТЕЖА ⭐ =====
     if current_status == "pending" and new_status == "paid":
         # Atomically claim payment — only one concurrent webhook wins
-        if not claim_payment_for_processing(payment_id):
+        if not await claim_payment_for_processing_async(payment_id):
             logger.info(f"🔁 Payment already claimed by another request: {payment_id}")
             return Response(status_code=200)
 
@@ -985,12 +958,12 @@ async def yookassa_webhook(request: Request):
         stored_amount = float(payment_data.get("amount") or 0)
         if stored_amount > 0 and abs(webhook_amount - stored_amount) > 0.01:
             logger.error(f"❌ Amount mismatch: webhook={webhook_amount}, stored={stored_amount}, payment={payment_id}")
-            update_payment_status(payment_id, "pending")  # revert claim
+            await update_payment_status_async(payment_id, "pending")  # revert claim
             return Response(status_code=400)
 
         # Для веб-заказов: привязать tg_id и user_id из users если есть
         if is_web_order and web_token:
-            web_user = get_user_by_web_token(web_token) if web_token else None
+            web_user = await get_user_by_web_token_async(web_token) if web_token else None
             if web_user:
                 tg_id = int(web_user.get('tg_id') or 0)
                 payment_data = {**payment_data, 'tg_id': tg_id, '_web_user_id': web_user['id']}
@@ -1054,7 +1027,7 @@ async def yookassa_webhook(request: Request):
 
         if not success:
             logger.error(f"❌ Failed to process payment {payment_id}")
-            update_payment_status(payment_id, "pending")  # revert so YooKassa retries
+            await update_payment_status_async(payment_id, "pending")  # revert so YooKassa retries
             if tg_id:
                 await send_telegram_notification(
                     tg_id,
@@ -1079,7 +1052,7 @@ async def yookassa_webhook(request: Request):
         logger.info(f"💾 Payment claimed and processed: {payment_id} -> paid")
     elif new_status == "canceled":
         # ===== 10. Обновление статуса отмены =====
-        update_payment_status(payment_id, new_status)
+        await update_payment_status_async(payment_id, new_status)
         logger.info(f"💾 Payment status updated: {payment_id} -> {new_status}")
     else:
         logger.info(f"ℹ️ Ignoring status transition: {payment_id} {current_status} -> {new_status}")
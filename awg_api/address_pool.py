@@ -0,0 +1,140 @@
+"""Client address allocator for awg0.
+
+Addresses come from the CIDRs in AWG_ADDRESS_POOLS (e.g. "10.10.0.0/16" or
+"10.10.0.0/24,10.20.0.0/22"). The network, broadcast and first host of every
+pool (the server's own address) are never handed out.
+
+Allocation state is one bitmap over all pools plus a FIFO free-list of
+released addresses, loaded from the DB once per process. allocate() is
+O(1) amortized: recycled addresses first, then a forward scan that
+bytearray.find() does in C. Cross-process races are settled by the UNIQUE
+index on awg_clients.address — on a duplicate we mark the address used and
+take the next one.
+"""
+import ipaddress
+import logging
+import threading
+from collections import deque
+
+import mysql.connector
+
+from . import db
+from .config import AWG_ADDRESS_POOLS
+
+logger = logging.getLogger(__name__)
+
+CREATE_RETRIES = 16
+
+
+class AddressPool:
+    def __init__(self, networks: list[str]):
+        self.networks = [ipaddress.ip_network(n, strict=False) for n in networks]
+        if not self.networks:
+            raise ValueError("At least one address pool is required")
+        self._ranges = []   # (network, first int, flat offset)
+        offset = 0
+        for net in self.networks:
+            self._ranges.append((net, int(net.network_address), offset))
+            offset += net.num_addresses
+        self._used = bytearray(offset)
+        self._reserved = set()
+        for net, _, base in self._ranges:
+            reserved = [0, 1] if net.num_addresses > 2 else []
+            if net.num_addresses > 2:
+                reserved.append(net.num_addresses - 1)
+            for i in reserved:
+                self._used[base + i] = 1
+                self._reserved.add(base + i)
+        self._free = deque()
+        self._cursor = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"AddressPool({', '.join(map(str, self.networks))})"
+
+    def _index(self, address: str) -> int | None:
+        try:
+            ip = ipaddress.ip_address(address.split("/")[0])
+        except ValueError:
+            return None
+        for net, first, base in self._ranges:
+            if ip in net:
+                return base + int(ip) - first
+        return None
+
+    def _address(self, idx: int) -> str:
+        for net, first, base in reversed(self._ranges):
+            if idx >= base:
+                return str(ipaddress.ip_address(first + idx - base))
+        raise IndexError(idx)
+
+    def allocate(self) -> str:
+        with self._lock:
+            while self._free:
+                idx = self._free.popleft()
+                if not self._used[idx]:
+                    self._used[idx] = 1
+                    return self._address(idx)
+            idx = self._used.find(0, self._cursor)
+            if idx < 0:
+                raise RuntimeError(f"No free addresses in {', '.join(map(str, self.networks))}")
+            self._used[idx] = 1
+            self._cursor = idx + 1
+            return self._address(idx)
+
+    def mark_used(self, address: str):
+        idx = self._index(address)
+        if idx is not None:
+            with self._lock:
+                self._used[idx] = 1
+
+    def release(self, address: str):
+        """Return an address to the pool; unknown/reserved addresses are ignored."""
+        idx = self._index(address)
+        if idx is None or idx in self._reserved:
+            return
+        with self._lock:
+            if self._used[idx]:
+                self._used[idx] = 0
+                self._free.append(idx)
+
+    def stats(self) -> dict:
+        with self._lock:
+            size = len(self._used) - len(self._reserved)
+            used = self._used.count(1) - len(self._reserved)
+        return {"pools": [str(n) for n in self.networks], "size": size, "used": used}
+
+
+_pool: AddressPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> AddressPool:
+    """Process-wide pool, seeded from awg_clients on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = AddressPool(AWG_ADDRESS_POOLS)
+            for addr in db.list_addresses():
+                pool.mark_used(addr)
+            _pool = pool
+            logger.info(f"AWG address pool loaded: {pool.stats()}")
+        return _pool
+
+
+def create_client(name: str, private_key: str, public_key: str, preshared_key: str) -> dict:
+    """Allocate an address and insert the client; retries if another writer took it."""
+    pool = get_pool()
+    for _ in range(CREATE_RETRIES):
+        address = pool.allocate()
+        try:
+            return db.create_client(name, address, private_key, public_key, preshared_key)
+        except mysql.connector.IntegrityError as e:
+            if "idx_address" not in str(e):
+                pool.release(address)
+                raise
+            logger.warning(f"Address {address} already taken, trying next")
+        except Exception:
+            pool.release(address)
+            raise
+    raise RuntimeError("Could not allocate a free address")
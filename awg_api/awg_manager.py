@@ -2,12 +2,13 @@
 import logging
 import subprocess
 import tempfile
+import threading
 from typing import Optional
 
-from . import db
+from . import db, peer_stats
 from .config import (
-    AWG_INTERFACE, AWG_CONF_PATH, SERVER_ADDRESS, SERVER_ENDPOINT,
-    LISTEN_PORT, DNS, MTU, KEEPALIVE, ALLOWED_IPS,
+    AWG_INTERFACE, AWG_CONF_PATH, AWG_ADDRESS_POOLS, SERVER_ADDRESS, SERVER_ENDPOINT,
+    LISTEN_PORT, DNS, MTU, KEEPALIVE, ALLOWED_IPS, CONF_WRITE_DELAY,
 )
 
 logger = logging.getLogger(__name__)
@@ -91,12 +92,15 @@ def write_server_conf():
     listen_port = int(srv['listen_port'])  # ensure integer
     private_key = _sanitize_config_value(srv['private_key'])
 
+    nat_up = " ".join(f"iptables -t nat -A POSTROUTING -s {n} -o ens3 -j MASQUERADE;" for n in AWG_ADDRESS_POOLS)
+    nat_down = " ".join(f"iptables -t nat -D POSTROUTING -s {n} -o ens3 -j MASQUERADE;" for n in AWG_ADDRESS_POOLS)
+
     conf = f"""[Interface]
 PrivateKey = {private_key}
 Address = {SERVER_ADDRESS}
 ListenPort = {listen_port}
-PostUp = iptables -t nat -A POSTROUTING -s 10.10.0.0/24 -o ens3 -j MASQUERADE; iptables -A INPUT -p udp -m udp --dport {listen_port} -j ACCEPT; iptables -A FORWARD -i {AWG_INTERFACE} -j ACCEPT; iptables -A FORWARD -o {AWG_INTERFACE} -j ACCEPT;
-PostDown = iptables -t nat -D POSTROUTING -s 10.10.0.0/24 -o ens3 -j MASQUERADE; iptables -D INPUT -p udp -m udp --dport {listen_port} -j ACCEPT; iptables -D FORWARD -i {AWG_INTERFACE} -j ACCEPT; iptables -D FORWARD -o {AWG_INTERFACE} -j ACCEPT;
+PostUp = {nat_up} iptables -A INPUT -p udp -m udp --dport {listen_port} -j ACCEPT; iptables -A FORWARD -i {AWG_INTERFACE} -j ACCEPT; iptables -A FORWARD -o {AWG_INTERFACE} -j ACCEPT;
+PostDown = {nat_down} iptables -D INPUT -p udp -m udp --dport {listen_port} -j ACCEPT; iptables -D FORWARD -i {AWG_INTERFACE} -j ACCEPT; iptables -D FORWARD -o {AWG_INTERFACE} -j ACCEPT;
 {awg_params}
 """
 
@@ -176,11 +180,10 @@ def reload_interface():
             if c.get("enabled")
         }
         if expected_peers:
-            show = subprocess.run(
-                ["awg", "show", AWG_INTERFACE, "peers"],
-                capture_output=True, text=True, check=False,
-            )
-            active_peers = set(show.stdout.strip().splitlines())
+            try:
+                active_peers = set(peer_stats.peers_by_key())
+            except peer_stats.PeerStatsUnavailable:
+                active_peers = set()
             missing = expected_peers - active_peers
             if missing:
                 logger.warning(
@@ -197,6 +200,108 @@ def reload_interface():
             subprocess.run(["rm", "-f", tmp_path], check=False)
 
 
+# ─────────────────────────────────────────────
+#  Incremental peer apply
+# ─────────────────────────────────────────────
+# Single-client changes go straight to the live interface with `awg set`
+# (O(1), existing sessions untouched); awg0.conf is rewritten in the
+# background, coalescing bursts of changes into one write. Full syncconf
+# is left to periodic reconciliation (reload_interface).
+
+_conf_lock = threading.Lock()
+_conf_timer: threading.Timer | None = None
+_conf_dirty = False
+
+
+def set_peer(client: dict):
+    """Add or update one peer on the running interface."""
+    addr = _validate_address(client["address"])
+    # PSK передаём через stdin, чтобы не светить его в argv и не писать во временный файл
+    subprocess.run(
+        ["awg", "set", AWG_INTERFACE, "peer", client["public_key"],
+         "preshared-key", "/dev/stdin", "allowed-ips", f"{addr}/32"],
+        input=client["preshared_key"], capture_output=True, text=True, check=True,
+    )
+
+
+def remove_peer(public_key: str):
+    """Remove one peer from the running interface."""
+    _run(["awg", "set", AWG_INTERFACE, "peer", public_key, "remove"])
+
+
+def apply_client(client: dict | None = None, removed_key: str | None = None):
+    """Push one client change to awg0 and schedule a config write.
+
+    client      — current DB row (enabled → set, disabled → remove)
+    removed_key — public key of a deleted client
+    """
+    try:
+        if removed_key:
+            remove_peer(removed_key)
+        elif client and client.get("enabled"):
+            set_peer(client)
+        elif client:
+            remove_peer(client["public_key"])
+    except subprocess.CalledProcessError as e:
+        if is_interface_up():
+            logger.warning(f"awg set failed ({(e.stderr or '').strip()}), falling back to full reload")
+            write_server_conf()
+            reload_interface()
+            return
+        # Интерфейс лежит — конфиг подхватится при awg-quick up
+    schedule_conf_write()
+
+
+def schedule_conf_write(delay: float = CONF_WRITE_DELAY):
+    """Rewrite awg0.conf after `delay` seconds; repeated calls coalesce."""
+    global _conf_timer, _conf_dirty
+    with _conf_lock:
+        _conf_dirty = True
+        if _conf_timer is not None:
+            return
+        _conf_timer = threading.Timer(delay, _write_scheduled)
+        _conf_timer.daemon = True
+        _conf_timer.start()
+
+
+def _write_scheduled():
+    global _conf_timer, _conf_dirty
+    with _conf_lock:
+        _conf_timer = None
+        if not _conf_dirty:
+            return
+        _conf_dirty = False
+    try:
+        write_server_conf()
+    except Exception as e:
+        logger.error(f"Deferred config write failed: {e}")
+        with _conf_lock:
+            _conf_dirty = True
+
+
+def flush_conf_write():
+    """Write a pending config now (shutdown, before reconciliation)."""
+    global _conf_timer
+    with _conf_lock:
+        if _conf_timer is not None:
+            _conf_timer.cancel()
+            _conf_timer = None
+    _write_scheduled()
+
+
+def reconcile():
+    """Periodic full sync: rewrite awg0.conf from the DB and syncconf it."""
+    global _conf_timer, _conf_dirty
+    with _conf_lock:
+        if _conf_timer is not None:
+            _conf_timer.cancel()
+            _conf_timer = None
+        _conf_dirty = False
+    write_server_conf()
+    if is_interface_up():
+        reload_interface()
+
+
 def interface_up():
     """Bring up awg0 interface."""
     _run(["awg-quick", "up", AWG_INTERFACE])
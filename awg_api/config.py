@@ -1,4 +1,5 @@
 """AWG 2.0 API configuration."""
+import ipaddress
 import os
 from dotenv import load_dotenv
 
@@ -12,14 +13,26 @@ if not API_PASSWORD:
 # Network
 AWG_INTERFACE = "awg0"
 AWG_CONF_PATH = "/etc/amnezia/amneziawg/awg0.conf"
-SERVER_ADDRESS = "10.10.0.1/24"
-NETWORK_PREFIX = "10.10.0."
+# Client address pools, comma-separated CIDRs (e.g. "10.10.0.0/16" or
+# "10.10.0.0/24,10.20.0.0/22"). The first host of each pool is the server.
+AWG_ADDRESS_POOLS = [
+    n.strip() for n in os.getenv("AWG_ADDRESS_POOLS", "10.10.0.0/24").split(",") if n.strip()
+]
+SERVER_ADDRESS = ", ".join(
+    f"{net[1]}/{net.prefixlen}"
+    for net in (ipaddress.ip_network(n, strict=False) for n in AWG_ADDRESS_POOLS)
+)
 SERVER_ENDPOINT = os.getenv("WG_HOST", "91.132.161.112")
 LISTEN_PORT = int(os.getenv("WG_PORT", "51888"))
 DNS = os.getenv("WG_DEFAULT_DNS", "1.1.1.1,8.8.8.8")
 MTU = int(os.getenv("WG_MTU", "1360"))
 KEEPALIVE = int(os.getenv("WG_PERSISTENT_KEEPALIVE", "25"))
 
+# awg0.conf is rewritten this many seconds after the last peer change;
+# a full syncconf runs every AWG_RECONCILE_INTERVAL seconds
+CONF_WRITE_DELAY = float(os.getenv("AWG_CONF_WRITE_DELAY", "2"))
+AWG_RECONCILE_INTERVAL = int(os.getenv("AWG_RECONCILE_INTERVAL", "900"))
+
 # AllowedIPs for clients (split-tunnel)
 ALLOWED_IPS = os.getenv("WG_ALLOWED_IPS", "0.0.0.0/0")
 
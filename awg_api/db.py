@@ -4,7 +4,7 @@ import uuid
 from datetime import datetime, timezone
 from typing import Optional
 
-import mysql.connector
+from db_pool import get_pool
 
 from .config import MYSQL_HOST, MYSQL_PORT, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DATABASE
 
@@ -49,11 +49,13 @@ CREATE TABLE IF NOT EXISTS awg_server (
 
 
 def _get_conn():
-    return mysql.connector.connect(
+    """Checkout from the shared 'awg' pool; conn.close() returns it."""
+    return get_pool(
+        "awg",
         host=MYSQL_HOST, port=MYSQL_PORT,
         user=MYSQL_USER, password=MYSQL_PASSWORD,
         database=MYSQL_DATABASE,
-    )
+    ).get_connection()
 
 
 def init_db():
@@ -129,13 +131,15 @@ def create_client(name: str, address: str, private_key: str, public_key: str, pr
     now = datetime.now(timezone.utc)
     conn = _get_conn()
     cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO awg_clients (id, name, address, private_key, public_key, preshared_key, enabled, created_at, updated_at)
-        VALUES (%s, %s, %s, %s, %s, %s, 1, %s, %s)
-    """, (client_id, name, address, private_key, public_key, preshared_key, now, now))
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        cur.execute("""
+            INSERT INTO awg_clients (id, name, address, private_key, public_key, preshared_key, enabled, created_at, updated_at)
+            VALUES (%s, %s, %s, %s, %s, %s, 1, %s, %s)
+        """, (client_id, name, address, private_key, public_key, preshared_key, now, now))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
     return {
         "id": client_id, "name": name, "address": address,
         "private_key": private_key, "public_key": public_key,
@@ -188,16 +192,11 @@ def update_client_address(client_id: str, address: str) -> bool:
     return affected > 0
 
 
-def next_free_address() -> str:
-    """Find next free IP in 10.10.0.0/24 (skip .1 = server)."""
+def list_addresses() -> list[str]:
     conn = _get_conn()
     cur = conn.cursor()
     cur.execute("SELECT address FROM awg_clients")
-    used = {r[0] for r in cur.fetchall()}
+    rows = [r[0] for r in cur.fetchall()]
     cur.close()
     conn.close()
-    for i in range(2, 255):
-        addr = f"10.10.0.{i}"
-        if addr not in used:
-            return addr
-    raise RuntimeError("No free addresses in 10.10.0.0/24")
+    return rows
@@ -10,16 +10,17 @@ import random
 import secrets
 from contextlib import asynccontextmanager
 from datetime import datetime, timezone
-from io import BytesIO
 
 import os
 
-import qrcode
 from fastapi import FastAPI, Request, Response, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.responses import PlainTextResponse, JSONResponse
 
-from . import db, awg_manager
-from admin.routes import router as admin_router, get_admin_page_route, _admin_ws_connections, _ws_authenticate, _broadcast_ws, _get_online_users
+from . import db, awg_manager, address_pool
+from .config import AWG_RECONCILE_INTERVAL
+from admin import access_log
+import qr_cache
+from admin.routes import router as admin_router, get_admin_page_route, _admin_ws_connections, _ws_authenticate, _broadcast_ws, presence, _serialize
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
 logger = logging.getLogger("awg_api")
@@ -80,24 +81,59 @@ def _client_to_json(c: dict) -> dict:
 
 
 _broadcast_task: asyncio.Task | None = None
+_reconcile_task: asyncio.Task | None = None
 
 
 async def _periodic_broadcast():
-    """Push online user snapshot to all WS clients every 10 seconds."""
+    """Forward presence diffs to all WS clients (engine refreshes every 10 seconds).
+
+    Runs only while at least one admin WS is connected: the subscription is what
+    keeps PresenceEngine recomputing, so with no open tabs there is no work.
+    """
+    queue = presence.subscribe()
+    try:
+        while True:
+            msg = await queue.get()
+            if not _admin_ws_connections:
+                continue
+            try:
+                if msg["type"] == "resync":
+                    msg = presence.snapshot.as_message()
+                await _broadcast_ws(msg)
+            except Exception as e:
+                logger.warning(f"broadcast error: {e}")
+    finally:
+        presence.unsubscribe(queue)
+
+
+def _ensure_broadcaster():
+    global _broadcast_task
+    if _broadcast_task is None or _broadcast_task.done():
+        _broadcast_task = asyncio.create_task(_periodic_broadcast())
+        logger.info("WS broadcast task started")
+
+
+def _stop_broadcaster_if_idle():
+    global _broadcast_task
+    if not _admin_ws_connections and _broadcast_task is not None:
+        _broadcast_task.cancel()
+        _broadcast_task = None
+        logger.info("WS broadcast task stopped (no admin connections)")
+
+
+async def _periodic_reconcile():
+    """Full awg0.conf rewrite + syncconf; catches drift missed by incremental applies."""
     while True:
-        await asyncio.sleep(10)
-        if not _admin_ws_connections:
-            continue
+        await asyncio.sleep(AWG_RECONCILE_INTERVAL)
         try:
-            online, _ = _get_online_users()
-            await _broadcast_ws({"type": "online", "data": online})
+            await asyncio.to_thread(awg_manager.reconcile)
         except Exception as e:
-            logger.warning(f"broadcast error: {e}")
+            logger.warning(f"AWG reconcile error: {e}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global _broadcast_task
+    global _broadcast_task, _reconcile_task
     # Startup
     logger.info("Starting AWG 2.0 API")
     db.init_db()
@@ -120,13 +156,20 @@ async def lifespan(app: FastAPI):
         db.save_server_config(cfg)
         logger.info(f"Server config created: pub={pub}")
 
-    _broadcast_task = asyncio.create_task(_periodic_broadcast())
-    logger.info("WS broadcast task started")
+    # xray access log follower for the admin online view (first read off the loop)
+    await asyncio.to_thread(access_log.get_tailer)
+
+    presence.start()
+    _reconcile_task = asyncio.create_task(_periodic_reconcile())
 
     yield
     # Shutdown
     if _broadcast_task:
         _broadcast_task.cancel()
+    if _reconcile_task:
+        _reconcile_task.cancel()
+    await asyncio.to_thread(awg_manager.flush_conf_write)
+    await presence.stop()
     logger.info("AWG 2.0 API shutting down")
 
 
@@ -142,14 +185,12 @@ async def admin_websocket(websocket: WebSocket):
 
     await websocket.accept()
     _admin_ws_connections.add(websocket)
+    _ensure_broadcaster()
 
-    # Send initial snapshot
+    # Send initial snapshot; later updates arrive as online_diff
     try:
-        online, _ = _get_online_users()
-        await websocket.send_text(json.dumps({
-            "type": "online",
-            "data": online,
-        }))
+        snap = await presence.get()
+        await websocket.send_text(json.dumps(snap.as_message(), default=_serialize))
     except Exception:
         pass
 
@@ -159,10 +200,17 @@ async def admin_websocket(websocket: WebSocket):
             msg = json.loads(data)
             if msg.get("type") == "ping":
                 await websocket.send_text(json.dumps({"type": "pong"}))
+            elif msg.get("type") == "resync":
+                # Client missed a diff (version gap) — send the full snapshot
+                snap = await presence.get()
+                await websocket.send_text(json.dumps(snap.as_message(), default=_serialize))
     except WebSocketDisconnect:
-        _admin_ws_connections.discard(websocket)
+        pass
     except Exception:
+        pass
+    finally:
         _admin_ws_connections.discard(websocket)
+        _stop_broadcaster_if_idle()
 
 
 app.include_router(admin_router)
@@ -204,14 +252,10 @@ async def create_client(request: Request):
 
     priv, pub = awg_manager.generate_keypair()
     psk = awg_manager.generate_preshared_key()
-    address = db.next_free_address()
-
-    client = db.create_client(name, address, priv, pub, psk)
+    client = address_pool.create_client(name, priv, pub, psk)
 
-    # Regenerate server conf and reload
-    awg_manager.write_server_conf()
-    if awg_manager.is_interface_up():
-        awg_manager.reload_interface()
+    # Add the peer to the live interface; awg0.conf is rewritten in the background
+    awg_manager.apply_client(client)
 
     return _client_to_json(client)
 
@@ -239,25 +283,20 @@ async def get_client_qr(client_id: str, request: Request):
     if not conf:
         raise HTTPException(status_code=404, detail="Client not found")
 
-    qr = qrcode.QRCode(version=1, box_size=10, border=4)
-    qr.add_data(conf)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    bio = BytesIO()
-    img.save(bio, "PNG")
-    bio.seek(0)
-    return Response(content=bio.getvalue(), media_type="image/png")
+    # конфиг содержит PrivateKey — только память, без дискового уровня
+    png = await asyncio.to_thread(qr_cache.png, conf, 10, 4, secret=True)
+    return Response(content=png, media_type="image/png")
 
 
 @app.delete("/api/wireguard/client/{client_id}")
 async def delete_client(client_id: str, request: Request):
     _check_session_from_request(request)
-    if not db.delete_client(client_id):
+    client = db.get_client(client_id)
+    if not client or not db.delete_client(client_id):
         raise HTTPException(status_code=404, detail="Client not found")
+    address_pool.get_pool().release(client["address"])
 
-    awg_manager.write_server_conf()
-    if awg_manager.is_interface_up():
-        awg_manager.reload_interface()
+    awg_manager.apply_client(removed_key=client["public_key"])
 
     return Response(status_code=204)
 
@@ -268,9 +307,7 @@ async def enable_client(client_id: str, request: Request):
     if not db.update_client_enabled(client_id, True):
         raise HTTPException(status_code=404)
 
-    awg_manager.write_server_conf()
-    if awg_manager.is_interface_up():
-        awg_manager.reload_interface()
+    awg_manager.apply_client(db.get_client(client_id))
 
     return Response(status_code=204)
 
@@ -281,9 +318,7 @@ async def disable_client(client_id: str, request: Request):
     if not db.update_client_enabled(client_id, False):
         raise HTTPException(status_code=404)
 
-    awg_manager.write_server_conf()
-    if awg_manager.is_interface_up():
-        awg_manager.reload_interface()
+    awg_manager.apply_client(db.get_client(client_id))
 
     return Response(status_code=204)
 
@@ -302,11 +337,13 @@ async def update_address(client_id: str, request: Request):
     _check_session_from_request(request)
     body = await request.json()
     new_addr = body.get("address", "")
-    if not db.update_client_address(client_id, new_addr):
+    old = db.get_client(client_id)
+    if not old or not db.update_client_address(client_id, new_addr):
         raise HTTPException(status_code=404)
+    pool = address_pool.get_pool()
+    pool.mark_used(new_addr)
+    pool.release(old["address"])
 
-    awg_manager.write_server_conf()
-    if awg_manager.is_interface_up():
-        awg_manager.reload_interface()
+    awg_manager.apply_client(db.get_client(client_id))
 
     return Response(status_code=204)
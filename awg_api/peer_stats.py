@@ -0,0 +1,199 @@
+"""In-process AWG peer stats: handshakes, endpoints and rx/tx per peer.
+
+Reads the cross-platform UAPI socket (/var/run/amneziawg/<iface>.sock, as
+served by amneziawg-go) with a single `get=1` round trip — no fork/exec,
+cheap enough for sub-second polling. When there is no UAPI socket (kernel
+module) it falls back to parsing `awg show <iface> dump`.
+
+Every reader returns the same structured records:
+
+    {"public_key": base64, "endpoint": "1.2.3.4:5678" | None,
+     "endpoint_ip": "1.2.3.4" | None, "allowed_ips": ["10.10.0.2/32"],
+     "handshake_ts": unix seconds (0 = never), "rx": bytes, "tx": bytes,
+     "keepalive": seconds}
+"""
+import base64
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+from .config import AWG_INTERFACE
+
+logger = logging.getLogger(__name__)
+
+UAPI_DIRS = [d for d in (os.getenv("AWG_UAPI_DIR"), "/var/run/amneziawg", "/var/run/wireguard") if d]
+UAPI_TIMEOUT = 2.0
+
+
+class PeerStatsUnavailable(Exception):
+    """Neither the UAPI socket nor `awg show` could be read."""
+
+
+def _new_peer(public_key: str) -> dict:
+    return {
+        "public_key": public_key,
+        "endpoint": None,
+        "endpoint_ip": None,
+        "allowed_ips": [],
+        "handshake_ts": 0,
+        "rx": 0,
+        "tx": 0,
+        "keepalive": 0,
+    }
+
+
+def _endpoint_ip(endpoint: str | None) -> str | None:
+    if not endpoint:
+        return None
+    host = endpoint.rsplit(":", 1)[0]
+    return host[1:-1] if host.startswith("[") else host
+
+
+# ─────────────────────────────────────────────
+#  UAPI
+# ─────────────────────────────────────────────
+
+def uapi_socket_path(interface: str = AWG_INTERFACE) -> str | None:
+    for d in UAPI_DIRS:
+        path = os.path.join(d, f"{interface}.sock")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def parse_uapi(text: str) -> list[dict]:
+    """Parse a UAPI `get=1` reply (key=value lines, hex keys)."""
+    peers: list[dict] = []
+    peer = None
+    for line in text.splitlines():
+        if not line or "=" not in line:
+            continue
+        key, _, value = line.partition("=")
+        if key == "errno":
+            if value != "0":
+                raise PeerStatsUnavailable(f"UAPI errno={value}")
+        elif key == "public_key":
+            peer = _new_peer(base64.b64encode(bytes.fromhex(value)).decode())
+            peers.append(peer)
+        elif peer is None:
+            continue  # interface-level keys (private_key, listen_port, jc, ...)
+        elif key == "endpoint":
+            peer["endpoint"] = value
+            peer["endpoint_ip"] = _endpoint_ip(value)
+        elif key == "allowed_ip":
+            peer["allowed_ips"].append(value)
+        elif key == "last_handshake_time_sec":
+            peer["handshake_ts"] = int(value)
+        elif key == "rx_bytes":
+            peer["rx"] = int(value)
+        elif key == "tx_bytes":
+            peer["tx"] = int(value)
+        elif key == "persistent_keepalive_interval":
+            peer["keepalive"] = int(value)
+    return peers
+
+
+def read_uapi(path: str) -> list[dict]:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(UAPI_TIMEOUT)
+        sock.connect(path)
+        sock.sendall(b"get=1\n\n")
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            # Ответ заканчивается пустой строкой после errno=N
+            tail = b"".join(chunks[-2:])
+            if b"errno=" in tail and tail.endswith(b"\n\n"):
+                break
+    return parse_uapi(b"".join(chunks).decode())
+
+
+# ─────────────────────────────────────────────
+#  `awg show <iface> dump` fallback
+# ─────────────────────────────────────────────
+
+def parse_dump(text: str) -> list[dict]:
+    """Parse `awg show <iface> dump`: the first line is the interface itself."""
+    peers = []
+    for line in text.strip().splitlines()[1:]:
+        parts = line.split("\t")
+        if len(parts) < 7:
+            continue
+        peer = _new_peer(parts[0])
+        if parts[2] != "(none)":
+            peer["endpoint"] = parts[2]
+            peer["endpoint_ip"] = _endpoint_ip(parts[2])
+        if parts[3] != "(none)":
+            peer["allowed_ips"] = parts[3].split(",")
+        peer["handshake_ts"] = int(parts[4]) if parts[4].isdigit() else 0
+        peer["rx"] = int(parts[5]) if parts[5].isdigit() else 0
+        peer["tx"] = int(parts[6]) if parts[6].isdigit() else 0
+        if len(parts) > 7 and parts[7].isdigit():
+            peer["keepalive"] = int(parts[7])
+        peers.append(peer)
+    return peers
+
+
+def read_dump(interface: str = AWG_INTERFACE) -> list[dict]:
+    result = subprocess.run(
+        ["awg", "show", interface, "dump"], capture_output=True, text=True, timeout=5
+    )
+    if result.returncode != 0:
+        raise PeerStatsUnavailable(result.stderr.strip() or f"awg show {interface} failed")
+    return parse_dump(result.stdout)
+
+
+# ─────────────────────────────────────────────
+#  Public API
+# ─────────────────────────────────────────────
+
+_cache: dict[str, tuple[float, list[dict]]] = {}
+_cache_lock = threading.Lock()
+
+
+def read_peers(interface: str = AWG_INTERFACE, max_age: float = 0.0) -> list[dict]:
+    """Peer records for `interface`; reuse a read younger than max_age seconds.
+
+    Raises PeerStatsUnavailable if the interface cannot be read at all.
+    """
+    if max_age > 0:
+        with _cache_lock:
+            cached = _cache.get(interface)
+        if cached and time.monotonic() - cached[0] < max_age:
+            return cached[1]
+
+    path = uapi_socket_path(interface)
+    peers = None
+    if path:
+        try:
+            peers = read_uapi(path)
+        except (OSError, ValueError, PeerStatsUnavailable) as e:
+            logger.warning(f"UAPI read of {path} failed, falling back to awg show: {e}")
+    if peers is None:
+        try:
+            peers = read_dump(interface)
+        except (OSError, subprocess.SubprocessError) as e:
+            raise PeerStatsUnavailable(str(e)) from e
+
+    with _cache_lock:
+        _cache[interface] = (time.monotonic(), peers)
+    return peers
+
+
+def peers_by_key(interface: str = AWG_INTERFACE, max_age: float = 0.0) -> dict[str, dict]:
+    """{public_key: record}"""
+    return {p["public_key"]: p for p in read_peers(interface, max_age)}
+
+
+def is_up(interface: str = AWG_INTERFACE) -> bool:
+    try:
+        read_peers(interface, max_age=1.0)
+        return True
+    except PeerStatsUnavailable:
+        return False
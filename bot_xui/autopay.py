@@ -2,159 +2,237 @@
 Автоплатежи — списание с сохранённой карты при истечении подписки.
 
 Запускается из scheduler в bot.py за 1 день до истечения.
+
+Вызовы YooKassa (блокирующий SDK) идут в пуле из AUTOPAY_WORKERS потоков.
+Перед каждым вызовом в autopay_attempts фиксируется попытка с ключом
+идемпотентности на цикл (user_id, DATE(subscription_until)): если процесс упал
+посреди списания, следующий запуск повторит запрос с тем же ключом и YooKassa
+вернёт тот же платёж, а не спишет второй раз. 5xx / 429 / сетевые ошибки
+повторяются с экспоненциальной задержкой. Сообщения в Telegram отправляются
+после списаний, через общий TokenBucket рассылок.
 """
+import asyncio
 import logging
-import uuid
+import time
+from datetime import date, datetime
 
 from yookassa import Configuration, Payment
 
 from config import YOO_KASSA_SHOP_ID, YOO_KASSA_SECRET_KEY
 from bot_xui.tariffs import TARIFFS
+from bot_xui.broadcast import TokenBucket, deliver, BROADCAST_RATE
 from api.db import (
-    get_autopay_users_due, log_autopay, create_payment,
+    get_autopay_users_due, log_autopay, create_payment, get_payment_by_id,
     disable_autopay, disable_autopay_by_id, get_permanent_discount,
+    claim_autopay_attempt, finish_autopay_attempt, record_job_run,
 )
 
 logger = logging.getLogger(__name__)
 
+AUTOPAY_WORKERS = 8         # одновременных запросов к YooKassa
+GATEWAY_ATTEMPTS = 4        # всего попыток на 5xx / 429 / сетевые ошибки
+GATEWAY_BACKOFF = 1.0       # секунд, удваивается с каждой попыткой
+NOTIFY_CONCURRENCY = 8
+JOB_NAME = "autopay"
+
+# Исходы по пользователю
+CHARGED, FAILED, SKIPPED, INVALID = "charged", "failed", "skipped", "invalid"
+
+
+class GatewayError(Exception):
+    def __init__(self, cause: Exception, attempts: int):
+        super().__init__(str(cause))
+        self.cause = cause
+        self.attempts = attempts
+
+
+def _is_retryable(e: Exception) -> bool:
+    """YooKassa SDK errors carry HTTP_CODE; ApiError (0) is any unmapped status, i.e. 5xx."""
+    code = getattr(type(e), "HTTP_CODE", None)
+    if isinstance(code, int):
+        return code == 0 or code == 202 or code == 429 or code >= 500
+    # requests.ConnectionError / Timeout наследуются от OSError
+    return isinstance(e, (OSError, TimeoutError))
+
+
+def _create_payment(body: dict, idempotence_key: str) -> tuple:
+    """Payment.create with retry/backoff on transient errors; returns (payment, attempts)."""
+    for attempt in range(1, GATEWAY_ATTEMPTS + 1):
+        try:
+            return Payment.create(body, idempotence_key), attempt
+        except Exception as e:
+            if attempt == GATEWAY_ATTEMPTS or not _is_retryable(e):
+                raise GatewayError(e, attempt) from e
+            delay = GATEWAY_BACKOFF * 2 ** (attempt - 1)
+            logger.warning(f"[AUTOPAY] Gateway error ({e}), retry {attempt} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def _price(user: dict, tariff: dict) -> int:
+    price = tariff['price']
+    perm_discount = user.get('permanent_discount') or 0
+    if perm_discount > 0:
+        price = max(1, round(price * (100 - perm_discount) / 100))
+    return price
+
+
+def _cycle(user: dict) -> date:
+    until = user.get('subscription_until')
+    return until.date() if isinstance(until, datetime) else (until or date.today())
+
+
+def _charge(user: dict, phase: int) -> dict:
+    """Worker thread: one user, one gateway call. Returns an outcome dict."""
+    tg_id = user.get('tg_id') or 0
+    user_id = user['id']
+    tariff_id = user.get('autopay_tariff') or 'monthly_30d'
+    tariff = TARIFFS.get(tariff_id)
+    outcome = {"user_id": user_id, "tg_id": tg_id, "tariff": tariff, "price": None, "retries": 0}
+    if not tariff or tariff.get('is_test'):
+        if phase == 1:
+            logger.warning(f"[AUTOPAY] Invalid tariff {tariff_id} for user {user_id}, disabling autopay")
+            disable_autopay_by_id(user_id)
+        return {**outcome, "status": INVALID}
+
+    price = outcome["price"] = _price(user, tariff)
+    attempt = claim_autopay_attempt(user_id, _cycle(user), phase, tariff_id, price)
+    if attempt is None:
+        logger.info(f"[AUTOPAY] Phase {phase}: user {user_id} already charged this cycle, skipping")
+        return {**outcome, "status": SKIPPED}
+
+    body = {
+        "amount": {"value": str(price), "currency": "RUB"},
+        "capture": True,
+        "payment_method_id": user['payment_method_id'],
+        "description": f"Автопродление тарифа {tariff['name']}",
+        "metadata": {
+            "tg_id": str(tg_id),
+            "tariff": tariff_id,
+            "vpn_type": user.get('autopay_vpn_type') or 'vless',
+            "is_renew": "true",
+            "is_autopayment": "true",
+        },
+    }
+    try:
+        payment, tries = _create_payment(body, attempt['idempotence_key'])
+    except GatewayError as e:
+        logger.error(f"[AUTOPAY] Phase {phase} failed for user {user_id}: {e}")
+        log_autopay(tg_id, user_id, tariff_id, price, None, "failed", str(e)[:500])
+        finish_autopay_attempt(attempt['id'], "failed", error=str(e), tries=e.attempts)
+        if phase == 0:
+            if tg_id:
+                disable_autopay(tg_id)
+            else:
+                disable_autopay_by_id(user_id)
+        return {**outcome, "status": FAILED, "retries": e.attempts - 1}
+
+    # Повтор после падения: платёж уже мог быть записан прошлым запуском
+    if not (attempt.get('resumed') and get_payment_by_id(payment.id)):
+        create_payment(payment_id=payment.id, tg_id=tg_id, tariff=tariff_id, amount=price, status="pending")
+        log_autopay(tg_id, user_id, tariff_id, price, payment.id, "pending")
+    finish_autopay_attempt(attempt['id'], "created", payment_id=payment.id, tries=tries)
+    logger.info(f"[AUTOPAY] Phase {phase}: charged tg:{tg_id}, payment {payment.id}")
+    return {**outcome, "status": CHARGED, "payment_id": payment.id, "retries": tries - 1}
+
+
+def _message(outcome: dict, phase: int) -> tuple[str, dict | None] | None:
+    tariff, price = outcome["tariff"], outcome["price"]
+    if outcome["status"] == CHARGED and phase == 1:
+        return (
+            f"⏰ <b>Автопродление завтра</b>\n\n"
+            f"📦 Тариф: {tariff['name']}\n"
+            f"💰 Завтра будет списано: {price} ₽\n\n"
+            f"Подписка истекает через 1 день. Автоматическое списание пройдёт завтра.\n\n"
+            f"<i>Отключить автопродление: /autopay</i>"
+        ), None
+    if outcome["status"] == CHARGED:
+        return (
+            f"🔄 <b>Автопродление подписки</b>\n\n"
+            f"📦 Тариф: {tariff['name']}\n"
+            f"💰 Списано: {price} ₽\n\n"
+            f"Платёж обрабатывается. Конфиг обновится автоматически.\n\n"
+            f"<i>Отключить автопродление: /autopay</i>"
+        ), None
+    if outcome["status"] == FAILED and phase == 0:
+        return (
+            f"❌ <b>Автопродление не удалось</b>\n\n"
+            f"Не удалось списать {price} ₽ за тариф {tariff['name']}.\n"
+            f"Автопродление отключено.\n\n"
+            f"Продлите подписку вручную:"
+        ), {"inline_keyboard": [[{"text": "💎 Тарифы", "callback_data": "tariffs"}]]}
+    return None
 
-async def process_autopayments(bot):
+
+async def _run_phase(bot, users: list[dict], phase: int, bucket: TokenBucket) -> dict:
+    workers = asyncio.Semaphore(AUTOPAY_WORKERS)
+
+    async def charge(user):
+        async with workers:
+            try:
+                return await asyncio.to_thread(_charge, user, phase)
+            except Exception as e:
+                # ошибка БД и т.п. — не роняем весь прогон
+                logger.exception(f"[AUTOPAY] Phase {phase}: user {user.get('id')} crashed: {e}")
+                return {"user_id": user.get('id'), "tg_id": 0, "status": FAILED, "retries": 0}
+
+    outcomes = await asyncio.gather(*(charge(u) for u in users))
+
+    senders = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def notify(outcome):
+        message = _message(outcome, phase) if outcome["tg_id"] else None
+        if not message:
+            return
+        text, markup = message
+        async with senders:
+            try:
+                await deliver(bot, bucket, outcome["tg_id"], text, "HTML", reply_markup=markup)
+            except Exception as e:
+                logger.warning(f"[AUTOPAY] Notify tg:{outcome['tg_id']} failed: {e}")
+
+    await asyncio.gather(*(notify(o) for o in outcomes))
+
+    summary = {CHARGED: 0, FAILED: 0, SKIPPED: 0, INVALID: 0, "retries": 0}
+    for o in outcomes:
+        summary[o["status"]] += 1
+        summary["retries"] += o["retries"]
+    return summary
+
+
+async def process_autopayments(bot) -> dict:
     """
     Two-phase autopay:
     - Phase 1 (days_before=1): notify user that charge will happen tomorrow, create pending payment
     - Phase 2 (days_before=0): charge the saved payment method
+    Returns a summary report (also logged and stored in job_runs).
     """
     Configuration.account_id = YOO_KASSA_SHOP_ID
     Configuration.secret_key = YOO_KASSA_SECRET_KEY
+    started_at = datetime.now()
+    t0 = time.monotonic()
+    bucket = TokenBucket(BROADCAST_RATE)
+    report = {}
 
     # Phase 1: notify + create payment (subscription expires tomorrow)
-    users_notify = get_autopay_users_due(days_before=1)
+    users_notify = await asyncio.to_thread(get_autopay_users_due, days_before=1)
     if users_notify:
         logger.info(f"[AUTOPAY] Phase 1: notifying {len(users_notify)} users about upcoming charge")
-        for user in users_notify:
-            tg_id = user.get('tg_id') or 0
-            user_id = user['id']
-            tariff_id = user.get('autopay_tariff') or 'monthly_30d'
-            tariff = TARIFFS.get(tariff_id)
-            if not tariff or tariff.get('is_test'):
-                logger.warning(f"[AUTOPAY] Invalid tariff {tariff_id} for user {user_id}, disabling autopay")
-                disable_autopay_by_id(user_id)
-                continue
-            price = tariff['price']
-            perm_discount = user.get('permanent_discount') or 0
-            if perm_discount > 0:
-                price = max(1, round(price * (100 - perm_discount) / 100))
-
-            try:
-                payment = Payment.create(
-                    {
-                        "amount": {"value": str(price), "currency": "RUB"},
-                        "capture": True,
-                        "payment_method_id": user['payment_method_id'],
-                        "description": f"Автопродление тарифа {tariff['name']}",
-                        "metadata": {
-                            "tg_id": str(tg_id),
-                            "tariff": tariff_id,
-                            "vpn_type": user.get('autopay_vpn_type') or 'vless',
-                            "is_renew": "true",
-                            "is_autopayment": "true",
-                        },
-                    },
-                    str(uuid.uuid4()),
-                )
-                create_payment(payment_id=payment.id, tg_id=tg_id, tariff=tariff_id, amount=price, status="pending")
-                log_autopay(tg_id, user_id, tariff_id, price, payment.id, "pending")
-
-                if tg_id:
-                    await bot.send_message(
-                        chat_id=tg_id,
-                        text=(
-                            f"⏰ <b>Автопродление завтра</b>\n\n"
-                            f"📦 Тариф: {tariff['name']}\n"
-                            f"💰 Завтра будет списано: {price} ₽\n\n"
-                            f"Подписка истекает через 1 день. Автоматическое списание пройдёт завтра.\n\n"
-                            f"<i>Отключить автопродление: /autopay</i>"
-                        ),
-                        parse_mode="HTML",
-                    )
-                logger.info(f"[AUTOPAY] Phase 1: notified tg:{tg_id}, payment {payment.id}")
-            except Exception as e:
-                logger.error(f"[AUTOPAY] Phase 1 failed for user {user_id}: {e}")
-                log_autopay(tg_id, user_id, tariff_id, price, None, "failed", str(e)[:500])
+        report["phase1"] = await _run_phase(bot, users_notify, 1, bucket)
 
     # Phase 2: charge users whose subscription expires today
-    users_charge = get_autopay_users_due(days_before=0)
+    users_charge = await asyncio.to_thread(get_autopay_users_due, days_before=0)
     if users_charge:
         logger.info(f"[AUTOPAY] Phase 2: charging {len(users_charge)} users")
-        for user in users_charge:
-            tg_id = user.get('tg_id') or 0
-            user_id = user['id']
-            tariff_id = user.get('autopay_tariff') or 'monthly_30d'
-            tariff = TARIFFS.get(tariff_id)
-            if not tariff or tariff.get('is_test'):
-                continue
-            price = tariff['price']
-            perm_discount = user.get('permanent_discount') or 0
-            if perm_discount > 0:
-                price = max(1, round(price * (100 - perm_discount) / 100))
-
-            try:
-                payment = Payment.create(
-                    {
-                        "amount": {"value": str(price), "currency": "RUB"},
-                        "capture": True,
-                        "payment_method_id": user['payment_method_id'],
-                        "description": f"Автопродление тарифа {tariff['name']}",
-                        "metadata": {
-                            "tg_id": str(tg_id),
-                            "tariff": tariff_id,
-                            "vpn_type": user.get('autopay_vpn_type') or 'vless',
-                            "is_renew": "true",
-                            "is_autopayment": "true",
-                        },
-                    },
-                    str(uuid.uuid4()),
-                )
-                create_payment(payment_id=payment.id, tg_id=tg_id, tariff=tariff_id, amount=price, status="pending")
-                log_autopay(tg_id, user_id, tariff_id, price, payment.id, "pending")
-
-                if tg_id:
-                    await bot.send_message(
-                        chat_id=tg_id,
-                        text=(
-                            f"🔄 <b>Автопродление подписки</b>\n\n"
-                            f"📦 Тариф: {tariff['name']}\n"
-                            f"💰 Списано: {price} ₽\n\n"
-                            f"Платёж обрабатывается. Конфиг обновится автоматически.\n\n"
-                            f"<i>Отключить автопродление: /autopay</i>"
-                        ),
-                        parse_mode="HTML",
-                    )
-                logger.info(f"[AUTOPAY] Phase 2: charged tg:{tg_id}, payment {payment.id}")
-            except Exception as e:
-                logger.error(f"[AUTOPAY] Phase 2 failed for user {user_id}: {e}")
-                log_autopay(tg_id, user_id, tariff_id, price, None, "failed", str(e)[:500])
-                if tg_id:
-                    disable_autopay(tg_id)
-                else:
-                    disable_autopay_by_id(user_id)
-                if tg_id:
-                    try:
-                        await bot.send_message(
-                            chat_id=tg_id,
-                            text=(
-                                f"❌ <b>Автопродление не удалось</b>\n\n"
-                                f"Не удалось списать {price} ₽ за тариф {tariff['name']}.\n"
-                                f"Автопродление отключено.\n\n"
-                                f"Продлите подписку вручную:"
-                            ),
-                            parse_mode="HTML",
-                            reply_markup={"inline_keyboard": [[{"text": "💎 Тарифы", "callback_data": "tariffs"}]]},
-                        )
-                    except Exception:
-                        pass
+        report["phase2"] = await _run_phase(bot, users_charge, 0, bucket)
 
     if not users_notify and not users_charge:
         logger.info("[AUTOPAY] No users due for auto-renewal")
 
-    logger.info("[AUTOPAY] Auto-renewal processing complete")
+    duration_ms = int((time.monotonic() - t0) * 1000)
+    report["duration_ms"] = duration_ms
+    logger.info(f"[AUTOPAY] Auto-renewal processing complete: {report}")
+    try:
+        await asyncio.to_thread(record_job_run, JOB_NAME, started_at, duration_ms, report)
+    except Exception as e:
+        logger.warning(f"[AUTOPAY] job_runs insert failed: {e}")
+    return report
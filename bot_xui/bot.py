@@ -9,9 +9,7 @@
 import logging
 import os
 import sys
-import io
 import pytz
-import qrcode
 from pathlib import Path
 
 START_IMAGE_PATH = Path(__file__).parent / "assets" / "no.png"
@@ -37,7 +35,6 @@ from api.db import (
     get_referral_count,
     get_subscription_until,
     get_web_token,
-    get_users_expiring_in_days,
     validate_promocode,
     use_promocode,
     create_promocode,
@@ -46,7 +43,7 @@ from api.db import (
     set_permanent_discount,
 )
 
-from bot_xui.helpers  import make_main_keyboard, MAIN_MENU_TEXT, MTPROTO_PROXY_LINK, safe_edit_text, make_proxy_file
+from bot_xui.helpers  import make_main_keyboard, MAIN_MENU_TEXT, MTPROTO_PROXY_LINK, safe_edit_text, make_proxy_file, send_qr_photo
 from bot_xui.views    import (
     show_main_menu, show_tariffs, show_configs,
     show_single_config, show_instructions, show_renew_tariffs,
@@ -56,6 +53,8 @@ from bot_xui.views    import (
 from bot_xui.payment     import process_payment
 from bot_xui.vpn_factory import handle_test_awg, handle_test_vless, handle_test_softether, handle_get_awg_config, handle_get_softether_config, grant_referral_vpn, activate_test_period
 from bot_xui.messaging   import send_message_by_tg_id
+from bot_xui import broadcast as broadcast_engine
+from bot_xui.expiry_notifier import notify_expiring_subscriptions
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 load_dotenv()
@@ -201,18 +200,7 @@ async def test_xui_connection(xui: XUIClient) -> bool:
 
 async def refer(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text, link = await _refer_text(context, update.effective_user.id)
-    qr = _make_qr(link)
-    await update.message.reply_photo(photo=qr, caption=text, parse_mode="HTML")
-
-
-def _make_qr(data: str) -> io.BytesIO:
-    """Генерирует QR-код и возвращает PNG в BytesIO."""
-    img = qrcode.make(data, box_size=8, border=2)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    buf.name = "qr.png"
-    return buf
+    await send_qr_photo(update.message.reply_photo, link, 8, 2, caption=text, parse_mode="HTML")
 
 
 async def _refer_text(context, tg_id: int) -> tuple[str, str]:
@@ -288,8 +276,21 @@ async def post_init(application):
         timezone=pytz.timezone("Asia/Tokyo"),
     )
 
+    from api.rollups import refresh_job, ROLLUP_INTERVAL_MIN
+    scheduler.add_job(
+        refresh_job,
+        trigger="interval",
+        minutes=ROLLUP_INTERVAL_MIN,
+    )
+
     scheduler.start()
-    logger.info("[NOTIFY] Subscription expiry + autopay + IP cleanup + session cleanup scheduler started")
+
+    # Рассылки, прерванные падением/рестартом, досылаем с места остановки
+    try:
+        await broadcast_engine.resume_unfinished(application.bot)
+    except Exception as e:
+        logger.error(f"[broadcast] resume failed: {e}")
+    logger.info("[NOTIFY] Subscription expiry + autopay + IP cleanup + session cleanup + rollups scheduler started")
 
 
 async def send_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -358,15 +359,18 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Убираем "/broadcast " из начала
     msg_html = full_html.split(maxsplit=1)[1] if len(full_html.split(maxsplit=1)) > 1 else raw[1]
 
-    users    = get_all_users_tg_ids()
-    ok = fail = 0
-    for uid in users:
-        if await send_message_by_tg_id(uid, msg_html, parse_mode="HTML", bot=context.bot):
-            ok += 1
-        else:
-            fail += 1
+    users = get_all_users_tg_ids()
+    await _launch_broadcast(update, context, "broadcast", [(uid, None) for uid in users], msg_html)
 
-    await update.message.reply_text(f"📬 Рассылка завершена\n✅ {ok}\n❌ {fail}")
+
+async def _launch_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE, kind: str,
+                            recipients: list[tuple[int, str | None]], text: str | None = None):
+    """Сохраняет задание рассылки и запускает его в фоне с живым отчётом админу."""
+    chat_id = update.effective_chat.id
+    job_id = await broadcast_engine.start_job(
+        kind, recipients, text, parse_mode="HTML", report_chat_id=chat_id,
+    )
+    context.application.create_task(broadcast_engine.run_with_report(context.bot, job_id, chat_id))
 
 
 async def broadcast_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -380,9 +384,7 @@ async def broadcast_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Нет пользователей с web_token")
         return
 
-    await update.message.reply_text(f"📬 Начинаю рассылку {len(users)} пользователям...")
-
-    ok = fail = 0
+    recipients = []
     for u in users:
         ref_link = f"https://344988.snk.wtf/?ref={u['web_token']}"
         msg = (
@@ -394,12 +396,9 @@ async def broadcast_ref(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "получат <b>20 дней бесплатно</b> вместо 3!\n"
             "А вы — <b>10 дней</b> за каждого друга."
         )
-        if await send_message_by_tg_id(u['tg_id'], msg, parse_mode="HTML", bot=context.bot):
-            ok += 1
-        else:
-            fail += 1
+        recipients.append((u['tg_id'], msg))
 
-    await update.message.reply_text(f"📬 Рассылка завершена\n✅ {ok}\n❌ {fail}")
+    await _launch_broadcast(update, context, "broadcast_ref", recipients)
 
 
 async def notify_sub_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -421,14 +420,7 @@ async def notify_sub_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     users = get_active_subscribers_tg_ids()
-    ok = fail = 0
-    for uid in users:
-        if await send_message_by_tg_id(uid, text, parse_mode="HTML", bot=context.bot):
-            ok += 1
-        else:
-            fail += 1
-
-    await update.message.reply_text(f"📬 Уведомление отправлено активным подписчикам\n✅ {ok}\n❌ {fail}")
+    await _launch_broadcast(update, context, "notify_sub_update", [(uid, None) for uid in users], text)
 
 
 # ──────────────────────────────────────────────────────────────────────────────
@@ -821,11 +813,10 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     elif data == "referral":
         text, link = await _refer_text(context, query.from_user.id)
-        qr = _make_qr(link)
         await query.message.delete()
-        await context.bot.send_photo(
+        await send_qr_photo(
+            context.bot.send_photo, link, 8, 2,
             chat_id=query.from_user.id,
-            photo=qr,
             caption=text,
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup([
@@ -936,117 +927,6 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
-# ──────────────────────────────────────────────────────────────────────────────
-# Интервалы
-# ──────────────────────────────────────────────────────────────────────────────
-
-async def notify_expiring_subscriptions(bot):
-    """Проверяет истекающие подписки и уведомляет пользователей."""
-    notifications = [
-        (3, "3 дня", "⏳"),
-        (1, "1 день", "⚠️"),
-        (0, "сегодня", "🔴"),
-    ]
-
-    for days, label, icon in notifications:
-        users = get_users_expiring_in_days(days)
-        for user in users:
-            tg_id = user['tg_id']
-            email = user.get('email')
-            until = user['subscription_until'].strftime("%d.%m.%Y")
-            has_autopay = user.get('autopay_enabled') and user.get('payment_method_id')
-
-            # Telegram notification (if user has tg_id)
-            if tg_id:
-                if has_autopay:
-                    # Autopay user — inform about upcoming charge, no manual CTA
-                    tariff_id = user.get('autopay_tariff') or 'monthly_30d'
-                    tariff = TARIFFS.get(tariff_id, {})
-                    tariff_name = tariff.get('name', tariff_id)
-                    price = tariff.get('price', '?')
-
-                    if days == 0:
-                        msg = (
-                            f"🔄 <b>Сегодня автоматически продлим подписку</b>\n\n"
-                            f"📦 Тариф: {tariff_name}\n"
-                            f"💰 Сумма: {price} ₽\n\n"
-                            f"<i>Отменить автопродление: /autopay</i>"
-                        )
-                    else:
-                        msg = (
-                            f"🔄 <b>Через {label} автоматически продлим подписку</b>\n\n"
-                            f"📦 Тариф: {tariff_name}\n"
-                            f"💰 Сумма: {price} ₽\n"
-                            f"📅 Окончание: <b>{until}</b>\n\n"
-                            f"<i>Отменить автопродление: /autopay</i>"
-                        )
-                    reply_markup = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("⚙️ Управление автопродлением", callback_data="autopay_manage")]
-                    ])
-                else:
-                    # No autopay — standard renewal reminder
-                    if days == 0:
-                        msg = (
-                            f"🔴 <b>Подписка истекает сегодня!</b>\n\n"
-                            f"📅 Окончание: <b>{until}</b>\n\n"
-                            f"Продлите сейчас, чтобы не потерять доступ."
-                        )
-                    else:
-                        msg = (
-                            f"{icon} <b>Подписка истекает через {label}</b>\n\n"
-                            f"📅 Окончание: <b>{until}</b>\n\n"
-                            f"Продлите, чтобы не потерять доступ."
-                        )
-                    reply_markup = InlineKeyboardMarkup([
-                        [InlineKeyboardButton("🔄 Продлить", callback_data="tariffs")]
-                    ])
-
-                try:
-                    await bot.send_message(
-                        chat_id=tg_id,
-                        text=msg,
-                        parse_mode="HTML",
-                        reply_markup=reply_markup,
-                    )
-                    logger.info(f"[NOTIFY] Sent expiry warning ({days}d) to tg:{tg_id}")
-                except Exception as e:
-                    logger.warning(f"[NOTIFY] Failed to notify tg:{tg_id}: {e}")
-
-            # Email notification (for web-only users or as backup)
-            if email and not tg_id:
-                try:
-                    from api.notifications import send_expiry_warning_email
-                    send_expiry_warning_email(to=email, days_left=days, expiry_date=until)
-                    logger.info(f"[NOTIFY] Sent expiry email ({days}d) to {email}")
-                except Exception as e:
-                    logger.warning(f"[NOTIFY] Failed to email {email}: {e}")
-
-    # Post-expiry: notify users whose subscription expired yesterday
-    from api.db import execute_query as _eq
-    expired_yesterday = _eq(
-        "SELECT tg_id, subscription_until FROM users "
-        "WHERE subscription_until BETWEEN NOW() - INTERVAL 2 DAY AND NOW() - INTERVAL 1 DAY "
-        "AND tg_id IS NOT NULL AND tg_id > 0",
-        fetch='all',
-    )
-    for user in (expired_yesterday or []):
-        try:
-            await bot.send_message(
-                chat_id=user['tg_id'],
-                text=(
-                    "❌ <b>Подписка истекла</b>\n\n"
-                    "VPN больше не работает. Продлите подписку, "
-                    "чтобы вернуть доступ."
-                ),
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("💎 Продлить", callback_data="tariffs")]
-                ])
-            )
-            logger.info(f"[NOTIFY] Sent post-expiry to tg:{user['tg_id']}")
-        except Exception as e:
-            logger.warning(f"[NOTIFY] Failed post-expiry tg:{user['tg_id']}: {e}")
-
 # ──────────────────────────────────────────────────────────────────────────────
 # Автопродление
 # ──────────────────────────────────────────────────────────────────────────────
@@ -0,0 +1,238 @@
+"""
+Рассылки: очередь получателей в MySQL, темп под лимиты Bot API, докачка после рестарта.
+
+Задание (broadcast_jobs) и его получатели (broadcast_recipients) создаются
+одной пачкой. run_job() отправляет только тех, кто ещё 'pending':
+  - TokenBucket держит общий темп (Bot API: ~30 сообщений/с на бота);
+  - 429 RetryAfter ставит на паузу весь bucket на retry_after секунд,
+    сообщение отправляется повторно, а не считается ошибкой;
+  - не больше BROADCAST_CONCURRENCY запросов одновременно;
+  - результаты пишутся в БД пачками (статусы получателей, счётчики
+    задания, users.bot_blocked) раз в FLUSH_EVERY ответов / FLUSH_INTERVAL с.
+
+Если бот упал посреди рассылки, задание остаётся 'running' и
+resume_unfinished() при старте досылает остаток (только задания бота, BOT_KINDS). Доставка at-least-once:
+после падения могут повториться максимум последние FLUSH_INTERVAL секунд.
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Optional
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+
+from api import db
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_RATE = 25.0          # сообщений в секунду (с запасом от лимита 30/с)
+BROADCAST_CONCURRENCY = 8      # одновременных sendMessage
+FLUSH_EVERY = 200              # ответов между записями в БД
+FLUSH_INTERVAL = 2.0           # ... или секунд
+PROGRESS_INTERVAL = 5.0        # как часто обновлять отчёт админу
+MAX_ATTEMPTS = 3               # сетевые ошибки (RetryAfter не считается)
+MAX_RETRY_AFTER = 20           # сколько раз подряд терпим 429 на одном сообщении
+
+SENT, FAILED, BLOCKED = "sent", "failed", "blocked"
+
+# Задания, которые запускает сам бот (bot.py). Задания scripts/broadcast_script
+# (kind="script") докачивает только скрипт — иначе два процесса шлют одним и тем же.
+BOT_KINDS = ("broadcast", "broadcast_ref", "notify_sub_update")
+
+ProgressCallback = Callable[[dict], Awaitable[None]]
+
+
+class TokenBucket:
+    """Async token bucket; pause() freezes it (Telegram flood-wait is per bot)."""
+
+    def __init__(self, rate: float, burst: float | None = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0.0
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _seconds(value) -> float:
+    # PTB 20 отдаёт int, PTB 21+ — timedelta
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+async def deliver(bot: Bot, bucket: TokenBucket, tg_id: int, text: str,
+                  parse_mode: Optional[str] = None, reply_markup=None) -> str:
+    """Send one message; returns SENT / FAILED / BLOCKED."""
+    attempts = flood_waits = 0
+    while True:
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id=tg_id, text=text, parse_mode=parse_mode,
+                                   reply_markup=reply_markup)
+            return SENT
+        except RetryAfter as e:
+            flood_waits += 1
+            wait = _seconds(e.retry_after)
+            logger.warning(f"[broadcast] 429 на {tg_id}, пауза {wait:.0f} с")
+            bucket.pause(wait)
+            if flood_waits >= MAX_RETRY_AFTER:
+                return FAILED
+        except Forbidden:
+            return BLOCKED  # заблокировал бота / деактивирован
+        except BadRequest as e:
+            logger.error(f"[broadcast] {tg_id}: {e}")
+            return FAILED
+        except (TimedOut, NetworkError) as e:
+            attempts += 1
+            if attempts >= MAX_ATTEMPTS:
+                logger.error(f"[broadcast] {tg_id}: {e}")
+                return FAILED
+            await asyncio.sleep(attempts)
+
+
+def _progress(job: dict, counts: dict, status: str) -> dict:
+    done = counts[SENT] + counts[FAILED] + counts[BLOCKED]
+    return {"job_id": job["id"], "total": job["total"], "done": done, "status": status, **counts}
+
+
+def format_progress(p: dict) -> str:
+    title = "📬 Рассылка завершена" if p["status"] == "done" else "📬 Рассылка идёт"
+    return (
+        f"{title} #{p['job_id']}: {p['done']}/{p['total']}\n"
+        f"✅ {p[SENT]}\n❌ {p[FAILED]}\n🚫 {p[BLOCKED]}"
+    )
+
+
+async def run_job(job_id: int, bot: Bot, on_progress: Optional[ProgressCallback] = None,
+                  bucket: Optional[TokenBucket] = None) -> dict:
+    """Send every pending recipient of the job; returns the final progress dict."""
+    job = await asyncio.to_thread(db.get_broadcast_job, job_id)
+    pending = await asyncio.to_thread(db.get_pending_broadcast_recipients, job_id)
+    bucket = bucket or TokenBucket(BROADCAST_RATE)
+    counts = {SENT: job["sent"], FAILED: job["failed"], BLOCKED: job["blocked"]}
+    results: list[tuple[int, str]] = []
+    flush_lock = asyncio.Lock()
+    logger.info(f"[broadcast] #{job_id}: {len(pending)} из {job['total']} в очереди")
+
+    async def flush():
+        nonlocal results
+        async with flush_lock:
+            batch, results = results, []
+            if batch:
+                await asyncio.to_thread(db.record_broadcast_results, job_id, batch)
+
+    queue: asyncio.Queue = asyncio.Queue()
+    for r in pending:
+        queue.put_nowait(r)
+
+    async def worker():
+        while True:
+            try:
+                r = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            status = await deliver(bot, bucket, r["tg_id"], r["text"] or job["text"], job["parse_mode"])
+            counts[status] += 1
+            results.append((r["tg_id"], status))
+            if len(results) >= FLUSH_EVERY:
+                await flush()
+
+    async def ticker():
+        last_report = time.monotonic()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            await flush()
+            if on_progress and time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                try:
+                    await on_progress(_progress(job, counts, "running"))
+                except Exception as e:
+                    logger.warning(f"[broadcast] progress report failed: {e}")
+
+    tick = asyncio.create_task(ticker())
+    try:
+        await asyncio.gather(*(worker() for _ in range(BROADCAST_CONCURRENCY)))
+    finally:
+        tick.cancel()
+        # Даже при отмене (остановка бота) сохраняем то, что уже отправлено
+        await asyncio.shield(flush())
+
+    await asyncio.to_thread(db.finish_broadcast_job, job_id)
+    final = _progress(job, counts, "done")
+    if on_progress:
+        await on_progress(final)
+    logger.info(f"[broadcast] #{job_id} завершена: {final}")
+    return final
+
+
+async def start_job(kind: str, recipients: list[tuple[int, Optional[str]]],
+                    text: Optional[str] = None, parse_mode: Optional[str] = "HTML",
+                    report_chat_id: Optional[int] = None) -> int:
+    """Persist a new job; the caller runs it with run_job()."""
+    return await asyncio.to_thread(
+        db.create_broadcast_job, kind, text, parse_mode, recipients, report_chat_id,
+    )
+
+
+def admin_reporter(bot: Bot, chat_id: int, message_id: int) -> ProgressCallback:
+    """Progress callback that keeps editing one status message."""
+    last_text = None
+
+    async def report(p: dict):
+        nonlocal last_text
+        text = format_progress(p)
+        if text == last_text:
+            return
+        last_text = text
+        try:
+            await bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+
+    return report
+
+
+async def run_with_report(bot: Bot, job_id: int, chat_id: int, header: str | None = None) -> dict:
+    """Send a status message to the admin and run the job, updating it live."""
+    job = await asyncio.to_thread(db.get_broadcast_job, job_id)
+    text = header or format_progress(_progress(job, {SENT: job["sent"], FAILED: job["failed"],
+                                                     BLOCKED: job["blocked"]}, "running"))
+    msg = await bot.send_message(chat_id=chat_id, text=text)
+    return await run_job(job_id, bot, admin_reporter(bot, chat_id, msg.message_id))
+
+
+async def resume_unfinished(bot: Bot) -> list[asyncio.Task]:
+    """Restart the bot's own jobs (BOT_KINDS) left 'running' by a crash/restart (call from post_init)."""
+    jobs = []
+    for kind in BOT_KINDS:
+        jobs += await asyncio.to_thread(db.get_unfinished_broadcast_jobs, kind)
+    tasks = []
+    for job in jobs:
+        logger.info(f"[broadcast] Возобновляю рассылку #{job['id']}")
+        if job.get("report_chat_id"):
+            coro = run_with_report(bot, job["id"], job["report_chat_id"],
+                                   header=f"🔁 Возобновляю рассылку #{job['id']}")
+        else:
+            coro = run_job(job["id"], bot)
+        tasks.append(asyncio.create_task(coro))
+    return tasks
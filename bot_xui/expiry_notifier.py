@@ -0,0 +1,170 @@
+"""
+Уведомления об окончании подписки (cron 10:00, до автоплатежей в 11:00).
+
+Один запрос в БД отдаёт всех кандидатов с days_left (3 / 1 / 0) и флагом
+expired_yesterday. Telegram-сообщения уходят параллельно через общий
+TokenBucket из broadcast.py (RetryAfter ставит на паузу весь поток), письма
+одним INSERT уходят в очередь mail_outbox (доставляет MailSender из api).
+Время и счётчики каждого запуска пишутся в job_runs.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
+
+from api.db import get_expiry_notification_candidates, set_bot_blocked, record_job_run
+from bot_xui.broadcast import TokenBucket, deliver, BROADCAST_RATE, SENT, BLOCKED
+from bot_xui.tariffs import TARIFFS
+
+logger = logging.getLogger(__name__)
+
+WARN_DAYS = {3: ("3 дня", "⏳"), 1: ("1 день", "⚠️"), 0: ("сегодня", "🔴")}
+NOTIFY_CONCURRENCY = 8
+JOB_NAME = "expiry_notify"
+
+
+def _warning_message(user: dict, days: int) -> tuple[str, InlineKeyboardMarkup]:
+    label, icon = WARN_DAYS[days]
+    until = user['subscription_until'].strftime("%d.%m.%Y")
+
+    if user.get('autopay_enabled') and user.get('payment_method_id'):
+        # Autopay user — inform about upcoming charge, no manual CTA
+        tariff_id = user.get('autopay_tariff') or 'monthly_30d'
+        tariff = TARIFFS.get(tariff_id, {})
+        tariff_name = tariff.get('name', tariff_id)
+        price = tariff.get('price', '?')
+
+        if days == 0:
+            msg = (
+                f"🔄 <b>Сегодня автоматически продлим подписку</b>\n\n"
+                f"📦 Тариф: {tariff_name}\n"
+                f"💰 Сумма: {price} ₽\n\n"
+                f"<i>Отменить автопродление: /autopay</i>"
+            )
+        else:
+            msg = (
+                f"🔄 <b>Через {label} автоматически продлим подписку</b>\n\n"
+                f"📦 Тариф: {tariff_name}\n"
+                f"💰 Сумма: {price} ₽\n"
+                f"📅 Окончание: <b>{until}</b>\n\n"
+                f"<i>Отменить автопродление: /autopay</i>"
+            )
+        return msg, InlineKeyboardMarkup([
+            [InlineKeyboardButton("⚙️ Управление автопродлением", callback_data="autopay_manage")]
+        ])
+
+    # No autopay — standard renewal reminder
+    if days == 0:
+        msg = (
+            f"🔴 <b>Подписка истекает сегодня!</b>\n\n"
+            f"📅 Окончание: <b>{until}</b>\n\n"
+            f"Продлите сейчас, чтобы не потерять доступ."
+        )
+    else:
+        msg = (
+            f"{icon} <b>Подписка истекает через {label}</b>\n\n"
+            f"📅 Окончание: <b>{until}</b>\n\n"
+            f"Продлите, чтобы не потерять доступ."
+        )
+    return msg, InlineKeyboardMarkup([
+        [InlineKeyboardButton("🔄 Продлить", callback_data="tariffs")]
+    ])
+
+
+def _expired_message() -> tuple[str, InlineKeyboardMarkup]:
+    return (
+        "❌ <b>Подписка истекла</b>\n\n"
+        "VPN больше не работает. Продлите подписку, "
+        "чтобы вернуть доступ."
+    ), InlineKeyboardMarkup([
+        [InlineKeyboardButton("💎 Продлить", callback_data="tariffs")]
+    ])
+
+
+def plan_notifications(rows: list[dict]) -> tuple[list[tuple], list[tuple]]:
+    """Split candidates into ([(kind, tg_id, text, markup)], [(email, days, until)])."""
+    messages, emails = [], []
+    for user in rows:
+        tg_id = user.get('tg_id')
+        if user.get('expired_yesterday'):
+            if tg_id and tg_id > 0:
+                messages.append(("expired", tg_id, *_expired_message()))
+            continue
+        days = user.get('days_left')
+        if days not in WARN_DAYS:
+            continue
+        if tg_id:
+            messages.append((f"{days}d", tg_id, *_warning_message(user, days)))
+        elif user.get('email'):
+            # Email — только для web-пользователей без Telegram
+            emails.append((user['email'], days, user['subscription_until'].strftime("%d.%m.%Y")))
+    return messages, emails
+
+
+def _queue_emails(batch: list[tuple]) -> dict:
+    """Runs in a worker thread: one bulk INSERT into mail_outbox for the whole run."""
+    from api import mail_queue
+    from api.notifications import _build_message, _smtp_configured, expiry_warning_email
+
+    if not batch:
+        return {"queued": 0, "failed": 0}
+    if not _smtp_configured():
+        return {"queued": 0, "failed": len(batch)}
+    messages = []
+    for email, days, until in batch:
+        subject, text, html = expiry_warning_email(days, until)
+        messages.append((email, subject, _build_message(email, subject, text, html)))
+    try:
+        queued = mail_queue.enqueue_many(messages, kind="expiry_warning", priority=mail_queue.PRIORITY_BULK)
+    except Exception as e:
+        logger.warning(f"[NOTIFY] Failed to queue {len(batch)} emails: {e}")
+        return {"queued": 0, "failed": len(batch)}
+    return {"queued": queued, "failed": 0}
+
+
+async def notify_expiring_subscriptions(bot: Bot) -> dict:
+    """Проверяет истекающие подписки и уведомляет пользователей."""
+    started_at = datetime.now()
+    t0 = time.monotonic()
+
+    rows = await asyncio.to_thread(get_expiry_notification_candidates)
+    messages, emails = plan_notifications(rows)
+    t_query = time.monotonic() - t0
+
+    email_task = asyncio.ensure_future(asyncio.to_thread(_queue_emails, emails))
+
+    bucket = TokenBucket(BROADCAST_RATE)
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def send(kind, tg_id, text, markup):
+        async with semaphore:
+            status = await deliver(bot, bucket, tg_id, text, "HTML", reply_markup=markup)
+        if status != SENT:
+            logger.warning(f"[NOTIFY] {kind} to tg:{tg_id}: {status}")
+        return kind, tg_id, status
+
+    results = await asyncio.gather(*(send(*m) for m in messages))
+    email_stats = await email_task
+
+    stats: dict = {"candidates": len(rows), "query_s": round(t_query, 3)}
+    for kind, _, status in results:
+        bucket_stats = stats.setdefault(kind, {})
+        bucket_stats[status] = bucket_stats.get(status, 0) + 1
+    stats["email"] = email_stats
+
+    blocked = [tg_id for _, tg_id, status in results if status == BLOCKED]
+    try:
+        if blocked:
+            await asyncio.to_thread(set_bot_blocked, blocked, True)
+    except Exception as e:
+        logger.warning(f"[NOTIFY] bot_blocked update failed: {e}")
+
+    duration_ms = int((time.monotonic() - t0) * 1000)
+    logger.info(f"[NOTIFY] Expiry run finished in {duration_ms} ms: {stats}")
+    try:
+        await asyncio.to_thread(record_job_run, JOB_NAME, started_at, duration_ms, stats)
+    except Exception as e:
+        logger.warning(f"[NOTIFY] job_runs insert failed: {e}")
+    return stats
@@ -3,11 +3,11 @@
 """
 import io
 import logging
-import sqlite3 
-import json
 from datetime import datetime, timedelta
 from urllib.parse import quote
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import qr_cache
+from bot_xui import xui_db
 from config import MTPROTO_SERVER, MTPROTO_PORT, MTPROTO_SECRET, BOT_USERNAME, REFERRAL_REWARD_DAYS, XUI_SUB_PATH
 
 logger = logging.getLogger(__name__)
@@ -24,50 +24,38 @@ PUBLIC_BASE_URL = "https://344988.snk.wtf"
 
 
 def get_user_sub_url(tg_id: int, users_id: int) -> str:
-    """Получает subId пользователя из 3x-ui"""
+    """Получает subId пользователя из 3x-ui (read-only зеркало bot_xui/xui_db.py)."""
 
-    db_path = "/etc/x-ui/x-ui.db"
-    tg_id_str = str(tg_id)
-    
     # Массив портов для проверки
     ports_to_check = [7443]  # Добавьте нужные порты
-    
+
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
+        snap = xui_db.snapshot()
 
         # Безопасная проверка tg_id
         if tg_id and tg_id != 0:  # Проверяем что tg_id не None и не 0
             search_pattern = str(tg_id)
+            main_email = f"tiin_{tg_id}"
         else:
             search_pattern = "web_" + str(users_id)  # Преобразуем users_id в строку
-        
+            main_email = f"tiin_web_{users_id}"
+
         for port in ports_to_check:
-            cursor.execute("""
-                SELECT settings 
-                FROM inbounds 
-                WHERE port = ?
-            """, (port,))
-            
-            result = cursor.fetchone()
-            
-            if result:
-                settings = json.loads(result[0])
-                clients = settings.get('clients', [])
-                
-                for client in clients:
-                    client_email = client.get('email', '')
-                    if search_pattern in client_email:
-                        sub_id = client.get('subId')
-                        if sub_id:
-                            conn.close()
-                            return f"{XUI_SUB_PATH}/sub/{sub_id}"
-                                    
-        conn.close()
+            # Основной ключ пользователя — сразу по индексу email
+            entry = snap.by_email.get(main_email)
+            if entry and entry[2].get('port') == port and entry[1].get('subId'):
+                return f"{XUI_SUB_PATH}/sub/{entry[1]['subId']}"
+
+            for _inbound, client in snap.clients(port=port):
+                if search_pattern in client.get('email', ''):
+                    sub_id = client.get('subId')
+                    if sub_id:
+                        return f"{XUI_SUB_PATH}/sub/{sub_id}"
+
         return ""
-        
+
     except Exception as e:
-        print(f"Error getting sub_url for tg_id {tg_id}: {e}")
+        logger.warning(f"Error getting sub_url for tg_id {tg_id}: {e}")
         return ""
 
 
@@ -215,4 +203,24 @@ async def safe_edit_text(query, text: str, reply_markup=None, parse_mode: str =
         return True
     except Exception as e:
         logger.warning(f"safe_edit_text edit failed: {e}")
-        return False
\ No newline at end of file
+        return False
+
+async def send_qr_photo(send, data: str, box_size: int = 8, border: int = 4, **kwargs):
+    """
+    Отправляет QR для `data` через `send` (reply_photo / send_photo и т.п.).
+    Уже загруженный QR уходит по file_id, без повторной загрузки картинки.
+    """
+    from telegram.error import BadRequest
+
+    photo = qr_cache.telegram_photo(data, box_size, border)
+    try:
+        message = await send(photo=photo, **kwargs)
+    except BadRequest as e:
+        if not isinstance(photo, str):
+            raise
+        # file_id протух (другой бот, удалён) — загружаем заново
+        logger.info(f"Cached QR file_id rejected ({e}), re-uploading")
+        qr_cache.forget_telegram_photo(data, box_size, border)
+        message = await send(photo=qr_cache.png_io(data, box_size, border), **kwargs)
+    qr_cache.remember_telegram_photo(data, message, box_size, border)
+    return message
@@ -5,15 +5,19 @@
 Зачем: x-ui limitIp считает уникальные IP, а не устройства.
 Мобильные пользователи с динамическим IP забивают лимит за 2-3 дня.
 Очистка IP старше 2 часов освобождает слоты для новых подключений.
+
+Пишет своим соединением (read-only зеркало bot_xui/xui_db.py только читает
+и подхватит изменения по PRAGMA data_version).
 """
 import json
 import logging
 import sqlite3
 import time
 
+from config import XUI_DB_PATH
+
 logger = logging.getLogger(__name__)
 
-XUI_DB_PATH = "/etc/x-ui/x-ui.db"
 IP_MAX_AGE = 2 * 3600  # 2 hours
 
 
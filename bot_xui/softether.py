@@ -1,58 +1,345 @@
 """
 SoftEther VPN Server client wrapper.
 Manages users via vpncmd CLI.
+
+Commands go through one long-lived interactive vpncmd process per worker
+(admin password is sent over stdin, not argv) instead of a fork + login per
+command. Several commands can be pipelined in one write (see _run_batch):
+create_users() sends every UserCreate in one round trip and the follow-up
+UserPasswordSet / UserExpiresSet of the users that were created in a second
+one; set_users_expiry() is a single round trip.
+If the session cannot be started we fall back to one-shot `vpncmd /CMD`.
+
+UserList / SessionList results are cached for LIST_CACHE_TTL seconds; any
+mutating command drops the cache.
 """
 import logging
+import os
+import re
+import select
 import subprocess
+import threading
+import time
 
 from config import SOFTETHER_VPNCMD, SOFTETHER_SERVER_PASSWORD, SOFTETHER_HUB
 
 logger = logging.getLogger(__name__)
 
-_CMD_BASE = [
-    SOFTETHER_VPNCMD, "127.0.0.1:5555", "/SERVER",
-    f"/PASSWORD:{SOFTETHER_SERVER_PASSWORD}",
-    f"/HUB:{SOFTETHER_HUB}",
-    "/CMD",
-]
+VPNCMD_SERVER = "127.0.0.1:5555"
+VPNCMD_TIMEOUT = 10
+SESSION_RETRY_AFTER = 60.0   # после неудачного старта сессии — one-shot режим на минуту
+LIST_CACHE_TTL = 5.0
 
+_LIST_COMMANDS = ("UserList", "SessionList")
+# Приглашение в начале строки; при конвейере за ним сразу идёт вывод следующей команды
+_PROMPT_RE = re.compile(r"(?:^|\n)VPN Server(?:/[^>\r\n]*)?>[ \t]*")
+_PASSWORD_RE = re.compile(r"Password:[ \t]*$")
+_ERROR_RE = re.compile(r"Error occurred\. \(Error code: (\d+)\)")
 
-def _run(*args) -> str:
-    """Run a vpncmd command and return stdout. Raises RuntimeError on failure."""
-    cmd = _CMD_BASE + list(args)
-    result = subprocess.run(cmd, capture_output=True, text=True, timeout=10)
+
+def _oneshot_cmd(*args) -> list[str]:
+    return [
+        SOFTETHER_VPNCMD, VPNCMD_SERVER, "/SERVER",
+        f"/PASSWORD:{SOFTETHER_SERVER_PASSWORD}",
+        f"/HUB:{SOFTETHER_HUB}",
+        "/CMD", *args,
+    ]
+
+
+def _command_line(cmd: tuple) -> str:
+    """Interactive vpncmd line; arguments with spaces are double-quoted."""
+    parts = []
+    for arg in cmd:
+        if "\n" in arg or "\r" in arg or '"' in arg:
+            raise ValueError(f"vpncmd {cmd[0]}: argument contains forbidden characters")
+        parts.append(f'"{arg}"' if " " in arg else arg)
+    return " ".join(parts) + "\n"
+
+
+# ─────────────────────────────────────────────
+#  Persistent vpncmd session
+# ─────────────────────────────────────────────
+
+class _SessionUnavailable(RuntimeError):
+    """The session could not be started; nothing was sent to vpncmd."""
+
+
+class _BatchInterrupted(RuntimeError):
+    """The session broke mid-batch; `outputs` holds the commands that completed."""
+
+    def __init__(self, message: str, outputs: list[str]):
+        super().__init__(message)
+        self.outputs = outputs
+
+
+class _VpncmdSession:
+    """One interactive vpncmd process; commands are written to stdin and
+    their output is read up to the next `VPN Server/<HUB>>` prompt."""
+
+    def __init__(self, timeout: float = VPNCMD_TIMEOUT):
+        self.timeout = timeout
+        self._proc: subprocess.Popen | None = None
+        self._buf = ""
+        self._lock = threading.Lock()
+        self._failed_at = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self._proc is not None and self._proc.poll() is None
+
+    def _start(self):
+        if time.monotonic() - self._failed_at < SESSION_RETRY_AFTER:
+            raise RuntimeError("vpncmd session recently failed to start")
+        try:
+            self._proc = subprocess.Popen(
+                [SOFTETHER_VPNCMD, VPNCMD_SERVER, "/SERVER", f"/HUB:{SOFTETHER_HUB}"],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                bufsize=0,
+            )
+            self._buf = ""
+            self._read_until_prompt(login=True)
+        except (OSError, RuntimeError):
+            self._failed_at = time.monotonic()
+            raise
+        self._failed_at = 0.0
+        logger.info("vpncmd session started")
+
+    def close(self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        try:
+            if proc.poll() is None:
+                proc.stdin.write(b"exit\n")
+                proc.stdin.close()
+                proc.wait(timeout=2)
+        except Exception:
+            proc.kill()
+            proc.wait()
+
+    def _read_until_prompt(self, login: bool = False) -> str:
+        fd = self._proc.stdout.fileno()
+        deadline = time.monotonic() + self.timeout
+        password_sent = False
+        while True:
+            match = _PROMPT_RE.search(self._buf)
+            if match:
+                out, self._buf = self._buf[:match.start()], self._buf[match.end():]
+                return out
+            if login and _PASSWORD_RE.search(self._buf):
+                if password_sent or not SOFTETHER_SERVER_PASSWORD:
+                    raise RuntimeError("vpncmd authentication failed")
+                self._proc.stdin.write(f"{SOFTETHER_SERVER_PASSWORD}\n".encode())
+                password_sent = True
+                self._buf = ""
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise RuntimeError("vpncmd timed out")
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise RuntimeError("vpncmd exited")
+            self._buf += chunk.decode(errors="replace")
+
+    def run_many(self, lines: list[str]) -> list[str]:
+        """Pipeline command lines; returns raw output per command."""
+        payload = "".join(lines)
+        with self._lock:
+            if not self.alive:
+                try:
+                    self._start()
+                except (OSError, RuntimeError) as e:
+                    self.close()
+                    raise _SessionUnavailable(str(e)) from e
+            outputs = []
+            try:
+                self._proc.stdin.write(payload.encode())
+                for _ in lines:
+                    outputs.append(self._read_until_prompt())
+                return outputs
+            except (OSError, RuntimeError) as e:
+                # Состояние сессии неизвестно — закрываем, следующий вызов поднимет новую
+                self.close()
+                raise _BatchInterrupted(str(e), outputs) from e
+
+
+_session = _VpncmdSession()
+
+
+def close_session():
+    _session.close()
+
+
+def _run_oneshot(*args) -> str:
+    result = subprocess.run(_oneshot_cmd(*args), capture_output=True, text=True, timeout=VPNCMD_TIMEOUT)
     if result.returncode != 0:
-        # Log only the command name, not args (may contain passwords)
-        logger.error(f"vpncmd error: command={args[0] if args else '?'}")
         raise RuntimeError(f"vpncmd failed: {args[0] if args else '?'}")
     return result.stdout
 
 
-def create_user(username: str, password: str) -> bool:
-    """Create a user with password authentication."""
+def _run_oneshot_many(commands: list[tuple]) -> list[str | None]:
+    outputs = []
+    for cmd in commands:
+        try:
+            outputs.append(_run_oneshot(*cmd))
+        except (OSError, RuntimeError, subprocess.SubprocessError):
+            outputs.append(None)
+    return outputs
+
+
+def _run_batch(commands: list[tuple]) -> list[str | None]:
+    """Run several vpncmd commands in one round trip. None marks a failed command.
+
+    One-shot fallback never replays a command that may already have run: it is
+    used when the session could not start (nothing sent) or, after a mid-batch
+    failure, only for the read-only remainder (UserList / SessionList).
+    """
     try:
-        _run("UserCreate", username, "/GROUP:none", "/REALNAME:none", "/NOTE:none")
-        _run("UserPasswordSet", username, f"/PASSWORD:{password}")
-        logger.info(f"SoftEther user created: {username}")
-        return True
-    except RuntimeError as e:
-        logger.error(f"Failed to create SoftEther user {username}: {e}")
-        return False
+        lines = [_command_line(cmd) for cmd in commands]
+    except ValueError as e:
+        logger.error(str(e))
+        return [None] * len(commands)
+    if not commands:
+        return []
+    if any(cmd[0] not in _LIST_COMMANDS for cmd in commands):
+        invalidate_cache()
+    try:
+        outputs = _session.run_many(lines)
+    except _SessionUnavailable as e:
+        logger.warning(f"vpncmd session unavailable ({e}), using one-shot vpncmd")
+        return _run_oneshot_many(commands)
+    except _BatchInterrupted as e:
+        outputs = list(e.outputs)
+        rest = commands[len(outputs):]
+        if all(cmd[0] in _LIST_COMMANDS for cmd in rest):
+            logger.warning(f"vpncmd session lost ({e}), re-reading via one-shot vpncmd")
+            outputs += _run_oneshot_many(rest)
+        else:
+            # Команда могла выполниться — не повторяем, считаем неудачей
+            logger.error(f"vpncmd session lost ({e}) during {rest[0][0]}; {len(rest)} command(s) not confirmed")
+            outputs += [None] * len(rest)
 
+    results = []
+    for cmd, out in zip(commands, outputs):
+        if out is None:
+            results.append(None)
+            continue
+        err = _ERROR_RE.search(out)
+        if err:
+            # Log only the command name, not args (may contain passwords)
+            logger.error(f"vpncmd error: command={cmd[0]} code={err.group(1)}")
+            results.append(None)
+        else:
+            results.append(out)
+    return results
 
-def set_user_expiry(username: str, expires_str: str) -> bool:
-    """Set user expiry date. Format: YYYY/MM/DD or YYYY/MM/DD HH:MM:SS"""
+
+def _run(*args) -> str:
+    """Run a vpncmd command and return its output. Raises RuntimeError on failure."""
+    out = _run_batch([args])[0]
+    if out is None:
+        raise RuntimeError(f"vpncmd failed: {args[0] if args else '?'}")
+    return out
+
+
+# ─────────────────────────────────────────────
+#  UserList / SessionList cache
+# ─────────────────────────────────────────────
+
+_list_cache: dict[str, tuple[float, list[dict]]] = {}
+_list_cache_lock = threading.Lock()
+
+
+def invalidate_cache():
+    with _list_cache_lock:
+        _list_cache.clear()
+
+
+def _cached(command: str, parse, max_age: float) -> list[dict]:
+    with _list_cache_lock:
+        hit = _list_cache.get(command)
+    if hit and time.monotonic() - hit[0] < max_age:
+        return hit[1]
+    try:
+        result = parse(_run(command))
+    except RuntimeError:
+        return []
+    with _list_cache_lock:
+        _list_cache[command] = (time.monotonic(), result)
+    return result
+
+
+# ─────────────────────────────────────────────
+#  Users
+# ─────────────────────────────────────────────
+
+def _full_expiry(expires_str: str) -> str:
     # vpncmd requires full datetime format: YYYY/MM/DD HH:MM:SS
     if len(expires_str) == 10:  # YYYY/MM/DD only
-        expires_str = f"{expires_str} 23:59:59"
+        return f"{expires_str} 23:59:59"
+    return expires_str
+
+
+def create_users(users: list[tuple[str, str, str | None]]) -> dict[str, bool]:
+    """Batch create: [(username, password, expires_str | None)] -> {username: ok}.
+
+    Two round trips for any number of users: all UserCreate, then password and
+    expiry only for users whose UserCreate succeeded — a failed create (user
+    exists) must not overwrite someone's password. A user created here whose
+    password/expiry could not be set is deleted again.
+    """
+    created = _run_batch([
+        ("UserCreate", username, "/GROUP:none", "/REALNAME:none", "/NOTE:none") for username, _, _ in users
+    ])
+    results = {username: out is not None for (username, _, _), out in zip(users, created)}
+
+    commands, owners = [], []
+    for username, password, expires_str in users:
+        if not results[username]:
+            continue
+        commands.append(("UserPasswordSet", username, f"/PASSWORD:{password}"))
+        owners.append(username)
+        if expires_str:
+            commands.append(("UserExpiresSet", username, f"/EXPIRES:{_full_expiry(expires_str)}"))
+            owners.append(username)
+    for username, out in zip(owners, _run_batch(commands)):
+        if out is None:
+            results[username] = False
+
+    half_made = [u for u in owners if not results[u]]
+    if half_made:
+        _run_batch([("UserDelete", u) for u in dict.fromkeys(half_made)])
+    for username, ok in results.items():
+        if ok:
+            logger.info(f"SoftEther user created: {username}")
+        else:
+            logger.error(f"Failed to create SoftEther user {username}")
+    return results
+
+
+def create_user(username: str, password: str, expires_str: str | None = None) -> bool:
+    """Create a user with password authentication (and expiry, if given)."""
+    return create_users([(username, password, expires_str)])[username]
+
+
+def set_user_expiry(username: str, expires_str: str) -> bool:
+    """Set user expiry date. Format: YYYY/MM/DD or YYYY/MM/DD HH:MM:SS"""
     try:
-        _run("UserExpiresSet", username, f"/EXPIRES:{expires_str}")
+        _run("UserExpiresSet", username, f"/EXPIRES:{_full_expiry(expires_str)}")
         return True
     except RuntimeError as e:
         logger.error(f"Failed to set expiry for {username}: {e}")
         return False
 
 
+def set_users_expiry(expiries: dict[str, str]) -> dict[str, bool]:
+    """Batch expiry update in one round trip: {username: expires_str} -> {username: ok}."""
+    names = list(expiries)
+    outputs = _run_batch([
+        ("UserExpiresSet", name, f"/EXPIRES:{_full_expiry(expiries[name])}") for name in names
+    ])
+    return {name: out is not None for name, out in zip(names, outputs)}
+
+
 def delete_user(username: str) -> bool:
     try:
         _run("UserDelete", username)
@@ -74,13 +361,7 @@ def disable_user(username: str) -> bool:
         return False
 
 
-def list_sessions() -> list[dict]:
-    """List active sessions (connected users) in the hub."""
-    try:
-        output = _run("SessionList")
-    except RuntimeError:
-        return []
-
+def _parse_sessions(output: str) -> list[dict]:
     sessions = []
     current = {}
     for line in output.splitlines():
@@ -108,13 +389,12 @@ def list_sessions() -> list[dict]:
     return [s for s in sessions if s.get("username") != "SecureNAT"]
 
 
-def list_users() -> list[dict]:
-    """List all users in the hub. Returns list of dicts with user info."""
-    try:
-        output = _run("UserList")
-    except RuntimeError:
-        return []
+def list_sessions(max_age: float = LIST_CACHE_TTL) -> list[dict]:
+    """List active sessions (connected users) in the hub."""
+    return _cached("SessionList", _parse_sessions, max_age)
+
 
+def _parse_users(output: str) -> list[dict]:
     users = []
     current = {}
     for line in output.splitlines():
@@ -143,3 +423,8 @@ def list_users() -> list[dict]:
         users.append(current)
 
     return users
+
+
+def list_users(max_age: float = LIST_CACHE_TTL) -> list[dict]:
+    """List all users in the hub. Returns list of dicts with user info."""
+    return _cached("UserList", _parse_users, max_age)
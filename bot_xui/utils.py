@@ -1,131 +1,265 @@
-import requests
+import asyncio
 import json
 import subprocess
+import threading
+import time
+import weakref
 from urllib.parse import quote
 import os
 import logging
+
+import httpx
 from config import XUI_HOST, XUI_USERNAME, XUI_PASSWORD, XUI_TOTP_SECRET, VLESS_DOMAIN, VLESS_PORT, VLESS_PATH, VLESS_SID, VLESS_SID_LIST, VLESS_PBK, VLESS_SNI
 
 logger = logging.getLogger(__name__)
 
-class XUIClient:
-    def __init__(self, host, username, password):
-        self.host = host.rstrip('/')  # Исправлено: host, не url
+# Сколько секунд переиспользуем /panel/api/inbounds/list между вызовами
+INBOUND_CACHE_TTL = 5.0
+
+# Не больше N одновременных запросов к панели с одного процесса/loop'а
+XUI_MAX_CONCURRENCY = int(os.getenv("XUI_MAX_CONCURRENCY", "4"))
+XUI_TIMEOUT = 10
+
+
+class _InboundSnapshot:
+    """Разобранный /panel/api/inbounds/list с индексами для O(1) поиска.
+
+    settings каждого inbound'а парсится один раз; клиенты индексируются
+    по email, tgId и протоколу inbound'а.
+    """
+
+    def __init__(self, inbounds: list[dict]):
+        self.inbounds = inbounds
+        self.fetched_at = time.monotonic()
+        self.by_id: dict[int, dict] = {}
+        self.by_email: dict[str, tuple[int, dict, dict]] = {}   # email -> (inbound_id, client, inbound)
+        self.by_tg_id: dict[str, list[tuple[int, dict]]] = {}   # str(tgId) -> [(inbound_id, client), ...]
+        self.by_protocol: dict[str, int] = {}                   # protocol -> first inbound_id
+        self.vless_reality_id: int | None = None
+
+        for inbound in inbounds:
+            ib_id = inbound['id']
+            protocol = inbound.get('protocol', '')
+            self.by_id[ib_id] = inbound
+            self.by_protocol.setdefault(protocol, ib_id)
+            if (self.vless_reality_id is None and protocol == 'vless'
+                    and 'reality' in inbound.get('streamSettings', '{}').lower()):
+                self.vless_reality_id = ib_id
+            try:
+                settings = json.loads(inbound.get('settings', '{}'))
+            except (TypeError, ValueError):
+                continue
+            for client in settings.get('clients', []):
+                email = client.get('email')
+                if email is not None:
+                    self.by_email.setdefault(email, (ib_id, client, inbound))
+                self.by_tg_id.setdefault(str(client.get('tgId')), []).append((ib_id, client))
+
+    def is_fresh(self) -> bool:
+        return time.monotonic() - self.fetched_at < INBOUND_CACHE_TTL
+
+
+def _extended_expiry(current_expiry: int, duration_ms: int) -> int:
+    """Новый expiryTime: продление от текущего срока или от now, если он истёк."""
+    now_ms = int(time.time() * 1000)
+    max_reasonable = now_ms + 10 * 365 * 24 * 60 * 60 * 1000
+    if current_expiry > max_reasonable:
+        logger.warning(f"Suspicious expiryTime {current_expiry}, resetting to now")
+        current_expiry = now_ms
+    base = current_expiry if current_expiry > now_ms else now_ms
+    return base + duration_ms
+
+
+class _XUIConnection:
+    """Keep-alive HTTP-пул к панели 3x-ui: cookie-сессия, логин, лимит запросов.
+
+    Один на (event loop, host, username) — все AsyncXUIClient с одинаковыми
+    кредами делят соединения, сессионную cookie и семафор.
+    """
+
+    def __init__(self, max_concurrency: int, transport=None):
+        self.http = httpx.AsyncClient(
+            verify=False,  # Отключаем проверку SSL для локального подключения
+            timeout=XUI_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency,
+                keepalive_expiry=60,
+            ),
+            transport=transport,
+        )
+        self.sem = asyncio.Semaphore(max_concurrency)
+        self.login_lock = asyncio.Lock()
+        self.logged_in = False
+        self.login_gen = 0  # растёт при каждом успешном логине
+
+
+# loop -> {(host, username): _XUIConnection}
+_xui_connections: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = weakref.WeakKeyDictionary()
+
+
+class AsyncXUIClient:
+    """Асинхронный клиент 3x-ui поверх пула httpx-соединений."""
+
+    def __init__(self, host, username, password, max_concurrency: int = XUI_MAX_CONCURRENCY, transport=None):
+        self.host = host.rstrip('/')
         self.username = username
         self.password = password
-        self.session = requests.Session()
-        self.session.verify = False  # Отключаем проверку SSL для локального подключения
-        self.cookie_file = '/tmp/xui-cookie.txt'
-        self._logged_in = False
+        self.max_concurrency = max_concurrency
+        self._transport = transport  # для тестов: httpx.MockTransport
+        self._own_conns = weakref.WeakKeyDictionary()  # loop -> _XUIConnection, если передан transport
+        self._snapshot: _InboundSnapshot | None = None
+
+    def _existing_conn(self, loop) -> _XUIConnection | None:
+        if self._transport is not None:
+            conn = self._own_conns.get(loop)
+        else:
+            conn = _xui_connections.get(loop, {}).get((self.host, self.username))
+        if conn is None or conn.http.is_closed:
+            return None
+        return conn
+
+    def _conn(self) -> _XUIConnection:
+        loop = asyncio.get_running_loop()
+        conn = self._existing_conn(loop)
+        if conn is not None:
+            return conn
+        conn = _XUIConnection(self.max_concurrency, self._transport)
+        if self._transport is not None:
+            self._own_conns[loop] = conn
+        else:
+            _xui_connections.setdefault(loop, {})[(self.host, self.username)] = conn
+        return conn
 
-    def login(self) -> bool:
+    @property
+    def _logged_in(self) -> bool:
+        try:
+            conn = self._existing_conn(asyncio.get_running_loop())
+        except RuntimeError:  # нет запущенного loop'а
+            return False
+        return bool(conn and conn.logged_in)
+
+    async def login(self) -> bool:
         """Login через nginx"""
+        conn = self._conn()
         try:
-            # Исправлено: используем self.host, нет base_path
-            login_url = f"{self.host}/login"
-            response = self.session.post(
-                login_url,
-                json={"username": self.username, "password": self.password},
-                headers={"Content-Type": "application/json"}
-            )
-            
+            async with conn.sem:
+                response = await conn.http.post(
+                    f"{self.host}/login",
+                    json={"username": self.username, "password": self.password},
+                    headers={"Content-Type": "application/json"}
+                )
             if response.status_code == 200:
                 data = response.json()
                 if data.get("success"):
                     logger.info("✅ XUI login successful")
-                    self._logged_in = True
+                    conn.logged_in = True
+                    conn.login_gen += 1
                     return True
             return False
         except Exception as e:
             logger.error(f"Login error: {e}")
             return False
 
-    def _request(self, method, url, **kwargs):
+    async def _relogin(self, seen_gen: int):
+        """Перелогиниться, если никто не сделал это после seen_gen."""
+        conn = self._conn()
+        async with conn.login_lock:
+            if conn.logged_in and conn.login_gen != seen_gen:
+                return
+            conn.logged_in = False
+            await self.login()
+
+    async def _request(self, method, url, **kwargs):
         """Выполняет запрос, при необходимости делает login/re-login."""
-        kwargs.setdefault('timeout', 10)
-        if not self._logged_in:
-            self.login()  # Синхронный вызов, без await
-        response = self.session.request(method, url, **kwargs)
+        conn = self._conn()
+        if not conn.logged_in:
+            await self._relogin(conn.login_gen)
+        seen_gen = conn.login_gen
+        async with conn.sem:
+            response = await conn.http.request(method, url, **kwargs)
         content_type = response.headers.get('content-type', '')
         if response.status_code in (401, 404) or (
             'application/json' not in content_type and response.status_code == 200
         ):
             logger.info("XUI session expired, re-logging in")
-            self._logged_in = False
-            self.login()
-            response = self.session.request(method, url, **kwargs)
+            await self._relogin(seen_gen)
+            async with conn.sem:
+                response = await conn.http.request(method, url, **kwargs)
         return response
 
-    def get_inbounds(self):  # Убран async
-        """Получить список inbounds"""
-        response = self._request("GET", f"{self.host}/panel/api/inbounds/list")
+    async def aclose(self):
+        """Закрыть HTTP-пул текущего loop'а."""
+        conn = self._existing_conn(asyncio.get_running_loop())
+        if conn is not None:
+            await conn.http.aclose()
+
+    async def _fetch_snapshot(self) -> _InboundSnapshot | None:
+        """Один запрос /inbounds/list на INBOUND_CACHE_TTL секунд."""
+        snap = self._snapshot
+        if snap is not None and snap.is_fresh():
+            return snap
+        response = await self._request("GET", f"{self.host}/panel/api/inbounds/list")
         data = response.json()
-        if data.get('success'):
-            return data.get('obj', [])
-        return []
+        if not data.get('success'):
+            return None
+        snap = _InboundSnapshot(data.get('obj') or [])
+        self._snapshot = snap
+        return snap
 
-    def get_vless_reality_inbound_id(self, fallback_id: int = 1) -> int:
+    def invalidate_inbounds(self):
+        """Сбросить кэш inbound'ов (вызывается после любых изменений клиентов)."""
+        self._snapshot = None
+
+    async def get_inbounds(self):
+        """Получить список inbounds"""
+        snap = await self._fetch_snapshot()
+        return snap.inbounds if snap else []
+
+    async def get_vless_reality_inbound_id(self, fallback_id: int = 1) -> int:
         """Find the first VLESS Reality inbound id dynamically."""
-        for inbound in self.get_inbounds():
-            protocol = inbound.get('protocol', '')
-            stream = inbound.get('streamSettings', '{}')
-            if protocol == 'vless' and 'reality' in stream.lower():
-                return inbound['id']
+        snap = await self._fetch_snapshot()
+        if snap and snap.vless_reality_id is not None:
+            return snap.vless_reality_id
         logger.warning(f"No VLESS Reality inbound found, using fallback={fallback_id}")
         return fallback_id
 
-    def get_client_by_email(self, email):
+    async def get_client_by_email(self, email):
         """Найти клиента по email"""
-        inbounds = self.get_inbounds()
-        for inbound in inbounds:
-            settings = json.loads(inbound.get('settings', '{}'))
-            clients = settings.get('clients', [])
-            for client in clients:
-                if client.get('email') == email:
-                    return {
-                        'inbound_id': inbound['id'],
-                        'client': client,
-                        'inbound': inbound
-                    }
-        return None
+        snap = await self._fetch_snapshot()
+        found = snap.by_email.get(email) if snap else None
+        if not found:
+            return None
+        inbound_id, client, inbound = found
+        return {
+            'inbound_id': inbound_id,
+            'client': client,
+            'inbound': inbound
+        }
 
-    def get_client_by_tg_id(self, tg_id):
+    async def get_client_by_tg_id(self, tg_id):
         """Найти клиента по tg_id среди всех inbound'ов"""
         try:
-            response = self._request("GET", f"{self.host}/panel/api/inbounds/list")
-            result = response.json()
-
-            if not result.get('success'):
+            snap = await self._fetch_snapshot()
+            if not snap:
                 return None
 
-            for inbound in result.get('obj', []):
-                settings = json.loads(inbound.get('settings', '{}'))
-                for client in settings.get('clients', []):
-                    if str(client.get('tgId')) == str(tg_id) and not client.get('email', '').startswith('test-'):
-                        return {
-                            'client': client,
-                            'inbound_id': inbound['id']
-                        }
+            for inbound_id, client in snap.by_tg_id.get(str(tg_id), []):
+                if not client.get('email', '').startswith('test-'):
+                    return {
+                        'client': client,
+                        'inbound_id': inbound_id
+                    }
             return None
-            
+
         except Exception as e:
             logger.error(f"Error searching client by tg_id: {e}")
             return None
 
-    def extend_client_expiry(self, inbound_id, client, duration_ms):
+    async def extend_client_expiry(self, inbound_id, client, duration_ms):
         """Продлить срок действия клиента на duration_ms миллисекунд."""
         try:
-            import time
-            now_ms = int(time.time() * 1000)
-            current_expiry = client.get('expiryTime', 0)
-
-            max_reasonable = now_ms + 10 * 365 * 24 * 60 * 60 * 1000
-            if current_expiry > max_reasonable:
-                logger.warning(f"Suspicious expiryTime {current_expiry}, resetting to now")
-                current_expiry = now_ms
-
-            base = current_expiry if current_expiry > now_ms else now_ms
-            new_expiry = base + duration_ms
+            new_expiry = _extended_expiry(client.get('expiryTime', 0), duration_ms)
 
             logger.info(f"duration_ms: {duration_ms}, new_expiry: {new_expiry}")
 
@@ -143,7 +277,7 @@ class XUIClient:
                 "settings": json.dumps({"clients": [updated_client]})
             }
 
-            response = self._request(
+            response = await self._request(
                 "POST",
                 f"{self.host}/panel/api/inbounds/updateClient/{client_id}",
                 json=payload,
@@ -152,6 +286,7 @@ class XUIClient:
 
             result = response.json()
             logger.info(f"Extend expiry response: {result}")
+            self.invalidate_inbounds()
             if result.get('success', False):
                 return new_expiry
             return False
@@ -160,10 +295,9 @@ class XUIClient:
             logger.error(f"Error extending client expiry: {e}", exc_info=True)
             return False
 
-    def add_or_extend_client(self, inbound_id, email, tg_id, uuid, expiry_time=0, total_gb=0, limit_ip=10, extend_ms=None):
+    async def add_or_extend_client(self, inbound_id, email, tg_id, uuid, expiry_time=0, total_gb=0, limit_ip=10, extend_ms=None):
         """Добавить клиента или продлить срок"""
-        import time
-        existing = self.get_client_by_tg_id(tg_id)
+        existing = await self.get_client_by_tg_id(tg_id)
 
         logger.debug(f"existing client: {existing}")
         if existing and not existing['client'].get('email', '').startswith('test-'):
@@ -174,28 +308,28 @@ class XUIClient:
             else:
                 now_ms = int(time.time() * 1000)
                 duration_ms = expiry_time - now_ms
-            return self.extend_client_expiry(
+            return await self.extend_client_expiry(
                 existing['inbound_id'],
                 existing['client'],
                 duration_ms
             )
-        
+
         logger.info(f"Client with tg_id={tg_id} not found, creating new")
-        return self.add_client(inbound_id, email, tg_id, uuid, expiry_time, total_gb, limit_ip)
+        return await self.add_client(inbound_id, email, tg_id, uuid, expiry_time, total_gb, limit_ip)
 
-    def add_client(self, inbound_id, email, tg_id, uuid, expiry_time=0, total_gb=0, limit_ip=10, sub_id=None):
+    async def add_client(self, inbound_id, email, tg_id, uuid, expiry_time=0, total_gb=0, limit_ip=10, sub_id=None):
         """Добавить клиента в inbound с учетом протокола (VLESS или Hysteria)"""
         import uuid as uuid_lib
-        
+
         # 1. Сначала узнаем протокол инбаунда
         protocol = "vless"
-        for ib in self.get_inbounds():
-            if ib['id'] == inbound_id:
-                protocol = ib.get('protocol', 'vless').lower()
-                break
+        snap = await self._fetch_snapshot()
+        ib = snap.by_id.get(inbound_id) if snap else None
+        if ib:
+            protocol = ib.get('protocol', 'vless').lower()
 
         final_sub_id = sub_id or str(uuid_lib.uuid4()).replace('-', '')[:16]
-        
+
         # 2. Формируем данные клиента в зависимости от протокола
         client_obj = {
             "email": email,
@@ -213,42 +347,42 @@ class XUIClient:
         else:
             client_obj["id"] = uuid
             client_obj["flow"] = "xtls-rprx-vision"
-        
+
         client_data = {
             "id": inbound_id,
             "settings": json.dumps({"clients": [client_obj]})
         }
-        
+
         try:
             logger.info(f"Sending addClient request ({protocol}) to: {self.host}/panel/api/inbounds/addClient")
-            
-            response = self._request(
+
+            response = await self._request(
                 "POST",
                 f"{self.host}/panel/api/inbounds/addClient",
                 json=client_data,
                 headers={"Content-Type": "application/json"}
             )
-            
+
             result = response.json()
             logger.info(f"api Response: {result}")
+            self.invalidate_inbounds()
             if result.get('success', False):
                 return {"success": True, "subId": final_sub_id}
             return {"success": False, "msg": result.get('msg')}
-            
+
         except Exception as e:
             logger.error(f"Error adding client: {e}")
             return {"success": False}
 
-    def get_hysteria_inbound_id(self, fallback_id: int = 4) -> int:
+    async def get_hysteria_inbound_id(self, fallback_id: int = 4) -> int:
         """Find the first Hysteria inbound id dynamically."""
-        for inbound in self.get_inbounds():
-            protocol = inbound.get('protocol', '')
-            if protocol == 'hysteria':
-                return inbound['id']
+        snap = await self._fetch_snapshot()
+        if snap and 'hysteria' in snap.by_protocol:
+            return snap.by_protocol['hysteria']
         logger.warning(f"No Hysteria inbound found, using fallback={fallback_id}")
         return fallback_id
 
-    def deactivate_client(self, inbound_id, client):
+    async def deactivate_client(self, inbound_id, client):
         """Отключить клиента (enable=false)"""
         client_to_update = {**client, 'enable': False}
         payload = {
@@ -256,76 +390,180 @@ class XUIClient:
             "settings": json.dumps({"clients": [client_to_update]})
         }
         try:
-            response = self._request(
+            response = await self._request(
                 "POST",
                 f"{self.host}/panel/api/inbounds/updateClient/{client['id']}",
                 json=payload,
                 headers={"Content-Type": "application/json"}
             )
+            self.invalidate_inbounds()
             return response.json().get('success', False)
         except Exception as e:
             logger.error(f"Error deactivating client: {e}")
             return False
 
-    def delete_client(self, inbound_id, client_email):
+    async def delete_client(self, inbound_id, client_email):
         """Удалить клиента по email из inbound"""
-        client_info = self.get_client_by_email(client_email)
+        client_info = await self.get_client_by_email(client_email)
         if not client_info:
             return False
-            
+
         try:
-            response = self._request(
+            response = await self._request(
                 "POST",
                 f"{self.host}/panel/api/inbounds/deleteClient/{client_info['client']['id']}",
                 headers={"Content-Type": "application/json"}
             )
+            self.invalidate_inbounds()
             return response.json().get('success', False)
         except Exception as e:
             logger.error(f"Error deleting client: {e}")
             return False
 
-    def reset_client_traffic(self, inbound_id, client_email):
+    async def reset_client_traffic(self, inbound_id, client_email):
         """Сбросить трафик клиента"""
         try:
-            response = self._request(
+            response = await self._request(
                 "POST",
                 f"{self.host}/panel/api/inbounds/{inbound_id}/resetClientTraffic/{client_email}",
                 headers={"Content-Type": "application/json"}
             )
+            self.invalidate_inbounds()
             return response.json().get('success', False)
         except Exception as e:
             logger.error(f"Error resetting client traffic: {e}")
             return False
 
-    def get_client_subscription_url(self, tg_id):
+    # ── Пакетные изменения ─────────────────────────────────────────────
+
+    async def update_clients(self, updates: list[tuple[int, dict]]) -> dict[str, bool]:
+        """Применить пачку изменённых клиентов: [(inbound_id, client), ...].
+
+        Изменения группируются по inbound'у: settings читаются один раз
+        (inbounds/get), клиенты подменяются по email и inbound пишется обратно
+        одним inbounds/update. Если панель отклонила update, для клиентов
+        этого inbound'а делается fallback на updateClient по одному.
+
+        Между get и update панель не блокируется — клиент, добавленный
+        в этот inbound параллельно, будет перезаписан. Для ночных джобов
+        это приемлемо, для платежей используйте одиночные методы.
+
+        Возвращает {email: success}.
+        """
+        by_inbound: dict[int, dict[str, dict]] = {}
+        for inbound_id, client in updates:
+            by_inbound.setdefault(inbound_id, {})[client['email']] = client
+
+        results: dict[str, bool] = {}
+        for inbound_id, changed in by_inbound.items():
+            ok = False
+            try:
+                ok = await self._update_inbound_clients(inbound_id, changed)
+            except Exception as e:
+                logger.warning(f"Bulk update of inbound {inbound_id} failed: {e}")
+            if ok:
+                results.update(dict.fromkeys(changed, True))
+                continue
+            logger.info(f"Falling back to per-client updates for inbound {inbound_id} ({len(changed)} clients)")
+            for email, client in changed.items():
+                results[email] = await self._update_client(inbound_id, client)
+
+        self.invalidate_inbounds()
+        return results
+
+    async def _update_inbound_clients(self, inbound_id: int, changed: dict[str, dict]) -> bool:
+        """inbounds/get → подмена клиентов → inbounds/update. False, если не вышло."""
+        response = await self._request("GET", f"{self.host}/panel/api/inbounds/get/{inbound_id}")
+        data = response.json()
+        inbound = data.get('obj') if data.get('success') else None
+        if not inbound:
+            return False
+
+        settings = json.loads(inbound.get('settings') or '{}')
+        clients = settings.get('clients', [])
+        present = {c.get('email') for c in clients}
+        if not set(changed) <= present:
+            # Клиента нет в inbound'е — пусть разбирается updateClient
+            return False
+        settings['clients'] = [changed.get(c.get('email'), c) for c in clients]
+
+        payload = {k: v for k, v in inbound.items() if k != 'clientStats'}
+        payload['settings'] = json.dumps(settings)
+        response = await self._request(
+            "POST",
+            f"{self.host}/panel/api/inbounds/update/{inbound_id}",
+            json=payload,
+            headers={"Content-Type": "application/json"}
+        )
+        result = response.json()
+        logger.info(f"Bulk update inbound {inbound_id}: {len(changed)} clients, success={result.get('success')}")
+        return bool(result.get('success', False))
+
+    async def _update_client(self, inbound_id: int, client: dict) -> bool:
+        """updateClient для одного клиента (fallback пакетного обновления)."""
+        client_key = client.get('id') or client.get('auth') or client.get('password')
+        if not client_key:
+            logger.error(f"Client has no id/auth: {client.get('email', 'unknown')}")
+            return False
+        payload = {
+            "id": inbound_id,
+            "settings": json.dumps({"clients": [client]})
+        }
+        try:
+            response = await self._request(
+                "POST",
+                f"{self.host}/panel/api/inbounds/updateClient/{client_key}",
+                json=payload,
+                headers={"Content-Type": "application/json"}
+            )
+            return bool(response.json().get('success', False))
+        except Exception as e:
+            logger.error(f"Error updating client {client.get('email')}: {e}")
+            return False
+
+    async def extend_clients_expiry(self, items: list[tuple[int, dict, int]]) -> dict[str, int | bool]:
+        """Продлить пачку клиентов: [(inbound_id, client, duration_ms), ...].
+
+        Возвращает {email: new_expiry} для успешных и {email: False} для остальных.
+        """
+        updates = []
+        new_expiry: dict[str, int] = {}
+        for inbound_id, client, duration_ms in items:
+            expiry = _extended_expiry(client.get('expiryTime', 0), duration_ms)
+            new_expiry[client['email']] = expiry
+            updates.append((inbound_id, {**client, 'expiryTime': expiry}))
+        results = await self.update_clients(updates)
+        return {email: (new_expiry[email] if ok else False) for email, ok in results.items()}
+
+    async def deactivate_clients(self, items: list[tuple[int, dict]]) -> dict[str, bool]:
+        """Отключить пачку клиентов: [(inbound_id, client), ...]."""
+        return await self.update_clients(
+            [(inbound_id, {**client, 'enable': False}) for inbound_id, client in items]
+        )
+
+    async def get_client_subscription_url(self, tg_id):
         """Получить ссылку подписки клиента"""
         from config import XUI_SUB_PATH
         if not XUI_SUB_PATH:
             logger.warning("XUI_SUB_PATH not configured")
             return None
         try:
-            import time
             now_ms = int(time.time() * 1000)
-            response = self._request("GET", f"{self.host}/panel/api/inbounds/list")
-            result = response.json()
-
-            if not result.get('success'):
+            snap = await self._fetch_snapshot()
+            if not snap:
                 return None
 
             best_sub_id = None
             best_expiry = -1
-            for inbound in result.get('obj', []):
-                settings = json.loads(inbound.get('settings', '{}'))
-                for client in settings.get('clients', []):
-                    if str(client.get('tgId')) == str(tg_id):
-                        sub_id = client.get('subId')
-                        if not sub_id:
-                            continue
-                        expiry = client.get('expiryTime', 0)
-                        if expiry == 0 or expiry > now_ms:
-                            if expiry == 0 or expiry > best_expiry:
-                                best_sub_id = sub_id
-                                best_expiry = expiry
+            for _, client in snap.by_tg_id.get(str(tg_id), []):
+                sub_id = client.get('subId')
+                if not sub_id:
+                    continue
+                expiry = client.get('expiryTime', 0)
+                if expiry == 0 or expiry > now_ms:
+                    if expiry == 0 or expiry > best_expiry:
+                        best_sub_id = sub_id
+                        best_expiry = expiry
             if best_sub_id:
                 return f"{XUI_SUB_PATH}/sub/{best_sub_id}"
             return None
@@ -335,6 +573,118 @@ class XUIClient:
             return None
 
 
+# ─────────────────────────────────────────────
+#  Синхронная обёртка
+# ─────────────────────────────────────────────
+
+_bg_loop: asyncio.AbstractEventLoop | None = None
+_bg_loop_lock = threading.Lock()
+
+
+def _run_sync(coro):
+    """Выполнить корутину на фоновом event loop'е и дождаться результата.
+
+    Все синхронные XUIClient делят этот loop, а значит и один пул
+    соединений к панели с общим лимитом параллельных запросов.
+    """
+    global _bg_loop
+    if _bg_loop is None:
+        with _bg_loop_lock:
+            if _bg_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="xui-loop", daemon=True).start()
+                _bg_loop = loop
+    return asyncio.run_coroutine_threadsafe(coro, _bg_loop).result()
+
+
+class XUIClient:
+    """Синхронный API 3x-ui для бота, скриптов и админки.
+
+    Тонкая обёртка над AsyncXUIClient (доступен как .aio — из async-кода
+    лучше вызывать его напрямую, чтобы не блокировать event loop).
+    """
+
+    def __init__(self, host, username, password, transport=None):
+        self.aio = AsyncXUIClient(host, username, password, transport=transport)
+
+    @property
+    def host(self):
+        return self.aio.host
+
+    @property
+    def username(self):
+        return self.aio.username
+
+    @property
+    def password(self):
+        return self.aio.password
+
+    @property
+    def _logged_in(self) -> bool:
+        conn = self.aio._existing_conn(_bg_loop) if _bg_loop else None
+        return bool(conn and conn.logged_in)
+
+    @property
+    def _snapshot(self):
+        return self.aio._snapshot
+
+    def login(self) -> bool:
+        return _run_sync(self.aio.login())
+
+    def _request(self, method, url, **kwargs):
+        return _run_sync(self.aio._request(method, url, **kwargs))
+
+    def invalidate_inbounds(self):
+        self.aio.invalidate_inbounds()
+
+    def get_inbounds(self):
+        return _run_sync(self.aio.get_inbounds())
+
+    def get_vless_reality_inbound_id(self, fallback_id: int = 1) -> int:
+        return _run_sync(self.aio.get_vless_reality_inbound_id(fallback_id))
+
+    def get_client_by_email(self, email):
+        return _run_sync(self.aio.get_client_by_email(email))
+
+    def get_client_by_tg_id(self, tg_id):
+        return _run_sync(self.aio.get_client_by_tg_id(tg_id))
+
+    def extend_client_expiry(self, inbound_id, client, duration_ms):
+        return _run_sync(self.aio.extend_client_expiry(inbound_id, client, duration_ms))
+
+    def add_or_extend_client(self, inbound_id, email, tg_id, uuid, expiry_time=0, total_gb=0, limit_ip=10, extend_ms=None):
+        return _run_sync(self.aio.add_or_extend_client(
+            inbound_id, email, tg_id, uuid, expiry_time, total_gb, limit_ip, extend_ms))
+
+    def add_client(self, inbound_id, email, tg_id, uuid, expiry_time=0, total_gb=0, limit_ip=10, sub_id=None):
+        return _run_sync(self.aio.add_client(
+            inbound_id, email, tg_id, uuid, expiry_time, total_gb, limit_ip, sub_id))
+
+    def get_hysteria_inbound_id(self, fallback_id: int = 4) -> int:
+        return _run_sync(self.aio.get_hysteria_inbound_id(fallback_id))
+
+    def deactivate_client(self, inbound_id, client):
+        return _run_sync(self.aio.deactivate_client(inbound_id, client))
+
+    def delete_client(self, inbound_id, client_email):
+        return _run_sync(self.aio.delete_client(inbound_id, client_email))
+
+    def reset_client_traffic(self, inbound_id, client_email):
+        return _run_sync(self.aio.reset_client_traffic(inbound_id, client_email))
+
+    def update_clients(self, updates):
+        return _run_sync(self.aio.update_clients(updates))
+
+    def extend_clients_expiry(self, items):
+        return _run_sync(self.aio.extend_clients_expiry(items))
+
+    def deactivate_clients(self, items):
+        return _run_sync(self.aio.deactivate_clients(items))
+
+    def get_client_subscription_url(self, tg_id):
+        return _run_sync(self.aio.get_client_subscription_url(tg_id))
+
+
 def generate_vless_link(
     client_id: str,
     domain: str,
@@ -5,12 +5,11 @@ import logging
 from datetime import datetime
 from io import BytesIO
 
-import qrcode
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
 from bot_xui.tariffs import TARIFFS
 from api.db import get_keys_by_tg_id, get_user_email, is_awg_test_activated, is_vless_test_activated, get_permanent_discount, update_vless_link, get_web_token, get_user_by_tg_id, get_payment_by_id, get_referral_count, get_user_by_web_token
-from bot_xui.helpers import convert_to_local, make_back_keyboard, make_main_keyboard, MAIN_MENU_TEXT, tariff_emoji, safe_edit_text, get_user_sub_url
+from bot_xui.helpers import convert_to_local, make_back_keyboard, make_main_keyboard, MAIN_MENU_TEXT, tariff_emoji, safe_edit_text, get_user_sub_url, send_qr_photo
 from bot_xui.test_mode import is_test_mode
 from config import ADMIN_TG_ID, REFERRAL_REWARD_DAYS, BOT_USERNAME
 
@@ -547,14 +546,6 @@ async def show_single_config(query, client_name: str, xui):
     vless_link = key.get("vless_link") or ""
     hysteria_link = key.get("hysteria_link") or ""
 
-    bio = BytesIO()
-    bio.name = "qr.png"
-    qr = qrcode.QRCode(version=1, box_size=8, border=4)
-    qr.add_data(sub_url)
-    qr.make(fit=True)
-    qr.make_image(fill_color="black", back_color="white").save(bio, "PNG")
-    bio.seek(0)
-
     from config import SERVER_LOCATION
     # Subscription link is always included — it's the primary way to connect
     sub_link_text = f"📎 <b>Ссылка подписки</b> (VLESS + Hysteria в одной):\n<code>{sub_url}</code>"
@@ -594,8 +585,8 @@ async def show_single_config(query, client_name: str, xui):
     keyboard.append([InlineKeyboardButton("🔙 К списку", callback_data="my_configs")])
 
     await query.message.delete()
-    await query.message.chat.send_photo(
-        photo=bio,
+    await send_qr_photo(
+        query.message.chat.send_photo, sub_url, 8, 4,
         caption=caption,
         parse_mode="HTML",
         reply_markup=InlineKeyboardMarkup(keyboard),
@@ -10,9 +10,9 @@ import httpx
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
 
-import qrcode
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+import qr_cache
 from config import (
     AMNEZIA_WG_API_URL, AMNEZIA_WG_API_PASSWORD,
     VLESS_DOMAIN, VLESS_PORT, VLESS_PATH,
@@ -37,16 +37,8 @@ logger = logging.getLogger(__name__)
 
 
 def make_qr_bytes(data: str, box_size: int = 10, border: int = 5) -> BytesIO:
-    """Генерирует PNG QR-код и возвращает BytesIO."""
-    qr = qrcode.QRCode(version=1, box_size=box_size, border=border)
-    qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    bio = BytesIO()
-    bio.name = "qr.png"
-    img.save(bio, "PNG")
-    bio.seek(0)
-    return bio
+    """PNG QR-код в BytesIO (из общего кэша qr_cache)."""
+    return qr_cache.png_io(data, box_size, border)
 
 
 async def create_awg_config(tg_id: int, client_name: str = None) -> dict:
@@ -144,8 +136,11 @@ async def create_xui_multi_config(tg_id: int, xui: XUIClient, days: int = None)
     expiry_ms = int(end_tokyo.timestamp() * 1000)
     expires_at = end_tokyo.astimezone(timezone.utc)
 
+    # Вызовы панели не должны блокировать event loop бота
+    aio = xui.aio
+
     # 1. Создаем VLESS (основной)
-    res_vless_raw = xui.add_client(
+    res_vless_raw = await aio.add_client(
         inbound_id=int(VLESS_INBOUND_ID),
         email=client_email,
         tg_id=tg_id,
@@ -159,7 +154,7 @@ async def create_xui_multi_config(tg_id: int, xui: XUIClient, days: int = None)
         # Если метод вернул True (как раньше), пробуем найти subId через sub_url
         if res_vless_raw:
              # Это fallback для старых версий add_client, которые возвращали True
-             sub_url = xui.get_client_subscription_url(tg_id)
+             sub_url = await aio.get_client_subscription_url(tg_id)
              sub_id = sub_url.split('/')[-1] if sub_url else "legacy_sub"
              res_vless = {"success": True, "subId": sub_id}
         else:
@@ -172,7 +167,7 @@ async def create_xui_multi_config(tg_id: int, xui: XUIClient, days: int = None)
 
     # 2. Создаем Hysteria (дополнительный) с тем же sub_id и паролем
     # Используем суффикс _h для email, так как email должен быть уникальным
-    xui.add_client(
+    await aio.add_client(
         inbound_id=int(HYSTERIA_INBOUND_ID),
         email=f"{client_email}_h",
         tg_id=tg_id,
@@ -239,14 +234,15 @@ async def grant_referral_vpn(tg_id: int, days: int, xui: XUIClient) -> dict | No
     Возвращает dict с информацией о конфиге или None при ошибке.
     """
     try:
+        aio = xui.aio
         duration_ms = days * 86400 * 1000
 
         # Check for existing active config (usually found in VLESS inbound)
-        existing = xui.get_client_by_tg_id(tg_id)
+        existing = await aio.get_client_by_tg_id(tg_id)
 
         if existing:
             # Продлеваем основной (VLESS)
-            result = xui.extend_client_expiry(
+            result = await aio.extend_client_expiry(
                 existing['inbound_id'],
                 existing['client'],
                 duration_ms,
@@ -256,11 +252,11 @@ async def grant_referral_vpn(tg_id: int, days: int, xui: XUIClient) -> dict | No
                 return None
 
             # Продлеваем дополнительный (Hysteria), если есть
-            hysteria_inbound_id = xui.get_hysteria_inbound_id()
-            hysteria_client = xui.get_client_by_email(f"{existing['client']['email']}_h")
+            hysteria_inbound_id = await aio.get_hysteria_inbound_id()
+            hysteria_client = await aio.get_client_by_email(f"{existing['client']['email']}_h")
             # Мы ищем по email с суффиксом _h
             if hysteria_client and hysteria_client['inbound_id'] == hysteria_inbound_id:
-                 xui.extend_client_expiry(
+                 await aio.extend_client_expiry(
                     hysteria_inbound_id,
                     hysteria_client['client'],
                     duration_ms,
@@ -279,7 +275,7 @@ async def grant_referral_vpn(tg_id: int, days: int, xui: XUIClient) -> dict | No
         if not data:
             return None
         
-        sub_url = xui.get_client_subscription_url(tg_id)
+        sub_url = await aio.get_client_subscription_url(tg_id)
         expires_at = data["expires_at"]
 
         upsert_vpn_key(
@@ -583,7 +579,7 @@ async def ensure_test_subscription(tg_id: int, xui: XUIClient) -> dict | None:
     """
     try:
         data = await create_xui_multi_config(tg_id, xui)
-        sub_url = xui.get_client_subscription_url(tg_id)
+        sub_url = await xui.aio.get_client_subscription_url(tg_id)
         upsert_vpn_key(
             tg_id=tg_id, payment_id=None,
             client_id=data["client_uuid"], client_name=data["client_email"],
@@ -801,10 +797,6 @@ def create_softether_config(tg_id: int, days: int = None, hours: int = None) ->
     username = f"se_{tg_id}_{uuid.uuid4().hex[:8]}"
     password = secrets.token_hex(8)
 
-    success = softether.create_user(username, password)
-    if not success:
-        raise RuntimeError("Failed to create SoftEther user")
-
     tz_tokyo = timezone(timedelta(hours=9))
     if days:
         raw_end = datetime.now(timezone.utc) + timedelta(days=days)
@@ -816,11 +808,10 @@ def create_softether_config(tg_id: int, days: int = None, hours: int = None) ->
     end_tokyo = raw_end.astimezone(tz_tokyo).replace(hour=23, minute=59, second=59, microsecond=0)
     expires_at = end_tokyo.astimezone(timezone.utc)
 
-    # Set expiry in SoftEther (date-only granularity)
+    # Create with expiry in one batch (date-only granularity); on failure the user is removed
     expiry_date_str = end_tokyo.strftime("%Y/%m/%d")
-    if not softether.set_user_expiry(username, expiry_date_str):
-        softether.delete_user(username)
-        raise RuntimeError("Failed to set SoftEther user expiry")
+    if not softether.create_user(username, password, expiry_date_str):
+        raise RuntimeError("Failed to create SoftEther user")
 
     vpn_file_bio = _make_softether_vpn_file(username, password)
     vpn_file_content = vpn_file_bio.getvalue().decode("utf-8")
@@ -0,0 +1,166 @@
+"""
+Read-only зеркало SQLite-базы 3x-ui (XUI_DB_PATH) для админки, бота и webhook'а.
+
+Одно разделяемое соединение (mode=ro) на процесс. Разобранные inbounds,
+клиенты и client_traffics живут в памяти (XUIDBSnapshot) и перечитываются
+только когда база реально изменилась:
+    • сменились inode / mtime / size файла или mtime WAL-файла;
+    • вырос PRAGMA data_version (коммит из другого соединения — x-ui).
+Проверка — не чаще раза в XUI_DB_CHECK_S секунд.
+
+Индексы как у _InboundSnapshot (кэш API панели): by_email, by_tg_id, плюс
+by_sub_id и traffic[email] = {up, down, enable, last_online}.
+
+Запись (sharing_monitor.cleanup_stale_ips) идёт своим соединением — зеркало
+увидит её по data_version.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from config import XUI_DB_PATH
+
+logger = logging.getLogger(__name__)
+
+XUI_DB_CHECK_S = float(os.getenv("XUI_DB_CHECK_S", "1.0"))
+
+
+class XUIDBSnapshot:
+    """Разобранные inbounds/client_traffics; индексы в формате _InboundSnapshot
+    (bot_xui/utils.py) плюс by_sub_id и traffic. settings парсится один раз."""
+
+    def __init__(self, inbounds: list[dict], traffics: list[dict]):
+        self.inbounds = inbounds
+        self.by_id: dict[int, dict] = {}
+        self.by_email: dict[str, tuple[int, dict, dict]] = {}   # email -> (inbound_id, client, inbound)
+        self.by_tg_id: dict[str, list[tuple[int, dict]]] = {}   # str(tgId) -> [(inbound_id, client), ...]
+        self.by_sub_id: dict[str, list[tuple[int, dict]]] = {}  # subId -> [(inbound_id, client), ...]
+        self.traffic: dict[str, dict] = {t['email']: t for t in traffics}
+
+        for inbound in inbounds:
+            ib_id = inbound['id']
+            self.by_id[ib_id] = inbound
+            try:
+                clients = json.loads(inbound.get('settings') or '{}').get('clients', [])
+            except (TypeError, ValueError, AttributeError):
+                clients = []
+            inbound['clients'] = clients
+            for client in clients:
+                email = client.get('email')
+                if email is not None:
+                    self.by_email.setdefault(email, (ib_id, client, inbound))
+                self.by_tg_id.setdefault(str(client.get('tgId')), []).append((ib_id, client))
+                if client.get('subId'):
+                    self.by_sub_id.setdefault(client['subId'], []).append((ib_id, client))
+
+    def clients(self, protocol: str | None = None, port: int | None = None):
+        """(inbound, client) по всем inbound'ам в порядке settings."""
+        for inbound in self.inbounds:
+            if protocol is not None and inbound.get('protocol') != protocol:
+                continue
+            if port is not None and inbound.get('port') != port:
+                continue
+            for client in inbound['clients']:
+                yield inbound, client
+
+    def client(self, email: str) -> dict | None:
+        entry = self.by_email.get(email)
+        return entry[1] if entry else None
+
+    def last_online(self, email: str) -> int:
+        return (self.traffic.get(email) or {}).get('last_online') or 0
+
+
+class XUIDBMirror:
+    def __init__(self, path: str = XUI_DB_PATH, check_interval: float = XUI_DB_CHECK_S):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._conn: sqlite3.Connection | None = None
+        self._snapshot: XUIDBSnapshot | None = None
+        self._signature = None
+        self._data_version = None
+        self._checked_at = 0.0
+        self.reloads = 0
+
+    def _file_signature(self) -> tuple:
+        st = os.stat(self.path)
+        try:
+            wal = os.stat(self.path + "-wal").st_mtime_ns
+        except FileNotFoundError:
+            wal = 0
+        return st.st_ino, st.st_mtime_ns, st.st_size, wal
+
+    def _connect(self):
+        if self._conn is not None:
+            self._conn.close()
+        self._conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=5,
+                                     check_same_thread=False)
+
+    def _load(self) -> XUIDBSnapshot:
+        conn = self._conn
+        conn.execute("BEGIN")  # inbounds и client_traffics из одного снимка базы
+        try:
+            inbounds = [
+                {"id": ib_id, "port": port, "protocol": protocol or "", "remark": remark,
+                 "enable": bool(enable), "settings": settings or "{}", "streamSettings": stream or "{}"}
+                for ib_id, port, protocol, remark, enable, settings, stream in conn.execute(
+                    "SELECT id, port, protocol, remark, enable, settings, stream_settings FROM inbounds ORDER BY id")
+            ]
+            traffics = [
+                {"email": email, "up": up or 0, "down": down or 0, "enable": bool(enable),
+                 "last_online": last_online or 0}
+                for email, up, down, enable, last_online in conn.execute(
+                    "SELECT email, up, down, enable, last_online FROM client_traffics")
+            ]
+        finally:
+            conn.execute("COMMIT")
+        return XUIDBSnapshot(inbounds, traffics)
+
+    def snapshot(self, fresh: bool = False) -> XUIDBSnapshot:
+        """Актуальный снимок; перечитывает базу, только если она изменилась.
+        fresh=True — проверить изменения сразу, без окна XUI_DB_CHECK_S
+        (после записи в x-ui в этом же запросе)."""
+        with self._lock:
+            now = time.monotonic()
+            if not fresh and self._snapshot is not None and now - self._checked_at < self.check_interval:
+                return self._snapshot
+            signature = self._file_signature()
+            if self._conn is None or self._signature is None or signature[0] != self._signature[0]:
+                self._connect()  # первый вызов или файл заменён (restore из бэкапа)
+            data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+            if (self._snapshot is None or signature != self._signature
+                    or data_version != self._data_version):
+                t0 = time.monotonic()
+                self._snapshot = self._load()
+                self.reloads += 1
+                logger.debug(f"[XUI-DB] reloaded {len(self._snapshot.by_email)} clients "
+                             f"in {(time.monotonic() - t0) * 1000:.0f}ms")
+            self._signature, self._data_version, self._checked_at = signature, data_version, now
+            return self._snapshot
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn = None
+            self._snapshot = None
+
+
+_mirror: XUIDBMirror | None = None
+_mirror_lock = threading.Lock()
+
+
+def mirror() -> XUIDBMirror:
+    global _mirror
+    with _mirror_lock:
+        if _mirror is None or _mirror.path != XUI_DB_PATH:
+            _mirror = XUIDBMirror(XUI_DB_PATH)
+        return _mirror
+
+
+def snapshot(fresh: bool = False) -> XUIDBSnapshot:
+    return mirror().snapshot(fresh)
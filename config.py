@@ -44,6 +44,7 @@ XUI_USERNAME = os.getenv("XUI_USERNAME")
 XUI_PASSWORD = os.getenv("XUI_PASSWORD")
 XUI_TOTP_SECRET = os.getenv("XUI_TOTP_SECRET", "")
 XUI_SUB_PATH = os.getenv("XUI_SUB_PATH")
+XUI_DB_PATH = os.getenv("XUI_DB_PATH", "/etc/x-ui/x-ui.db")  # SQLite панели (bot_xui/xui_db.py)
 
 # VLESS настройки
 VLESS_DOMAIN = os.getenv("VLESS_DOMAIN")
@@ -90,6 +91,15 @@ MTPROTO_SECRET = os.getenv("MTPROTO_SECRET", "")
 REFERRAL_REWARD_DAYS = int(os.getenv("REFERRAL_REWARD_DAYS", "3"))
 REFERRAL_NEWCOMER_DAYS = int(os.getenv("REFERRAL_NEWCOMER_DAYS", "3"))
 
+# Rate limiter: путь к SQLite-файлу, общему для всех uvicorn-воркеров.
+# Пусто — лимиты считаются в памяти каждого процесса.
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", "")
+
+# Кэш web_token → (пользователь, ключи) для /my/{token} и /sub/{token}.
+# Изменения из процесса бота видны не позже чем через TTL секунд.
+WEB_BUNDLE_CACHE_TTL = float(os.getenv("WEB_BUNDLE_CACHE_TTL", "30"))
+WEB_BUNDLE_CACHE_SIZE = int(os.getenv("WEB_BUNDLE_CACHE_SIZE", "10000"))
+
 _admin_tg_raw = os.getenv("ADMIN_TG_ID")
 if not _admin_tg_raw:
     raise RuntimeError("ADMIN_TG_ID must be set in .env")
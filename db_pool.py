@@ -0,0 +1,224 @@
+"""Process-wide MySQL connection pools shared by api, awg_api and admin.
+
+Usage:
+    conn = get_pool("awg", host=..., user=...).get_connection()
+    ...
+    conn.close()   # returns the connection to the pool
+
+Every named pool is created once per process. Size and checkout timeout
+come from the environment (DB_POOL_<NAME>_SIZE / DB_POOL_<NAME>_TIMEOUT),
+falling back to POOL_DEFAULTS.
+"""
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import mysql.connector
+
+logger = logging.getLogger(__name__)
+
+# name -> (size, checkout timeout in seconds)
+POOL_DEFAULTS = {
+    "api": (10, 5.0),
+    "awg": (5, 5.0),
+}
+_FALLBACK_DEFAULT = (5, 5.0)
+
+# Idle connections older than this are pinged before being handed out
+HEALTH_CHECK_INTERVAL = 30.0
+
+
+class PoolExhausted(Exception):
+    """No connection became free within the pool's checkout timeout."""
+
+
+class _PooledConnection:
+    """Proxy around a mysql.connector connection; close() returns it to the pool."""
+
+    def __init__(self, pool: "ConnectionPool", cnx):
+        self._pool = pool
+        self._cnx = cnx
+
+    def __getattr__(self, name):
+        cnx = self.__dict__.get("_cnx")
+        if cnx is None:
+            raise AttributeError(f"connection already returned to pool ({name})")
+        return getattr(cnx, name)
+
+    def close(self):
+        cnx, self._cnx = self._cnx, None
+        if cnx is not None:
+            self._pool._release(cnx)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __del__(self):
+        # Callers that raise between _get_conn() and close() must not leak a slot
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Thread-safe LIFO pool of mysql.connector connections with stats."""
+
+    def __init__(self, name: str, size: int, timeout: float, **connect_kwargs):
+        self.name = name
+        self.size = size
+        self.timeout = timeout
+        self._connect_kwargs = connect_kwargs
+        self._idle: deque[tuple[object, float]] = deque()  # (cnx, returned_at)
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "created": 0,
+            "exhausted": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "wait_total_ms": 0.0,
+            "wait_max_ms": 0.0,
+        }
+
+    # ── checkout / release ──────────────────────────────────────────────
+
+    def get_connection(self) -> _PooledConnection:
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            waited = False
+            while not self._idle and self._in_use >= self.size:
+                if not waited:
+                    self._stats["exhausted"] += 1
+                    waited = True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolExhausted(
+                        f"pool '{self.name}' exhausted ({self.size} in use, waited {self.timeout}s)"
+                    )
+                self._cond.wait(remaining)
+            entry = self._idle.pop() if self._idle else None
+            self._in_use += 1
+            wait_ms = (time.monotonic() - started) * 1000
+            self._stats["checkouts"] += 1
+            self._stats["wait_total_ms"] += wait_ms
+            self._stats["wait_max_ms"] = max(self._stats["wait_max_ms"], wait_ms)
+
+        # Connect / health-check outside the lock
+        try:
+            cnx = self._checked(entry) if entry else None
+            if cnx is None:
+                cnx = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return _PooledConnection(self, cnx)
+
+    def _connect(self):
+        cnx = mysql.connector.connect(**self._connect_kwargs)
+        with self._cond:
+            self._stats["created"] += 1
+        return cnx
+
+    def _checked(self, entry):
+        """Return the idle connection if it is still usable, else None."""
+        cnx, returned_at = entry
+        if time.monotonic() - returned_at < HEALTH_CHECK_INTERVAL:
+            return cnx
+        try:
+            cnx.ping(reconnect=False)
+            return cnx
+        except Exception as e:
+            logger.info(f"DB pool '{self.name}': dropping dead connection ({e})")
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+            self._discard(cnx)
+            return None
+
+    def _release(self, cnx):
+        try:
+            # End the implicit transaction so the next user gets a fresh snapshot
+            cnx.rollback()
+            reusable = True
+        except Exception:
+            reusable = False
+        if not reusable:
+            self._discard(cnx)
+        with self._cond:
+            self._in_use -= 1
+            if reusable:
+                self._idle.append((cnx, time.monotonic()))
+            self._cond.notify()
+
+    @staticmethod
+    def _discard(cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+
+    # ── maintenance ────────────────────────────────────────────────────
+
+    def clear(self):
+        """Close all idle connections (e.g. after the DB server restarted)."""
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+        for cnx, _ in idle:
+            self._discard(cnx)
+
+    def stats(self) -> dict:
+        with self._cond:
+            s = dict(self._stats)
+            s.update(
+                name=self.name,
+                size=self.size,
+                timeout=self.timeout,
+                in_use=self._in_use,
+                idle=len(self._idle),
+            )
+        s["wait_avg_ms"] = round(s["wait_total_ms"] / s["checkouts"], 3) if s["checkouts"] else 0.0
+        s["wait_total_ms"] = round(s["wait_total_ms"], 3)
+        s["wait_max_ms"] = round(s["wait_max_ms"], 3)
+        return s
+
+
+_pools: dict[str, ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_config(name: str) -> tuple[int, float]:
+    size, timeout = POOL_DEFAULTS.get(name, _FALLBACK_DEFAULT)
+    env = name.upper()
+    size = int(os.getenv(f"DB_POOL_{env}_SIZE", size))
+    timeout = float(os.getenv(f"DB_POOL_{env}_TIMEOUT", timeout))
+    return size, timeout
+
+
+def get_pool(name: str, **connect_kwargs) -> ConnectionPool:
+    """Return the process-wide pool `name`, creating it on first call."""
+    pool = _pools.get(name)
+    if pool is not None:
+        return pool
+    with _pools_lock:
+        pool = _pools.get(name)
+        if pool is None:
+            size, timeout = _pool_config(name)
+            pool = ConnectionPool(name, size, timeout, **connect_kwargs)
+            _pools[name] = pool
+            logger.info(f"DB pool '{name}' created (size={size}, timeout={timeout}s)")
+    return pool
+
+
+def pool_stats() -> list[dict]:
+    """Stats for every pool created in this process."""
+    return [p.stats() for p in list(_pools.values())]
@@ -0,0 +1,237 @@
+"""Process-wide QR code cache shared by api, bot_xui and awg_api.
+
+QR images are content-addressed: key = sha256(format, box_size, border,
+payload). Subscription URLs and AWG configs rarely change, so a page load
+or a "show config" tap normally costs a dict lookup instead of a render.
+
+Tiers:
+    memory  — LRU of PNG bytes and, separately, their base64 text
+              (QR_CACHE_MAX_ENTRIES each);
+    disk    — optional, QR_CACHE_DIR/<k[:2]>/<k>.png, shared between
+              processes and kept across restarts (0700 dirs, 0600 files).
+
+Payloads that are secrets themselves (AWG configs carry the PrivateKey) are
+rendered with secret=True: they stay in the memory tier only and never
+touch the disk.
+
+For Telegram, the file_id of an already uploaded QR is remembered per key
+(telegram_photo / remember_telegram_photo), so repeated sends skip the
+upload entirely.
+
+Usage:
+    png = qr_cache.png(url, box_size=8, border=4)        # bytes
+    b64 = qr_cache.png_base64(url, box_size=8, border=4) # str for <img src=data:...>
+    bio = qr_cache.png_io(url)                           # fresh BytesIO named qr.png
+    png = qr_cache.png(awg_conf, secret=True)            # memory only
+"""
+import base64
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import qrcode
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+QR_CACHE_MAX_ENTRIES = int(os.getenv("QR_CACHE_MAX_ENTRIES", "1024"))
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", "")
+
+
+def qr_key(data: str, box_size: int, border: int, fmt: str = "png") -> str:
+    return hashlib.sha256(f"{fmt}|{box_size}|{border}|{data}".encode()).hexdigest()
+
+
+def render_png(data: str, box_size: int = 10, border: int = 4) -> bytes:
+    """
+    Same image as qrcode's make_image(fill_color="black", back_color="white"),
+    but drawn from the module matrix in one go: 1 px per module, then a
+    NEAREST upscale, instead of a rectangle per module.
+    """
+    qr = qrcode.QRCode(version=1, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()  # включает рамку
+    n = len(matrix)
+    raw = b"".join(bytes(0 if cell else 255 for cell in row) for row in matrix)
+    img = Image.frombytes("L", (n, n), raw).resize((n * box_size, n * box_size), Image.NEAREST)
+    bio = BytesIO()
+    img.convert("1").save(bio, "PNG")
+    return bio.getvalue()
+
+
+class _LRU:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._items: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class QRCache:
+    def __init__(self, max_entries: int = QR_CACHE_MAX_ENTRIES, directory: str = QR_CACHE_DIR):
+        self.directory = directory
+        self._png = _LRU(max_entries)
+        self._b64 = _LRU(max_entries)
+        self._file_ids = _LRU(max_entries)
+        self._stats_lock = threading.Lock()
+        self._stats = dict.fromkeys(("hits", "disk_hits", "renders", "b64_hits", "file_id_hits"), 0)
+
+    # ── disk tier ──
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.{ext}")
+
+    def _read(self, key: str, ext: str) -> bytes | None:
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key, ext), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning(f"[QR] disk cache read failed: {e}")
+            return None
+
+    def _write(self, key: str, ext: str, content: bytes):
+        if not self.directory:
+            return
+        path = self._path(key, ext)
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)  # атомарно: другие процессы не увидят полфайла
+        except OSError as e:
+            logger.warning(f"[QR] disk cache write failed: {e}")
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    # ── public API ──
+
+    def png(self, data: str, box_size: int = 10, border: int = 4, secret: bool = False) -> bytes:
+        """secret=True — не читать и не писать дисковый уровень (payload содержит ключи)."""
+        key = qr_key(data, box_size, border)
+        content = self._png.get(key)
+        if content is not None:
+            self._count("hits")
+            return content
+        content = None if secret else self._read(key, "png")
+        if content is not None:
+            self._count("disk_hits")
+        else:
+            self._count("renders")
+            content = render_png(data, box_size, border)
+            if not secret:
+                self._write(key, "png", content)
+        self._png.put(key, content)
+        return content
+
+    def png_base64(self, data: str, box_size: int = 10, border: int = 4, secret: bool = False) -> str:
+        key = qr_key(data, box_size, border)
+        text = self._b64.get(key)
+        if text is not None:
+            self._count("b64_hits")
+            return text
+        text = base64.b64encode(self.png(data, box_size, border, secret)).decode()
+        self._b64.put(key, text)
+        return text
+
+    def png_io(self, data: str, box_size: int = 10, border: int = 4, name: str = "qr.png",
+               secret: bool = False) -> BytesIO:
+        """A fresh BytesIO per call: senders read and close it."""
+        bio = BytesIO(self.png(data, box_size, border, secret))
+        bio.name = name
+        return bio
+
+    def telegram_photo(self, data: str, box_size: int = 10, border: int = 4) -> str | BytesIO:
+        """file_id of this QR if it was uploaded before, else PNG to upload."""
+        key = qr_key(data, box_size, border)
+        file_id = self._file_ids.get(key)
+        if file_id is None:
+            raw = self._read(key, "tgid")
+            if raw:
+                file_id = raw.decode()
+                self._file_ids.put(key, file_id)
+        if file_id is not None:
+            self._count("file_id_hits")
+            return file_id
+        return self.png_io(data, box_size, border)
+
+    def remember_telegram_photo(self, data: str, message, box_size: int = 10, border: int = 4):
+        """Store the file_id Telegram assigned to the QR sent in `message`."""
+        photos = getattr(message, "photo", None)
+        if not photos:
+            return
+        file_id = photos[-1].file_id
+        if not isinstance(file_id, str):
+            return
+        key = qr_key(data, box_size, border)
+        if self._file_ids.get(key) != file_id:
+            self._file_ids.put(key, file_id)
+            self._write(key, "tgid", file_id.encode())
+
+    def forget_telegram_photo(self, data: str, box_size: int = 10, border: int = 4):
+        """Drop a file_id Telegram no longer accepts."""
+        key = qr_key(data, box_size, border)
+        self._file_ids.pop(key)
+        if self.directory:
+            try:
+                os.remove(self._path(key, "tgid"))
+            except OSError:
+                pass
+
+    def clear(self):
+        self._png.clear()
+        self._b64.clear()
+        self._file_ids.clear()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            s = dict(self._stats)
+        s.update(png_entries=len(self._png), b64_entries=len(self._b64), disk=bool(self.directory))
+        return s
+
+
+_CACHE = QRCache()
+
+png = _CACHE.png
+png_base64 = _CACHE.png_base64
+png_io = _CACHE.png_io
+telegram_photo = _CACHE.telegram_photo
+remember_telegram_photo = _CACHE.remember_telegram_photo
+forget_telegram_photo = _CACHE.forget_telegram_photo
+clear = _CACHE.clear
+stats = _CACHE.stats
@@ -13,7 +13,6 @@ Cron: */5 * * * *
 import json
 import logging
 import os
-import subprocess
 import sys
 import time
 from collections import defaultdict
@@ -50,30 +49,14 @@ def _save_state(state: dict):
 
 
 def _get_awg_peers() -> list[dict]:
-    """Parse `awg show <iface> dump` into list of peer dicts."""
-    result = subprocess.run(
-        ["awg", "show", AWG_INTERFACE, "dump"],
-        capture_output=True, text=True, check=False,
-    )
-    if result.returncode != 0:
-        log.error("awg show failed: %s", result.stderr)
+    """Peer records (public_key, endpoint_ip, handshake_ts, ...) from awg_api.peer_stats."""
+    from awg_api import peer_stats
+    try:
+        return peer_stats.read_peers(AWG_INTERFACE)
+    except peer_stats.PeerStatsUnavailable as e:
+        log.error("awg peer stats unavailable: %s", e)
         return []
 
-    peers = []
-    for line in result.stdout.strip().splitlines()[1:]:  # skip interface line
-        parts = line.split("\t")
-        if len(parts) < 7:
-            continue
-        endpoint = parts[2]
-        ip = endpoint.rsplit(":", 1)[0] if endpoint != "(none)" else None
-        peers.append({
-            "public_key": parts[0],
-            "allowed_ips": parts[3],
-            "handshake_ts": int(parts[4]) if parts[4] != "0" else 0,
-            "endpoint_ip": ip,
-        })
-    return peers
-
 
 def _resolve_peer_names() -> dict:
     """Map public_key → client_name via awg_clients DB."""
@@ -115,9 +98,8 @@ def _disable_peer(public_key: str, name_map: dict):
         for c in clients:
             if c["public_key"] == public_key:
                 awg_db.update_client_enabled(c["id"], False)
-                awg_manager.write_server_conf()
-                if awg_manager.is_interface_up():
-                    awg_manager.reload_interface()
+                awg_manager.apply_client(removed_key=public_key)
+                awg_manager.flush_conf_write()
                 log.info("DISABLED peer %s (%s)", c["name"], c["id"])
                 return
     except Exception as e:
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк разбора xray access.log: пропускная способность парсера (строк/с).
+
+Генерирует синтетический лог (по умолчанию 1 000 000 строк, ~2000 клиентов,
+10% строк без email) и сравнивает:
+  regex  — старый разбор из admin/routes._get_online_users (3 regex на строку)
+  tailer — admin.access_log.AccessLogTailer.poll() по всему файлу
+
+Запуск:
+  python3 scripts/bench_access_log.py --lines 1000000
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admin.access_log import AccessLogTailer
+
+
+def _generate(path: str, lines: int, clients: int):
+    rnd = random.Random(42)
+    start = time.time() - 240  # всё укладывается в 5-минутное окно
+    step = 240 / lines
+    with open(path, "w") as f:
+        for i in range(lines):
+            stamp = datetime.fromtimestamp(start + i * step, timezone.utc).strftime("%Y/%m/%d %H:%M:%S")
+            ip = f"{rnd.randint(1, 223)}.{rnd.randint(0, 255)}.{rnd.randint(0, 255)}.{rnd.randint(1, 254)}"
+            if rnd.random() < 0.1:
+                f.write(f"{stamp}.000000 [Info] [{rnd.randint(1, 10**9)}] proxy/vless/inbound: firstLen = 1\n")
+                continue
+            c = rnd.randrange(clients)
+            email = f"tiin_{c}_h" if c % 5 == 0 else f"tiin_{c}"
+            f.write(f"{stamp}.{rnd.randint(0, 999999):06d} from tcp:{ip}:{rnd.randint(1024, 65535)} "
+                    f"accepted tcp:www.example.com:443 [inbound-443 >> direct] email: {email}\n")
+
+
+def _regex_parse(path: str) -> int:
+    """Логика старого _get_online_users, но по всему файлу, а не по tail -500."""
+    cutoff = time.time() - 300
+    vless_ips: dict[str, set[str]] = {}
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if "email:" not in line or "127.0.0.1" in line.split("from ")[1][:15] if "from " in line else True:
+                continue
+            ts_match = re.match(r"(\d{4}/\d{2}/\d{2} \d{2}:\d{2}:\d{2})", line)
+            if not ts_match:
+                continue
+            ts = datetime.strptime(ts_match.group(1), "%Y/%m/%d %H:%M:%S").replace(tzinfo=timezone.utc)
+            if ts.timestamp() < cutoff:
+                continue
+            ip_match = re.search(r"from (?:tcp:)?(\d+\.\d+\.\d+\.\d+)", line)
+            ip = ip_match.group(1) if ip_match else "?"
+            email_match = re.search(r"email: (.+)$", line)
+            if email_match:
+                vless_ips.setdefault(email_match.group(1).strip(), set()).add(ip)
+    return len(vless_ips)
+
+
+def _tailer_parse(path: str) -> int:
+    t = AccessLogTailer(path, bootstrap_bytes=1 << 40)
+    t.poll()
+    return len(t.snapshot())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=1_000_000)
+    parser.add_argument("--clients", type=int, default=2000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "access.log")
+        _generate(path, args.lines, args.clients)
+        size_mb = os.path.getsize(path) / 2**20
+        print(f"log: {args.lines} lines, {size_mb:.1f} MiB")
+
+        for name, fn in (("regex", _regex_parse), ("tailer", _tailer_parse)):
+            t0 = time.perf_counter()
+            emails = fn(path)
+            dt = time.perf_counter() - t0
+            print(f"{name:>6}: {dt:6.2f} s  {args.lines / dt / 1000:8.1f} k lines/s  {emails} emails")
+
+
+if __name__ == "__main__":
+    main()
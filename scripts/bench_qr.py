@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк /my/{token}: генерация QR на каждый заход против qr_cache.
+
+БД не нужна: get_web_bundle_async и проверка тестового периода подменены,
+так что измеряется только сама страница (рендер QR + HTML).
+  before — прежний _generate_qr_base64 (qrcode.make_image + PNG + base64 на каждый запрос)
+  after  — qr_cache.png_base64 (первый заход рендерит, дальше — LRU)
+Плюс отдельно: рендер PNG через qrcode.make_image и через qr_cache.render_png.
+
+Запуск:
+  python3 scripts/bench_qr.py --requests 300 --tokens 20
+"""
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from io import BytesIO
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import qrcode
+
+import qr_cache
+from api import web_portal
+
+
+def _legacy_qr_base64(data: str) -> str:
+    """Копия прежней реализации из api/web_portal.py."""
+    return base64.b64encode(_legacy_png(data, 8, 4)).decode()
+
+
+def _legacy_png(data: str, box_size: int, border: int) -> bytes:
+    qr = qrcode.QRCode(version=1, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    bio = BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(bio, "PNG")
+    return bio.getvalue()
+
+
+def _bundle(token: str):
+    future = datetime.now() + timedelta(days=30)
+    user = {"id": 1, "tg_id": 100, "first_name": "Bench", "subscription_until": future, "email": None}
+    keys = [{"vpn_type": "vless", "subscription_link": f"https://xui/sub/{token}", "expires_at": future}]
+    return user, keys
+
+
+async def _run(name: str, tokens: list[str], n: int):
+    async def bundle(token):
+        return _bundle(token)
+
+    async def test_used(_user_id):
+        return True
+
+    with patch.object(web_portal, "get_web_bundle_async", bundle), \
+            patch.object(web_portal, "is_vless_test_activated_by_id_async", test_used):
+        t0 = time.perf_counter()
+        for i in range(n):
+            resp = await web_portal.personal_page(tokens[i % len(tokens)])
+            assert resp.status_code == 200
+        dt = time.perf_counter() - t0
+    print(f"{name:>7}: {dt / n * 1000:7.2f} ms/req  {n / dt:8.1f} req/s")
+
+
+def _render(name: str, fn, n: int):
+    t0 = time.perf_counter()
+    for i in range(n):
+        fn(f"https://344988.snk.wtf/sub/token-{i:08d}", 8, 4)
+    dt = time.perf_counter() - t0
+    print(f"{name:>14}: {dt / n * 1000:7.2f} ms/QR")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--tokens", type=int, default=20, help="разных пользователей в потоке запросов")
+    args = parser.parse_args()
+
+    tokens = [f"tok{i:04d}" for i in range(args.tokens)]
+    print(f"/my/{{token}}: {args.requests} requests over {args.tokens} tokens")
+    with patch.object(web_portal, "_generate_qr_base64", _legacy_qr_base64):
+        asyncio.run(_run("before", tokens, args.requests))
+    qr_cache.clear()
+    asyncio.run(_run("after", tokens, args.requests))
+    print(f"qr_cache: {qr_cache.stats()}")
+
+    n = max(20, args.requests // 5)
+    print(f"\nPNG render, {n} distinct payloads")
+    _render("qrcode image", _legacy_png, n)
+    _render("render_png", qr_cache.render_png, n)
+
+
+if __name__ == "__main__":
+    main()
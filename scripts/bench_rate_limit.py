@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк rate limiter'а: накладные расходы на запрос (нс/вызов).
+
+Сравнивает на одном и том же потоке запросов (--ips адресов, 90% трафика —
+/sub/..., остальное — лимитированные /api/... пути):
+  legacy  — старый _check_rate_limit (список timestamp'ов на (path, ip),
+            перебор RATE_LIMITS на каждый запрос, глобальный Lock)
+  memory  — api.rate_limit.RateLimiter + MemoryBackend
+  sqlite  — api.rate_limit.RateLimiter + SQLiteBackend (общий для воркеров)
+
+Запуск:
+  python3 scripts/bench_rate_limit.py --requests 500000 --ips 5000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api.rate_limit import RateLimiter, MemoryBackend, SQLiteBackend
+
+RATE_LIMITS = {
+    "/api/auth/send-code": (5, 300),
+    "/api/auth/verify": (10, 300),
+    "/api/web/order/send-code": (5, 300),
+    "/api/web/activate-test": (3, 3600),
+    "/api/web/support/send-code": (5, 300),
+    "/api/web/order": (10, 300),
+    "/api/web/event": (30, 60),
+}
+
+
+def _legacy_limiter():
+    """Копия прежней реализации из api/webhook.py."""
+    lock = threading.Lock()
+    buckets = defaultdict(lambda: defaultdict(list))
+    state = {"last_purge": 0.0}
+
+    def check(ip: str, path: str) -> bool:
+        limit_cfg = None
+        for prefix, cfg in RATE_LIMITS.items():
+            if path == prefix or path.startswith(prefix):
+                limit_cfg = cfg
+                break
+        if not limit_cfg:
+            return True
+        max_req, window = limit_cfg
+        now = time.time()
+        with lock:
+            if now - state["last_purge"] > 600:
+                state["last_purge"] = now
+                max_window = max(w for _, w in RATE_LIMITS.values())
+                for p in list(buckets.keys()):
+                    for k in list(buckets[p].keys()):
+                        buckets[p][k] = [t for t in buckets[p][k] if now - t < max_window]
+                        if not buckets[p][k]:
+                            del buckets[p][k]
+                    if not buckets[p]:
+                        del buckets[p]
+            bucket = buckets[path][ip]
+            buckets[path][ip] = bucket = [t for t in bucket if now - t < window]
+            if len(bucket) >= max_req:
+                return False
+            bucket.append(now)
+        return True
+
+    return check
+
+
+def _traffic(n: int, ips: int, limited_share: float) -> list[tuple[str, str]]:
+    rnd = random.Random(42)
+    limited = ["/api/web/event"] * 8 + ["/api/web/order", "/api/auth/verify"]
+    pool = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}" for i in range(1, ips + 1)]
+    out = []
+    for _ in range(n):
+        ip = rnd.choice(pool)
+        if rnd.random() < limited_share:
+            out.append((ip, rnd.choice(limited)))
+        else:
+            out.append((ip, f"/sub/{rnd.getrandbits(64):016x}"))
+    return out
+
+
+def _run(name: str, check, traffic) -> None:
+    t0 = time.perf_counter()
+    denied = 0
+    for ip, path in traffic:
+        if not check(ip, path):
+            denied += 1
+    dt = time.perf_counter() - t0
+    print(f"{name:>7}: {dt / len(traffic) * 1e9:8.0f} ns/req  {len(traffic) / dt / 1000:8.1f} k req/s  "
+          f"denied {denied}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500_000)
+    parser.add_argument("--ips", type=int, default=5000)
+    parser.add_argument("--limited-share", type=float, default=0.1,
+                        help="доля запросов на лимитированные пути")
+    args = parser.parse_args()
+
+    traffic = _traffic(args.requests, args.ips, args.limited_share)
+    print(f"{args.requests} requests, {args.limited_share:.0%} on limited paths")
+
+    _run("legacy", _legacy_limiter(), traffic)
+    _run("memory", RateLimiter(RATE_LIMITS, MemoryBackend()).check, traffic)
+    with tempfile.TemporaryDirectory() as tmp:
+        _run("sqlite", RateLimiter(RATE_LIMITS, SQLiteBackend(os.path.join(tmp, "rl.db"))).check, traffic)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк /sub/{token}: N конкурентных запросов, p50/p99 латентности.
+
+Сравнивает два режима на одном и том же стенде:
+  before — DB-хелперы блокируют event loop (как синхронный execute_query)
+  after  — DB-хелперы асинхронные (execute_query_async на aiomysql-пуле)
+
+Вместо MySQL используется стенд с фиксированной задержкой запроса
+(--db-latency-ms), XUI-подписка тоже подменяется (--xui-latency-ms),
+поэтому скрипту не нужны ни база, ни панель.
+
+Запуск:
+  python3 scripts/bench_sub_proxy.py --requests 500 --concurrency 100
+"""
+import argparse
+import asyncio
+import base64
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import FastAPI
+
+from api import sub_proxy
+
+XUI_BODY = base64.b64encode(b"vless://uuid@host:443?type=tcp&security=reality#remark")
+
+
+def _standin_rows(sql: str, params: tuple, fetch: str | None):
+    """Ответы стенда MySQL: пользователь по web_token и один VLESS-ключ."""
+    if "FROM users" in sql:
+        token = params[0]
+        return {"id": abs(hash(token)) % 10**6, "tg_id": abs(hash(token)) % 10**9, "web_token": token}
+    if "hysteria_link" in sql:
+        return None
+    if "FROM vpn_keys" in sql:
+        return [{
+            "vpn_type": "vless",
+            "subscription_link": f"https://xui.local/sub/{params[0]}",
+            "expires_at": datetime.utcnow() + timedelta(days=30),
+        }]
+    return None if fetch == "one" else []
+
+
+def _make_query_standin(mode: str, db_latency: float):
+    async def blocking_query(sql, params=(), fetch=None, _retried=False):
+        time.sleep(db_latency)  # как mysql.connector внутри async-хендлера
+        return _standin_rows(sql, params, fetch)
+
+    async def async_query(sql, params=(), fetch=None, _retried=False):
+        await asyncio.sleep(db_latency)
+        return _standin_rows(sql, params, fetch)
+
+    return blocking_query if mode == "before" else async_query
+
+
+def _percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+async def _run(mode: str, requests: int, concurrency: int, db_latency: float, xui_latency: float) -> dict:
+    async def fake_fetch_xui(url: str) -> bytes:
+        await asyncio.sleep(xui_latency)
+        return XUI_BODY
+
+    app = FastAPI()
+    app.include_router(sub_proxy.sub_router)
+    sub_proxy._CACHE.clear()
+
+    latencies: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    with patch("api.db.execute_query_async", _make_query_standin(mode, db_latency)), \
+         patch.object(sub_proxy, "_fetch_xui", fake_fetch_xui):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+            async def one(i: int):
+                async with sem:
+                    t0 = time.perf_counter()
+                    resp = await client.get(f"/sub/token-{i}")
+                    latencies.append(time.perf_counter() - t0)
+                    assert resp.status_code == 200, resp.status_code
+
+            started = time.perf_counter()
+            await asyncio.gather(*(one(i) for i in range(requests)))
+            wall = time.perf_counter() - started
+
+    return {
+        "mode": mode,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "rps": requests / wall,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--db-latency-ms", type=float, default=2.0)
+    parser.add_argument("--xui-latency-ms", type=float, default=20.0)
+    args = parser.parse_args()
+
+    for mode in ("before", "after"):
+        r = asyncio.run(_run(
+            mode, args.requests, args.concurrency,
+            args.db_latency_ms / 1000, args.xui_latency_ms / 1000,
+        ))
+        print(f"{r['mode']:>6}: p50={r['p50_ms']:8.1f} ms  p99={r['p99_ms']:8.1f} ms  {r['rps']:8.1f} req/s")
+
+
+if __name__ == "__main__":
+    main()
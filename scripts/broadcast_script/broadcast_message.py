@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 """Массовая рассылка сообщения всем пользователям с tg_id."""
 
+import asyncio
 import sys
 import time
 import logging
@@ -10,6 +11,7 @@ import mysql.connector
 import requests
 
 sys.path.insert(0, str(Path(__file__).resolve().parent))
+sys.path.insert(1, str(Path(__file__).resolve().parents[2]))
 from config import (
     TELEGRAM_BOT_TOKEN,
     MYSQL_HOST,
@@ -18,8 +20,9 @@ from config import (
     MYSQL_DATABASE,
 )
 
-# Файл для логирования отправленных сообщений (чтобы не дублировать)
-SENT_LOG = Path(__file__).resolve().parent / "broadcast_sent.log"
+# Прогресс рассылки хранится в MySQL (broadcast_jobs / broadcast_recipients):
+# повторный запуск досылает незавершённое задание этого типа
+JOB_KIND = "script"
 
 # Файл для редактирования сообщения (можно создать broadcast_message.txt)
 MESSAGE_FILE = Path(__file__).resolve().parent / "broadcast_message.txt"
@@ -126,20 +129,6 @@ def get_all_users():
         logger.error(f"❌ Ошибка подключения к БД: {e}")
         return []
 
-def already_sent(tg_id: int) -> bool:
-    """Проверяет, отправляли ли уже сообщение этому пользователю."""
-    if not SENT_LOG.exists():
-        return False
-    with open(SENT_LOG, "r") as f:
-        return str(tg_id) in f.read()
-
-
-def mark_sent(tg_id: int):
-    """Отмечает в логе, что сообщение отправлено."""
-    with open(SENT_LOG, "a") as f:
-        f.write(f"{tg_id}\n")
-
-
 def send_message_to_user(tg_id: int) -> bool:
     """Отправляет сообщение пользователю через Telegram."""
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
@@ -165,10 +154,6 @@ def send_message_to_user(tg_id: int) -> bool:
 def main():
     import sys as sys_module
     
-    total = 0
-    sent_count = 0
-    skipped_count = 0
-    
     # Проверяем, указан ли конкретный tg_id для теста
     test_tg_id = None
     for arg in sys_module.argv:
@@ -205,34 +190,33 @@ def main():
         logger.info("❌ Нет пользователей с tg_id для рассылки")
         return
 
-    total = len(users)
-    logger.info(f"🚀 Начинаем рассылку {total} пользователям...")
+    from telegram import Bot
+    from api import db as api_db
+    from bot_xui import broadcast as engine
 
-    for i, user in enumerate(users):
-        tg_id = user["tg_id"]
-        username = user.get('username', '')
-        
-        # Пропускаем уже отправленных
-        if already_sent(tg_id):
-            logger.debug(f"⏭️ Пропускаем (уже отправлено): tg_id={tg_id} (@{username})")
-            skipped_count += 1
-            continue
+    unfinished = api_db.get_unfinished_broadcast_jobs(JOB_KIND)
+    if unfinished:
+        job_id = unfinished[-1]["id"]
+        logger.info(f"🔁 Продолжаем незавершённую рассылку #{job_id}")
+    else:
+        job_id = api_db.create_broadcast_job(JOB_KIND, MESSAGE, "HTML", [(u["tg_id"], None) for u in users])
+        logger.info(f"🚀 Рассылка #{job_id}: {len(users)} пользователей")
 
-        logger.info(f"📨 [{i+1}/{total}] Отправка tg_id={tg_id} (@{username})...")
-        
-        if send_message_to_user(tg_id):
-            mark_sent(tg_id)
-            sent_count += 1
-        else:
-            logger.error(f"❌ Не удалось отправить tg_id={tg_id}")
+    async def report(p):
+        logger.info(engine.format_progress(p).replace("\n", "  "))
+
+    async def run():
+        async with Bot(TELEGRAM_BOT_TOKEN) as bot:
+            return await engine.run_job(job_id, bot, on_progress=report)
 
-        time.sleep(0.1)  # задержка 100 мс между сообщениями
+    final = asyncio.run(run())
 
     # Итоговая статистика
     logger.info(f"📊 РАССЫЛКА ЗАВЕРШЕНА:")
-    logger.info(f"   ✅ Отправлено: {sent_count}")
-    logger.info(f"   ⏭️ Пропущено (уже были): {skipped_count}")
-    logger.info(f"   📋 Всего в списке: {total}")
+    logger.info(f"   ✅ Отправлено: {final['sent']}")
+    logger.info(f"   🚫 Заблокировали бота: {final['blocked']}")
+    logger.info(f"   ❌ Ошибки: {final['failed']}")
+    logger.info(f"   📋 Всего в задании: {final['total']}")
     logger.info(f"   ⏱️ Время выполнения: {time.time() - start_time:.1f} сек.")
 
 
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Дневные агрегаты для админки (api/rollups.py).
+
+Запуск: python3 scripts/rollup_analytics.py [--backfill] [--check [--days N]]
+  без флагов  — догнать агрегаты до последних строк (то же, что делает планировщик бота)
+  --backfill  — удалить агрегаты и пересчитать всю историю с нуля
+  --check     — сравнить агрегаты с «сырыми» GROUP BY за последние N дней
+                (код выхода 1, если есть расхождения)
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api import rollups
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+log = logging.getLogger(__name__)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backfill", action="store_true", help="пересчитать всю историю")
+    parser.add_argument("--check", action="store_true", help="сверить с исходными таблицами")
+    parser.add_argument("--days", type=int, default=7, help="глубина проверки в днях")
+    args = parser.parse_args()
+
+    t0 = time.monotonic()
+    if args.backfill:
+        stats = rollups.rebuild()
+        log.info(f"Backfill done in {time.monotonic() - t0:.1f}s: {stats}")
+    elif not args.check:
+        stats = rollups.refresh()
+        log.info(f"Refresh done in {time.monotonic() - t0:.1f}s: {stats}")
+
+    if args.check:
+        mismatches = rollups.check(args.days)
+        if not mismatches:
+            log.info(f"Check: rollups match raw tables for the last {args.days} days")
+            return 0
+        for m in mismatches:
+            log.warning(f"{m['day']} {m['metric']}[{m['dim']}]: rollup={m['rollup']} raw={m['raw']}")
+        log.error(f"Check: {len(mismatches)} mismatches")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
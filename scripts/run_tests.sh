@@ -47,6 +47,23 @@ TEST_SUITES=(
     "tests/test_views.py|Views"
     "tests/test_sharing_monitor.py|Sharing-Monitor"
     "tests/test_bot_handler.py|Bot-Handler"
+    "tests/test_db_pool.py|DB-Pool"
+    "tests/test_access_log.py|Access-Log"
+    "tests/test_presence.py|Presence"
+    "tests/test_peer_stats.py|Peer-Stats"
+    "tests/test_address_pool.py|Address-Pool"
+    "tests/test_broadcast.py|Broadcast"
+    "tests/test_expiry_notifier.py|Expiry-Notifier"
+    "tests/test_rate_limit.py|Rate-Limit"
+    "tests/test_session_cache.py|Session-Cache"
+    "tests/test_qr_cache.py|QR-Cache"
+    "tests/test_mail_queue.py|Mail-Queue"
+    "tests/test_event_buffer.py|Event-Buffer"
+    "tests/test_rollups.py|Rollups"
+    "tests/test_user_search.py|User-Search"
+    "tests/test_admin_listing.py|Admin-Listing"
+    "tests/test_xui_db.py|XUI-DB-Mirror"
+    "tests/test_internal.py|Internal-Endpoints"
 )
 
 ALL_OK=1
@@ -10,6 +10,7 @@
 import sys
 import os
 import json
+import re
 import asyncio
 import logging
 from datetime import datetime, timedelta
@@ -131,9 +132,9 @@ def get_traffic_from_panel(xui):
                 _add_traffic(traffic, tg_id, cs.get('up', 0), cs.get('down', 0),
                              cs.get('enable', True), cs.get('lastOnline', 0))
 
-    # ── AWG (awg show dump) ──
+    # ── AWG (peer stats) ──
     try:
-        import subprocess
+        from awg_api import peer_stats
         name_to_tg = _get_client_name_to_tg_id()
 
         # Map public_key → client name from AWG DB
@@ -141,18 +142,10 @@ def get_traffic_from_panel(xui):
         awg_clients = awg_list_clients()
         pub_to_name = {c['public_key']: c['name'] for c in awg_clients}
 
-        result = subprocess.run(
-            ["awg", "show", "awg0", "dump"], capture_output=True, text=True, timeout=5
-        )
-        for line in result.stdout.strip().split("\n")[1:]:
-            parts = line.split("\t")
-            if len(parts) < 7:
-                continue
-            pub_key = parts[0]
-            handshake_ts = int(parts[4]) if parts[4].isdigit() else 0
-            rx_bytes = int(parts[5]) if parts[5].isdigit() else 0
-            tx_bytes = int(parts[6]) if parts[6].isdigit() else 0
-            name = pub_to_name.get(pub_key)
+        for peer in peer_stats.read_peers():
+            handshake_ts = peer['handshake_ts']
+            rx_bytes, tx_bytes = peer['rx'], peer['tx']
+            name = pub_to_name.get(peer['public_key'])
             if name:
                 tg_id = name_to_tg.get(name)
                 if tg_id:
@@ -508,29 +501,42 @@ def print_report(results):
     print(f"{'='*60}\n")
 
 
-def _extend_test_keys(tg_id: int):
-    """Extend all expired test keys for user by 1 day from now."""
+def _extend_test_keys(tg_ids: list[int]):
+    """Extend all expired test keys of the given users by 1 day from now."""
+    if not tg_ids:
+        return
     tomorrow = NOW + timedelta(days=1)
+    placeholders = ", ".join(["%s"] * len(tg_ids))
     execute_query(
         "UPDATE vpn_keys SET expires_at = %s "
-        "WHERE tg_id = %s AND expires_at < NOW()",
-        (tomorrow, tg_id),
+        f"WHERE tg_id IN ({placeholders}) AND expires_at < NOW()",
+        (tomorrow, *tg_ids),
     )
-    # Extend VLESS keys in x-ui panel
+    # Extend VLESS/Hysteria keys in x-ui panel — one bulk update per inbound
     try:
         xui = XUIClient(XUI_HOST, XUI_USERNAME, XUI_PASSWORD)
         inbounds = xui.get_inbounds()
         one_day_ms = 24 * 60 * 60 * 1000
+        now_ms = int(NOW.timestamp() * 1000)
+        wanted = {str(t) for t in tg_ids}
+        batch = []
         for ib in inbounds:
             settings = json.loads(ib.get("settings", "{}"))
             for client in settings.get("clients", []):
-                if str(tg_id) in client.get("email", ""):
-                    expiry = client.get("expiryTime", 0)
-                    if 0 < expiry < int(NOW.timestamp() * 1000):
-                        xui.extend_client_expiry(ib["id"], client, one_day_ms)
-                        log.info(f"  Extended VLESS key {client['email']} in x-ui for {tg_id}")
+                email = client.get("email", "")
+                # tiin_<tg_id>, tiin_<tg_id>_h, test-<tg_id>-...
+                if not wanted.intersection(re.findall(r"\d+", email)):
+                    continue
+                expiry = client.get("expiryTime", 0)
+                if 0 < expiry < now_ms:
+                    batch.append((ib["id"], client, one_day_ms))
+        results = xui.extend_clients_expiry(batch)
+        for email, ok in results.items():
+            if not ok:
+                log.warning(f"  Failed to extend {email} in x-ui")
+        log.info(f"  Extended {sum(1 for ok in results.values() if ok)}/{len(batch)} x-ui clients for {len(tg_ids)} users")
     except Exception as e:
-        log.warning(f"  Failed to extend VLESS in x-ui for {tg_id}: {e}")
+        log.warning(f"  Failed to extend VLESS in x-ui: {e}")
 
 
 async def send_messages(results):
@@ -553,6 +559,12 @@ async def send_messages(results):
 
         buttons = get_buttons_for_scenario(scenario)
 
+        # Extend expired test keys before notifying — all users in one batch
+        if scenario == 'test_no_connect':
+            to_extend = [u['tg_id'] for u in users if u['tg_id'] and u['tg_id'] not in recent]
+            _extend_test_keys(to_extend)
+            log.info(f"  Extended test keys +1 day for {len(to_extend)} users")
+
         for u in users:
             tg_id = u['tg_id']
             if not tg_id:
@@ -567,11 +579,6 @@ async def send_messages(results):
                 skipped += 1
                 continue
 
-            # Extend expired test keys before notifying
-            if scenario == 'test_no_connect':
-                _extend_test_keys(tg_id)
-                log.info(f"  Extended test keys +1 day for {tg_id}")
-
             msg = msg_template
             if '{price}' in msg:
                 from bot_xui.tariffs import TARIFFS
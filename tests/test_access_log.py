@@ -0,0 +1,125 @@
+"""Tests for admin/access_log.py — incremental xray access log follower."""
+import os
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from admin.access_log import AccessLogTailer, _parse_ip
+
+
+def _line(email, ip="1.2.3.4", ts=None, proto="tcp"):
+    ts = ts if ts is not None else time.time()
+    stamp = datetime.fromtimestamp(ts, timezone.utc).strftime("%Y/%m/%d %H:%M:%S")
+    return (f"{stamp}.123456 from {proto}:{ip}:51234 accepted tcp:www.google.com:443 "
+            f"[inbound-443 >> direct] email: {email}\n")
+
+
+@pytest.fixture
+def log_path(tmp_path):
+    return str(tmp_path / "access.log")
+
+
+def _append(path, *lines):
+    with open(path, "a") as f:
+        f.writelines(lines)
+
+
+def test_parse_ip_variants():
+    assert _parse_ip("2024/01/01 00:00:00 from tcp:1.2.3.4:5678 accepted") == "1.2.3.4"
+    assert _parse_ip("2024/01/01 00:00:00 from 5.6.7.8:5678 accepted") == "5.6.7.8"
+    assert _parse_ip("2024/01/01 00:00:00 from udp:[2001:db8::1]:443 accepted") == "2001:db8::1"
+    assert _parse_ip("2024/01/01 00:00:00 api call") is None
+
+
+def test_collects_ips_and_last_seen(log_path):
+    now = time.time()
+    _append(log_path,
+            _line("tiin_1", "1.1.1.1", now - 10),
+            _line("tiin_1", "2.2.2.2", now - 5),
+            _line("tiin_2_h", "3.3.3.3", now - 1, proto="udp"),
+            "2024/01/01 00:00:00 [Info] app/dispatcher: no email here\n")
+    t = AccessLogTailer(log_path)
+    assert t.poll() == 4
+
+    snap = t.snapshot(now)
+    assert snap["tiin_1"]["ips"] == {"1.1.1.1", "2.2.2.2"}
+    assert snap["tiin_1"]["last_seen"] == pytest.approx(int(now - 5), abs=1)
+    assert snap["tiin_2_h"]["ips"] == {"3.3.3.3"}
+
+
+def test_skips_localhost_and_old_lines(log_path):
+    now = time.time()
+    _append(log_path,
+            _line("local", "127.0.0.1", now),
+            _line("old", "1.1.1.1", now - 3600))
+    t = AccessLogTailer(log_path)
+    t.poll()
+    assert t.snapshot(now) == {}
+
+
+def test_window_expires_entries(log_path):
+    now = time.time()
+    _append(log_path, _line("tiin_1", ts=now))
+    t = AccessLogTailer(log_path, window=300)
+    t.poll()
+    assert "tiin_1" in t.snapshot(now)
+    assert t.snapshot(now + 301) == {}
+
+
+def test_reads_only_appended_data(log_path):
+    _append(log_path, _line("a"))
+    t = AccessLogTailer(log_path)
+    assert t.poll() == 1
+    assert t.poll() == 0
+    _append(log_path, _line("b"), _line("c"))
+    assert t.poll() == 2
+    assert set(t.snapshot()) == {"a", "b", "c"}
+
+
+def test_partial_line_waits_for_newline(log_path):
+    line = _line("tiin_9")
+    _append(log_path, line[:20])
+    t = AccessLogTailer(log_path)
+    assert t.poll() == 0
+    _append(log_path, line[20:])
+    assert t.poll() == 1
+    assert "tiin_9" in t.snapshot()
+
+
+def test_rotation_by_rename_drains_old_file(log_path):
+    _append(log_path, _line("a"))
+    t = AccessLogTailer(log_path)
+    t.poll()
+    _append(log_path, _line("late-in-old-file"))
+    os.rename(log_path, log_path + ".1")
+    _append(log_path, _line("fresh"))
+
+    assert t.poll() == 2
+    assert {"a", "late-in-old-file", "fresh"} <= set(t.snapshot())
+    assert t.stats["rotations"] == 1
+
+
+def test_copytruncate_restarts_from_beginning(log_path):
+    _append(log_path, _line("a"), _line("b"), _line("c"))
+    t = AccessLogTailer(log_path)
+    t.poll()
+    with open(log_path, "w") as f:
+        f.write(_line("after-truncate"))
+    assert t.poll() == 1
+    assert "after-truncate" in t.snapshot()
+    assert t.stats["rotations"] == 1
+
+
+def test_bootstrap_reads_only_tail(log_path):
+    _append(log_path, *(_line(f"old-{i}") for i in range(1000)), _line("last"))
+    t = AccessLogTailer(log_path, bootstrap_bytes=500)
+    parsed = t.poll()
+    assert 0 < parsed < 10
+    assert "last" in t.snapshot()
+
+
+def test_missing_file_is_not_an_error(log_path):
+    t = AccessLogTailer(log_path)
+    assert t.poll() == 0
+    assert t.snapshot() == {}
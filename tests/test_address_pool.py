@@ -0,0 +1,116 @@
+"""Tests for awg_api/address_pool.py — CIDR-based AWG address allocator."""
+import threading
+from unittest.mock import patch, MagicMock
+
+import mysql.connector
+import pytest
+
+from awg_api import address_pool
+from awg_api.address_pool import AddressPool
+
+
+def test_skips_network_server_and_broadcast():
+    pool = AddressPool(["10.10.0.0/29"])
+    got = [pool.allocate() for _ in range(5)]
+    assert got == ["10.10.0.2", "10.10.0.3", "10.10.0.4", "10.10.0.5", "10.10.0.6"]
+    with pytest.raises(RuntimeError, match="No free addresses"):
+        pool.allocate()
+
+
+def test_continues_into_next_pool():
+    pool = AddressPool(["10.10.0.0/30", "10.20.0.0/29"])
+    assert pool.allocate() == "10.10.0.2"
+    assert pool.allocate() == "10.20.0.2"
+    assert pool.stats()["size"] == 1 + 5
+
+
+def test_mark_used_and_release_recycles():
+    pool = AddressPool(["10.10.0.0/24"])
+    pool.mark_used("10.10.0.2")
+    pool.mark_used("10.10.0.3")
+    assert pool.allocate() == "10.10.0.4"
+    pool.release("10.10.0.2")
+    assert pool.allocate() == "10.10.0.2"
+    assert pool.allocate() == "10.10.0.5"
+
+
+def test_release_ignores_reserved_and_foreign_addresses():
+    pool = AddressPool(["10.10.0.0/24"])
+    pool.release("10.10.0.1")
+    pool.release("192.168.1.5")
+    pool.release("garbage")
+    assert pool.allocate() == "10.10.0.2"
+
+
+def test_large_pool_concurrent_allocations_are_unique():
+    pool = AddressPool(["10.10.0.0/16"])
+    got, lock = [], threading.Lock()
+
+    def worker():
+        mine = [pool.allocate() for _ in range(1000)]
+        with lock:
+            got.extend(mine)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(got) == len(set(got)) == 8000
+    assert "10.10.0.1" not in got
+
+
+@pytest.fixture
+def fresh_pool(monkeypatch):
+    monkeypatch.setattr(address_pool, "_pool", None)
+    monkeypatch.setattr(address_pool, "AWG_ADDRESS_POOLS", ["10.10.0.0/24"])
+
+
+@patch("awg_api.address_pool.db")
+def test_get_pool_seeds_from_db_once(mock_db, fresh_pool):
+    mock_db.list_addresses.return_value = ["10.10.0.2", "10.10.0.3"]
+    pool = address_pool.get_pool()
+    assert address_pool.get_pool() is pool
+    mock_db.list_addresses.assert_called_once()
+    assert pool.allocate() == "10.10.0.4"
+
+
+@patch("awg_api.address_pool.db")
+def test_create_client_retries_on_duplicate_address(mock_db, fresh_pool):
+    mock_db.list_addresses.return_value = []
+    dup = mysql.connector.IntegrityError("Duplicate entry '10.10.0.2' for key 'idx_address'")
+    mock_db.create_client.side_effect = [dup, {"id": "c1", "address": "10.10.0.3"}]
+
+    client = address_pool.create_client("n", "priv", "pub", "psk")
+
+    assert client["address"] == "10.10.0.3"
+    assert [c[0][1] for c in mock_db.create_client.call_args_list] == ["10.10.0.2", "10.10.0.3"]
+    # the address taken by the other writer stays marked used
+    assert address_pool.get_pool().allocate() == "10.10.0.4"
+
+
+@patch("awg_api.address_pool.db")
+def test_create_client_releases_address_on_other_errors(mock_db, fresh_pool):
+    mock_db.list_addresses.return_value = []
+    mock_db.create_client.side_effect = mysql.connector.IntegrityError(
+        "Duplicate entry 'pub' for key 'idx_public_key'")
+    with pytest.raises(mysql.connector.IntegrityError):
+        address_pool.create_client("n", "priv", "pub", "psk")
+    assert address_pool.get_pool().allocate() == "10.10.0.2"
+
+
+@patch("builtins.open", new_callable=MagicMock)
+@patch("awg_api.awg_manager.db")
+def test_server_conf_masquerades_every_pool(mock_db, mock_open, monkeypatch):
+    from awg_api import awg_manager
+    monkeypatch.setattr(awg_manager, "AWG_ADDRESS_POOLS", ["10.10.0.0/16", "10.20.0.0/22"])
+    mock_db.get_server_config.return_value = {"private_key": "k", "listen_port": 51888}
+    mock_db.list_clients.return_value = []
+
+    awg_manager.write_server_conf()
+
+    written = mock_open().__enter__().write.call_args[0][0]
+    assert "-A POSTROUTING -s 10.10.0.0/16" in written
+    assert "-A POSTROUTING -s 10.20.0.0/22" in written
+    assert "-D POSTROUTING -s 10.20.0.0/22" in written
+    assert "10.10.0.0/24" not in written
@@ -0,0 +1,128 @@
+"""Tests for admin/listing.py — keyset pages, NDJSON streaming, one-pass encoding."""
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from admin import listing
+
+
+async def _body(resp) -> bytes:
+    return b"".join([chunk async for chunk in resp.body_iterator])
+
+
+def _rows(ids):
+    return [{"id": i, "amount": Decimal("199.00"), "created_at": datetime(2026, 4, 1, 12, 30)} for i in ids]
+
+
+def test_dumps_matches_old_clean_semantics():
+    out = json.loads(listing.dumps({
+        "a": Decimal("199.00"), "b": Decimal("1.5"), "c": b"\xd0\xb0",
+        "d": datetime(2026, 4, 1, 12, 30, 5), "e": date(2026, 4, 1), 7: None,
+    }))
+    assert out == {"a": 199, "b": 1.5, "c": "а", "d": "2026-04-01T12:30:05", "e": "2026-04-01", "7": None}
+
+
+def test_by_id_passes_cursor_and_detects_last_page():
+    fetch_rows = MagicMock(side_effect=[_rows([9, 8]), _rows([7])])
+    fetch = listing.by_id(fetch_rows, 2)
+    assert [r["id"] for r in fetch(None)[0]] == [9, 8]
+    assert fetch(None)[1] is None
+    assert fetch_rows.call_args_list[0].args == (2, None)
+
+    fetch_rows = MagicMock(return_value=_rows([9, 8]))
+    rows, cursor = listing.by_id(fetch_rows, 2)("10")
+    assert cursor == "8" and fetch_rows.call_args.args == (2, 10)
+    # мусор в cursor = первая страница
+    listing.by_id(fetch_rows, 2)("abc")
+    assert fetch_rows.call_args.args == (2, None)
+
+
+@pytest.mark.asyncio
+async def test_respond_json_page():
+    fetch = listing.by_id(lambda limit, before: _rows([5, 4]), 2)
+    resp = await listing.respond(fetch, None, "json", transform=lambda r: {**r, "x": 1})
+    assert resp.media_type == "application/json"
+    assert json.loads(resp.body) == {
+        "items": [{"id": 5, "amount": 199, "created_at": "2026-04-01T12:30:00", "x": 1},
+                  {"id": 4, "amount": 199, "created_at": "2026-04-01T12:30:00", "x": 1}],
+        "next_cursor": "4",
+    }
+
+
+@pytest.mark.asyncio
+async def test_respond_ndjson_walks_all_pages():
+    pages = {None: _rows([5, 4]), 4: _rows([3, 2]), 2: _rows([1])}
+    fetch_rows = MagicMock(side_effect=lambda limit, before: pages[before])
+    resp = await listing.respond(listing.by_id(fetch_rows, 2), None, "ndjson")
+    assert resp.media_type == listing.NDJSON
+    lines = (await _body(resp)).decode().splitlines()
+    assert [json.loads(line)["id"] for line in lines] == [5, 4, 3, 2, 1]
+    assert fetch_rows.call_count == 3
+
+
+# ─────────────────────────────────────────────
+#  routes
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_winback_route_adds_message_and_cursor():
+    from admin.routes import winback_log
+    rows = [{"id": 12, "tg_id": 1, "scenario": "never_activated", "sent_at": datetime(2026, 4, 1)}]
+    with patch("admin.db.list_winback_log", return_value=rows) as mock_log:
+        resp = await winback_log(limit=1, cursor="13", fmt="json")
+    mock_log.assert_called_once_with(1, 13)
+    page = json.loads(resp.body)
+    assert page["next_cursor"] == "12"
+    assert page["items"][0]["message"].startswith("👋")
+
+
+def _inbounds():
+    clients = [{"email": e, "id": f"uuid-{e}", "enable": True} for e in ("c_user", "a_user", "b_user")]
+    return [
+        {"id": 1, "settings": json.dumps({"clients": clients}),
+         "clientStats": [{"email": "a_user", "up": 10, "down": 20}, {"email": "c_user", "up": 1, "down": 1}]},
+        {"id": 2, "settings": "{}", "clientStats": [{"email": "a_user", "up": 5, "down": 5}]},
+    ]
+
+
+def _name_db(rows):
+    cur = MagicMock()
+    cur.fetchall.return_value = rows
+    conn = MagicMock()
+    conn.cursor.return_value = cur
+    return conn, cur
+
+
+@pytest.mark.asyncio
+async def test_xui_clients_paged_by_email_and_enriched_per_page():
+    from admin.routes import xui_inbound_clients
+    xui = MagicMock()
+    xui.get_inbounds.return_value = _inbounds()
+    conn, cur = _name_db([{"client_name": "a_user", "first_name": "Анна", "tg_id": 5, "web_token": "t"}])
+    with patch("admin.routes._get_xui", return_value=xui), \
+            patch("admin.routes.awg_db._get_conn", return_value=conn):
+        resp = await xui_inbound_clients(1, limit=2, cursor=None, fmt="json")
+        page = json.loads(resp.body)
+        assert [c["email"] for c in page["items"]] == ["a_user", "b_user"]
+        assert page["next_cursor"] == "b_user"
+        a = page["items"][0]
+        assert (a["up"], a["down"], a["first_name"], a["tg_id_db"]) == (15, 25, "Анна", 5)
+        # имена ищем только для emails текущей страницы
+        assert cur.execute.call_args.args[1] == ("a_user", "b_user")
+
+        resp = await xui_inbound_clients(1, limit=2, cursor="b_user", fmt="json")
+    page = json.loads(resp.body)
+    assert [c["email"] for c in page["items"]] == ["c_user"] and page["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_xui_clients_unknown_inbound():
+    from admin.routes import xui_inbound_clients
+    xui = MagicMock()
+    xui.get_inbounds.return_value = _inbounds()
+    with patch("admin.routes._get_xui", return_value=xui):
+        resp = await xui_inbound_clients(99, limit=10, cursor=None, fmt="json")
+    assert resp.status_code == 404
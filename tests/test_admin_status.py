@@ -23,17 +23,15 @@ def test_offline_user_filtering(mock_time, mock_subprocess, mock_admin_db, mock_
 
         # Mock SoftEther list_users to return an empty list so it doesn't pollute the test
         with patch("bot_xui.softether.list_users", return_value=[]):
-            # 2. Mock SQLite for offline VLESS check
-            # We need to simulate the sqlite connection
-            with patch("sqlite3.connect") as mock_conn:
-                mock_cur = MagicMock()
-                mock_conn.return_value.cursor.return_value = mock_cur
-
-                # Simulate one online user and one offline user in the DB
-                mock_cur.fetchall.side_effect = [
-                    [], # client_traffics
-                    [('{"clients": [{"email": "user1@email.com"}, {"email": "user2@email.com"}]}',)] # inbounds
-                ]
+            # 2. Mock the x-ui SQLite mirror for offline VLESS check
+            # Simulate one online user and one offline user in the DB
+            from bot_xui.xui_db import XUIDBSnapshot
+            snap = XUIDBSnapshot(
+                [{"id": 1, "protocol": "vless",
+                  "settings": '{"clients": [{"email": "user1@email.com"}, {"email": "user2@email.com"}]}'}],
+                [],  # client_traffics
+            )
+            with patch("bot_xui.xui_db.snapshot", return_value=snap):
 
                 from admin.routes import offline_users
 
@@ -1,5 +1,8 @@
 """Tests for bot_xui/autopay.py — automatic payment renewal."""
 import sys
+import threading
+import time
+import uuid
 from unittest.mock import patch, MagicMock, AsyncMock
 
 import pytest
@@ -7,6 +10,45 @@ import pytest
 sys.modules.setdefault("yookassa", MagicMock())
 
 
+@pytest.fixture(autouse=True)
+def _attempts_store():
+    """Every autopay test gets an empty in-memory autopay_attempts table."""
+    store = _AttemptStore()
+    with patch("bot_xui.autopay.claim_autopay_attempt", side_effect=store.claim), \
+         patch("bot_xui.autopay.finish_autopay_attempt", side_effect=store.finish), \
+         patch("bot_xui.autopay.record_job_run"), \
+         patch("bot_xui.autopay.GATEWAY_BACKOFF", 0):
+        yield store
+
+
+class _AttemptStore:
+    """Mirrors api.db.claim_autopay_attempt / finish_autopay_attempt semantics."""
+
+    def __init__(self):
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def claim(self, user_id, cycle, phase, tariff, amount):
+        with self.lock:
+            row = self.rows.get((user_id, cycle))
+            if row is None:
+                row = self.rows[(user_id, cycle)] = {
+                    "id": (user_id, cycle), "status": "pending",
+                    "idempotence_key": str(uuid.uuid4()), "resumed": False,
+                }
+                return dict(row)
+            if row["status"] == "pending":
+                return {**row, "resumed": True}
+            if row["status"] == "failed":
+                row.update(status="pending", idempotence_key=str(uuid.uuid4()))
+                return {**row, "resumed": False}
+            return None
+
+    def finish(self, attempt_id, status, payment_id=None, error=None, tries=1):
+        with self.lock:
+            self.rows[attempt_id].update(status=status, payment_id=payment_id)
+
+
 def _make_user(user_id=1, tg_id=100, pm_id="pm-saved-card",
                tariff="monthly_30d", vpn_type="vless", discount=0):
     return {
@@ -231,3 +273,148 @@ async def test_web_user_failure_disables_by_id(mock_due, mock_pay_cls,
     await process_autopayments(bot)
 
     mock_disable_id.assert_called_once_with(1)
+
+
+# ═════════════════════════════════════════════
+#  Charging pipeline: retries, idempotency, load
+# ═════════════════════════════════════════════
+
+class _GatewayDown(Exception):
+    HTTP_CODE = 503
+
+
+class _Declined(Exception):
+    HTTP_CODE = 400
+
+
+class FakeYooKassa:
+    """Payment.create stand-in: dedupes by idempotence key like the real API,
+    fails every `flaky_every`-th request with 5xx and sleeps `latency` seconds."""
+
+    def __init__(self, latency=0.0, flaky_every=0, declined=()):
+        self.latency = latency
+        self.flaky_every = flaky_every
+        self.declined = set(declined)
+        self.requests = 0
+        self.by_key = {}
+        self.charges = []
+        self.in_flight = self.peak = 0
+        self.lock = threading.Lock()
+
+    def create(self, body, key):
+        with self.lock:
+            self.requests += 1
+            n = self.requests
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            if self.flaky_every and n % self.flaky_every == 0:
+                raise _GatewayDown("503 Service Unavailable")
+            if body["payment_method_id"] in self.declined:
+                raise _Declined("card declined")
+            with self.lock:
+                if key not in self.by_key:
+                    payment = MagicMock()
+                    payment.id = f"pay-{len(self.by_key) + 1}"
+                    self.by_key[key] = payment
+                    self.charges.append((body["metadata"]["tg_id"], body["amount"]["value"]))
+                return self.by_key[key]
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def _due_users(n, start=1):
+    return [_make_user(user_id=i, tg_id=100000 + i, pm_id=f"pm-{i}") for i in range(start, start + n)]
+
+
+@pytest.mark.asyncio
+@patch("bot_xui.autopay.log_autopay")
+@patch("bot_xui.autopay.create_payment")
+@patch("bot_xui.autopay.Payment")
+@patch("bot_xui.autopay.get_autopay_users_due")
+async def test_gateway_5xx_retried_with_same_key(mock_due, mock_pay_cls, mock_create, mock_log):
+    from bot_xui.autopay import process_autopayments
+
+    mock_due.side_effect = [[], [_make_user()]]
+    payment = MagicMock()
+    payment.id = "pay-after-retry"
+    mock_pay_cls.create.side_effect = [_GatewayDown("503"), _GatewayDown("502"), payment]
+    bot = MagicMock()
+    bot.send_message = AsyncMock()
+
+    report = await process_autopayments(bot)
+
+    keys = {c.args[1] for c in mock_pay_cls.create.call_args_list}
+    assert mock_pay_cls.create.call_count == 3 and len(keys) == 1
+    assert report["phase2"]["charged"] == 1 and report["phase2"]["retries"] == 2
+    mock_create.assert_called_once()
+
+
+@pytest.mark.asyncio
+@patch("bot_xui.autopay.log_autopay")
+@patch("bot_xui.autopay.create_payment")
+@patch("bot_xui.autopay.get_autopay_users_due")
+async def test_rerun_after_crash_does_not_double_charge(mock_due, mock_create, mock_log, _attempts_store):
+    """A run dies after the gateway accepted the payment; the rerun reuses the key."""
+    from bot_xui import autopay
+
+    gateway = FakeYooKassa()
+    users = _due_users(3)
+    mock_due.side_effect = [[], users, [], users]
+
+    crashed = {"done": False}
+
+    def create_then_crash(**kw):
+        if not crashed["done"]:
+            crashed["done"] = True
+            raise RuntimeError("MySQL server has gone away")
+
+    mock_create.side_effect = create_then_crash
+    bot = MagicMock()
+    bot.send_message = AsyncMock()
+    with patch("bot_xui.autopay.Payment", gateway), \
+         patch("bot_xui.autopay.get_payment_by_id", return_value=None):
+        first = await autopay.process_autopayments(bot)
+        second = await autopay.process_autopayments(bot)
+
+    assert first["phase2"]["failed"] == 1 and first["phase2"]["charged"] == 2
+    # второй прогон: упавший досписывается тем же ключом, остальные пропущены
+    assert second["phase2"]["charged"] == 1 and second["phase2"]["skipped"] == 2
+    assert len(gateway.charges) == 3
+
+
+@pytest.mark.asyncio
+@patch("bot_xui.autopay.disable_autopay")
+@patch("bot_xui.autopay.log_autopay")
+@patch("bot_xui.autopay.create_payment")
+@patch("bot_xui.autopay.get_autopay_users_due")
+async def test_load_thousands_of_due_users(mock_due, mock_create, mock_log, mock_disable):
+    """3000 due users against a fake gateway with latency and periodic 5xx."""
+    from bot_xui import autopay
+
+    users = _due_users(3000)
+    declined = {"pm-7", "pm-1500"}
+    gateway = FakeYooKassa(latency=0.002, flaky_every=50, declined=declined)
+    mock_due.side_effect = [[], users]
+    bot = MagicMock()
+    bot.send_message = AsyncMock()
+
+    started = time.monotonic()
+    with patch("bot_xui.autopay.Payment", gateway), \
+         patch("bot_xui.autopay.BROADCAST_RATE", 100000):
+        report = await autopay.process_autopayments(bot)
+    elapsed = time.monotonic() - started
+
+    assert report["phase2"]["charged"] == 2998
+    assert report["phase2"]["failed"] == 2
+    assert report["phase2"]["retries"] >= 3000 // 50 - 1
+    # каждый пользователь списан ровно один раз
+    charged = [tg for tg, _ in gateway.charges]
+    assert len(charged) == len(set(charged)) == 2998
+    assert 1 < gateway.peak <= autopay.AUTOPAY_WORKERS
+    assert mock_disable.call_count == 2
+    assert bot.send_message.await_count == 3000
+    # 3000 × 2 мс последовательно ≈ 6 с; пул из 8 потоков укладывается с запасом
+    assert elapsed < 6
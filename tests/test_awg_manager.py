@@ -203,3 +203,77 @@ def test_reload_interface(mock_run, mock_subprocess):
     reload_interface()
     # awg syncconf should be called
     assert any("syncconf" in str(c) for c in mock_run.call_args_list)
+
+
+# ─────────────────────────────────────────────
+#  incremental peer apply
+# ─────────────────────────────────────────────
+
+_CLIENT = {"id": "c1", "name": "u", "address": "10.10.0.7", "public_key": "PUB=",
+           "preshared_key": "PSK=", "enabled": True}
+
+
+@pytest.fixture
+def no_conf_timer(monkeypatch):
+    """Keep scheduled config writes from firing during the test."""
+    from awg_api import awg_manager
+    monkeypatch.setattr(awg_manager, "schedule_conf_write", MagicMock())
+    return awg_manager.schedule_conf_write
+
+
+@patch("awg_api.awg_manager.subprocess.run")
+def test_apply_enabled_client_sets_peer(mock_subprocess, no_conf_timer):
+    from awg_api.awg_manager import apply_client
+    apply_client(_CLIENT)
+    cmd = mock_subprocess.call_args[0][0]
+    assert cmd[:5] == ["awg", "set", "awg0", "peer", "PUB="]
+    assert cmd[-2:] == ["allowed-ips", "10.10.0.7/32"]
+    assert mock_subprocess.call_args[1]["input"] == "PSK="
+    assert "PSK=" not in cmd
+    no_conf_timer.assert_called_once()
+
+
+@patch("awg_api.awg_manager.write_server_conf")
+@patch("awg_api.awg_manager._run")
+def test_apply_disabled_and_removed_client_removes_peer(mock_run, mock_write, no_conf_timer):
+    from awg_api.awg_manager import apply_client
+    apply_client({**_CLIENT, "enabled": False})
+    apply_client(removed_key="GONE=")
+    cmds = [c[0][0] for c in mock_run.call_args_list]
+    assert cmds == [["awg", "set", "awg0", "peer", "PUB=", "remove"],
+                    ["awg", "set", "awg0", "peer", "GONE=", "remove"]]
+    mock_write.assert_not_called()
+    assert no_conf_timer.call_count == 2
+
+
+@patch("awg_api.awg_manager.reload_interface")
+@patch("awg_api.awg_manager.write_server_conf")
+@patch("awg_api.awg_manager.is_interface_up", return_value=True)
+@patch("awg_api.awg_manager._run")
+def test_apply_falls_back_to_full_reload(mock_run, mock_up, mock_write, mock_reload, no_conf_timer):
+    import subprocess
+    from awg_api.awg_manager import apply_client
+    mock_run.side_effect = subprocess.CalledProcessError(1, "awg", stderr="boom")
+    apply_client(removed_key="X=")
+    mock_write.assert_called_once()
+    mock_reload.assert_called_once()
+
+
+@patch("awg_api.awg_manager.write_server_conf")
+def test_conf_writes_are_coalesced(mock_write):
+    import time
+    from awg_api import awg_manager
+    for _ in range(5):
+        awg_manager.schedule_conf_write(delay=0.05)
+    time.sleep(0.3)
+    assert mock_write.call_count == 1
+
+
+@patch("awg_api.awg_manager.write_server_conf")
+def test_flush_writes_pending_conf_immediately(mock_write):
+    from awg_api import awg_manager
+    awg_manager.schedule_conf_write(delay=60)
+    awg_manager.flush_conf_write()
+    mock_write.assert_called_once()
+    awg_manager.flush_conf_write()  # nothing pending
+    mock_write.assert_called_once()
@@ -0,0 +1,211 @@
+"""Tests for bot_xui/broadcast.py — throttled, resumable broadcast engine."""
+import asyncio
+import sys
+import time
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+
+sys.modules.setdefault("yookassa", MagicMock())
+
+from telegram.error import Forbidden, RetryAfter, TimedOut, BadRequest
+
+from bot_xui import broadcast
+from bot_xui.broadcast import TokenBucket, deliver, run_job, SENT, FAILED, BLOCKED
+
+
+class _FakeDB:
+    """In-memory stand-in for the api.db broadcast helpers."""
+
+    def __init__(self, recipients, text="hi", sent=0):
+        self.job = {"id": 7, "kind": "broadcast", "text": text, "parse_mode": "HTML",
+                    "total": len(recipients), "sent": sent, "failed": 0, "blocked": 0,
+                    "status": "running", "report_chat_id": None}
+        self.recipients = {tg_id: {"tg_id": tg_id, "text": t, "status": "pending"}
+                           for tg_id, t in recipients}
+        self.flushes = []
+
+    def get_broadcast_job(self, job_id):
+        return dict(self.job)
+
+    def get_pending_broadcast_recipients(self, job_id):
+        return [dict(r) for r in self.recipients.values() if r["status"] == "pending"]
+
+    def record_broadcast_results(self, job_id, results):
+        self.flushes.append(list(results))
+        for tg_id, status in results:
+            self.recipients[tg_id]["status"] = status
+            self.job[status] += 1
+
+    def finish_broadcast_job(self, job_id, status="done"):
+        self.job["status"] = status
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    def install(*args, **kwargs):
+        fake = _FakeDB(*args, **kwargs)
+        for name in ("get_broadcast_job", "get_pending_broadcast_recipients",
+                     "record_broadcast_results", "finish_broadcast_job"):
+            monkeypatch.setattr(broadcast.db, name, getattr(fake, name))
+        return fake
+    return install
+
+
+def _bot(side_effect=None):
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=side_effect)
+    return bot
+
+
+# ─────────────────────────────────────────────
+#  TokenBucket
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_token_bucket_limits_rate():
+    bucket = TokenBucket(rate=50, burst=5)
+    start = time.monotonic()
+    for _ in range(15):
+        await bucket.acquire()
+    # 5 из запаса + 10 по 20 мс
+    assert time.monotonic() - start >= 0.18
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_pause_blocks_acquire():
+    bucket = TokenBucket(rate=1000)
+    bucket.pause(0.1)
+    start = time.monotonic()
+    await bucket.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+# ─────────────────────────────────────────────
+#  deliver
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_and_resends():
+    bot = _bot([RetryAfter(0), None])
+    bucket = TokenBucket(rate=1000)
+    with patch.object(bucket, "pause", wraps=bucket.pause) as pause:
+        assert await deliver(bot, bucket, 1, "x") == SENT
+    pause.assert_called_once_with(0)
+    assert bot.send_message.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_forbidden_is_blocked_and_bad_request_failed():
+    bucket = TokenBucket(rate=1000)
+    assert await deliver(_bot(Forbidden("bot was blocked by the user")), bucket, 1, "x") == BLOCKED
+    assert await deliver(_bot(BadRequest("Chat not found")), bucket, 1, "x") == FAILED
+
+
+@pytest.mark.asyncio
+async def test_network_errors_retry_then_fail(monkeypatch):
+    monkeypatch.setattr(broadcast.asyncio, "sleep", AsyncMock())
+    bot = _bot(TimedOut())
+    assert await deliver(bot, TokenBucket(rate=1000), 1, "x") == FAILED
+    assert bot.send_message.await_count == broadcast.MAX_ATTEMPTS
+
+
+# ─────────────────────────────────────────────
+#  run_job
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_run_job_sends_all_and_records_in_bulk(fake_db, monkeypatch):
+    monkeypatch.setattr(broadcast, "FLUSH_EVERY", 4)
+    db = fake_db([(i, None) for i in range(1, 10)] + [(100, "personal")])
+    blocked = {3, 5}
+
+    async def send(chat_id, text, **kw):
+        if chat_id in blocked:
+            raise Forbidden("bot was blocked by the user")
+
+    bot = _bot(send)
+    progress = AsyncMock()
+    final = await run_job(7, bot, on_progress=progress, bucket=TokenBucket(rate=1000))
+
+    assert final == {"job_id": 7, "total": 10, "done": 10, "status": "done",
+                     SENT: 8, FAILED: 0, BLOCKED: 2}
+    assert db.job["status"] == "done"
+    assert {tg for tg, r in db.recipients.items() if r["status"] == BLOCKED} == blocked
+    # результаты пишутся пачками, а не по одному
+    assert len(db.flushes) < 10
+    texts = {c.kwargs["chat_id"]: c.kwargs["text"] for c in bot.send_message.await_args_list}
+    assert texts[100] == "personal" and texts[1] == "hi"
+    assert progress.await_args.args[0]["status"] == "done"
+
+
+@pytest.mark.asyncio
+async def test_run_job_resumes_only_pending(fake_db):
+    db = fake_db([(1, None), (2, None), (3, None)], sent=2)
+    db.recipients[1]["status"] = SENT
+    db.recipients[2]["status"] = SENT
+
+    bot = _bot()
+    final = await run_job(7, bot, bucket=TokenBucket(rate=1000))
+
+    assert [c.kwargs["chat_id"] for c in bot.send_message.await_args_list] == [3]
+    assert final[SENT] == 3 and final["done"] == 3
+
+
+@pytest.mark.asyncio
+async def test_cancelled_job_keeps_progress_and_stays_running(fake_db, monkeypatch):
+    monkeypatch.setattr(broadcast, "BROADCAST_CONCURRENCY", 1)
+    db = fake_db([(i, None) for i in range(1, 6)])
+    stuck = asyncio.Event()
+
+    async def send(chat_id, text, **kw):
+        if chat_id == 3:
+            stuck.set()
+            await asyncio.Event().wait()  # «бот остановлен» посреди отправки
+
+    task = asyncio.create_task(run_job(7, _bot(send), bucket=TokenBucket(rate=1000)))
+    await asyncio.wait_for(stuck.wait(), 2)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    # уже отправленное сохранено, задание осталось 'running' для докачки
+    assert db.job["status"] == "running"
+    assert [r["status"] for r in db.recipients.values()] == [SENT, SENT, "pending", "pending", "pending"]
+
+
+@pytest.mark.asyncio
+async def test_resume_unfinished_starts_running_jobs(monkeypatch):
+    jobs = {"broadcast": [{"id": 1, "report_chat_id": None}], "broadcast_ref": [{"id": 2, "report_chat_id": 99}],
+            "script": [{"id": 3, "report_chat_id": None}]}
+    monkeypatch.setattr(broadcast.db, "get_unfinished_broadcast_jobs", lambda kind: jobs.get(kind, []))
+    run_job_mock = AsyncMock()
+    run_with_report_mock = AsyncMock()
+    monkeypatch.setattr(broadcast, "run_job", run_job_mock)
+    monkeypatch.setattr(broadcast, "run_with_report", run_with_report_mock)
+
+    tasks = await broadcast.resume_unfinished(MagicMock())
+    await asyncio.gather(*tasks)
+
+    # задание скрипта (kind="script") бот не трогает
+    assert [c.args[0] for c in run_job_mock.await_args_list] == [1]
+    assert run_with_report_mock.await_args.args[1:3] == (2, 99)
+
+
+# ─────────────────────────────────────────────
+#  api.db: пакетная запись результатов
+# ─────────────────────────────────────────────
+
+@patch("api.db.execute_many")
+@patch("api.db.execute_query")
+def test_record_broadcast_results_groups_statuses(mock_query, mock_many):
+    from api import db as api_db
+
+    api_db.record_broadcast_results(5, [(1, SENT), (2, BLOCKED), (3, SENT), (4, FAILED)])
+
+    sqls = " ".join(str(c.args[0]) for c in mock_query.call_args_list + mock_many.call_args_list)
+    assert "broadcast_recipients" in sqls
+    assert "bot_blocked" in sqls
+    assert "broadcast_jobs" in sqls
+    # один запрос на группу, а не на каждого получателя
+    assert mock_query.call_count + mock_many.call_count <= 6
@@ -1,5 +1,7 @@
 """Тесты для api/db.py — базовые операции с БД."""
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
 
 
 def _make_mock_pool():
@@ -77,3 +79,77 @@ def test_deactivate_key_by_payment(mock_get_pool):
     args = mock_cursor.execute.call_args
     assert "expires_at = NOW()" in args[0][0]
     mock_conn.commit.assert_called_once()
+
+
+# ─────────────────────────────────────────────
+#  execute_query_async (aiomysql pool)
+# ─────────────────────────────────────────────
+
+def _make_mock_async_pool():
+    """Создаёт мок aiomysql-пула: pool.acquire() → conn, conn.cursor() → cursor."""
+    mock_cursor = MagicMock()
+    mock_cursor.execute = AsyncMock()
+    mock_cursor.fetchone = AsyncMock()
+    mock_cursor.fetchall = AsyncMock()
+    mock_conn = MagicMock()
+    mock_conn.cursor.return_value.__aenter__ = AsyncMock(return_value=mock_cursor)
+    mock_conn.cursor.return_value.__aexit__ = AsyncMock(return_value=False)
+    mock_pool = MagicMock()
+    mock_pool.acquire.return_value.__aenter__ = AsyncMock(return_value=mock_conn)
+    mock_pool.acquire.return_value.__aexit__ = AsyncMock(return_value=False)
+    mock_pool.clear = AsyncMock()
+    return mock_pool, mock_conn, mock_cursor
+
+
+@pytest.mark.asyncio
+async def test_execute_query_async_insert():
+    mock_pool, mock_conn, mock_cursor = _make_mock_async_pool()
+    mock_cursor.lastrowid = 7
+
+    with patch("api.db._get_async_pool", new_callable=AsyncMock, return_value=mock_pool):
+        from api.db import execute_query_async
+        result = await execute_query_async("INSERT INTO users (tg_id) VALUES (%s)", (123,))
+
+    assert result == 7
+    mock_cursor.execute.assert_awaited_once_with("INSERT INTO users (tg_id) VALUES (%s)", (123,))
+
+
+@pytest.mark.asyncio
+async def test_execute_query_async_fetch_one_and_all():
+    mock_pool, mock_conn, mock_cursor = _make_mock_async_pool()
+    mock_cursor.fetchone.return_value = {"tg_id": 123}
+    mock_cursor.fetchall.return_value = ({"tg_id": 1}, {"tg_id": 2})
+
+    with patch("api.db._get_async_pool", new_callable=AsyncMock, return_value=mock_pool):
+        from api.db import execute_query_async
+        one = await execute_query_async("SELECT * FROM users WHERE tg_id = %s", (123,), fetch='one')
+        rows = await execute_query_async("SELECT tg_id FROM users", fetch='all')
+
+    assert one == {"tg_id": 123}
+    assert rows == [{"tg_id": 1}, {"tg_id": 2}]
+
+
+@pytest.mark.asyncio
+async def test_execute_query_async_retries_transient_error_once():
+    mock_pool, mock_conn, mock_cursor = _make_mock_async_pool()
+    mock_cursor.execute.side_effect = [Exception("Lost connection to MySQL server"), None]
+    mock_cursor.fetchone.return_value = {"status": "paid"}
+
+    with patch("api.db._get_async_pool", new_callable=AsyncMock, return_value=mock_pool):
+        from api.db import get_payment_status_async
+        assert await get_payment_status_async("pay-1") == "paid"
+
+    assert mock_cursor.execute.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_execute_query_async_does_not_retry_other_errors():
+    mock_pool, mock_conn, mock_cursor = _make_mock_async_pool()
+    mock_cursor.execute.side_effect = Exception("Duplicate entry")
+
+    with patch("api.db._get_async_pool", new_callable=AsyncMock, return_value=mock_pool):
+        from api.db import execute_query_async
+        with pytest.raises(Exception, match="Duplicate entry"):
+            await execute_query_async("INSERT INTO payments (payment_id) VALUES (%s)", ("p",))
+
+    assert mock_cursor.execute.await_count == 1
@@ -0,0 +1,103 @@
+"""Tests for db_pool.py — shared MySQL connection pools."""
+import threading
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+import db_pool
+from db_pool import ConnectionPool, PoolExhausted
+
+
+@pytest.fixture
+def connect():
+    with patch("db_pool.mysql.connector.connect", side_effect=lambda **kw: MagicMock()) as m:
+        yield m
+
+
+def test_connection_is_reused_after_close(connect):
+    pool = ConnectionPool("t", size=2, timeout=0.1, host="h")
+    c1 = pool.get_connection()
+    raw = c1._cnx
+    c1.close()
+    c2 = pool.get_connection()
+    assert c2._cnx is raw
+    assert connect.call_count == 1
+    connect.assert_called_with(host="h")
+
+
+def test_close_rolls_back_open_transaction(connect):
+    pool = ConnectionPool("t", size=1, timeout=0.1)
+    conn = pool.get_connection()
+    raw = conn._cnx
+    conn.close()
+    raw.rollback.assert_called_once()
+
+
+def test_proxy_delegates_to_connection(connect):
+    pool = ConnectionPool("t", size=1, timeout=0.1)
+    conn = pool.get_connection()
+    conn.cursor(dictionary=True)
+    conn._cnx.cursor.assert_called_once_with(dictionary=True)
+
+
+def test_exhausted_pool_times_out(connect):
+    pool = ConnectionPool("t", size=1, timeout=0.05)
+    held = pool.get_connection()
+    with pytest.raises(PoolExhausted):
+        pool.get_connection()
+    stats = pool.stats()
+    assert stats["exhausted"] == 1
+    assert stats["timeouts"] == 1
+    assert stats["in_use"] == 1
+    held.close()
+
+
+def test_waiter_gets_released_connection(connect):
+    pool = ConnectionPool("t", size=1, timeout=2)
+    held = pool.get_connection()
+    threading.Timer(0.05, held.close).start()
+    conn = pool.get_connection()
+    stats = pool.stats()
+    assert stats["exhausted"] == 1
+    assert stats["wait_max_ms"] >= 40
+    assert connect.call_count == 1
+    conn.close()
+
+
+def test_dropped_reference_returns_slot(connect):
+    pool = ConnectionPool("t", size=1, timeout=0.05)
+    pool.get_connection()  # never closed — garbage-collected immediately
+    conn = pool.get_connection()
+    assert pool.stats()["in_use"] == 1
+    conn.close()
+
+
+def test_dead_idle_connection_is_replaced(connect):
+    pool = ConnectionPool("t", size=1, timeout=0.1)
+    conn = pool.get_connection()
+    raw = conn._cnx
+    raw.ping.side_effect = Exception("MySQL server has gone away")
+    conn.close()
+    with patch("db_pool.HEALTH_CHECK_INTERVAL", 0):
+        fresh = pool.get_connection()
+    assert fresh._cnx is not raw
+    assert pool.stats()["health_check_failures"] == 1
+    fresh.close()
+
+
+def test_connect_failure_frees_slot():
+    pool = ConnectionPool("t", size=1, timeout=0.05)
+    with patch("db_pool.mysql.connector.connect", side_effect=Exception("can't connect")):
+        with pytest.raises(Exception):
+            pool.get_connection()
+    assert pool.stats()["in_use"] == 0
+
+
+def test_get_pool_is_process_wide(connect, monkeypatch):
+    monkeypatch.setattr(db_pool, "_pools", {})
+    monkeypatch.setenv("DB_POOL_TESTPOOL_SIZE", "3")
+    p1 = db_pool.get_pool("testpool", host="h")
+    p2 = db_pool.get_pool("testpool", host="other")
+    assert p1 is p2
+    assert p1.size == 3
+    assert [s["name"] for s in db_pool.pool_stats()] == ["testpool"]
@@ -0,0 +1,112 @@
+"""Tests for api/event_buffer.py — write-behind site_events / email_opens."""
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from api.event_buffer import EventBuffer
+
+
+@pytest.fixture
+def db():
+    """Records the batched DB calls; visitor 'old' already has a visit row."""
+    calls = {"inserts": [], "opens": [], "lookups": []}
+
+    def known(ids):
+        calls["lookups"].append(list(ids))
+        return {"old"} & set(ids)
+
+    with patch("api.event_buffer.known_visitors", side_effect=known), \
+            patch("api.event_buffer.insert_site_events", side_effect=lambda rows: calls["inserts"].append(rows)), \
+            patch("api.event_buffer.mark_emails_opened", side_effect=lambda ids: calls["opens"].append(sorted(ids))):
+        yield calls
+
+
+@pytest.mark.asyncio
+async def test_flush_is_one_multi_row_insert(db):
+    buf = EventBuffer()
+    assert buf.add_event("visit", "v1", "1.1.1.1") is True
+    assert buf.add_event("visit", "v1", "1.1.1.1") is False     # дубль в том же батче
+    assert buf.add_event("visit", "old", "2.2.2.2") is True     # в памяти не знаем — проверит flush
+    buf.add_event("click_buy", "v1", "1.1.1.1")
+    buf.add_event("click_buy", "v1", "1.1.1.1")
+
+    assert await buf.flush() == 3
+    assert db["lookups"] == [["v1", "old"]]
+    assert db["inserts"] == [[
+        ("click_buy", "v1", "1.1.1.1"), ("click_buy", "v1", "1.1.1.1"), ("visit", "v1", "1.1.1.1"),
+    ]]
+    # после flush оба visitor_id известны — повторный visit не доходит до БД
+    assert buf.add_event("visit", "old", "2.2.2.2") is False
+    assert await buf.flush() == 0
+    s = buf.stats()
+    assert (s["dup_visits"], s["flushed_events"], s["flushed_visits"], s["pending"]) == (2, 2, 1, 0)
+
+
+@pytest.mark.asyncio
+async def test_opens_are_coalesced(db):
+    buf = EventBuffer()
+    for track_id in ("a", "b", "a", "a"):
+        buf.add_open(track_id)
+    await buf.flush()
+    assert db["opens"] == [["a", "b"]]
+    assert db["inserts"] == []
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_batch(db):
+    buf = EventBuffer()
+    buf.add_event("click_buy", "v1", "ip")
+    with patch("api.event_buffer.insert_site_events", side_effect=Exception("MySQL down")):
+        assert await buf.flush() == 0
+    assert buf.stats()["flush_errors"] == 1 and buf.pending() == 1
+    assert await buf.flush() == 1
+    assert db["inserts"] == [[("click_buy", "v1", "ip")]]
+
+
+@pytest.mark.asyncio
+async def test_overflow_is_dropped_and_counted(db):
+    buf = EventBuffer(max_pending=3)
+    for i in range(5):
+        buf.add_event("click_buy", f"v{i}", "ip")
+    buf.add_open("t1")
+    assert buf.pending() == 3
+    assert buf.stats()["dropped"] == 3
+
+
+@pytest.mark.asyncio
+async def test_seen_set_is_bounded(db):
+    buf = EventBuffer(seen_max=2)
+    for v in ("a", "b", "c"):
+        buf.add_event("visit", v, "ip")
+    await buf.flush()
+    assert buf.stats()["seen_visitors"] == 2
+    assert buf.add_event("visit", "a", "ip") is True   # вытеснен — снова проверит БД
+
+
+@pytest.mark.asyncio
+async def test_batch_threshold_triggers_early_flush(db):
+    buf = EventBuffer(flush_interval=60, flush_batch=3)
+    buf.start()
+    try:
+        for i in range(3):
+            buf.add_event("click_buy", f"v{i}", "ip")
+        for _ in range(50):
+            if db["inserts"]:
+                break
+            await asyncio.sleep(0.01)
+    finally:
+        await buf.stop()
+    assert len(db["inserts"]) == 1 and len(db["inserts"][0]) == 3
+
+
+@pytest.mark.asyncio
+async def test_stop_drains_buffer(db):
+    buf = EventBuffer(flush_interval=60)
+    buf.start()
+    buf.add_event("visit", "v1", "ip")
+    buf.add_open("t1")
+    await buf.stop()
+    assert db["inserts"] == [[("visit", "v1", "ip")]]
+    assert db["opens"] == [["t1"]]
+    assert buf.stats()["pending"] == 0
@@ -0,0 +1,162 @@
+"""Tests for bot_xui/expiry_notifier.py — batched, rate-limited expiry notifications."""
+import sys
+from datetime import datetime
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+
+sys.modules.setdefault("yookassa", MagicMock())
+
+from telegram.error import Forbidden
+
+from bot_xui import expiry_notifier
+from bot_xui.expiry_notifier import plan_notifications, notify_expiring_subscriptions
+
+UNTIL = datetime(2026, 4, 3, 12, 0)
+
+
+def _row(tg_id, days_left, email=None, expired=0, autopay=False):
+    return {
+        "tg_id": tg_id, "email": email, "subscription_until": UNTIL,
+        "autopay_enabled": 1 if autopay else 0,
+        "payment_method_id": "pm_1" if autopay else None,
+        "autopay_tariff": "monthly_30d",
+        "days_left": days_left, "expired_yesterday": expired,
+    }
+
+
+# ─────────────────────────────────────────────
+#  plan_notifications
+# ─────────────────────────────────────────────
+
+def test_plan_buckets_by_days_left():
+    rows = [
+        _row(1, 3), _row(2, 1), _row(3, 0), _row(4, 2),       # 2 дня — не уведомляем
+        _row(5, -1, expired=1), _row(-6, -1, expired=1),      # web-пользователь без tg
+        _row(None, 1, email="web@example.com"),
+        _row(7, 1, email="both@example.com"),                 # есть tg — письмо не шлём
+    ]
+    messages, emails = plan_notifications(rows)
+
+    assert [(kind, tg) for kind, tg, _, _ in messages] == [
+        ("3d", 1), ("1d", 2), ("0d", 3), ("expired", 5), ("1d", 7),
+    ]
+    assert emails == [("web@example.com", 1, "03.04.2026")]
+
+
+def test_plan_autopay_text():
+    messages, _ = plan_notifications([_row(1, 0, autopay=True), _row(2, 3)])
+    assert "автоматически продлим" in messages[0][2]
+    assert messages[0][3].inline_keyboard[0][0].callback_data == "autopay_manage"
+    assert "через 3 дня" in messages[1][2]
+    assert messages[1][3].inline_keyboard[0][0].callback_data == "tariffs"
+
+
+# ─────────────────────────────────────────────
+#  notify_expiring_subscriptions
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+@patch("bot_xui.expiry_notifier.record_job_run")
+@patch("bot_xui.expiry_notifier.set_bot_blocked")
+@patch("bot_xui.expiry_notifier._queue_emails", return_value={"queued": 1, "failed": 0})
+@patch("bot_xui.expiry_notifier.get_expiry_notification_candidates")
+async def test_notify_runs_one_query_and_records_stats(mock_rows, mock_emails, mock_blocked, mock_runs):
+    mock_rows.return_value = [_row(1, 3), _row(2, 1), _row(3, -1, expired=1),
+                              _row(None, 0, email="web@example.com")]
+
+    async def send(chat_id, **kw):
+        if chat_id == 2:
+            raise Forbidden("bot was blocked by the user")
+
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=send)
+
+    stats = await notify_expiring_subscriptions(bot)
+
+    mock_rows.assert_called_once_with()
+    assert bot.send_message.await_count == 3
+    assert stats["3d"] == {"sent": 1}
+    assert stats["1d"] == {"blocked": 1}
+    assert stats["expired"] == {"sent": 1}
+    assert stats["email"] == {"queued": 1, "failed": 0}
+    mock_emails.assert_called_once_with([("web@example.com", 0, "03.04.2026")])
+    mock_blocked.assert_called_once_with([2], True)
+    job, started_at, duration_ms, recorded = mock_runs.call_args[0]
+    assert job == "expiry_notify" and duration_ms >= 0 and recorded is stats
+
+
+@pytest.mark.asyncio
+@patch("bot_xui.expiry_notifier.record_job_run")
+@patch("bot_xui.expiry_notifier.get_expiry_notification_candidates")
+async def test_notify_sends_concurrently(mock_rows, mock_runs, monkeypatch):
+    import asyncio
+    mock_rows.return_value = [_row(i, 1) for i in range(1, 21)]
+    in_flight = peak = 0
+
+    async def send(chat_id, **kw):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+
+    monkeypatch.setattr(expiry_notifier, "BROADCAST_RATE", 1000)
+    bot = MagicMock()
+    bot.send_message = AsyncMock(side_effect=send)
+    await notify_expiring_subscriptions(bot)
+
+    assert bot.send_message.await_count == 20
+    assert 1 < peak <= expiry_notifier.NOTIFY_CONCURRENCY
+
+
+# ─────────────────────────────────────────────
+#  Письма: одна пачка в mail_outbox
+# ─────────────────────────────────────────────
+
+@patch("api.notifications.SMTP_HOST", "smtp.example.com")
+@patch("api.notifications.SMTP_USER", "user@example.com")
+@patch("api.notifications.SMTP_PASSWORD", "pass")
+@patch("api.notifications.SMTP_FROM", "noreply@example.com")
+@patch("api.mail_queue.enqueue_mail")
+def test_queue_emails_one_bulk_insert(mock_enqueue):
+    stats = expiry_notifier._queue_emails([
+        ("a@example.com", 1, "03.04.2026"),
+        ("b@example.com", 3, "05.04.2026"),
+        ("c@example.com", 0, "02.04.2026"),
+    ])
+    assert stats == {"queued": 3, "failed": 0}
+    rows = mock_enqueue.call_args[0][0]
+    assert [(r[0], r[2], r[5]) for r in rows] == [
+        ("expiry_warning", "a@example.com", None),
+        ("expiry_warning", "b@example.com", None),
+        ("expiry_warning", "c@example.com", None),
+    ]
+    assert "1 день" in rows[0][3] and "To: b@example.com" in rows[1][4]
+
+
+@patch("api.mail_queue.enqueue_mail")
+def test_queue_emails_empty_batch(mock_enqueue):
+    assert expiry_notifier._queue_emails([]) == {"queued": 0, "failed": 0}
+    mock_enqueue.assert_not_called()
+
+
+@patch("api.notifications.SMTP_HOST", "smtp.example.com")
+@patch("api.notifications.SMTP_PORT", "587")
+@patch("api.notifications.SMTP_USER", "user@example.com")
+@patch("api.notifications.SMTP_PASSWORD", "pass")
+@patch("api.notifications.SMTP_FROM", "noreply@example.com")
+@patch("api.notifications.smtplib.SMTP")
+def test_smtp_connection_reconnects_after_disconnect(mock_smtp_cls):
+    import smtplib
+    from api.notifications import SMTPConnection
+
+    first, second = MagicMock(), MagicMock()
+    first.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+    mock_smtp_cls.side_effect = [first, second]
+
+    with SMTPConnection() as conn:
+        conn.sendmail("a@example.com", "msg")
+
+    assert mock_smtp_cls.call_count == 2
+    second.sendmail.assert_called_once_with("noreply@example.com", "a@example.com", "msg")
@@ -0,0 +1,50 @@
+"""Tests for api/internal.py — localhost-only guard of the internal stats endpoints."""
+import sys
+from unittest.mock import MagicMock, patch
+
+import pytest
+from fastapi import HTTPException
+
+from api.internal import require_localhost
+
+sys.modules.setdefault("yookassa", MagicMock())
+
+
+def _request(host, headers=None):
+    request = MagicMock()
+    request.client.host = host
+    request.headers = headers or {}
+    return request
+
+
+@pytest.mark.parametrize("host", ["127.0.0.1", "::1"])
+def test_direct_localhost_passes(host):
+    require_localhost(_request(host))
+
+
+@pytest.mark.parametrize("host, headers", [
+    ("10.0.0.5", {}),
+    ("127.0.0.1", {"x-real-ip": "1.2.3.4"}),        # пришёл через nginx
+    ("127.0.0.1", {"x-forwarded-for": "1.2.3.4"}),
+])
+def test_remote_or_proxied_is_hidden(host, headers):
+    with pytest.raises(HTTPException) as exc:
+        require_localhost(_request(host, headers))
+    assert exc.value.status_code == 404
+
+
+def test_request_without_client_is_hidden():
+    request = _request("")
+    request.client = None
+    with pytest.raises(HTTPException):
+        require_localhost(request)
+
+
+@pytest.mark.parametrize("path", ["/sub-cache/stats", "/api/auth/cache-stats", "/api/web/event-stats"])
+def test_all_stats_endpoints_use_the_guard(path):
+    from fastapi.testclient import TestClient
+    from api.webhook import app
+    client = TestClient(app)
+    assert client.get(path).status_code == 404  # testclient host
+    with patch("api.internal.LOCAL_HOSTS", ("testclient",)):
+        assert client.get(path).status_code == 200
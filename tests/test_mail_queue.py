@@ -0,0 +1,291 @@
+"""Tests for api/mail_queue.py — durable outbox + pooled SMTP sender.
+
+mail_outbox is replaced by an in-memory FakeOutbox with the same claim/finish
+semantics; SMTP goes over real sockets to a minimal asyncio SMTP server
+(EHLO/AUTH/MAIL/RCPT/DATA/RSET/QUIT), so SMTPConnection and smtplib run
+unmodified apart from STARTTLS.
+"""
+import asyncio
+import smtplib
+import sys
+import time
+from unittest.mock import patch, MagicMock
+
+import pytest
+import pytest_asyncio
+
+sys.modules.setdefault("yookassa", MagicMock())
+
+from api import mail_queue
+from api.mail_queue import MailSender, retry_delay, PRIORITY_AUTH, PRIORITY_BULK
+
+
+# ─────────────────────────────────────────────
+#  Stand-ins
+# ─────────────────────────────────────────────
+
+class FakeOutbox:
+    def __init__(self):
+        self.rows: dict[int, dict] = {}
+        self._next_id = 1
+
+    def enqueue_mail(self, rows):
+        ids = []
+        for kind, priority, to, subject, message, ttl in rows:
+            mail_id, self._next_id = self._next_id, self._next_id + 1
+            self.rows[mail_id] = dict(
+                id=mail_id, kind=kind, priority=priority, to_addr=to, subject=subject,
+                message=message, status="queued", attempts=0, next_attempt_at=0.0,
+                discard_after=None if ttl is None else time.monotonic() + ttl,
+                claimed_by=None, last_error=None,
+            )
+            ids.append(mail_id)
+        return ids[0] if len(ids) == 1 else None
+
+    def claim_mail(self, worker, limit):
+        now = time.monotonic()
+        due = sorted((r for r in self.rows.values()
+                      if r["status"] == "queued" and r["next_attempt_at"] <= now),
+                     key=lambda r: (-r["priority"], r["id"]))[:limit]
+        for r in due:
+            r.update(status="sending", claimed_by=worker)
+        return [dict(r, stale=int(r["discard_after"] is not None and r["discard_after"] <= now))
+                for r in due]
+
+    def finish_mail(self, results):
+        for mail_id, status, attempts, retry_in, error in results:
+            self.rows[mail_id].update(status=status, attempts=attempts, last_error=error,
+                                      claimed_by=None,
+                                      next_attempt_at=time.monotonic() + (retry_in or 0))
+
+    def requeue_stale_mail(self, older_than_s):
+        return 0
+
+    def by_status(self, status):
+        return [r for r in self.rows.values() if r["status"] == status]
+
+
+class SMTPStandIn:
+    """Just enough of RFC 5321 for smtplib: RCPT to reject@… → 550, to flaky@… → 451 once."""
+
+    def __init__(self):
+        self.messages: list[tuple[str, str]] = []
+        self.connections = 0
+        self.logins = 0
+        self._flaky_seen: set[str] = set()
+        self._server = None
+        self.port = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._session, "127.0.0.1", 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _session(self, reader, writer):
+        self.connections += 1
+
+        def reply(line: str):
+            writer.write(line.encode() + b"\r\n")
+
+        reply("220 standin ESMTP")
+        rcpt = None
+        try:
+            while line := await reader.readline():
+                cmd = line.decode().strip()
+                verb = cmd.split(" ", 1)[0].upper()
+                if verb in ("EHLO", "HELO"):
+                    reply("250-standin\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME")
+                elif verb == "AUTH":
+                    self.logins += 1
+                    reply("235 2.7.0 Authentication successful")
+                elif verb == "MAIL":
+                    rcpt = None
+                    reply("250 OK")
+                elif verb == "RCPT":
+                    addr = cmd.split(":", 1)[1].strip("<> ")
+                    if addr.startswith("reject@"):
+                        reply("550 5.1.1 No such user")
+                    elif addr.startswith("flaky@") and addr not in self._flaky_seen:
+                        self._flaky_seen.add(addr)
+                        reply("451 4.3.0 Try again later")
+                    else:
+                        rcpt = addr
+                        reply("250 OK")
+                elif verb == "DATA":
+                    reply("354 End data with <CR><LF>.<CR><LF>")
+                    await writer.drain()
+                    data = []
+                    while (chunk := await reader.readline()) != b".\r\n":
+                        data.append(chunk)
+                    self.messages.append((rcpt, b"".join(data).decode()))
+                    reply("250 OK queued")
+                elif verb in ("RSET", "NOOP"):
+                    reply("250 OK")
+                elif verb == "QUIT":
+                    reply("221 Bye")
+                    await writer.drain()
+                    break
+                else:
+                    reply("502 Command not implemented")
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+@pytest.fixture
+def outbox():
+    fake = FakeOutbox()
+    with patch.multiple(mail_queue, enqueue_mail=fake.enqueue_mail, claim_mail=fake.claim_mail,
+                        finish_mail=fake.finish_mail, requeue_stale_mail=fake.requeue_stale_mail):
+        yield fake
+
+
+@pytest_asyncio.fixture
+async def smtp_server():
+    server = SMTPStandIn()
+    await server.start()
+    with patch("api.notifications.SMTP_HOST", "127.0.0.1"), \
+            patch("api.notifications.SMTP_PORT", str(server.port)), \
+            patch("api.notifications.SMTP_USER", "user@example.com"), \
+            patch("api.notifications.SMTP_PASSWORD", "pass"), \
+            patch("api.notifications.SMTP_FROM", "noreply@example.com"), \
+            patch.object(smtplib.SMTP, "starttls", lambda self, *a, **kw: (220, b"")):
+        yield server
+    await server.stop()
+
+
+def _msg(to: str) -> str:
+    return f"From: noreply@example.com\r\nTo: {to}\r\nSubject: t\r\n\r\nhello {to}\r\n"
+
+
+async def _drain(sender: MailSender):
+    while await sender.run_once():
+        pass
+
+
+# ─────────────────────────────────────────────
+#  Delivery
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_throughput_over_pooled_connections(outbox, smtp_server):
+    n = 300
+    mail_queue.enqueue_many([(f"u{i}@example.com", "t", _msg(f"u{i}@example.com")) for i in range(n)],
+                            kind="bulk")
+    sender = MailSender(pool_size=3, batch_size=50)
+    t0 = time.perf_counter()
+    await _drain(sender)
+    elapsed = time.perf_counter() - t0
+    await sender.stop()
+
+    assert len(smtp_server.messages) == n
+    assert {to for to, _ in smtp_server.messages} == {f"u{i}@example.com" for i in range(n)}
+    assert len(outbox.by_status("sent")) == n
+    # один логин на соединение пула, а не на письмо
+    assert smtp_server.connections <= 3 and smtp_server.logins == smtp_server.connections
+    assert sender.stats()["sent"] == n and sender.stats()["batches"] == 6
+    assert elapsed < 10
+
+
+@pytest.mark.asyncio
+async def test_priority_order(outbox, smtp_server):
+    outbox.enqueue_mail([("expiry_warning", PRIORITY_BULK, "bulk@example.com", "t", _msg("bulk"), None)])
+    outbox.enqueue_mail([("auth_code", PRIORITY_AUTH, "auth@example.com", "t", _msg("auth"), 600)])
+    sender = MailSender(pool_size=1, batch_size=1)
+    await _drain(sender)
+    await sender.stop()
+    assert [to for to, _ in smtp_server.messages] == ["auth@example.com", "bulk@example.com"]
+
+
+@pytest.mark.asyncio
+async def test_permanent_rejection_is_failed(outbox, smtp_server):
+    mail_id = outbox.enqueue_mail([("auth_code", PRIORITY_AUTH, "reject@example.com", "t", _msg("x"), None)])
+    sender = MailSender(pool_size=1)
+    await _drain(sender)
+    await sender.stop()
+    row = outbox.rows[mail_id]
+    assert row["status"] == "failed" and row["attempts"] == 1
+    assert "SMTPRecipientsRefused" in row["last_error"]
+
+
+@pytest.mark.asyncio
+async def test_transient_error_retries_with_backoff(outbox, smtp_server):
+    mail_id = outbox.enqueue_mail([("support_team", 5, "flaky@example.com", "t", _msg("x"), None)])
+    sender = MailSender(pool_size=1)
+    assert await sender.run_once() == 1
+    row = outbox.rows[mail_id]
+    assert row["status"] == "queued" and row["attempts"] == 1
+    assert row["next_attempt_at"] - time.monotonic() > retry_delay(1) - 5
+    assert await sender.run_once() == 0   # ещё не пора
+
+    row["next_attempt_at"] = 0
+    assert await sender.run_once() == 1
+    await sender.stop()
+    assert row["status"] == "sent" and row["attempts"] == 2
+    assert [to for to, _ in smtp_server.messages] == ["flaky@example.com"]
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_max_attempts(outbox, monkeypatch):
+    monkeypatch.setattr(mail_queue, "MAX_ATTEMPTS", 2)
+    conn = MagicMock()
+    conn.sendmail.side_effect = smtplib.SMTPServerDisconnected("gone")
+    mail_id = outbox.enqueue_mail([("x", 0, "a@example.com", "t", _msg("a"), None)])
+    sender = MailSender(pool_size=1, connect=lambda: conn)
+
+    await sender.run_once()
+    assert outbox.rows[mail_id]["status"] == "queued"
+    outbox.rows[mail_id]["next_attempt_at"] = 0
+    await sender.run_once()
+    assert outbox.rows[mail_id]["status"] == "failed" and outbox.rows[mail_id]["attempts"] == 2
+    assert conn.close.call_count == 2  # после каждой ошибки соединение сбрасывается
+
+
+@pytest.mark.asyncio
+async def test_expired_auth_code_is_not_sent(outbox, smtp_server):
+    mail_id = outbox.enqueue_mail([("auth_code", PRIORITY_AUTH, "late@example.com", "t", _msg("x"), 600)])
+    outbox.rows[mail_id]["discard_after"] = time.monotonic() - 1
+    sender = MailSender(pool_size=1)
+    await _drain(sender)
+    await sender.stop()
+    assert outbox.rows[mail_id]["status"] == "expired"
+    assert smtp_server.messages == [] and smtp_server.connections == 0
+
+
+@pytest.mark.asyncio
+async def test_enqueue_wakes_running_sender(outbox, smtp_server, monkeypatch):
+    monkeypatch.setattr(mail_queue, "POLL_INTERVAL", 60)
+    sender = MailSender(pool_size=1)
+    sender.start()
+    try:
+        await asyncio.sleep(0.05)  # цикл уснул на пустой очереди
+        mail_id = await asyncio.to_thread(mail_queue.enqueue, "wake@example.com", "t", _msg("w"), "auth_code")
+        for _ in range(100):
+            if outbox.rows[mail_id]["status"] == "sent":
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        await sender.stop()
+    assert outbox.rows[mail_id]["status"] == "sent"
+    assert mail_queue.sender_stats() is None  # stop() снимает регистрацию
+
+
+def test_retry_delay_doubles_and_caps():
+    assert [retry_delay(n) for n in (1, 2, 3)] == [30, 60, 120]
+    assert retry_delay(20) == mail_queue.RETRY_MAX
+
+
+@pytest.mark.parametrize("exc,permanent", [
+    (smtplib.SMTPRecipientsRefused({"a@b": (550, b"no")}), True),
+    (smtplib.SMTPRecipientsRefused({"a@b": (450, b"busy")}), False),
+    (smtplib.SMTPDataError(554, b"spam"), True),
+    (smtplib.SMTPDataError(451, b"later"), False),
+    (smtplib.SMTPAuthenticationError(535, b"bad creds"), False),
+    (smtplib.SMTPSenderRefused(553, b"bad from", "x@y"), False),
+    (TimeoutError(), False),
+])
+def test_is_permanent(exc, permanent):
+    assert mail_queue._is_permanent(exc) is permanent
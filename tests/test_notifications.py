@@ -120,20 +120,60 @@ def test_send_unknown_channel():
 #  _send_email
 # ─────────────────────────────────────────────
 
+@patch("api.notifications.SMTP_HOST", "smtp.example.com")
+@patch("api.notifications.SMTP_USER", "user@example.com")
+@patch("api.notifications.SMTP_PASSWORD", "pass")
+@patch("api.notifications.SMTP_FROM", "noreply@example.com")
+@patch("api.mail_queue.enqueue", return_value=42)
+def test_send_email_queues_auth_code(mock_enqueue):
+    from api.notifications import _send_email, CODE_TTL_MINUTES
+    from api.mail_queue import PRIORITY_AUTH
+    assert _send_email("to@example.com", "123456") is True
+    to, subject, message = mock_enqueue.call_args[0]
+    assert to == "to@example.com" and "123456" in subject
+    assert "From: TIIN <noreply@example.com>" in message
+    assert mock_enqueue.call_args.kwargs == {
+        "kind": "auth_code", "priority": PRIORITY_AUTH, "ttl": CODE_TTL_MINUTES * 60,
+    }
+
+
+@patch("api.notifications.SMTP_HOST", "")
+@patch("api.notifications.SMTP_USER", "")
+@patch("api.notifications.SMTP_PASSWORD", "")
+@patch("api.mail_queue.enqueue")
+def test_send_email_no_config(mock_enqueue):
+    from api.notifications import _send_email
+    assert _send_email("to@example.com", "code") is False
+    mock_enqueue.assert_not_called()
+
+
+@patch("api.notifications.SMTP_HOST", "smtp.example.com")
+@patch("api.notifications.SMTP_USER", "user@example.com")
+@patch("api.notifications.SMTP_PASSWORD", "pass")
+@patch("api.mail_queue.enqueue", side_effect=Exception("MySQL gone away"))
+def test_send_email_queue_failure(mock_enqueue):
+    from api.notifications import _send_email
+    assert _send_email("to@example.com", "code") is False
+
+
+# ─────────────────────────────────────────────
+#  _send_html_email (CLI scripts: inline SMTP)
+# ─────────────────────────────────────────────
+
 @patch("api.notifications.SMTP_HOST", "smtp.example.com")
 @patch("api.notifications.SMTP_PORT", "587")
 @patch("api.notifications.SMTP_USER", "user@example.com")
 @patch("api.notifications.SMTP_PASSWORD", "pass")
 @patch("api.notifications.SMTP_FROM", "noreply@example.com")
 @patch("api.notifications.smtplib.SMTP")
-def test_send_email_starttls(mock_smtp_cls):
-    from api.notifications import _send_email
-    mock_server = MagicMock()
-    mock_smtp_cls.return_value.__enter__ = MagicMock(return_value=mock_server)
-    mock_smtp_cls.return_value.__exit__ = MagicMock(return_value=False)
-    result = _send_email("to@example.com", "123456")
-    assert result is True
+def test_send_html_email_starttls(mock_smtp_cls):
+    from api.notifications import _send_html_email
+    assert _send_html_email("to@example.com", "Subj", "text", "<p>html</p>") is True
     mock_smtp_cls.assert_called_once_with("smtp.example.com", 587)
+    server = mock_smtp_cls.return_value
+    server.starttls.assert_called_once()
+    server.sendmail.assert_called_once()
+    server.quit.assert_called_once()
 
 
 @patch("api.notifications.SMTP_HOST", "smtp.example.com")
@@ -142,33 +182,21 @@ def test_send_email_starttls(mock_smtp_cls):
 @patch("api.notifications.SMTP_PASSWORD", "pass")
 @patch("api.notifications.SMTP_FROM", "noreply@example.com")
 @patch("api.notifications.smtplib.SMTP_SSL")
-def test_send_email_ssl(mock_smtp_ssl):
-    from api.notifications import _send_email
-    mock_server = MagicMock()
-    mock_smtp_ssl.return_value.__enter__ = MagicMock(return_value=mock_server)
-    mock_smtp_ssl.return_value.__exit__ = MagicMock(return_value=False)
-    result = _send_email("to@example.com", "123456")
-    assert result is True
+def test_send_html_email_ssl(mock_smtp_ssl):
+    from api.notifications import _send_html_email
+    assert _send_html_email("to@example.com", "Subj", "text", "<p>html</p>") is True
     mock_smtp_ssl.assert_called_once_with("smtp.example.com", 465)
 
 
-@patch("api.notifications.SMTP_HOST", "")
-@patch("api.notifications.SMTP_USER", "")
-@patch("api.notifications.SMTP_PASSWORD", "")
-def test_send_email_no_config():
-    from api.notifications import _send_email
-    assert _send_email("to@example.com", "code") is False
-
-
 @patch("api.notifications.SMTP_HOST", "smtp.example.com")
 @patch("api.notifications.SMTP_PORT", "587")
 @patch("api.notifications.SMTP_USER", "user@example.com")
 @patch("api.notifications.SMTP_PASSWORD", "pass")
 @patch("api.notifications.SMTP_FROM", "noreply@example.com")
 @patch("api.notifications.smtplib.SMTP", side_effect=Exception("Connection refused"))
-def test_send_email_exception(mock_smtp):
-    from api.notifications import _send_email
-    assert _send_email("to@example.com", "code") is False
+def test_send_html_email_exception(mock_smtp):
+    from api.notifications import _send_html_email
+    assert _send_html_email("to@example.com", "Subj", "text", "<p>html</p>") is False
 
 
 # ─────────────────────────────────────────────
@@ -186,7 +214,7 @@ def test_branded_html_contains_branding():
 #  Transactional emails
 # ─────────────────────────────────────────────
 
-@patch("api.notifications._send_html_email", return_value=True)
+@patch("api.notifications._queue_html_email", return_value=True)
 def test_send_payment_success_email(mock_send):
     from api.notifications import send_payment_success_email
     result = send_payment_success_email("u@e.com", "Месяц", "30 дней", "https://example.com/my/tok")
@@ -197,7 +225,7 @@ def test_send_payment_success_email(mock_send):
     assert "Месяц" in args[0][2]
 
 
-@patch("api.notifications._send_html_email", return_value=True)
+@patch("api.notifications._queue_html_email", return_value=True)
 def test_send_expiry_warning_1_day(mock_send):
     from api.notifications import send_expiry_warning_email
     result = send_expiry_warning_email("u@e.com", 1, "2026-04-01")
@@ -206,7 +234,7 @@ def test_send_expiry_warning_1_day(mock_send):
     assert "1 день" in subject
 
 
-@patch("api.notifications._send_html_email", return_value=True)
+@patch("api.notifications._queue_html_email", return_value=True)
 def test_send_expiry_warning_3_days(mock_send):
     from api.notifications import send_expiry_warning_email
     result = send_expiry_warning_email("u@e.com", 3, "2026-04-03")
@@ -215,7 +243,7 @@ def test_send_expiry_warning_3_days(mock_send):
     assert "3 дня" in subject
 
 
-@patch("api.notifications._send_html_email", return_value=True)
+@patch("api.notifications._queue_html_email", return_value=True)
 def test_send_expiry_warning_7_days(mock_send):
     from api.notifications import send_expiry_warning_email
     result = send_expiry_warning_email("u@e.com", 7, "2026-04-07")
@@ -224,7 +252,7 @@ def test_send_expiry_warning_7_days(mock_send):
     assert "7 дней" in subject
 
 
-@patch("api.notifications._send_html_email", return_value=True)
+@patch("api.notifications._queue_html_email", return_value=True)
 def test_send_support_autoreply(mock_send):
     from api.notifications import send_support_autoreply
     result = send_support_autoreply("u@e.com")
@@ -233,7 +261,7 @@ def test_send_support_autoreply(mock_send):
     assert "обращение" in mock_send.call_args[0][1].lower()
 
 
-@patch("api.notifications._send_html_email", return_value=True)
+@patch("api.notifications._queue_html_email", return_value=True)
 def test_send_support_message_to_team(mock_send):
     from api.notifications import send_support_message_to_team
     result = send_support_message_to_team("user@e.com", "Help me!")
@@ -242,7 +270,7 @@ def test_send_support_message_to_team(mock_send):
     assert "user@e.com" in mock_send.call_args[0][1]
 
 
-@patch("api.notifications._send_html_email", return_value=True)
+@patch("api.notifications._queue_html_email", return_value=True)
 def test_send_support_message_escapes_html(mock_send):
     from api.notifications import send_support_message_to_team
     send_support_message_to_team("<script>xss</script>@e.com", "<b>bad</b>")
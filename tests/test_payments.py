@@ -104,8 +104,9 @@ def test_get_payment_status_not_found(mock_get_pool):
 #  update_payment_status
 # ─────────────────────────────────────────────
 
+@patch("api.rollups.resync_payment")
 @patch("api.db._get_pool")
-def test_update_payment_status(mock_get_pool):
+def test_update_payment_status(mock_get_pool, mock_resync):
     mock_pool, mock_conn, mock_cursor = _make_mock_pool()
     mock_get_pool.return_value = mock_pool
 
@@ -117,6 +118,19 @@ def test_update_payment_status(mock_get_pool):
     assert "UPDATE payments SET status" in sql
     assert params == ("succeeded", "pay-abc-123")
     mock_conn.commit.assert_called_once()
+    # статус мог смениться у уже свёрнутого платежа — день пересчитывается
+    mock_resync.assert_called_once_with("pay-abc-123")
+
+
+@patch("api.rollups.resync_payment", side_effect=Exception("db down"))
+@patch("api.db._get_pool")
+def test_update_payment_status_survives_rollup_error(mock_get_pool, mock_resync):
+    mock_pool, mock_conn, mock_cursor = _make_mock_pool()
+    mock_get_pool.return_value = mock_pool
+
+    from api.db import update_payment_status
+    update_payment_status("pay-abc-123", "refunded")
+    mock_conn.commit.assert_called_once()
 
 
 # ─────────────────────────────────────────────
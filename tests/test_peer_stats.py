@@ -0,0 +1,153 @@
+"""Tests for awg_api/peer_stats.py — UAPI reader with `awg show dump` fallback."""
+import base64
+import os
+import socketserver
+import threading
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from awg_api import peer_stats
+
+KEY_A = bytes(range(32))
+KEY_B = bytes(range(32, 64))
+B64_A = base64.b64encode(KEY_A).decode()
+B64_B = base64.b64encode(KEY_B).decode()
+
+UAPI_REPLY = (
+    "private_key=" + "11" * 32 + "\n"
+    "listen_port=51820\n"
+    "jc=4\n"
+    f"public_key={KEY_A.hex()}\n"
+    "preshared_key=" + "00" * 32 + "\n"
+    "endpoint=203.0.113.7:40123\n"
+    "last_handshake_time_sec=1700000000\n"
+    "last_handshake_time_nsec=5\n"
+    "tx_bytes=2048\n"
+    "rx_bytes=1024\n"
+    "persistent_keepalive_interval=25\n"
+    "allowed_ip=10.10.0.2/32\n"
+    f"public_key={KEY_B.hex()}\n"
+    "endpoint=[2001:db8::1]:51820\n"
+    "last_handshake_time_sec=0\n"
+    "allowed_ip=10.10.0.3/32\n"
+    "allowed_ip=fd00::3/128\n"
+    "errno=0\n\n"
+)
+
+DUMP = (
+    "privkey\tpubkey\t51820\toff\n"
+    f"{B64_A}\t(none)\t203.0.113.7:40123\t10.10.0.2/32\t1700000000\t1024\t2048\t25\n"
+    f"{B64_B}\t(none)\t[2001:db8::1]:51820\t10.10.0.3/32,fd00::3/128\t0\t0\t0\toff\n"
+)
+
+
+class _FakeUAPI(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Answers every `get=1` with a canned reply; counts requests."""
+    daemon_threads = True
+
+    def __init__(self, path, reply):
+        self.reply = reply
+        self.requests = []
+        super().__init__(path, _UAPIHandler)
+
+
+class _UAPIHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        lines = []
+        while True:
+            line = self.rfile.readline().decode()
+            if line in ("\n", ""):
+                break
+            lines.append(line.strip())
+        self.server.requests.append(lines)
+        self.wfile.write(self.server.reply.encode())
+
+
+@pytest.fixture
+def uapi(tmp_path, monkeypatch):
+    """Start a fake amneziawg-go UAPI socket for interface `awg0` in tmp_path."""
+    monkeypatch.setattr(peer_stats, "UAPI_DIRS", [str(tmp_path)])
+    peer_stats._cache.clear()
+    servers = []
+
+    def start(reply=UAPI_REPLY):
+        server = _FakeUAPI(os.path.join(str(tmp_path), "awg0.sock"), reply)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for s in servers:
+        s.shutdown()
+        s.server_close()
+
+
+def test_parse_uapi_records():
+    peers = peer_stats.parse_uapi(UAPI_REPLY)
+    assert [p["public_key"] for p in peers] == [B64_A, B64_B]
+    a, b = peers
+    assert a["endpoint"] == "203.0.113.7:40123"
+    assert a["endpoint_ip"] == "203.0.113.7"
+    assert (a["handshake_ts"], a["rx"], a["tx"], a["keepalive"]) == (1700000000, 1024, 2048, 25)
+    assert a["allowed_ips"] == ["10.10.0.2/32"]
+    assert b["endpoint_ip"] == "2001:db8::1"
+    assert b["allowed_ips"] == ["10.10.0.3/32", "fd00::3/128"]
+
+
+def test_parse_uapi_errno_raises():
+    with pytest.raises(peer_stats.PeerStatsUnavailable):
+        peer_stats.parse_uapi("errno=19\n\n")
+
+
+def test_parse_dump_matches_uapi():
+    assert peer_stats.parse_dump(DUMP) == peer_stats.parse_uapi(UAPI_REPLY)
+
+
+def test_read_peers_over_socket(uapi):
+    server = uapi()
+    with patch("awg_api.peer_stats.subprocess.run") as mock_run:
+        peers = peer_stats.read_peers("awg0")
+    mock_run.assert_not_called()
+    assert server.requests == [["get=1"]]
+    assert peer_stats.peers_by_key("awg0")[B64_A]["rx"] == 1024
+    assert len(peers) == 2
+
+
+def test_max_age_reuses_recent_read(uapi):
+    server = uapi()
+    peer_stats.read_peers("awg0")
+    peer_stats.read_peers("awg0", max_age=60)
+    assert len(server.requests) == 1
+    peer_stats.read_peers("awg0")
+    assert len(server.requests) == 2
+
+
+def test_falls_back_to_dump_without_socket(tmp_path, monkeypatch):
+    monkeypatch.setattr(peer_stats, "UAPI_DIRS", [str(tmp_path)])
+    with patch("awg_api.peer_stats.subprocess.run",
+               return_value=MagicMock(returncode=0, stdout=DUMP)) as mock_run:
+        peers = peer_stats.read_peers("awg0")
+    assert mock_run.call_args[0][0] == ["awg", "show", "awg0", "dump"]
+    assert [p["public_key"] for p in peers] == [B64_A, B64_B]
+
+
+def test_falls_back_to_dump_on_uapi_error(uapi):
+    uapi("errno=1\n\n")
+    with patch("awg_api.peer_stats.subprocess.run",
+               return_value=MagicMock(returncode=0, stdout=DUMP)) as mock_run:
+        peers = peer_stats.read_peers("awg0")
+    mock_run.assert_called_once()
+    assert len(peers) == 2
+
+
+def test_unavailable_interface(tmp_path, monkeypatch):
+    monkeypatch.setattr(peer_stats, "UAPI_DIRS", [str(tmp_path)])
+    peer_stats._cache.clear()
+    with patch("awg_api.peer_stats.subprocess.run",
+               return_value=MagicMock(returncode=1, stdout="", stderr="No such device")):
+        with pytest.raises(peer_stats.PeerStatsUnavailable):
+            peer_stats.read_peers("awg0")
+        assert peer_stats.is_up("awg0") is False
+    with patch("awg_api.peer_stats.subprocess.run", side_effect=FileNotFoundError("awg")):
+        assert peer_stats.is_up("awg0") is False
@@ -0,0 +1,151 @@
+"""Tests for admin/presence.py — shared online-presence engine."""
+import asyncio
+import threading
+
+import pytest
+
+from admin import presence as presence_mod
+from admin.presence import PresenceEngine, diff_snapshots, PresenceSnapshot, user_key
+
+
+def _user(tg_id, speed=0, name=None):
+    return {"tg_id": tg_id, "user_id": None, "first_name": name or f"u{tg_id}",
+            "names": [f"tiin_{tg_id}"], "protocols": ["vless"], "speed_mbps": speed}
+
+
+class _Compute:
+    """Returns the queued results in order; counts calls."""
+
+    def __init__(self, *results):
+        self.results = list(results)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.calls += 1
+            users = self.results[min(self.calls, len(self.results)) - 1]
+        return [dict(u) for u in users], {("vless", u["names"][0]) for u in users}
+
+
+def test_user_key_prefers_tg_then_user_then_name():
+    assert user_key({"tg_id": 5, "user_id": 7}) == "tg:5"
+    assert user_key({"tg_id": None, "user_id": 7}) == "uid:7"
+    assert user_key({"names": ["se_user"]}) == "name:se_user"
+
+
+def test_diff_joined_left_changed():
+    old = PresenceSnapshot(1, [_user(1), _user(2, speed=1)], set())
+    new = PresenceSnapshot(2, [_user(2, speed=5), _user(3)], set())
+    diff = diff_snapshots(old, new)
+    assert diff["base_version"] == 1 and diff["version"] == 2
+    assert [u["key"] for u in diff["joined"]] == ["tg:3"]
+    assert diff["left"] == ["tg:1"]
+    assert [u["speed_mbps"] for u in diff["changed"]] == [5]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_gets_share_one_computation():
+    compute = _Compute([_user(1)])
+    engine = PresenceEngine(compute, interval=60)
+    snaps = await asyncio.gather(*(engine.get() for _ in range(5)))
+    assert compute.calls == 1
+    assert len({s.version for s in snaps}) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_reuses_snapshot_within_interval():
+    compute = _Compute([_user(1)])
+    engine = PresenceEngine(compute, interval=60)
+    first = await engine.get()
+    second = await engine.get()
+    assert first is second
+    assert compute.calls == 1
+    assert isinstance(first.users, tuple)
+    assert first.identities == frozenset({("vless", "tiin_1")})
+
+
+@pytest.mark.asyncio
+async def test_subscribers_receive_diffs_only_on_change():
+    compute = _Compute([_user(1)], [_user(1)], [_user(1), _user(2)])
+    engine = PresenceEngine(compute, interval=60)
+    await engine.refresh()
+    q = engine.subscribe()
+
+    await engine.refresh()  # same users — nothing to send
+    assert q.empty()
+
+    await engine.refresh()
+    diff = q.get_nowait()
+    assert diff["type"] == "online_diff"
+    assert [u["key"] for u in diff["joined"]] == ["tg:2"]
+
+
+@pytest.mark.asyncio
+async def test_empty_refresh_keeps_version_chain():
+    compute = _Compute([_user(1)], [_user(1)], [_user(1)], [_user(1, speed=3)])
+    engine = PresenceEngine(compute, interval=60)
+    first = await engine.refresh()
+    q = engine.subscribe()
+
+    await engine.refresh()
+    quiet = await engine.refresh()
+    assert quiet.version == first.version and quiet is not first  # свежий снимок, та же версия
+    assert q.empty()
+
+    await engine.refresh()
+    diff = q.get_nowait()
+    # клиент на v1 применяет дифф без resync
+    assert diff["base_version"] == first.version and diff["version"] == first.version + 1
+    assert engine.snapshot.version == diff["version"]
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_gets_resync(monkeypatch):
+    monkeypatch.setattr(presence_mod, "SUBSCRIBER_QUEUE", 2)
+    results = [[_user(1, speed=i)] for i in range(6)]
+    engine = PresenceEngine(_Compute(*results), interval=60)
+    await engine.refresh()
+    q = engine.subscribe()
+    for _ in range(4):
+        await engine.refresh()
+
+    msgs = [q.get_nowait() for _ in range(q.qsize())]
+    assert any(m["type"] == "resync" for m in msgs)
+    assert engine.stats["dropped"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_background_loop_refreshes_only_with_subscribers():
+    compute = _Compute([_user(1)], [_user(2)])
+    engine = PresenceEngine(compute, interval=0.01)
+    engine.start()
+    await asyncio.sleep(0.05)
+    assert compute.calls == 0
+
+    q = engine.subscribe()
+    diff = await asyncio.wait_for(q.get(), timeout=1)
+    assert diff["left"] == ["tg:1"]
+    assert [u["key"] for u in diff["joined"]] == ["tg:2"]
+    await engine.stop()
+
+
+@pytest.mark.asyncio
+async def test_ws_broadcaster_subscribes_only_while_clients_connected(monkeypatch):
+    from awg_api import main
+    engine = PresenceEngine(_Compute([_user(1)]), interval=0.01)
+    monkeypatch.setattr(main, "presence", engine)
+    monkeypatch.setattr(main, "_broadcast_task", None)
+    ws = object()
+    main._admin_ws_connections.add(ws)
+    try:
+        main._ensure_broadcaster()
+        await asyncio.sleep(0.01)
+        assert len(engine._subscribers) == 1
+    finally:
+        main._admin_ws_connections.discard(ws)
+    main._stop_broadcaster_if_idle()
+    await asyncio.sleep(0.01)
+    # последний админ ушёл — подписки нет, фоновый пересчёт простаивает
+    assert not engine._subscribers
+    assert main._broadcast_task is None
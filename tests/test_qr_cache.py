@@ -0,0 +1,142 @@
+"""Tests for qr_cache.py — content-addressed QR cache and Telegram file_id reuse."""
+import base64
+from io import BytesIO
+from types import SimpleNamespace
+from unittest.mock import patch, AsyncMock
+
+import pytest
+import qrcode
+from PIL import Image, ImageChops
+
+import qr_cache
+from qr_cache import QRCache, render_png
+
+URL = "https://344988.snk.wtf/sub/abcdefghijklmnop"
+
+
+def _legacy_png(data, box_size, border):
+    qr = qrcode.QRCode(version=1, box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    bio = BytesIO()
+    qr.make_image(fill_color="black", back_color="white").save(bio, "PNG")
+    return bio.getvalue()
+
+
+@pytest.mark.parametrize("data,box_size,border", [(URL, 8, 4), ("x" * 500, 10, 5), ("hi", 8, 2)])
+def test_render_matches_qrcode_image(data, box_size, border):
+    old = Image.open(BytesIO(_legacy_png(data, box_size, border)))
+    new = Image.open(BytesIO(render_png(data, box_size, border)))
+    assert new.size == old.size
+    assert ImageChops.difference(old.convert("L"), new.convert("L")).getbbox() is None
+
+
+def test_memory_hits_skip_render():
+    cache = QRCache(max_entries=10, directory="")
+    with patch("qr_cache.render_png", wraps=render_png) as render:
+        first = cache.png(URL, 8, 4)
+        assert cache.png(URL, 8, 4) == first
+        assert cache.png_base64(URL, 8, 4) == base64.b64encode(first).decode()
+        cache.png_base64(URL, 8, 4)
+        cache.png(URL, 10, 4)  # другой размер — другой ключ
+    assert render.call_count == 2
+    s = cache.stats()
+    assert (s["renders"], s["hits"], s["b64_hits"]) == (2, 2, 1)
+
+
+def test_lru_bound():
+    cache = QRCache(max_entries=2, directory="")
+    for i in range(5):
+        cache.png(f"payload-{i}", 2, 1)
+    assert cache.stats()["png_entries"] == 2
+
+
+def test_disk_tier_shared_between_instances(tmp_path):
+    QRCache(directory=str(tmp_path)).png(URL, 8, 4)
+    other = QRCache(directory=str(tmp_path))
+    with patch("qr_cache.render_png") as render:
+        assert other.png(URL, 8, 4).startswith(b"\x89PNG")
+    render.assert_not_called()
+    assert other.stats()["disk_hits"] == 1
+
+
+def test_disk_files_private(tmp_path):
+    directory = tmp_path / "qr"
+    QRCache(directory=str(directory)).png(URL, 8, 4)
+    files = list(directory.rglob("*.png"))
+    assert len(files) == 1
+    assert files[0].stat().st_mode & 0o777 == 0o600
+    assert files[0].parent.stat().st_mode & 0o777 == 0o700
+    assert directory.stat().st_mode & 0o777 == 0o700
+
+
+def test_secret_payload_never_touches_disk(tmp_path):
+    conf = "[Interface]\nPrivateKey = c2VjcmV0\n"
+    cache = QRCache(directory=str(tmp_path))
+    with patch("qr_cache.render_png", wraps=render_png) as render:
+        first = cache.png(conf, 10, 4, secret=True)
+        assert cache.png(conf, 10, 4, secret=True) == first  # память работает
+    assert render.call_count == 1
+    assert list(tmp_path.rglob("*")) == []
+    # уже лежащий на диске файл для секрета не читается
+    QRCache(directory=str(tmp_path)).png(conf, 10, 4)
+    other = QRCache(directory=str(tmp_path))
+    other.png(conf, 10, 4, secret=True)
+    assert (other.stats()["disk_hits"], other.stats()["renders"]) == (0, 1)
+
+
+def test_png_io_is_fresh_stream():
+    cache = QRCache(directory="")
+    a, b = cache.png_io(URL), cache.png_io(URL)
+    a.read()
+    assert a is not b and b.tell() == 0 and b.name == "qr.png"
+
+
+def test_telegram_file_id_roundtrip(tmp_path):
+    cache = QRCache(directory=str(tmp_path))
+    assert isinstance(cache.telegram_photo(URL, 8, 4), BytesIO)
+    message = SimpleNamespace(photo=[SimpleNamespace(file_id="small"), SimpleNamespace(file_id="big")])
+    cache.remember_telegram_photo(URL, message, 8, 4)
+    assert cache.telegram_photo(URL, 8, 4) == "big"
+    # переживает рестарт через дисковый уровень
+    assert QRCache(directory=str(tmp_path)).telegram_photo(URL, 8, 4) == "big"
+    cache.forget_telegram_photo(URL, 8, 4)
+    assert isinstance(QRCache(directory=str(tmp_path)).telegram_photo(URL, 8, 4), BytesIO)
+
+
+# ─────────────────────────────────────────────
+#  bot_xui.helpers.send_qr_photo
+# ─────────────────────────────────────────────
+
+@pytest.fixture
+def fresh_cache():
+    cache = QRCache(directory="")
+    with patch.multiple(qr_cache, telegram_photo=cache.telegram_photo, png_io=cache.png_io,
+                        remember_telegram_photo=cache.remember_telegram_photo,
+                        forget_telegram_photo=cache.forget_telegram_photo):
+        yield cache
+
+
+@pytest.mark.asyncio
+async def test_send_qr_photo_reuses_file_id(fresh_cache):
+    from bot_xui.helpers import send_qr_photo
+    sent = SimpleNamespace(photo=[SimpleNamespace(file_id="FILE-1")])
+    send = AsyncMock(return_value=sent)
+    await send_qr_photo(send, URL, 8, 4, caption="c")
+    await send_qr_photo(send, URL, 8, 4, caption="c")
+    first, second = send.call_args_list
+    assert isinstance(first.kwargs["photo"], BytesIO)
+    assert second.kwargs["photo"] == "FILE-1"
+    assert second.kwargs["caption"] == "c"
+
+
+@pytest.mark.asyncio
+async def test_send_qr_photo_reuploads_rejected_file_id(fresh_cache):
+    from telegram.error import BadRequest
+    from bot_xui.helpers import send_qr_photo
+    fresh_cache.remember_telegram_photo(URL, SimpleNamespace(photo=[SimpleNamespace(file_id="OLD")]), 8, 4)
+    sent = SimpleNamespace(photo=[SimpleNamespace(file_id="NEW")])
+    send = AsyncMock(side_effect=[BadRequest("Wrong file identifier"), sent])
+    await send_qr_photo(send, URL, 8, 4)
+    assert isinstance(send.call_args.kwargs["photo"], BytesIO)
+    assert fresh_cache.telegram_photo(URL, 8, 4) == "NEW"
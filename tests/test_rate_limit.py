@@ -0,0 +1,123 @@
+"""Tests for api/rate_limit.py — sliding-window limiter, memory and SQLite backends."""
+import multiprocessing
+import os
+
+import pytest
+
+from api.rate_limit import RateLimiter, MemoryBackend, SQLiteBackend, PathMatcher, Rule, make_backend
+
+RULES = {
+    "/api/auth/send-code": (5, 300),
+    "/api/web/order/send-code": (5, 300),
+    "/api/web/order": (10, 300),
+    "/api/web/event": (30, 60),
+}
+T0 = 1_700_000_050.0  # не на границе окна
+
+
+# ─────────────────────────────────────────────
+#  PathMatcher
+# ─────────────────────────────────────────────
+
+def test_matcher_keeps_declaration_order():
+    m = PathMatcher([Rule(p, *cfg) for p, cfg in RULES.items()])
+    assert m.match("/api/web/order/send-code").prefix == "/api/web/order/send-code"
+    assert m.match("/api/web/order").prefix == "/api/web/order"
+    assert m.match("/api/web/order/123").prefix == "/api/web/order"
+    assert m.match("/sub/abcdef") is None
+    assert m.match("/api/web/me") is None
+    assert PathMatcher([]).match("/api/web/order") is None
+
+
+# ─────────────────────────────────────────────
+#  Sliding window
+# ─────────────────────────────────────────────
+
+@pytest.fixture(params=["memory", "sqlite"])
+def limiter(request, tmp_path):
+    backend = MemoryBackend() if request.param == "memory" else SQLiteBackend(str(tmp_path / "rl.db"))
+    return RateLimiter(RULES, backend)
+
+
+def test_limit_per_ip_and_rule(limiter):
+    assert all(limiter.check("1.1.1.1", "/api/auth/send-code", T0 + i) for i in range(5))
+    assert limiter.check("1.1.1.1", "/api/auth/send-code", T0 + 5) is False
+    # другой IP и другое правило считаются отдельно
+    assert limiter.check("2.2.2.2", "/api/auth/send-code", T0 + 5) is True
+    assert limiter.check("1.1.1.1", "/api/web/order", T0 + 5) is True
+
+
+def test_unlimited_paths_always_allowed(limiter):
+    assert all(limiter.check("1.1.1.1", "/sub/token", T0) for _ in range(1000))
+
+
+def test_window_slides(limiter):
+    for _ in range(5):
+        assert limiter.check("1.1.1.1", "/api/auth/send-code", T0)
+    start = (int(T0 / 300) + 1) * 300
+    # на середине следующего окна предыдущее весит 0.5 × 5 = 2.5 → проходят 2.5, 3.5, 4.5
+    allowed = [limiter.check("1.1.1.1", "/api/auth/send-code", start + 150) for _ in range(4)]
+    assert allowed == [True, True, True, False]
+    # через два окна — счётчик пуст
+    assert all(limiter.check("1.1.1.1", "/api/auth/send-code", start + 600) for _ in range(5))
+
+
+def test_memory_backend_expires_stale_keys():
+    backend = MemoryBackend(stripes=1)
+    limiter = RateLimiter({"/api/web/event": (30, 60)}, backend)
+    for i in range(1000):
+        limiter.check(f"10.0.{i // 250}.{i % 250}", "/api/web/event", T0)
+    assert len(backend) == 1000
+    # через два окна каждый новый запрос вычищает пару старых ключей
+    for i in range(600):
+        limiter.check(f"10.1.{i // 250}.{i % 250}", "/api/web/event", T0 + 180)
+    assert len(backend) == 600
+
+
+def test_sqlite_backend_error_fails_open(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "rl.db"))
+    limiter = RateLimiter(RULES, backend)
+    backend._conn().execute("DROP TABLE rate_limits")
+    assert limiter.check("1.1.1.1", "/api/auth/send-code") is True
+
+
+def test_make_backend(tmp_path):
+    assert isinstance(make_backend(""), MemoryBackend)
+    assert isinstance(make_backend(str(tmp_path / "rl.db")), SQLiteBackend)
+    assert isinstance(make_backend(str(tmp_path / "missing" / "rl.db")), MemoryBackend)
+
+
+def _hammer(path, out):
+    limiter = RateLimiter(RULES, SQLiteBackend(path))
+    out.put(sum(limiter.check("9.9.9.9", "/api/web/order", T0) for _ in range(10)))
+
+
+def test_sqlite_limit_is_shared_between_processes(tmp_path):
+    """Four "uvicorn workers" together get the limit once, not four times."""
+    path = str(tmp_path / "rl.db")
+    SQLiteBackend(path)
+    ctx = multiprocessing.get_context("fork" if os.name == "posix" else "spawn")
+    out = ctx.Queue()
+    procs = [ctx.Process(target=_hammer, args=(path, out)) for _ in range(4)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(10)
+    assert sum(out.get(timeout=5) for _ in procs) == 10
+
+
+# ─────────────────────────────────────────────
+#  Middleware
+# ─────────────────────────────────────────────
+
+def test_middleware_uses_limiter():
+    from api import webhook
+    limiter = RateLimiter({"/api/web/event": (2, 60)})
+    original, webhook._rate_limiter = webhook._rate_limiter, limiter
+    try:
+        assert webhook._check_rate_limit("3.3.3.3", "/api/web/event")
+        assert webhook._check_rate_limit("3.3.3.3", "/api/web/event")
+        assert not webhook._check_rate_limit("3.3.3.3", "/api/web/event")
+        assert webhook._check_rate_limit("3.3.3.3", "/sub/x")
+    finally:
+        webhook._rate_limiter = original
@@ -1,6 +1,6 @@
 """Tests for api/webhook.py — process_refund and deactivate_xui_client."""
 import sys
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 
 import pytest
 
@@ -13,40 +13,45 @@ sys.modules.setdefault("yookassa", MagicMock())
 
 class TestDeactivateXuiClient:
 
-    @patch("api.webhook.XUIClient")
-    def test_success(self, mock_xui_cls):
-        """Deactivates client via XUI panel."""
+    @pytest.mark.asyncio
+    @patch("api.webhook.AsyncXUIClient")
+    async def test_success(self, mock_xui_cls):
+        """Deactivates client via XUI panel (awaited, no event-loop blocking)."""
         from api.webhook import deactivate_xui_client
 
-        xui = MagicMock()
+        xui = AsyncMock()
         xui.get_client_by_email.return_value = {
             "inbound_id": 1, "client": {"email": "tiin_100"}
         }
         xui.deactivate_client.return_value = True
         mock_xui_cls.return_value = xui
 
-        assert deactivate_xui_client("tiin_100") is True
-        xui.deactivate_client.assert_called_once()
+        assert await deactivate_xui_client("tiin_100") is True
+        xui.deactivate_client.assert_awaited_once_with(1, {"email": "tiin_100"})
 
-    @patch("api.webhook.XUIClient")
-    def test_client_not_found(self, mock_xui_cls):
+    @pytest.mark.asyncio
+    @patch("api.webhook.AsyncXUIClient")
+    async def test_client_not_found(self, mock_xui_cls):
         """Returns False if client not found in XUI."""
         from api.webhook import deactivate_xui_client
 
-        xui = MagicMock()
+        xui = AsyncMock()
         xui.get_client_by_email.return_value = None
         mock_xui_cls.return_value = xui
 
-        assert deactivate_xui_client("nonexistent") is False
+        assert await deactivate_xui_client("nonexistent") is False
 
-    @patch("api.webhook.XUIClient")
-    def test_xui_exception(self, mock_xui_cls):
+    @pytest.mark.asyncio
+    @patch("api.webhook.AsyncXUIClient")
+    async def test_xui_exception(self, mock_xui_cls):
         """Returns False on XUI error (doesn't crash)."""
         from api.webhook import deactivate_xui_client
 
-        mock_xui_cls.side_effect = ConnectionError("panel down")
+        xui = AsyncMock()
+        xui.get_client_by_email.side_effect = ConnectionError("panel down")
+        mock_xui_cls.return_value = xui
 
-        assert deactivate_xui_client("tiin_100") is False
+        assert await deactivate_xui_client("tiin_100") is False
 
 
 # ═════════════════════════════════════════════
@@ -57,7 +62,7 @@ class TestProcessRefund:
 
     @pytest.mark.asyncio
     @patch("api.webhook.deactivate_key_by_payment")
-    @patch("api.webhook.deactivate_xui_client", return_value=True)
+    @patch("api.webhook.deactivate_xui_client", new_callable=AsyncMock, return_value=True)
     @patch("api.webhook.get_user_email", return_value="tiin_100")
     @patch("api.webhook.get_payment_by_id")
     async def test_success(self, mock_get_pay, mock_get_email,
@@ -70,7 +75,7 @@ class TestProcessRefund:
         result = await process_refund("pay-123")
 
         assert result is True
-        mock_deactivate.assert_called_once_with("tiin_100")
+        mock_deactivate.assert_awaited_once_with("tiin_100")
         mock_deactivate_key.assert_called_once_with("pay-123")
 
     @pytest.mark.asyncio
@@ -95,7 +100,7 @@ class TestProcessRefund:
         assert result is False
 
     @pytest.mark.asyncio
-    @patch("api.webhook.deactivate_xui_client", return_value=False)
+    @patch("api.webhook.deactivate_xui_client", new_callable=AsyncMock, return_value=False)
     @patch("api.webhook.get_user_email", return_value="tiin_100")
     @patch("api.webhook.get_payment_by_id")
     async def test_xui_deactivation_fails(self, mock_get_pay, mock_get_email,
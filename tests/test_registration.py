@@ -31,6 +31,14 @@ def _make_mock_pool():
     return mock_pool, mock_conn, mock_cursor
 
 
+@pytest.fixture(autouse=True)
+def _clear_session_cache():
+    from api import session_cache
+    session_cache.clear()
+    yield
+    session_cache.clear()
+
+
 @pytest.fixture
 def client():
     from api.webhook import app
@@ -503,8 +511,7 @@ class TestSessionManagement:
         mock_get_pool.return_value = mock_pool
         future = datetime.now() + timedelta(days=30)
         mock_cursor.fetchone.side_effect = [
-            {"user_id": 5},  # session lookup
-            {  # user lookup
+            {  # session JOIN users
                 "id": 5, "email": "user@test.com", "phone": None,
                 "first_name": "Test", "subscription_until": future,
                 "tg_id": None,
@@ -568,7 +575,6 @@ class TestSessionManagement:
         mock_get_pool.return_value = mock_pool
         past = datetime.now() - timedelta(days=1)
         mock_cursor.fetchone.side_effect = [
-            {"user_id": 5},
             {
                 "id": 5, "email": "expired@test.com", "phone": None,
                 "first_name": "Test", "subscription_until": past,
@@ -590,7 +596,6 @@ class TestSessionManagement:
         mock_pool, mock_conn, mock_cursor = _make_mock_pool()
         mock_get_pool.return_value = mock_pool
         mock_cursor.fetchone.side_effect = [
-            {"user_id": 5},
             {
                 "id": 5, "email": "nosub@test.com", "phone": None,
                 "first_name": "Test", "subscription_until": None,
@@ -760,7 +765,6 @@ class TestCrossPathEdgeCases:
         mock_pool, mock_conn, mock_cursor = _make_mock_pool()
         mock_get_pool.return_value = mock_pool
         mock_cursor.fetchone.side_effect = [
-            {"user_id": 5},
             {
                 "id": 5, "email": "bearer@test.com", "phone": None,
                 "first_name": "Bearer", "subscription_until": None,
@@ -0,0 +1,218 @@
+"""Tests for api/rollups.py — daily (UTC+9) analytics rollups with id watermarks."""
+from datetime import date, datetime
+from decimal import Decimal
+from unittest.mock import patch, MagicMock
+
+import pytest
+
+from api import rollups
+from api.rollups import Snapshot
+
+D1, D2, D3 = date(2026, 3, 30), date(2026, 3, 31), date(2026, 4, 1)
+
+
+def _snap(*rows):
+    snap = Snapshot()
+    for row in rows:
+        snap.add(*row)
+    return snap
+
+
+# ─────────────────────────────────────────────
+#  Snapshot
+# ─────────────────────────────────────────────
+
+def test_snapshot_aggregations():
+    snap = _snap(
+        (D1, "paid", "monthly_30d", Decimal("2.00")), (D1, "revenue", "monthly_30d", Decimal("398.00")),
+        (D3, "paid", "yearly_365d", 1), (D3, "revenue", "yearly_365d", Decimal("1990.50")),
+        (D3, "paid", "monthly_30d", 1), (D3, "revenue", "monthly_30d", Decimal("199")),
+    )
+    assert snap.total("paid") == 4 and isinstance(snap.total("paid"), int)
+    assert snap.total("revenue") == pytest.approx(2587.5)
+    assert snap.total("revenue", since=D2) == pytest.approx(2189.5)
+    assert snap.total("paid", day=D1) == 2
+    assert snap.by_dim("paid") == {"monthly_30d": 3, "yearly_365d": 1}
+    assert snap.by_dim("paid", day=D3) == {"monthly_30d": 1, "yearly_365d": 1}
+    assert snap.by_day("paid") == {D1: 2, D3: 2}
+    assert snap.by_month("revenue") == {"2026-03": 398.0, "2026-04": 2189.5}
+    assert snap.first_day("paid") == D1
+    assert snap.first_day("registrations") is None
+
+
+def test_day_start_utc_is_midnight_utc9():
+    assert rollups.day_start_utc(D3) == datetime(2026, 3, 31, 15, 0)
+
+
+# ─────────────────────────────────────────────
+#  snapshot(): rollups + live tail
+# ─────────────────────────────────────────────
+
+def _fake_query(sql, params=(), fetch=None):
+    if "FROM analytics_daily" in sql:
+        return [{"day": D1, "metric": "paid", "dim": "monthly_30d", "value": Decimal("3.00")},
+                {"day": D1, "metric": "revenue", "dim": "monthly_30d", "value": Decimal("597.00")}]
+    if "FROM analytics_watermarks" in sql:
+        return [{"source": "payments", "last_id": 120}]
+    if "FROM payments" in sql:
+        assert params == (120,) and "id > %s" in sql
+        return [{"day": D3, "tariff": "monthly_30d", "n": 2, "paid": 1, "revenue": Decimal("199.00")}]
+    raise AssertionError(f"unexpected query: {sql}")
+
+
+@patch("api.rollups._ready", True)
+@patch("api.rollups.execute_query", side_effect=_fake_query)
+def test_snapshot_adds_live_rows_past_watermark(mock_query):
+    snap = rollups.snapshot({"paid", "revenue"})
+    assert snap.by_day("paid") == {D1: 3, D3: 1}
+    assert snap.total("revenue") == pytest.approx(796.0)
+    # site_events / users не нужны для этих метрик — их не трогаем
+    assert not any("site_events" in c.args[0] or "FROM users" in c.args[0] for c in mock_query.call_args_list)
+
+
+# ─────────────────────────────────────────────
+#  refresh
+# ─────────────────────────────────────────────
+
+def _fake_db(last_id, hi, agg_rows, n=0):
+    cur = MagicMock()
+    results = iter([{"last_id": last_id}, {"hi": hi, "n": n}])
+    cur.fetchone.side_effect = lambda: next(results)
+    cur.fetchall.return_value = agg_rows
+    db = MagicMock()
+    db.cursor.return_value = cur
+    return db, cur
+
+
+def test_refresh_source_folds_new_rows_and_moves_watermark():
+    db, cur = _fake_db(100, 140, [{"day": D3, "tariff": "monthly_30d", "n": 5, "paid": 2,
+                                   "revenue": Decimal("398.00")}], n=5)
+    with patch("api.rollups.get_db", return_value=db):
+        assert rollups._refresh_source("payments") == 5
+
+    sqls = [c.args[0] for c in cur.execute.call_args_list]
+    assert "FOR UPDATE" in sqls[1]
+    # только «устоявшиеся» платежи: статус меняется после INSERT
+    assert "created_at < NOW() - INTERVAL %s SECOND" in sqls[2]
+    # chunk строк, а не диапазон id: дыра в AUTO_INCREMENT не останавливает водяной знак
+    assert "ORDER BY id LIMIT %s" in sqls[2] and "id <= %s" not in sqls[2]
+    assert cur.execute.call_args_list[2].args[1] == (100, rollups.PAYMENT_SETTLE_HOURS * 3600,
+                                                     rollups.REFRESH_CHUNK)
+    assert cur.execute.call_args_list[3].args[1] == (100, 140)
+    upsert_sql, upsert_rows = cur.executemany.call_args.args
+    assert "ON DUPLICATE KEY UPDATE value = value + VALUES(value)" in upsert_sql
+    assert upsert_rows == [(D3, "payments", "monthly_30d", 5), (D3, "paid", "monthly_30d", 2),
+                           (D3, "revenue", "monthly_30d", Decimal("398.00"))]
+    assert cur.execute.call_args_list[-1].args[1] == (140, "payments")
+    db.commit.assert_called_once()
+
+
+def test_refresh_source_waits_for_settle_window_on_every_source():
+    # id AUTO_INCREMENT коммитятся не по порядку — водяной знак не должен обогнать незакоммиченный id
+    for source in ("site_events", "users"):
+        db, cur = _fake_db(0, None, [])
+        with patch("api.rollups.get_db", return_value=db):
+            rollups._refresh_source(source)
+        sql, params = cur.execute.call_args_list[2].args
+        assert "created_at < NOW() - INTERVAL %s SECOND" in sql
+        assert params == (0, rollups.ROLLUP_SETTLE_SECONDS, rollups.REFRESH_CHUNK)
+
+
+def test_refresh_source_noop_without_new_rows():
+    db, cur = _fake_db(100, None, [])
+    with patch("api.rollups.get_db", return_value=db):
+        assert rollups._refresh_source("users") == 0
+    cur.executemany.assert_not_called()
+    db.commit.assert_not_called()
+    db.rollback.assert_called_once()
+
+
+def test_refresh_source_rolls_back_on_error():
+    db, cur = _fake_db(0, 10, [])
+    cur.executemany.side_effect = Exception("deadlock")
+    cur.fetchall.return_value = [{"day": D3, "n": 3}]
+    with patch("api.rollups.get_db", return_value=db), pytest.raises(Exception):
+        rollups._refresh_source("users")
+    db.rollback.assert_called_once()
+    db.commit.assert_not_called()
+
+
+def _resync_db(last_id, payment, agg_rows):
+    cur = MagicMock()
+    results = iter([{"last_id": last_id}, payment])
+    cur.fetchone.side_effect = lambda: next(results)
+    cur.fetchall.return_value = agg_rows
+    db = MagicMock()
+    db.cursor.return_value = cur
+    return db, cur
+
+
+@patch("api.rollups._ready", True)
+def test_resync_payment_recounts_folded_day():
+    # refund пришёл после свёртки: 2026-03-31 20:00 UTC = 1 апреля UTC+9
+    payment = {"id": 90, "created_at": datetime(2026, 3, 31, 20, 0)}
+    db, cur = _resync_db(120, payment, [{"day": D3, "tariff": "monthly_30d", "n": 2, "paid": 1,
+                                         "revenue": Decimal("199.00")}])
+    with patch("api.rollups.get_db", return_value=db):
+        assert rollups.resync_payment("pay-1") is True
+
+    calls = cur.execute.call_args_list
+    assert "FOR UPDATE" in calls[0].args[0]
+    agg_sql, agg_params = calls[2].args
+    assert "FROM payments" in agg_sql and "created_at >= %s AND created_at < %s" in agg_sql
+    assert agg_params == (0, 120, datetime(2026, 3, 31, 15, 0), datetime(2026, 4, 1, 15, 0))
+    assert "DELETE FROM analytics_daily" in calls[3].args[0] and calls[3].args[1] == (D3,)
+    assert cur.executemany.call_args.args[1] == [(D3, "payments", "monthly_30d", 2),
+                                                  (D3, "paid", "monthly_30d", 1),
+                                                  (D3, "revenue", "monthly_30d", Decimal("199.00"))]
+    db.commit.assert_called_once()
+
+
+@patch("api.rollups._ready", True)
+def test_resync_payment_skips_live_tail():
+    db, cur = _resync_db(120, {"id": 130, "created_at": datetime(2026, 4, 1)}, [])
+    with patch("api.rollups.get_db", return_value=db):
+        assert rollups.resync_payment("pay-2") is False
+    cur.executemany.assert_not_called()
+    db.commit.assert_not_called()
+
+
+@patch("api.rollups._ready", True)
+def test_refresh_loops_until_caught_up(monkeypatch):
+    monkeypatch.setattr(rollups, "REFRESH_CHUNK", 10)
+    folded = {"site_events": [10, 10, 3], "users": [0], "payments": [7]}
+    with patch("api.rollups._refresh_source", side_effect=lambda s: folded[s].pop(0)):
+        assert rollups.refresh() == {"site_events": 23, "users": 0, "payments": 7}
+
+
+# ─────────────────────────────────────────────
+#  check
+# ─────────────────────────────────────────────
+
+def test_compare_reports_only_differences_in_window():
+    rollup = _snap((D1, "event", "visit", 5), (D2, "event", "visit", 7), (D2, "revenue", "x", 100))
+    raw = _snap((D1, "event", "visit", 9), (D2, "event", "visit", 7), (D2, "revenue", "x", 100),
+                (D3, "registrations", "", 2))
+    assert rollups.compare(rollup, raw, since=D2) == [
+        {"day": "2026-04-01", "metric": "registrations", "dim": "", "rollup": 0, "raw": 2},
+    ]
+
+
+# ─────────────────────────────────────────────
+#  admin endpoints read the snapshot
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_site_stats_uses_rollups():
+    from admin.routes import site_stats
+    today = rollups.today()
+    snap = _snap((D1, "event", "visit", 10), (today, "event", "visit", 2), (today, "event", "click_buy", 1),
+                 (D1, "unique_visitors", "", 10), (today, "unique_visitors", "", 2))
+    with patch("api.rollups.snapshot", return_value=snap), \
+            patch("api.db.execute_query", return_value={"cnt": 4}) as mock_query:
+        result = await site_stats()
+    assert result["total"] == {"visit": 12, "click_buy": 1, "unique_visitors": 12}
+    assert result["today"] == {"visit": 2, "click_buy": 1, "unique_visitors": 2}
+    # сегодняшние коды — диапазон по created_at, без DATE(CONVERT_TZ(...))
+    today_sql, today_params = mock_query.call_args.args
+    assert "CONVERT_TZ" not in today_sql and today_params == (rollups.day_start_utc(today),)
@@ -0,0 +1,247 @@
+"""Tests for api/session_cache.py and its use in web auth (_get_current_user)."""
+import asyncio
+import sys
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock, AsyncMock
+
+import pytest
+
+sys.modules.setdefault("yookassa", MagicMock())
+
+from api import session_cache
+from api.session_cache import TokenCache
+
+USER = {"id": 5, "tg_id": 777, "email": "user@test.com", "phone": None,
+        "first_name": "Test", "subscription_until": None}
+
+
+@pytest.fixture(autouse=True)
+def _clear():
+    session_cache.clear()
+    yield
+    session_cache.clear()
+
+
+# ─────────────────────────────────────────────
+#  Cache
+# ─────────────────────────────────────────────
+
+def test_get_put_and_stats():
+    cache = TokenCache(ttl=30, max_entries=10)
+    assert cache.get("tok") is None
+    cache.put("tok", USER)
+    assert cache.get("tok") == USER
+    assert cache.get("tok") == USER
+    s = cache.stats()
+    assert (s["hits"], s["misses"], s["size"]) == (2, 1, 1)
+    assert s["hit_ratio"] == pytest.approx(2 / 3, abs=1e-3)
+
+
+def test_raw_token_not_stored():
+    cache = TokenCache(ttl=30, max_entries=10)
+    cache.put("secret-token", USER)
+    assert "secret-token" not in cache._entries
+
+
+def test_returned_row_is_a_copy():
+    session_cache.put("tok", USER)
+    session_cache.get("tok")["email"] = "changed"
+    assert session_cache.get("tok")["email"] == "user@test.com"
+
+
+def test_ttl_expires_entry():
+    cache = TokenCache(ttl=30, max_entries=10)
+    with patch("api.session_cache.time.monotonic", return_value=1000.0):
+        cache.put("tok", USER)
+    with patch("api.session_cache.time.monotonic", return_value=1029.0):
+        assert cache.get("tok") is not None
+    with patch("api.session_cache.time.monotonic", return_value=1031.0):
+        assert cache.get("tok") is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_ttl_bounded_by_session_expiry():
+    cache = TokenCache(ttl=30, max_entries=10)
+    with patch("api.session_cache.time.monotonic", return_value=1000.0):
+        cache.put("tok", USER, datetime.now() + timedelta(seconds=5))
+        cache.put("dead", USER, datetime.now() - timedelta(seconds=1))
+    with patch("api.session_cache.time.monotonic", return_value=1006.0):
+        assert cache.get("tok") is None
+    assert cache.get("dead") is None
+
+
+def test_invalidate_token_and_user():
+    cache = TokenCache(ttl=30, max_entries=10)
+    cache.put("a", USER)
+    cache.put("b", USER)
+    cache.put("other", {**USER, "id": 6, "tg_id": None})
+    cache.invalidate_token("a")
+    assert cache.get("a") is None and cache.get("b") is not None
+
+    cache.invalidate_user(tg_id=777)
+    assert cache.get("b") is None
+    assert cache.get("other") is not None
+
+    cache.invalidate_user(6)
+    assert cache.get("other") is None
+    assert cache.stats()["invalidations"] == 3
+    assert cache._by_user == {}
+
+
+def test_lru_eviction():
+    cache = TokenCache(ttl=30, max_entries=2)
+    cache.put("a", USER)
+    cache.put("b", USER)
+    cache.get("a")
+    cache.put("c", USER)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+# ─────────────────────────────────────────────
+#  Web auth
+# ─────────────────────────────────────────────
+
+@pytest.fixture
+def client():
+    from api.webhook import app
+    from fastapi.testclient import TestClient
+    return TestClient(app)
+
+
+def _session_row(**extra):
+    return {**USER, "session_expires_at": datetime.now() + timedelta(days=30), **extra}
+
+
+@patch("api.web_auth.execute_query")
+def test_me_hits_db_once(mock_query, client):
+    mock_query.return_value = _session_row()
+    for _ in range(5):
+        resp = client.get("/api/auth/me", cookies={"session_token": "tok"})
+        assert resp.status_code == 200
+        assert resp.json()["email"] == "user@test.com"
+    assert mock_query.call_count == 1
+    sql = mock_query.call_args[0][0]
+    assert "JOIN users" in sql and "auth_sessions" in sql
+
+
+@patch("api.web_auth.execute_query")
+def test_invalid_session_not_cached(mock_query, client):
+    mock_query.return_value = None
+    for _ in range(2):
+        assert client.get("/api/auth/me", cookies={"session_token": "bad"}).status_code == 401
+    assert mock_query.call_count == 2
+
+
+@patch("api.web_auth.execute_query")
+def test_logout_invalidates(mock_query, client):
+    mock_query.return_value = _session_row()
+    client.get("/api/auth/me", cookies={"session_token": "tok"})
+    client.post("/api/auth/logout", cookies={"session_token": "tok"})
+    mock_query.return_value = None
+    assert client.get("/api/auth/me", cookies={"session_token": "tok"}).status_code == 401
+
+
+@patch("api.db.execute_query")
+@patch("api.web_auth.execute_query")
+def test_subscription_change_invalidates(mock_query, mock_db_query, client):
+    from api.db import sync_expiry_by_user_id, upsert_user_subscription
+    mock_query.return_value = _session_row()
+    assert client.get("/api/auth/me", cookies={"session_token": "tok"}).json()["is_active"] is False
+
+    until = datetime.now() + timedelta(days=30)
+    sync_expiry_by_user_id(5, until)
+    mock_query.return_value = _session_row(subscription_until=until)
+    assert client.get("/api/auth/me", cookies={"session_token": "tok"}).json()["is_active"] is True
+
+    upsert_user_subscription(777, None)
+    mock_query.return_value = _session_row()
+    assert client.get("/api/auth/me", cookies={"session_token": "tok"}).json()["is_active"] is False
+    assert mock_query.call_count == 3
+
+
+def test_stats_endpoint_localhost_only(client):
+    assert client.get("/api/auth/cache-stats").status_code == 404  # testclient host
+    with patch("api.web_auth.session_cache.stats", return_value={"hits": 1}):
+        from api.web_auth import cache_stats
+        assert asyncio.run(cache_stats()) == {"hits": 1}
+
+
+# ─────────────────────────────────────────────
+#  web_token → (user, keys) bundle
+# ─────────────────────────────────────────────
+
+KEY = {"id": 1, "tg_id": 777, "user_id": 5, "vpn_type": "vless", "payment_id": "pay-1"}
+
+
+def _fake_query(sql, params=(), fetch=None):
+    if fetch == 'all':
+        return [{"tg_id": 777, "user_id": 5}]
+    return {"id": 1} if fetch == 'one' else None
+
+
+@pytest.fixture
+def bundle_db():
+    from api import db
+    db._web_bundles.clear()
+    with patch("api.db.get_user_by_web_token_async", new_callable=AsyncMock, return_value=USER) as user, \
+            patch("api.db.get_keys_by_tg_id_async", new_callable=AsyncMock, return_value=[KEY]) as by_tg, \
+            patch("api.db.get_keys_by_user_id_async", new_callable=AsyncMock, return_value=[]) as by_id, \
+            patch("api.db.execute_query", side_effect=_fake_query):
+        yield db, user, by_tg, by_id
+    db._web_bundles.clear()
+
+
+@pytest.mark.asyncio
+async def test_bundle_read_through(bundle_db):
+    db, user, by_tg, by_id = bundle_db
+    for _ in range(3):
+        assert await db.get_web_bundle_async("web-tok") == (USER, [KEY])
+    assert (user.await_count, by_tg.await_count, by_id.await_count) == (1, 1, 0)
+    assert db.web_bundle_cache_stats()["hits"] == 2
+
+
+@pytest.mark.asyncio
+async def test_bundle_falls_back_to_user_id_keys(bundle_db):
+    db, user, by_tg, by_id = bundle_db
+    by_tg.return_value = []
+    by_id.return_value = [KEY]
+    assert await db.get_web_bundle_async("web-tok") == (USER, [KEY])
+    user.return_value = {**USER, "tg_id": None}
+    assert (await db.get_web_bundle_async("other"))[1] == [KEY]
+    assert by_tg.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_unknown_web_token_not_cached(bundle_db):
+    db, user, _, _ = bundle_db
+    user.return_value = None
+    assert await db.get_web_bundle_async("nope") is None
+    assert await db.get_web_bundle_async("nope") is None
+    assert user.await_count == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("mutate", [
+    lambda db: db.upsert_vpn_key(777, "pay-2", "c", "n", "ip", "pk", vpn_type="vless"),
+    lambda db: db.sync_expiry(777, datetime(2030, 1, 1)),
+    lambda db: db.update_vless_link(777, "vless://new"),
+    lambda db: db.deactivate_key_by_payment("pay-1"),
+    lambda db: db.sync_expiry_by_user_id(5, datetime(2030, 1, 1)),
+])
+async def test_key_mutations_invalidate_bundle(bundle_db, mutate):
+    db, user, by_tg, _ = bundle_db
+    await db.get_web_bundle_async("web-tok")
+    mutate(db)
+    await db.get_web_bundle_async("web-tok")
+    assert by_tg.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_other_users_bundle_survives(bundle_db):
+    db, _, by_tg, _ = bundle_db
+    await db.get_web_bundle_async("web-tok")
+    db.update_vless_link(999, "vless://x")
+    await db.get_web_bundle_async("web-tok")
+    assert by_tg.await_count == 1
@@ -1,8 +1,21 @@
 """Тесты для SoftEther VPN — CLI wrapper (bot_xui/softether.py) и фабрика конфигов."""
 import json
+import sys
 from unittest.mock import patch, MagicMock
 from subprocess import CompletedProcess
 
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def _fresh_softether_state():
+    """UserList/SessionList are cached and vpncmd runs as a session — reset both."""
+    from bot_xui import softether
+    softether.invalidate_cache()
+    softether._session._failed_at = 0.0
+    yield
+    softether.invalidate_cache()
+
 
 # ─────────────────────────────────────────────
 #  softether._run
@@ -36,23 +49,23 @@ def test_run_failure_raises(mock_run):
 #  softether.create_user
 # ─────────────────────────────────────────────
 
-@patch("bot_xui.softether._run")
-def test_create_user_success(mock_run):
-    mock_run.return_value = "OK"
+@patch("bot_xui.softether._run_batch")
+def test_create_user_success(mock_batch):
+    mock_batch.side_effect = lambda commands: ["OK"] * len(commands)
 
     from bot_xui.softether import create_user
     result = create_user("testuser", "testpass")
 
     assert result is True
-    assert mock_run.call_count == 2
-    # First call: UserCreate
-    assert "UserCreate" in mock_run.call_args_list[0][0][0]
-    # Second call: UserPasswordSet
-    assert "UserPasswordSet" in mock_run.call_args_list[1][0][0]
+    assert mock_batch.call_count == 2
+    # First round trip: UserCreate
+    assert [c[0] for c in mock_batch.call_args_list[0][0][0]] == ["UserCreate"]
+    # Second round trip: UserPasswordSet
+    assert [c[0] for c in mock_batch.call_args_list[1][0][0]] == ["UserPasswordSet"]
 
 
-@patch("bot_xui.softether._run", side_effect=RuntimeError("fail"))
-def test_create_user_failure(mock_run):
+@patch("bot_xui.softether._run_batch", side_effect=lambda commands: [None] * len(commands))
+def test_create_user_failure(mock_batch):
     from bot_xui.softether import create_user
     result = create_user("testuser", "testpass")
 
@@ -169,8 +182,9 @@ def test_create_softether_config_with_days(mock_se):
     assert config["password"] == result["password"]
     assert "vpn_file" in result
 
+    # пользователь и срок — одним батчем
     mock_se.create_user.assert_called_once()
-    mock_se.set_user_expiry.assert_called_once()
+    assert mock_se.create_user.call_args.args[2] is not None
 
 
 @patch("bot_xui.vpn_factory.softether")
@@ -324,3 +338,216 @@ def test_list_users_empty(mock_run):
 def test_list_users_error_returns_empty(mock_run):
     from bot_xui.softether import list_users
     assert list_users() == []
+
+
+# ─────────────────────────────────────────────
+#  persistent vpncmd session (fake vpncmd)
+# ─────────────────────────────────────────────
+
+FAKE_VPNCMD = r'''
+import os, shlex, sys
+
+log = open(os.environ["FAKE_VPNCMD_LOG"], "a")
+log.write("START " + " ".join(sys.argv[1:]) + "\n")
+log.flush()
+users = {}
+
+def out(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+out("vpncmd command - SoftEther VPN Command Line Management Utility\n\n")
+while True:
+    out("Password: ")
+    entered = sys.stdin.readline()
+    if not entered:
+        sys.exit(1)
+    if entered.strip() == os.environ["FAKE_VPNCMD_PASSWORD"]:
+        break
+out('Connection has been established with VPN Server "127.0.0.1" (port 5555).\n\n')
+
+for line in iter(lambda: (out("VPN Server/VPN>"), sys.stdin.readline())[1], ""):
+    args = shlex.split(line)
+    if not args:
+        continue
+    log.write("CMD " + line)
+    log.flush()
+    cmd, rest = args[0], args[1:]
+    if cmd == "exit":
+        break
+    out(f"{cmd} command - fake\n")
+    ok = True
+    if cmd == "UserCreate":
+        ok = rest[0] not in users
+        users.setdefault(rest[0], {"expires": "No Expiration"})
+    elif cmd in ("UserPasswordSet", "UserDelete", "UserExpiresSet"):
+        ok = rest[0] in users
+        if ok and cmd == "UserDelete":
+            del users[rest[0]]
+        elif ok and cmd == "UserExpiresSet":
+            users[rest[0]]["expires"] = rest[1].split(":", 1)[1]
+    elif cmd == "UserList":
+        for name, u in users.items():
+            out("---\n")
+            out(f"User Name                        |{name}\n")
+            out(f"Expiration Date                  |{u['expires']}\n")
+    elif cmd == "SessionList":
+        pass
+    if ok:
+        out("The command completed successfully.\n\n")
+    else:
+        out("Error occurred. (Error code: 29)\n\n")
+'''
+
+
+@pytest.fixture
+def fake_vpncmd(tmp_path, monkeypatch):
+    """Point softether at a fake interactive vpncmd; yields a reader for its log."""
+    from bot_xui import softether
+    script = tmp_path / "vpncmd"
+    script.write_text(f"#!{sys.executable}\n{FAKE_VPNCMD}")
+    script.chmod(0o755)
+    log = tmp_path / "vpncmd.log"
+    log.write_text("")
+    monkeypatch.setenv("FAKE_VPNCMD_LOG", str(log))
+    monkeypatch.setenv("FAKE_VPNCMD_PASSWORD", "s3cret")
+    monkeypatch.setattr(softether, "SOFTETHER_VPNCMD", str(script))
+    monkeypatch.setattr(softether, "SOFTETHER_SERVER_PASSWORD", "s3cret")
+    session = softether._VpncmdSession(timeout=5)
+    monkeypatch.setattr(softether, "_session", session)
+    yield lambda: log.read_text().splitlines()
+    session.close()
+
+
+def test_session_reuses_one_process(fake_vpncmd):
+    from bot_xui import softether
+    assert softether.create_user("se_1", "pw1") is True
+    assert softether.set_user_expiry("se_1", "2030/01/31") is True
+    assert softether.delete_user("nobody") is False
+
+    log = fake_vpncmd()
+    starts = [l for l in log if l.startswith("START")]
+    assert len(starts) == 1
+    assert "s3cret" not in starts[0]  # password goes over stdin, not argv
+    assert 'CMD UserExpiresSet se_1 "/EXPIRES:2030/01/31 23:59:59"' in log
+
+
+def test_create_existing_user_keeps_its_password(fake_vpncmd):
+    from bot_xui import softether
+    assert softether.create_user("dup", "x") is True
+    assert softether.create_user("dup", "other") is False
+    # UserCreate упал — UserPasswordSet не отправляется
+    assert sum(l.startswith("CMD UserPasswordSet dup") for l in fake_vpncmd()) == 1
+
+
+def test_create_users_batches_and_skips_failed_creates(fake_vpncmd):
+    from bot_xui import softether
+    assert softether.create_user("taken", "orig") is True
+    results = softether.create_users([("se_a", "pa", "2030/01/31"), ("taken", "hijack", "2030/01/31"),
+                                      ("se_b", "pb", None)])
+    assert results == {"se_a": True, "taken": False, "se_b": True}
+
+    log = fake_vpncmd()
+    assert sum(l.startswith("START") for l in log) == 1
+    # у существующего пользователя не трогаем ни пароль, ни срок
+    assert sum(l.startswith("CMD UserPasswordSet taken") for l in log) == 1
+    assert not any(l.startswith("CMD UserExpiresSet taken") for l in log)
+    assert 'CMD UserExpiresSet se_a "/EXPIRES:2030/01/31 23:59:59"' in log
+    assert not any(l.startswith("CMD UserExpiresSet se_b") for l in log)
+    expires = {u["username"]: u["expires"] for u in softether.list_users(max_age=0)}
+    assert expires == {"taken": None, "se_a": "2030/01/31 23:59:59", "se_b": None}
+
+
+def test_create_users_removes_half_created_user(monkeypatch):
+    from bot_xui import softether
+    batches = []
+
+    def fake_batch(commands):
+        batches.append([c[0] for c in commands])
+        return ["ok" if c[0] != "UserExpiresSet" else None for c in commands]
+
+    monkeypatch.setattr(softether, "_run_batch", fake_batch)
+    assert softether.create_user("se_x", "p", "2030/01/31") is False
+    assert batches == [["UserCreate"], ["UserPasswordSet", "UserExpiresSet"], ["UserDelete"]]
+
+
+def test_set_users_expiry_one_round_trip(fake_vpncmd):
+    from bot_xui import softether
+    softether.create_users([("se_1", "p", None), ("se_2", "p", None)])
+    assert softether.set_users_expiry({"se_1": "2030/01/31", "nobody": "2030/01/31"}) == \
+        {"se_1": True, "nobody": False}
+    assert sum(l.startswith("START") for l in fake_vpncmd()) == 1
+
+
+def test_batch_pipelines_commands(fake_vpncmd):
+    from bot_xui import softether
+    outputs = softether._run_batch([("UserCreate", "se_a"), ("UserCreate", "se_a"), ("UserList",)])
+    assert outputs[0] is not None and outputs[1] is None
+    assert "se_a" in outputs[2]
+    assert sum(l.startswith("START") for l in fake_vpncmd()) == 1
+
+
+def test_interrupted_batch_does_not_replay_mutations(monkeypatch):
+    from bot_xui import softether
+    session = MagicMock()
+    session.run_many.side_effect = softether._BatchInterrupted("vpncmd exited", ["ok\n"])
+    monkeypatch.setattr(softether, "_session", session)
+    with patch("bot_xui.softether._run_oneshot") as oneshot:
+        outputs = softether._run_batch([("UserCreate", "a"), ("UserPasswordSet", "a", "/PASSWORD:x")])
+    assert outputs == ["ok\n", None]
+    oneshot.assert_not_called()
+
+
+def test_interrupted_read_only_remainder_is_reread(monkeypatch):
+    from bot_xui import softether
+    session = MagicMock()
+    session.run_many.side_effect = softether._BatchInterrupted("timed out", [])
+    monkeypatch.setattr(softether, "_session", session)
+    with patch("bot_xui.softether._run_oneshot", return_value="list\n") as oneshot:
+        assert softether._run_batch([("UserList",)]) == ["list\n"]
+    oneshot.assert_called_once_with("UserList")
+
+
+def test_session_unavailable_falls_back_to_oneshot(monkeypatch):
+    from bot_xui import softether
+    session = MagicMock()
+    session.run_many.side_effect = softether._SessionUnavailable("no vpncmd")
+    monkeypatch.setattr(softether, "_session", session)
+    with patch("bot_xui.softether._run_oneshot", return_value="done\n") as oneshot:
+        assert softether.create_user("u", "p") is True
+    assert [c.args[0] for c in oneshot.call_args_list] == ["UserCreate", "UserPasswordSet"]
+
+
+def test_user_list_is_cached_until_a_mutation(fake_vpncmd):
+    from bot_xui import softether
+    softether.list_users()
+    softether.list_users()
+    assert sum(l == "CMD UserList" for l in fake_vpncmd()) == 1
+
+    softether.create_user("se_new", "pw")
+    assert [u["username"] for u in softether.list_users()] == ["se_new"]
+    assert sum(l == "CMD UserList" for l in fake_vpncmd()) == 2
+
+
+def test_session_restarts_after_process_dies(fake_vpncmd):
+    from bot_xui import softether
+    softether.list_sessions(max_age=0)
+    softether._session._proc.kill()
+    softether._session._proc.wait()
+    assert softether.list_sessions(max_age=0) == []
+    assert sum(l.startswith("START") for l in fake_vpncmd()) == 2
+
+
+def test_wrong_password_falls_back_to_oneshot(fake_vpncmd, monkeypatch):
+    from bot_xui import softether
+    monkeypatch.setattr(softether, "SOFTETHER_SERVER_PASSWORD", "wrong")
+    with patch("bot_xui.softether.subprocess.run",
+               return_value=CompletedProcess(args=[], returncode=0, stdout="OK\n", stderr="")) as mock_run:
+        assert softether._run("UserList") == "OK\n"
+    assert "/CMD" in mock_run.call_args[0][0]
+
+
+def test_forbidden_characters_are_rejected(fake_vpncmd):
+    from bot_xui import softether
+    assert softether.create_user("evil\nUserDelete x", "pw") is False
+    assert not any(l.startswith("START") for l in fake_vpncmd())
@@ -3,6 +3,16 @@ from unittest.mock import patch, MagicMock
 import pytest
 
 
+@pytest.fixture(autouse=True)
+def _fresh_softether_state():
+    """UserList/SessionList are cached and vpncmd runs as a session — reset both."""
+    from bot_xui import softether
+    softether.invalidate_cache()
+    softether._session._failed_at = 0.0
+    yield
+    softether.invalidate_cache()
+
+
 # ─────────────────────────────────────────────
 #  disable_user
 # ─────────────────────────────────────────────
@@ -1,4 +1,5 @@
 """Tests for api/sub_proxy.py — VLESS subscription proxy endpoint."""
+import asyncio
 import base64
 import sys
 import time
@@ -48,48 +49,39 @@ class TestBuildHeaders:
 
 class TestPickVlessKey:
 
-    @patch("api.sub_proxy.get_keys_by_tg_id")
-    def test_picks_active_over_expired(self, mock_keys):
+    def test_picks_active_over_expired(self):
         from api.sub_proxy import _pick_vless_key
         now = datetime.utcnow()
-        mock_keys.return_value = [
+        result = _pick_vless_key([
             {"vpn_type": "vless", "subscription_link": "https://xui/old",
              "expires_at": now - timedelta(days=10)},
             {"vpn_type": "vless", "subscription_link": "https://xui/new",
              "expires_at": now + timedelta(days=10)},
-        ]
-        result = _pick_vless_key({"tg_id": 100, "id": 1})
+        ])
         assert result is not None
         assert result["subscription_link"] == "https://xui/new"
 
-    @patch("api.sub_proxy.get_keys_by_tg_id", return_value=[])
-    def test_no_keys_returns_none(self, mock_keys):
+    def test_no_keys_returns_none(self):
         from api.sub_proxy import _pick_vless_key
-        with patch("api.sub_proxy.get_keys_by_user_id", return_value=[]):
-            result = _pick_vless_key({"tg_id": 100, "id": 1})
-            assert result is None
+        assert _pick_vless_key([]) is None
 
-    @patch("api.sub_proxy.get_keys_by_tg_id")
-    def test_ignores_keys_without_subscription_link(self, mock_keys):
+    def test_ignores_keys_without_subscription_link(self):
         from api.sub_proxy import _pick_vless_key
-        mock_keys.return_value = [
+        result = _pick_vless_key([
             {"vpn_type": "vless", "subscription_link": None,
              "expires_at": datetime.utcnow() + timedelta(days=10)},
-        ]
-        result = _pick_vless_key({"tg_id": 100, "id": 1})
+        ])
         assert result is None
 
-    @patch("api.sub_proxy.get_keys_by_tg_id")
-    def test_ignores_awg_and_softether(self, mock_keys):
+    def test_ignores_awg_and_softether(self):
         from api.sub_proxy import _pick_vless_key
         future = datetime.utcnow() + timedelta(days=10)
-        mock_keys.return_value = [
+        result = _pick_vless_key([
             {"vpn_type": "awg", "subscription_link": "https://awg",
              "expires_at": future},
             {"vpn_type": "softether", "subscription_link": "https://se",
              "expires_at": future},
-        ]
-        result = _pick_vless_key({"tg_id": 100, "id": 1})
+        ])
         assert result is None
 
 
@@ -102,10 +94,10 @@ class TestProxySubscription:
     def setup_method(self):
         """Clear cache between tests."""
         from api import sub_proxy
-        sub_proxy._CACHE.clear()
+        sub_proxy._CACHE = sub_proxy._SubCache(sub_proxy.SUB_CACHE_MAX_ENTRIES)
 
     @pytest.mark.asyncio
-    @patch("api.sub_proxy.get_user_by_web_token", return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=None)
     async def test_invalid_token_404(self, mock_user):
         from fastapi import HTTPException
         from api.sub_proxy import proxy_subscription
@@ -115,7 +107,7 @@ class TestProxySubscription:
 
     @pytest.mark.asyncio
     @patch("api.sub_proxy._pick_vless_key", return_value=None)
-    @patch("api.sub_proxy.get_user_by_web_token", return_value={"tg_id": 100, "id": 1})
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
     async def test_no_vless_key_404(self, mock_user, mock_pick):
         from fastapi import HTTPException
         from api.sub_proxy import proxy_subscription
@@ -126,8 +118,9 @@ class TestProxySubscription:
     @pytest.mark.asyncio
     @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock)
     @patch("api.sub_proxy._pick_vless_key")
-    @patch("api.sub_proxy.get_user_by_web_token", return_value={"tg_id": 100, "id": 1})
-    async def test_happy_path_returns_proxied_body(self, mock_user, mock_pick, mock_fetch):
+    @patch("api.sub_proxy.get_hysteria_link_by_tg_id_async", new_callable=AsyncMock, return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
+    async def test_happy_path_returns_proxied_body(self, mock_user, mock_hy, mock_pick, mock_fetch):
         from api.sub_proxy import proxy_subscription
         future = datetime.utcnow() + timedelta(days=23)
         mock_pick.return_value = {
@@ -150,10 +143,10 @@ class TestProxySubscription:
     @pytest.mark.asyncio
     @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock)
     @patch("api.sub_proxy._pick_vless_key")
-    @patch("api.sub_proxy.get_user_by_web_token", return_value={"tg_id": 100, "id": 1})
-    async def test_cache_hit_skips_xui_fetch(self, mock_user, mock_pick, mock_fetch):
+    @patch("api.sub_proxy.get_hysteria_link_by_tg_id_async", new_callable=AsyncMock, return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
+    async def test_cache_hit_skips_xui_fetch(self, mock_user, mock_hy, mock_pick, mock_fetch):
         from api.sub_proxy import proxy_subscription
-        import time
         mock_pick.return_value = {
             "subscription_link": "https://xui.example/sub/abc",
             "expires_at": datetime.utcnow() + timedelta(days=10),
@@ -161,17 +154,21 @@ class TestProxySubscription:
         mock_fetch.return_value = base64.b64encode(b"vless://u@h:443#r")
 
         # First call — fetches
-        await proxy_subscription("tok")
+        first = await proxy_subscription("tok")
         assert mock_fetch.call_count == 1
 
-        # Second call — should hit cache
-        await proxy_subscription("tok")
-        assert mock_fetch.call_count == 1  # unchanged (1 was still the count)    @pytest.mark.asyncio
+        # Second call — served from cache without touching DB or XUI
+        second = await proxy_subscription("tok")
+        assert mock_fetch.call_count == 1
+        assert mock_user.call_count == 1
+        assert second.body == first.body  # cached body is the rewritten one
+
     @pytest.mark.asyncio
     @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock)
     @patch("api.sub_proxy._pick_vless_key")
-    @patch("api.sub_proxy.get_user_by_web_token", return_value={"tg_id": 100, "id": 1})
-    async def test_cache_expires_after_ttl(self, mock_user, mock_pick, mock_fetch):
+    @patch("api.sub_proxy.get_hysteria_link_by_tg_id_async", new_callable=AsyncMock, return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
+    async def test_cache_expires_after_stale_window(self, mock_user, mock_hy, mock_pick, mock_fetch):
         from api import sub_proxy
         mock_pick.return_value = {
             "subscription_link": "https://xui.example/sub/abc",
@@ -182,10 +179,8 @@ class TestProxySubscription:
         await sub_proxy.proxy_subscription("tok")
         assert mock_fetch.call_count == 1
 
-        # Expire cache entry manually
-        ts, body, hdr = sub_proxy._CACHE["tok"]
-        # Set TS to be older than SUB_CACHE_TTL
-        sub_proxy._CACHE["tok"] = (datetime.utcnow() - timedelta(seconds=sub_proxy.SUB_CACHE_TTL + 1), body, hdr)
+        # Older than TTL + stale window — a plain miss
+        sub_proxy._CACHE.get("tok").created -= sub_proxy.SUB_CACHE_TTL + sub_proxy.SUB_CACHE_STALE + 1
 
         await sub_proxy.proxy_subscription("tok")
         assert mock_fetch.call_count == 2
@@ -193,8 +188,35 @@ class TestProxySubscription:
     @pytest.mark.asyncio
     @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock)
     @patch("api.sub_proxy._pick_vless_key")
-    @patch("api.sub_proxy.get_user_by_web_token", return_value={"tg_id": 100, "id": 1})
-    async def test_xui_error_falls_back_to_stale_cache(self, mock_user, mock_pick, mock_fetch):
+    @patch("api.sub_proxy.get_hysteria_link_by_tg_id_async", new_callable=AsyncMock, return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
+    async def test_stale_entry_served_while_revalidating(self, mock_user, mock_hy, mock_pick, mock_fetch):
+        from api import sub_proxy
+        mock_pick.return_value = {
+            "subscription_link": "https://xui.example/sub/abc",
+            "expires_at": datetime.utcnow() + timedelta(days=10),
+        }
+        mock_fetch.return_value = base64.b64encode(b"vless://old@h:443#r")
+        old = await sub_proxy.proxy_subscription("tok")
+        sub_proxy._CACHE.get("tok").created -= sub_proxy.SUB_CACHE_TTL + 1
+
+        mock_fetch.return_value = base64.b64encode(b"vless://new@h:443#r")
+        stale = await sub_proxy.proxy_subscription("tok")
+        assert stale.body == old.body
+
+        await asyncio.sleep(0.01)  # background refresh
+        fresh = await sub_proxy.proxy_subscription("tok")
+        assert b"new" in base64.b64decode(fresh.body)
+        stats = sub_proxy.cache_stats()
+        assert stats["stale"] == 1
+        assert stats["refreshes"] == 1
+
+    @pytest.mark.asyncio
+    @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock)
+    @patch("api.sub_proxy._pick_vless_key")
+    @patch("api.sub_proxy.get_hysteria_link_by_tg_id_async", new_callable=AsyncMock, return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
+    async def test_xui_error_falls_back_to_stale_cache(self, mock_user, mock_hy, mock_pick, mock_fetch):
         from api import sub_proxy
         mock_pick.return_value = {
             "subscription_link": "https://xui.example/sub/abc",
@@ -203,21 +225,78 @@ class TestProxySubscription:
         mock_fetch.return_value = base64.b64encode(b"vless://u@h:443#r")
 
         # Prime cache
-        await sub_proxy.proxy_subscription("tok")
+        primed = await sub_proxy.proxy_subscription("tok")
 
-        # Expire it and make XUI fail
-        ts, body, hdr = sub_proxy._CACHE["tok"]
-        sub_proxy._CACHE["tok"] = (datetime.utcnow() - timedelta(seconds=sub_proxy.SUB_CACHE_TTL + 1), body, hdr)
+        # Expire it completely and make XUI fail
+        sub_proxy._CACHE.get("tok").created -= sub_proxy.SUB_CACHE_TTL + sub_proxy.SUB_CACHE_STALE + 1
         mock_fetch.side_effect = RuntimeError("XUI down")
 
         response = await sub_proxy.proxy_subscription("tok")
-        # Fallback returns the stale cached body
-        assert response.body == body
+        # Fallback returns the old cached body
+        assert response.body == primed.body
+        assert sub_proxy.cache_stats()["served_on_error"] == 1
+
+    @pytest.mark.asyncio
+    @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock)
+    @patch("api.sub_proxy._pick_vless_key")
+    @patch("api.sub_proxy.get_hysteria_link_by_tg_id_async", new_callable=AsyncMock, return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
+    async def test_concurrent_misses_share_one_fetch(self, mock_user, mock_hy, mock_pick, mock_fetch):
+        from api import sub_proxy
+        mock_pick.return_value = {
+            "subscription_link": "https://xui.example/sub/abc",
+            "expires_at": datetime.utcnow() + timedelta(days=10),
+        }
+
+        async def slow_fetch(url):
+            await asyncio.sleep(0.02)
+            return base64.b64encode(b"vless://u@h:443#r")
+        mock_fetch.side_effect = slow_fetch
+
+        responses = await asyncio.gather(*(sub_proxy.proxy_subscription("tok") for _ in range(10)))
+
+        assert mock_fetch.call_count == 1
+        assert len({r.body for r in responses}) == 1
+        assert sub_proxy.cache_stats()["coalesced"] == 9
+
+    @pytest.mark.asyncio
+    @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock)
+    @patch("api.sub_proxy._pick_vless_key")
+    @patch("api.sub_proxy.get_hysteria_link_by_tg_id_async", new_callable=AsyncMock, return_value=None)
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
+    async def test_if_none_match_returns_304(self, mock_user, mock_hy, mock_pick, mock_fetch):
+        from api import sub_proxy
+        mock_pick.return_value = {
+            "subscription_link": "https://xui.example/sub/abc",
+            "expires_at": datetime.utcnow() + timedelta(days=10),
+        }
+        mock_fetch.return_value = base64.b64encode(b"vless://u@h:443#r")
+
+        first = await sub_proxy.proxy_subscription("tok")
+        etag = first.headers["etag"]
+
+        again = await sub_proxy.proxy_subscription("tok", if_none_match=etag)
+        assert again.status_code == 304
+        assert again.body == b""
+
+        other = await sub_proxy.proxy_subscription("tok", if_none_match='"other"')
+        assert other.status_code == 200
+
+    def test_lru_evicts_oldest(self):
+        from api.sub_proxy import _SubCache, _SubEntry
+        cache = _SubCache(max_entries=2)
+        for tok in ("a", "b"):
+            cache.put(tok, _SubEntry(tok.encode(), {}))
+        cache.get("a")  # "b" becomes least recently used
+        cache.put("c", _SubEntry(b"c", {}))
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.stats()["evictions"] == 1
 
     @pytest.mark.asyncio
     @patch("api.sub_proxy._fetch_xui", new_callable=AsyncMock, side_effect=RuntimeError("boom"))
     @patch("api.sub_proxy._pick_vless_key")
-    @patch("api.sub_proxy.get_user_by_web_token", return_value={"tg_id": 100, "id": 1})
+    @patch("api.sub_proxy.get_web_bundle_async", new_callable=AsyncMock, return_value=({"tg_id": 100, "id": 1}, []))
     async def test_xui_error_no_cache_returns_503(self, mock_user, mock_pick, mock_fetch):
         from fastapi import HTTPException
         from api.sub_proxy import proxy_subscription
@@ -32,6 +32,14 @@ def _mock_cursor(rowcount=1):
     return cur
 
 
+def _mock_xui(**add_client):
+    """AsyncXUIClient double: panel calls are awaited by activate_test."""
+    xui = MagicMock()
+    xui.add_client = AsyncMock(**add_client)
+    xui.get_hysteria_inbound_id = AsyncMock(return_value=4)
+    return xui
+
+
 def _mock_db(cursor):
     db = MagicMock()
     db.cursor.return_value = cursor
@@ -47,7 +55,7 @@ class TestActivateTest:
     @patch("api.web_api.process_web_referral", create=True)
     @patch("api.db.update_user_subscription_by_id")
     @patch("api.db.create_vpn_key")
-    @patch("bot_xui.utils.XUIClient")
+    @patch("bot_xui.utils.AsyncXUIClient")
     @patch("api.db.get_db")
     @patch("api.web_api.get_user_by_web_token")
     def test_success(self, mock_get_user, mock_get_db, mock_xui_cls,
@@ -56,8 +64,7 @@ class TestActivateTest:
         mock_get_user.return_value = FAKE_USER.copy()
         cur = _mock_cursor(rowcount=1)
         mock_get_db.return_value = _mock_db(cur)
-        xui = MagicMock()
-        xui.add_client.return_value = True
+        xui = _mock_xui(return_value=True)
         xui.get_subscription_url_by_uuid.return_value = "https://sub/uuid"
         mock_xui_cls.return_value = xui
 
@@ -93,7 +100,7 @@ class TestActivateTest:
         assert resp.status_code == 400
         assert "уже" in resp.json()["detail"].lower()
 
-    @patch("bot_xui.utils.XUIClient")
+    @patch("bot_xui.utils.AsyncXUIClient")
     @patch("api.db.get_db")
     @patch("api.web_api.get_user_by_web_token")
     def test_xui_failure_rollback(self, mock_get_user, mock_get_db,
@@ -109,8 +116,7 @@ class TestActivateTest:
         db2 = _mock_db(cur2)
         mock_get_db.side_effect = [db1, db2]
 
-        xui = MagicMock()
-        xui.add_client.return_value = False  # XUI fails
+        xui = _mock_xui(return_value=False)  # XUI fails
         mock_xui_cls.return_value = xui
 
         resp = client.post("/api/web/activate-test", json={"web_token": "tok-abc"})
@@ -120,7 +126,7 @@ class TestActivateTest:
         rollback_sql = cur2.execute.call_args[0][0]
         assert "test_vless_activated = 0" in rollback_sql
 
-    @patch("bot_xui.utils.XUIClient")
+    @patch("bot_xui.utils.AsyncXUIClient")
     @patch("api.db.get_db")
     @patch("api.web_api.get_user_by_web_token")
     def test_xui_exception_rollback(self, mock_get_user, mock_get_db,
@@ -133,8 +139,7 @@ class TestActivateTest:
         db2 = _mock_db(cur2)
         mock_get_db.side_effect = [db1, db2]
 
-        xui = MagicMock()
-        xui.add_client.side_effect = ConnectionError("panel down")
+        xui = _mock_xui(side_effect=ConnectionError("panel down"))
         mock_xui_cls.return_value = xui
 
         resp = client.post("/api/web/activate-test", json={"web_token": "tok-abc"})
@@ -146,31 +151,30 @@ class TestActivateTest:
     @patch("api.web_api.process_web_referral", create=True)
     @patch("api.db.update_user_subscription_by_id")
     @patch("api.db.create_vpn_key")
-    @patch("bot_xui.utils.XUIClient")
+    @patch("bot_xui.utils.AsyncXUIClient")
     @patch("api.db.get_db")
     @patch("api.web_api.get_user_by_web_token")
     def test_xui_called_with_credentials(self, mock_get_user, mock_get_db,
                                          mock_xui_cls, mock_create_key,
                                          mock_update_sub, mock_ref, client):
-        """XUIClient must be instantiated with host/user/pass (the bug that broke prod)."""
+        """AsyncXUIClient must be instantiated with host/user/pass (the bug that broke prod)."""
         mock_get_user.return_value = FAKE_USER.copy()
         cur = _mock_cursor(rowcount=1)
         mock_get_db.return_value = _mock_db(cur)
-        xui = MagicMock()
-        xui.add_client.return_value = True
+        xui = _mock_xui(return_value=True)
         xui.get_subscription_url_by_uuid.return_value = ""
         mock_xui_cls.return_value = xui
 
         client.post("/api/web/activate-test", json={"web_token": "tok-abc"})
 
         args = mock_xui_cls.call_args[0]
-        assert len(args) == 3, f"XUIClient must get 3 positional args, got {len(args)}"
-        assert all(a is not None for a in args), "XUIClient args must not be None"
+        assert len(args) == 3, f"AsyncXUIClient must get 3 positional args, got {len(args)}"
+        assert all(a is not None for a in args), "AsyncXUIClient args must not be None"
 
     @patch("api.db.process_web_referral")
     @patch("api.db.update_user_subscription_by_id")
     @patch("api.db.create_vpn_key")
-    @patch("bot_xui.utils.XUIClient")
+    @patch("bot_xui.utils.AsyncXUIClient")
     @patch("api.db.get_db")
     @patch("api.web_api.get_user_by_web_token")
     def test_referral_processed(self, mock_get_user, mock_get_db, mock_xui_cls,
@@ -180,8 +184,7 @@ class TestActivateTest:
         mock_get_user.return_value = FAKE_USER.copy()
         cur = _mock_cursor(rowcount=1)
         mock_get_db.return_value = _mock_db(cur)
-        xui = MagicMock()
-        xui.add_client.return_value = True
+        xui = _mock_xui(return_value=True)
         xui.get_subscription_url_by_uuid.return_value = ""
         mock_xui_cls.return_value = xui
         mock_process_ref.return_value = True
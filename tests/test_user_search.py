@@ -0,0 +1,147 @@
+"""Tests for admin/search.py — ranked user search with keyset cursors."""
+import json
+from unittest.mock import patch
+
+import pytest
+
+from admin import search
+from admin.search import UserSearchIndex
+
+USERS = [
+    {"id": 1, "first_name": "Анна", "last_name": "Петрова", "old_first_name": None, "email": None},
+    {"id": 2, "first_name": "Иван", "last_name": "Annenkov", "old_first_name": None, "email": "ivan@mail.ru"},
+    {"id": 3, "first_name": "", "last_name": None, "old_first_name": "Ann", "email": "hanna@example.com"},
+    {"id": 4, "first_name": "Олег", "last_name": None, "old_first_name": None, "email": None},
+]
+KEYS = [
+    {"id": 10, "uid": 4, "client_name": "oleg_iphone"},
+    {"id": 11, "uid": 2, "client_name": "annex-laptop"},
+]
+
+
+def _index(users=USERS, keys=KEYS):
+    index = UserSearchIndex()
+    for row in users:
+        index.add_user(row)
+    for row in keys:
+        index.add_key(row)
+    return index
+
+
+# ─────────────────────────────────────────────
+#  UserSearchIndex
+# ─────────────────────────────────────────────
+
+def test_exact_beats_prefix_beats_substring():
+    ranked = _index().search("ann")
+    uids = [uid for _, uid in ranked]
+    # 3: old_first_name == "ann"; 2: префикс фамилии; 1: не совпадает («анна» — кириллица)
+    assert uids == [3, 2]
+    assert ranked[0][0] > ranked[1][0]
+
+
+def test_substring_and_case_insensitive():
+    assert [uid for _, uid in _index().search("IPHON")] == [4]
+    assert [uid for _, uid in _index().search("етро")] == [1]
+
+
+def test_two_char_query_uses_word_prefixes():
+    index = _index()
+    assert {uid for _, uid in index.search("ив")} == {2}
+    assert {uid for _, uid in index.search("la")} == {2}      # "laptop" в annex-laptop
+    assert index.search("a") == []
+
+
+def test_multi_word_terms_are_anded():
+    index = _index()
+    assert [uid for _, uid in index.search("иван annenkov")] == [2]
+    assert index.search("иван петрова") == []
+
+
+def test_field_weight_breaks_score_ties():
+    index = UserSearchIndex()
+    index.add(5, "client", "mark")
+    index.add(6, "name", "mark")
+    assert [uid for _, uid in index.search("mark")] == [6, 5]
+
+
+def test_incremental_adds_track_watermarks():
+    index = _index()
+    assert index.marks == {"users": 4, "keys": 11}
+    index.add_user({"id": 7, "first_name": "Annabel", "email": None})
+    assert 7 in {uid for _, uid in index.search("anna")}
+    assert index.marks["users"] == 7
+
+
+# ─────────────────────────────────────────────
+#  search_users: exact hits, cursors, refresh
+# ─────────────────────────────────────────────
+
+@pytest.fixture
+def shared_index(monkeypatch):
+    monkeypatch.setattr(search, "_index", UserSearchIndex())
+    monkeypatch.setattr(search, "_built_at", float("-inf"))
+    monkeypatch.setattr(search, "_refreshed_at", float("-inf"))
+    with patch("admin.db.users_for_search", side_effect=lambda after=0: [u for u in USERS if u["id"] > after]), \
+            patch("admin.db.client_names_for_search", side_effect=lambda after=0: [k for k in KEYS if k["id"] > after]), \
+            patch("admin.db.users_by_ids", side_effect=lambda ids: [{"id": i} for i in ids]):
+        yield
+
+
+def test_exact_match_ranked_first_and_cursor_pages(shared_index):
+    with patch("admin.db.exact_user_matches", return_value=[4]):
+        rows, cursor = search.search_users("ann", limit=2)
+        assert [r["id"] for r in rows] == [4, 3]
+        assert rows[0]["score"] == search.EXACT_SCORE
+        assert cursor == f"{rows[1]['score']}:3"
+
+        rows, cursor = search.search_users("ann", limit=2, cursor=cursor)
+        assert [r["id"] for r in rows] == [2]
+        assert cursor is None
+
+
+def test_rebuild_then_incremental_refresh(shared_index, monkeypatch):
+    with patch("admin.db.exact_user_matches", return_value=[]):
+        search.search_users("oleg")
+    assert len(search._index) == 4
+
+    USERS.append({"id": 9, "first_name": "Olga", "email": None})
+    try:
+        monkeypatch.setattr(search, "_refreshed_at", float("-inf"))
+        with patch("admin.db.users_for_search", return_value=[USERS[-1]]) as mock_users, \
+                patch("admin.db.client_names_for_search", return_value=[]) as mock_keys, \
+                patch("admin.db.exact_user_matches", return_value=[]):
+            rows, _ = search.search_users("olga")
+        mock_users.assert_called_once_with(4)
+        mock_keys.assert_called_once_with(11)
+        assert [r["id"] for r in rows] == [9]
+    finally:
+        USERS.pop()
+
+
+def test_decode_cursor_rejects_garbage():
+    assert search.decode_cursor("60:12") == (60, 12)
+    assert search.decode_cursor("x") is None
+    assert search.decode_cursor(None) is None
+
+
+# ─────────────────────────────────────────────
+#  /users route
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_users_route_lists_with_id_cursor():
+    from admin.routes import users_list
+    with patch("admin.db.list_users", return_value=[{"id": 50}, {"id": 49}]) as mock_list:
+        resp = await users_list(search=None, limit=2, cursor="51", fmt="json")
+    mock_list.assert_called_once_with(2, 51)
+    assert json.loads(resp.body) == {"items": [{"id": 50}, {"id": 49}], "next_cursor": "49"}
+
+
+@pytest.mark.asyncio
+async def test_users_route_search_path():
+    from admin.routes import users_list
+    with patch("admin.search.search_users", return_value=([{"id": 3, "score": 103}], None)) as mock_search:
+        resp = await users_list(search=" ann ", limit=20, cursor=None, fmt="json")
+    mock_search.assert_called_once_with(" ann ", 20, None)
+    assert json.loads(resp.body) == {"items": [{"id": 3, "score": 103}], "next_cursor": None}
@@ -1,7 +1,10 @@
 """Тесты для bot_xui/utils.py — XUIClient, generate_vless_link, format_bytes."""
 import sys
 import json
+import asyncio
 from unittest.mock import patch, MagicMock
+
+import httpx
 import pytest
 
 sys.modules.setdefault("yookassa", MagicMock())
@@ -95,6 +98,59 @@ def test_generate_vless_link_custom_fp():
 #  XUIClient
 # ─────────────────────────────────────────────
 
+class _FakePanel:
+    """Stand-in for the 3x-ui panel behind httpx.MockTransport."""
+
+    def __init__(self, inbounds=None, login_ok=True, latency=0.0):
+        self.inbounds = inbounds or []
+        self.login_ok = login_ok
+        self.latency = latency
+        self.calls: list[str] = []   # request paths, login excluded
+        self.logins = 0
+        self.expire_session = False  # next API call answers 401
+        self.reject_bulk = False     # inbounds/update answers success=false
+        self.updated: dict[int, list] = {}  # inbound id -> clients written by inbounds/update
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            path = request.url.path
+            if path == "/login":
+                self.logins += 1
+                return httpx.Response(200, json={"success": self.login_ok})
+            self.calls.append(path)
+            if self.expire_session:
+                self.expire_session = False
+                return httpx.Response(401, text="unauthorized")
+            if path.endswith("/inbounds/list"):
+                return httpx.Response(200, json={"success": True, "obj": self.inbounds})
+            if "/inbounds/get/" in path:
+                inbound_id = int(path.rsplit("/", 1)[1])
+                ib = next((i for i in self.inbounds if i["id"] == inbound_id), None)
+                return httpx.Response(200, json={"success": ib is not None, "obj": ib})
+            if "/inbounds/update/" in path:
+                if self.reject_bulk:
+                    return httpx.Response(200, json={"success": False, "msg": "rejected"})
+                body = json.loads(request.content)
+                self.updated[body["id"]] = json.loads(body["settings"])["clients"]
+            return httpx.Response(200, json={"success": True})
+        finally:
+            self.in_flight -= 1
+
+    def transport(self):
+        return httpx.MockTransport(self.handler)
+
+
+def _client(panel, password="pass"):
+    from bot_xui.utils import XUIClient
+    return XUIClient("https://panel", "admin", password, transport=panel.transport())
+
+
 def test_xui_client_init():
     from bot_xui.utils import XUIClient
     c = XUIClient("https://panel.example.com", "admin", "pass")
@@ -102,132 +158,62 @@ def test_xui_client_init():
     assert c._logged_in is False
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_client_login(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    mock_resp = MagicMock()
-    mock_resp.status_code = 200
-    mock_resp.json.return_value = {"success": True}
-    mock_session.post.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
-    c.login()
+def test_xui_client_login():
+    panel = _FakePanel()
+    c = _client(panel)
+    assert c.login() is True
     assert c._logged_in is True
-    mock_session.post.assert_called_once()
+    assert panel.logins == 1
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_client_login_failure(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    mock_resp = MagicMock()
-    mock_resp.status_code = 200 # Status OK but success: False
-    mock_resp.json.return_value = {"success": False, "msg": "wrong password"}
-    mock_session.post.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "wrong")
-    assert c.login() is False # login() returns False on failure now
+def test_xui_client_login_failure():
+    panel = _FakePanel(login_ok=False)
+    c = _client(panel, password="wrong")
+    assert c.login() is False  # login() returns False on failure now
+    assert c._logged_in is False
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_get_inbounds(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    # login
-    mock_session.post.return_value.json.return_value = {"success": True}
-    # get inbounds
-    inbound_data = [{"id": 5, "settings": '{"clients":[]}'}]
-    mock_resp = MagicMock()
-    mock_resp.json.return_value = {"success": True, "obj": inbound_data}
-    mock_resp.headers = {"content-type": "application/json"}
-    mock_resp.status_code = 200
-    mock_session.request.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
+def test_xui_get_inbounds():
+    panel = _FakePanel([{"id": 5, "settings": '{"clients":[]}'}])
+    c = _client(panel)
     result = c.get_inbounds()
     assert len(result) == 1
     assert result[0]["id"] == 5
+    assert panel.logins == 1
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_get_client_by_email(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    mock_session.post.return_value.json.return_value = {"success": True}
-    inbound = {
+def test_xui_get_client_by_email():
+    panel = _FakePanel([{
         "id": 5,
         "settings": json.dumps({"clients": [
             {"id": "uuid-1", "email": "client@test", "tgId": 123},
         ]}),
-    }
-    mock_resp = MagicMock()
-    mock_resp.json.return_value = {"success": True, "obj": [inbound]}
-    mock_resp.headers = {"content-type": "application/json"}
-    mock_resp.status_code = 200
-    mock_session.request.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
+    }])
+    c = _client(panel)
     result = c.get_client_by_email("client@test")
     assert result is not None
     assert result["client"]["email"] == "client@test"
     assert result["inbound_id"] == 5
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_get_client_by_email_not_found(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    mock_session.post.return_value.json.return_value = {"success": True}
-    mock_resp = MagicMock()
-    mock_resp.json.return_value = {"success": True, "obj": [
-        {"id": 5, "settings": json.dumps({"clients": []})}
-    ]}
-    mock_resp.headers = {"content-type": "application/json"}
-    mock_resp.status_code = 200
-    mock_session.request.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
+def test_xui_get_client_by_email_not_found():
+    panel = _FakePanel([{"id": 5, "settings": json.dumps({"clients": []})}])
+    c = _client(panel)
     assert c.get_client_by_email("nobody@test") is None
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_deactivate_client(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    mock_session.post.return_value.json.return_value = {"success": True}
-    mock_resp = MagicMock()
-    mock_resp.json.return_value = {"success": True}
-    mock_resp.headers = {"content-type": "application/json"}
-    mock_resp.status_code = 200
-    mock_session.request.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
+def test_xui_deactivate_client():
+    panel = _FakePanel()
+    c = _client(panel)
     client = {"id": "uuid-1", "email": "test", "enable": True}
-    result = c.deactivate_client(5, client)
-    assert result is True
+    assert c.deactivate_client(5, client) is True
+    assert panel.calls == ["/panel/api/inbounds/updateClient/uuid-1"]
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_extend_client_expiry(mock_session_cls):
-    from bot_xui.utils import XUIClient
+def test_xui_extend_client_expiry():
     import time
-    mock_session = MagicMock()
-    mock_session.post.return_value.json.return_value = {"success": True}
-    mock_resp = MagicMock()
-    mock_resp.json.return_value = {"success": True}
-    mock_resp.headers = {"content-type": "application/json"}
-    mock_resp.status_code = 200
-    mock_session.request.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
+    panel = _FakePanel()
+    c = _client(panel)
     now_ms = int(time.time() * 1000)
     client = {"id": "uuid-1", "email": "test", "expiryTime": now_ms + 86400000}
     result = c.extend_client_expiry(5, client, 86400000 * 30)
@@ -235,51 +221,181 @@ def test_xui_extend_client_expiry(mock_session_cls):
     assert result > now_ms
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_delete_client(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    # Mock for login
-    mock_session.post.return_value.json.return_value = {"success": True}
-    mock_session.post.return_value.status_code = 200
-
-    # Mock for get_inbounds (called inside get_client_by_email)
-    mock_inbounds_resp = MagicMock()
-    mock_inbounds_resp.status_code = 200
-    mock_inbounds_resp.headers = {"content-type": "application/json"}
-    mock_inbounds_resp.json.return_value = {
-        "success": True,
-        "obj": [{
-            "id": 5,
-            "settings": json.dumps({"clients": [{"id": "uuid-123", "email": "test-email"}]})
-        }]
-    }
-
-    # Mock for the deleteClient request itself
-    mock_delete_resp = MagicMock()
-    mock_delete_resp.status_code = 200
-    mock_delete_resp.headers = {"content-type": "application/json"}
-    mock_delete_resp.json.return_value = {"success": True}
-
-    # Side effect to handle multiple calls to session.request
-    mock_session.request.side_effect = [mock_inbounds_resp, mock_delete_resp]
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
+def test_xui_delete_client():
+    panel = _FakePanel([{
+        "id": 5,
+        "settings": json.dumps({"clients": [{"id": "uuid-123", "email": "test-email"}]}),
+    }])
+    c = _client(panel)
     assert c.delete_client(5, "test-email") is True
+    assert panel.calls[-1] == "/panel/api/inbounds/deleteClient/uuid-123"
 
 
-@patch("bot_xui.utils.requests.Session")
-def test_xui_reset_client_traffic(mock_session_cls):
-    from bot_xui.utils import XUIClient
-    mock_session = MagicMock()
-    mock_session.post.return_value.json.return_value = {"success": True}
-    mock_resp = MagicMock()
-    mock_resp.json.return_value = {"success": True}
-    mock_resp.headers = {"content-type": "application/json"}
-    mock_resp.status_code = 200
-    mock_session.request.return_value = mock_resp
-    mock_session_cls.return_value = mock_session
-
-    c = XUIClient("https://panel", "admin", "pass")
+def test_xui_reset_client_traffic():
+    panel = _FakePanel()
+    c = _client(panel)
     assert c.reset_client_traffic(5, "test-email") is True
+    assert panel.calls == ["/panel/api/inbounds/5/resetClientTraffic/test-email"]
+
+
+def test_xui_relogin_on_expired_session():
+    panel = _FakePanel([{"id": 5, "settings": '{"clients":[]}'}])
+    c = _client(panel)
+    c.login()
+    panel.expire_session = True
+    assert len(c.get_inbounds()) == 1
+    assert panel.logins == 2
+    assert panel.calls == ["/panel/api/inbounds/list"] * 2
+
+
+# ─────────────────────────────────────────────
+#  AsyncXUIClient
+# ─────────────────────────────────────────────
+
+@pytest.mark.asyncio
+async def test_async_xui_limits_concurrent_requests():
+    from bot_xui.utils import AsyncXUIClient
+    panel = _FakePanel(latency=0.01)
+    c = AsyncXUIClient("https://panel", "admin", "pass", max_concurrency=2,
+                       transport=panel.transport())
+    results = await asyncio.gather(*(
+        c.reset_client_traffic(1, f"user-{i}") for i in range(10)
+    ))
+    assert all(results)
+    assert panel.max_in_flight == 2
+    await c.aclose()
+
+
+@pytest.mark.asyncio
+async def test_async_xui_concurrent_relogin_happens_once():
+    from bot_xui.utils import AsyncXUIClient
+    panel = _FakePanel(latency=0.01)
+    c = AsyncXUIClient("https://panel", "admin", "pass", transport=panel.transport())
+    await asyncio.gather(*(c.reset_client_traffic(1, f"user-{i}") for i in range(5)))
+    assert panel.logins == 1
+    await c.aclose()
+
+
+@pytest.mark.asyncio
+async def test_async_xui_add_or_extend_creates_new_client():
+    from bot_xui.utils import AsyncXUIClient
+    panel = _FakePanel([{"id": 1, "protocol": "vless", "settings": '{"clients":[]}'}])
+    c = AsyncXUIClient("https://panel", "admin", "pass", transport=panel.transport())
+    res = await c.add_or_extend_client(1, "tiin_7", 7, "uuid-7")
+    assert res["success"] is True
+    assert panel.calls[-1] == "/panel/api/inbounds/addClient"
+    await c.aclose()
+
+
+# ─────────────────────────────────────────────
+#  XUIClient — inbound snapshot cache
+# ─────────────────────────────────────────────
+
+_SNAPSHOT_INBOUNDS = [
+    {"id": 1, "protocol": "vless", "streamSettings": '{"security": "reality"}',
+     "settings": json.dumps({"clients": [
+         {"id": "u-test", "email": "test-1", "tgId": 42, "subId": "s0", "expiryTime": 0},
+         {"id": "u-1", "email": "tiin_42", "tgId": 42, "subId": "s1", "expiryTime": 0},
+     ]})},
+    {"id": 4, "protocol": "hysteria", "streamSettings": "{}",
+     "settings": json.dumps({"clients": [
+         {"auth": "pw", "email": "tiin_42_h", "tgId": 42},
+     ]})},
+]
+
+
+def test_xui_lookups_share_one_inbounds_fetch():
+    panel = _FakePanel(_SNAPSHOT_INBOUNDS)
+    c = _client(panel)
+    assert c.get_client_by_tg_id(42)["client"]["email"] == "tiin_42"
+    assert c.get_client_by_email("tiin_42_h")["inbound_id"] == 4
+    assert c.get_vless_reality_inbound_id() == 1
+    assert c.get_hysteria_inbound_id() == 4
+    assert len(c.get_inbounds()) == 2
+
+    assert len(panel.calls) == 1
+
+
+def test_xui_mutation_invalidates_snapshot():
+    panel = _FakePanel(_SNAPSHOT_INBOUNDS)
+    c = _client(panel)
+    found = c.get_client_by_tg_id(42)
+    c.deactivate_client(found["inbound_id"], found["client"])
+    c.get_client_by_tg_id(42)
+
+    # list, updateClient, list again
+    assert len(panel.calls) == 3
+
+
+def test_xui_snapshot_expires_after_ttl():
+    from bot_xui import utils
+    panel = _FakePanel(_SNAPSHOT_INBOUNDS)
+    c = _client(panel)
+    c.get_inbounds()
+    c._snapshot.fetched_at -= utils.INBOUND_CACHE_TTL + 1
+    c.get_inbounds()
+
+    assert len(panel.calls) == 2
+
+
+# ─────────────────────────────────────────────
+#  XUIClient — batch client updates
+# ─────────────────────────────────────────────
+
+def _batch_inbounds(n):
+    past = 1_000_000
+    return [
+        {"id": 1, "protocol": "vless", "settings": json.dumps({"clients": [
+            {"id": f"u-{i}", "email": f"test-{i}", "expiryTime": past} for i in range(n)
+        ]})},
+        {"id": 4, "protocol": "hysteria", "settings": json.dumps({"clients": [
+            {"auth": f"u-{i}", "email": f"test-{i}_h", "expiryTime": past} for i in range(n)
+        ]})},
+    ]
+
+
+def _all_clients(c):
+    return [(ib["id"], cl) for ib in c.get_inbounds()
+            for cl in json.loads(ib["settings"])["clients"]]
+
+
+def test_xui_extend_clients_expiry_one_update_per_inbound():
+    import time
+    panel = _FakePanel(_batch_inbounds(50))
+    c = _client(panel)
+    items = [(ib_id, cl, 86400000) for ib_id, cl in _all_clients(c)]
+
+    results = c.extend_clients_expiry(items)
+
+    assert len(results) == 100
+    assert all(isinstance(v, int) and v > time.time() * 1000 for v in results.values())
+    # list, then get + update for each of the two inbounds
+    assert panel.calls.count("/panel/api/inbounds/update/1") == 1
+    assert panel.calls.count("/panel/api/inbounds/update/4") == 1
+    assert len(panel.calls) == 5
+    assert all(cl["expiryTime"] == results[cl["email"]] for cl in panel.updated[1])
+
+
+def test_xui_update_clients_keeps_untouched_clients():
+    panel = _FakePanel(_batch_inbounds(3))
+    c = _client(panel)
+    _, first = _all_clients(c)[0]
+
+    assert c.deactivate_clients([(1, first)]) == {"test-0": True}
+    written = {cl["email"]: cl for cl in panel.updated[1]}
+    assert set(written) == {"test-0", "test-1", "test-2"}
+    assert written["test-0"]["enable"] is False
+    assert "enable" not in written["test-1"]
+
+
+def test_xui_update_clients_falls_back_to_per_client():
+    panel = _FakePanel(_batch_inbounds(3))
+    panel.reject_bulk = True
+    c = _client(panel)
+
+    results = c.deactivate_clients(_all_clients(c))
+
+    assert all(results.values())
+    assert panel.calls.count("/panel/api/inbounds/updateClient/u-1") == 2  # vless + hysteria (auth)
+    assert sum("/updateClient/" in p for p in panel.calls) == 6
+
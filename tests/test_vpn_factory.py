@@ -9,6 +9,13 @@ import pytest
 sys.modules.setdefault("yookassa", MagicMock())
 
 
+def _mock_xui():
+    """XUIClient mock: async-код ходит в панель через xui.aio."""
+    xui = MagicMock()
+    xui.aio = AsyncMock()
+    return xui
+
+
 # ═════════════════════════════════════════════
 #  make_qr_bytes
 # ═════════════════════════════════════════════
@@ -34,8 +41,9 @@ class TestCreateVlessConfig:
         """Creates VLESS client via XUI and returns config dict."""
         from bot_xui.vpn_factory import create_vless_config
 
-        xui = MagicMock()
-        xui.add_client.return_value = True
+        xui = _mock_xui()
+        xui.aio.add_client.return_value = True
+        xui.aio.get_client_subscription_url.return_value = "https://sub/abc"
 
         result = await create_vless_config(tg_id=12345, xui=xui)
 
@@ -43,15 +51,15 @@ class TestCreateVlessConfig:
         assert len(result["client_uuid"]) == 36  # UUID format
         assert result["vless_link"] == "vless://fake"
         assert isinstance(result["expires_at"], datetime)
-        assert xui.add_client.call_count == 2
+        assert xui.aio.add_client.call_count == 2
 
     @pytest.mark.asyncio
     async def test_xui_failure_raises(self):
         """XUI returning False raises RuntimeError."""
         from bot_xui.vpn_factory import create_vless_config
 
-        xui = MagicMock()
-        xui.add_client.return_value = False
+        xui = _mock_xui()
+        xui.aio.add_client.return_value = False
 
         with pytest.raises(RuntimeError, match="Не удалось"):
             await create_vless_config(tg_id=99, xui=xui)
@@ -129,18 +137,18 @@ class TestGrantReferralVpn:
         """Extends existing client's expiry when they already have a config."""
         from bot_xui.vpn_factory import grant_referral_vpn
 
-        xui = MagicMock()
-        xui.get_client_by_tg_id.return_value = {
+        xui = _mock_xui()
+        xui.aio.get_client_by_tg_id.return_value = {
             "inbound_id": 1, "client": {"email": "tiin_100"}
         }
         new_ms = int((datetime.now(timezone.utc) + timedelta(days=10)).timestamp() * 1000)
-        xui.extend_client_expiry.return_value = new_ms
+        xui.aio.extend_client_expiry.return_value = new_ms
 
         result = await grant_referral_vpn(tg_id=100, days=7, xui=xui)
 
         assert result["action"] == "extended"
         assert result["days"] == 7
-        xui.add_client.assert_not_called()
+        xui.aio.add_client.assert_not_called()
         mock_sync.assert_called_once()
 
     @pytest.mark.asyncio
@@ -151,18 +159,18 @@ class TestGrantReferralVpn:
         """Creates new VLESS+Hysteria config when user has no existing config."""
         from bot_xui.vpn_factory import grant_referral_vpn
 
-        xui = MagicMock()
-        xui.get_client_by_tg_id.return_value = None
-        xui.add_client.return_value = {"success": True, "subId": "url"}
-        xui.get_subscription_url_by_uuid.return_value = "https://sub/url"
-        xui.get_hysteria_inbound_id.return_value = 4
+        xui = _mock_xui()
+        xui.aio.get_client_by_tg_id.return_value = None
+        xui.aio.add_client.return_value = {"success": True, "subId": "url"}
+        xui.aio.get_subscription_url_by_uuid.return_value = "https://sub/url"
+        xui.aio.get_hysteria_inbound_id.return_value = 4
 
         result = await grant_referral_vpn(tg_id=200, days=3, xui=xui)
 
         assert result["action"] == "created"
         assert result["vless_link"] == "vless://ref"
         # 2 вызова add_client: VLESS и Hysteria
-        assert xui.add_client.call_count == 2
+        assert xui.aio.add_client.call_count == 2
         mock_create_key.assert_called_once()
 
     @pytest.mark.asyncio
@@ -170,9 +178,9 @@ class TestGrantReferralVpn:
         """Returns None if XUI add_client fails."""
         from bot_xui.vpn_factory import grant_referral_vpn
 
-        xui = MagicMock()
-        xui.get_client_by_tg_id.return_value = None
-        xui.add_client.return_value = False
+        xui = _mock_xui()
+        xui.aio.get_client_by_tg_id.return_value = None
+        xui.aio.add_client.return_value = False
 
         result = await grant_referral_vpn(tg_id=300, days=5, xui=xui)
         assert result is None
@@ -182,8 +190,8 @@ class TestGrantReferralVpn:
         """Returns None on unexpected error (doesn't crash)."""
         from bot_xui.vpn_factory import grant_referral_vpn
 
-        xui = MagicMock()
-        xui.get_client_by_tg_id.side_effect = ConnectionError("panel down")
+        xui = _mock_xui()
+        xui.aio.get_client_by_tg_id.side_effect = ConnectionError("panel down")
 
         result = await grant_referral_vpn(tg_id=400, days=5, xui=xui)
         assert result is None
@@ -325,7 +333,6 @@ class TestCreateSoftEtherConfig:
         from bot_xui.vpn_factory import create_softether_config
 
         mock_se.create_user.return_value = True
-        mock_se.set_user_expiry.return_value = True
 
         result = create_softether_config(tg_id=600, days=30)
 
@@ -333,8 +340,10 @@ class TestCreateSoftEtherConfig:
         assert len(result["password"]) == 16  # hex(8)
         assert "host" in result["config"]
         assert result["vpn_file"]  # non-empty
-        mock_se.create_user.assert_called_once()
-        mock_se.set_user_expiry.assert_called_once()
+        # expiry goes in the same vpncmd batch as the user
+        username, password, expires_str = mock_se.create_user.call_args.args
+        assert username == result["username"] and len(expires_str) == 10
+        mock_se.set_user_expiry.assert_not_called()
 
     @patch("bot_xui.vpn_factory.softether")
     def test_create_fails_raises(self, mock_se):
@@ -346,18 +355,20 @@ class TestCreateSoftEtherConfig:
         with pytest.raises(RuntimeError, match="Failed to create"):
             create_softether_config(tg_id=700)
 
-    @patch("bot_xui.vpn_factory.softether")
-    def test_expiry_fails_cleans_up(self, mock_se):
+    def test_expiry_fails_cleans_up(self):
         """If expiry setting fails, user is deleted and error raised."""
         from bot_xui.vpn_factory import create_softether_config
+        batches = []
 
-        mock_se.create_user.return_value = True
-        mock_se.set_user_expiry.return_value = False
+        def fake_batch(commands):
+            batches.append([c[0] for c in commands])
+            return [None if c[0] == "UserExpiresSet" else "ok" for c in commands]
 
-        with pytest.raises(RuntimeError, match="Failed to set"):
+        with patch("bot_xui.softether._run_batch", side_effect=fake_batch), \
+                pytest.raises(RuntimeError, match="Failed to create"):
             create_softether_config(tg_id=800)
 
-        mock_se.delete_user.assert_called_once()
+        assert batches[-1] == ["UserDelete"]
 
 
 # ═════════════════════════════════════════════
@@ -387,8 +398,8 @@ class TestEnsureTestSubscription:
             "client_email": "tiin_222", "client_uuid": "uuid-x",
             "vless_link": "vless://test", "expires_at": datetime.now(timezone.utc),
         }
-        xui = MagicMock()
-        xui.get_client_subscription_url.return_value = "https://sub/222"
+        xui = _mock_xui()
+        xui.aio.get_client_subscription_url.return_value = "https://sub/222"
 
         result = await ensure_test_subscription(tg_id=222, xui=xui)
 
@@ -1,6 +1,6 @@
 """Тесты для api/web_portal.py — XSS protection and injection fixes."""
 import sys
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import pytest
 
 # Mock yookassa before importing
@@ -24,16 +24,14 @@ def test_xss_in_first_name_is_escaped():
     assert "&lt;script&gt;" in escaped
 
 
-@patch("api.web_portal.is_vless_test_activated_by_id", return_value=False)
-@patch("api.web_portal.get_keys_by_user_id", return_value=[])
-@patch("api.web_portal.get_keys_by_tg_id", return_value=[])
-@patch("api.web_portal.get_user_by_web_token")
-def test_sub_url_empty_is_json_encoded(mock_get_user, mock_keys, mock_keys_uid, mock_test, client):
+@patch("api.web_portal.is_vless_test_activated_by_id_async", new_callable=AsyncMock, return_value=False)
+@patch("api.web_portal.get_web_bundle_async", new_callable=AsyncMock)
+def test_sub_url_empty_is_json_encoded(mock_bundle, mock_test, client):
     """SUB_URL should be JSON-encoded (empty string becomes ""), not raw interpolation."""
-    mock_get_user.return_value = {
+    mock_bundle.return_value = ({
         "id": 1, "tg_id": 456, "first_name": "Test",
         "subscription_until": None, "email": None,
-    }
+    }, [])
 
     response = client.get("/my/some-token")
 
@@ -44,24 +42,21 @@ def test_sub_url_empty_is_json_encoded(mock_get_user, mock_keys, mock_keys_uid,
     assert "const SUB_URL = ;" not in html
 
 
-@patch("api.web_portal.is_vless_test_activated_by_id", return_value=True)
-@patch("api.web_portal.get_keys_by_user_id", return_value=[])
-@patch("api.web_portal.get_keys_by_tg_id")
-@patch("api.web_portal.get_user_by_web_token")
-def test_sub_url_uses_proxy_endpoint(mock_get_user, mock_keys, mock_keys_uid, mock_test, client):
+@patch("api.web_portal.is_vless_test_activated_by_id_async", new_callable=AsyncMock, return_value=True)
+@patch("api.web_portal.get_web_bundle_async", new_callable=AsyncMock)
+def test_sub_url_uses_proxy_endpoint(mock_bundle, mock_test, client):
     """SUB_URL is built from the web token + /sub/ proxy path, not raw XUI URL."""
     from datetime import datetime, timedelta
     future = datetime.now() + timedelta(days=30)
 
-    mock_get_user.return_value = {
+    mock_bundle.return_value = ({
         "id": 2, "tg_id": 789, "first_name": "User",
         "subscription_until": future, "email": None,
-    }
-    mock_keys.return_value = [{
+    }, [{
         "vpn_type": "vless",
         "subscription_link": "https://xui.example.com/sub/abc",
         "expires_at": future,
-    }]
+    }])
 
     response = client.get("/my/token-with-sub")
 
@@ -73,8 +68,8 @@ def test_sub_url_uses_proxy_endpoint(mock_get_user, mock_keys, mock_keys_uid, mo
     assert "xui.example.com" not in html
 
 
-@patch("api.web_portal.get_user_by_web_token", return_value=None)
-def test_invalid_token_returns_404(mock_get_user, client):
+@patch("api.web_portal.get_web_bundle_async", new_callable=AsyncMock, return_value=None)
+def test_invalid_token_returns_404(mock_bundle, client):
     """Invalid token should return 404."""
     response = client.get("/my/bad-token")
     assert response.status_code == 404
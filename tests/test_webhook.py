@@ -75,7 +75,7 @@ def test_webhook_no_payment_id(mock_verify, client):
     assert response.status_code == 200
 
 
-@patch("api.webhook.get_payment_status", return_value="paid")
+@patch("api.webhook.get_payment_status_async", new_callable=AsyncMock, return_value="paid")
 @patch("api.webhook.verify_yookassa_ip")
 def test_webhook_duplicate_ignored(mock_verify, mock_status, client):
     """Дублирующий вебхук для уже оплаченного — ignored."""
@@ -88,7 +88,7 @@ def test_webhook_duplicate_ignored(mock_verify, mock_status, client):
     assert data["status"] == "duplicate"
 
 
-@patch("api.webhook.get_payment_status", return_value=None)
+@patch("api.webhook.get_payment_status_async", new_callable=AsyncMock, return_value=None)
 @patch("api.webhook.verify_yookassa_ip")
 def test_webhook_unknown_payment(mock_verify, mock_status, client):
     """Неизвестный payment_id — ignored."""
@@ -182,7 +182,7 @@ async def test_vless_inbound_count_guard(mock_get_user):
     mock_xui = MagicMock()
     mock_xui.get_inbounds.return_value = [{"id": 1}, {"id": 2}]  # Only 2
 
-    with patch("api.webhook.XUIClient", return_value=mock_xui):
+    with patch("api.webhook.AsyncXUIClient", return_value=mock_xui):
         result = await process_successful_payment(
             "pay-456",
             {"tg_id": 99999, "tariff": "1month"},
@@ -214,7 +214,9 @@ async def test_vless_payment_sets_hysteria_link(
 
     mock_get_sub.return_value = datetime(2026, 6, 1)
 
-    mock_xui = MagicMock()
+    mock_xui = AsyncMock()
+    mock_xui.host = "https://xui.local"
+    mock_xui.invalidate_inbounds = MagicMock()
     mock_xui.get_vless_reality_inbound_id.return_value = 1
     mock_xui.get_hysteria_inbound_id.return_value = 4
     mock_xui.get_client_by_tg_id.return_value = None
@@ -222,7 +224,7 @@ async def test_vless_payment_sets_hysteria_link(
     mock_xui.get_client_by_email.return_value = None  # no existing hysteria client
     mock_xui.add_client.return_value = {"success": True, "subId": "sub123"}
 
-    with patch("bot_xui.utils.XUIClient", return_value=mock_xui):
+    with patch("api.webhook.AsyncXUIClient", return_value=mock_xui):
         result = await process_successful_payment(
             "pay-vless-001",
             {"tg_id": 12345, "tariff": "monthly_30d"},
@@ -245,11 +247,12 @@ async def test_vless_payment_sets_hysteria_link(
 # ─────────────────────────────────────────────
 
 @patch("api.webhook.process_successful_payment", new_callable=AsyncMock, return_value=True)
-@patch("api.webhook.get_payment_by_id")
-@patch("api.webhook.update_payment_status")
-@patch("api.webhook.get_payment_status", return_value="pending")
+@patch("api.webhook.claim_payment_for_processing_async", new_callable=AsyncMock, return_value=True)
+@patch("api.webhook.get_payment_by_id_async", new_callable=AsyncMock)
+@patch("api.webhook.update_payment_status_async", new_callable=AsyncMock)
+@patch("api.webhook.get_payment_status_async", new_callable=AsyncMock, return_value="pending")
 @patch("api.webhook.verify_yookassa_ip")
-def test_web_order_tg_id_is_int(mock_verify, mock_status, mock_update, mock_get_pay, mock_process, client):
+def test_web_order_tg_id_is_int(mock_verify, mock_status, mock_update, mock_get_pay, mock_claim, mock_process, client):
     """Web order tg_id should be int, not str."""
     mock_get_pay.return_value = {
         "tg_id": 12345,
@@ -259,7 +262,7 @@ def test_web_order_tg_id_is_int(mock_verify, mock_status, mock_update, mock_get_
         "web_token": "tok-abc",
     }
 
-    with patch("api.webhook.get_user_by_web_token", return_value={"tg_id": 67890}):
+    with patch("api.webhook.get_user_by_web_token_async", new_callable=AsyncMock, return_value={"tg_id": 67890}):
         response = client.post("/webhook", json={
             "event": "payment.succeeded",
             "object": {"id": "pay-web-1", "status": "succeeded", "metadata": {}},
@@ -0,0 +1,140 @@
+"""Tests for bot_xui/xui_db.py — read-only x-ui SQLite mirror with change detection."""
+import json
+import os
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+from bot_xui import xui_db
+from bot_xui.xui_db import XUIDBMirror
+
+
+def _client(email, tg_id="", sub_id="", enable=True, expiry=0):
+    return {"email": email, "id": f"uuid-{email}", "tgId": tg_id, "subId": sub_id,
+            "enable": enable, "expiryTime": expiry}
+
+
+def _create_db(path, inbounds, traffics=()):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, port INTEGER, protocol TEXT, remark TEXT,"
+                 " enable INTEGER, settings TEXT, stream_settings TEXT)")
+    conn.execute("CREATE TABLE client_traffics (id INTEGER PRIMARY KEY, inbound_id INTEGER, enable INTEGER,"
+                 " email TEXT, up INTEGER, down INTEGER, last_online INTEGER)")
+    for ib_id, port, protocol, clients in inbounds:
+        conn.execute("INSERT INTO inbounds VALUES (?, ?, ?, ?, 1, ?, '{}')",
+                     (ib_id, port, protocol, f"ib{ib_id}", json.dumps({"clients": clients})))
+    for email, up, down, last_online in traffics:
+        conn.execute("INSERT INTO client_traffics (inbound_id, enable, email, up, down, last_online)"
+                     " VALUES (1, 1, ?, ?, ?, ?)", (email, up, down, last_online))
+    conn.commit()
+    conn.close()
+
+
+def _set_clients(path, ib_id, clients):
+    conn = sqlite3.connect(path)
+    conn.execute("UPDATE inbounds SET settings = ? WHERE id = ?", (json.dumps({"clients": clients}), ib_id))
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / "x-ui.db")
+    _create_db(path, [
+        (1, 7443, "vless", [_client("tiin_100", 100, "sub100"), _client("test-100-ab", 100, "subtest"),
+                            _client("tiin_web_7", "", "subweb7")]),
+        (2, 54321, "hysteria2", [_client("tiin_100_h", 100, "sub100")]),
+    ], [("tiin_100", 10, 20, 1700000000000)])
+    return path
+
+
+# ─────────────────────────────────────────────
+#  Snapshot indexes
+# ─────────────────────────────────────────────
+
+def test_snapshot_indexes(db_path):
+    snap = XUIDBMirror(db_path).snapshot()
+    assert snap.client("tiin_web_7")["subId"] == "subweb7"
+    assert snap.by_email["tiin_100_h"][0] == 2
+    assert [c["email"] for _, c in snap.by_tg_id["100"]] == ["tiin_100", "test-100-ab", "tiin_100_h"]
+    assert [ib for ib, _ in snap.by_sub_id["sub100"]] == [1, 2]
+    assert snap.last_online("tiin_100") == 1700000000000 and snap.last_online("nobody") == 0
+    assert snap.traffic["tiin_100"]["up"] == 10
+    assert [c["email"] for _, c in snap.clients(protocol="vless")] == ["tiin_100", "test-100-ab", "tiin_web_7"]
+    assert [c["email"] for _, c in snap.clients(port=54321)] == ["tiin_100_h"]
+
+
+# ─────────────────────────────────────────────
+#  Change detection
+# ─────────────────────────────────────────────
+
+def test_no_reload_while_unchanged(db_path):
+    mirror = XUIDBMirror(db_path, check_interval=0)
+    first = mirror.snapshot()
+    assert mirror.snapshot() is first
+    assert mirror.reloads == 1
+
+
+def test_reload_after_external_commit(db_path):
+    mirror = XUIDBMirror(db_path, check_interval=0)
+    mirror.snapshot()
+    _set_clients(db_path, 1, [_client("tiin_200", 200, "sub200")])
+    snap = mirror.snapshot()
+    assert mirror.reloads == 2
+    assert snap.client("tiin_200")["subId"] == "sub200" and snap.client("tiin_web_7") is None
+
+
+def test_reload_after_external_commit_in_wal_mode(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.close()
+    mirror = XUIDBMirror(db_path, check_interval=0)
+    mirror.snapshot()
+    _set_clients(db_path, 1, [_client("tiin_300")])
+    assert mirror.snapshot().client("tiin_300") is not None
+
+
+def test_file_replaced_reconnects(db_path, tmp_path):
+    mirror = XUIDBMirror(db_path, check_interval=0)
+    mirror.snapshot()
+    other = str(tmp_path / "restored.db")
+    _create_db(other, [(1, 7443, "vless", [_client("restored")])])
+    os.replace(other, db_path)
+    assert mirror.snapshot().client("restored") is not None
+
+
+def test_check_interval_throttles_unless_fresh(db_path):
+    mirror = XUIDBMirror(db_path, check_interval=60)
+    mirror.snapshot()
+    _set_clients(db_path, 1, [_client("tiin_400", 400, "sub400")])
+    assert mirror.snapshot().client("tiin_400") is None
+    assert mirror.snapshot(fresh=True).client("tiin_400")["subId"] == "sub400"
+
+
+def test_missing_file_raises():
+    with pytest.raises(FileNotFoundError):
+        XUIDBMirror("/nonexistent/x-ui.db").snapshot()
+
+
+# ─────────────────────────────────────────────
+#  Callers
+# ─────────────────────────────────────────────
+
+def test_get_subid_from_xui_db(db_path):
+    from api.webhook import get_subid_from_xui_db
+    with patch("bot_xui.xui_db.XUI_DB_PATH", db_path):
+        assert get_subid_from_xui_db("tiin_web_7") == "subweb7"
+        assert get_subid_from_xui_db("nobody") is None
+    with patch("bot_xui.xui_db.XUI_DB_PATH", "/nonexistent/x-ui.db"):
+        assert get_subid_from_xui_db("tiin_web_7") is None
+
+
+def test_get_user_sub_url_prefers_main_key(db_path):
+    from bot_xui.helpers import get_user_sub_url
+    with patch("bot_xui.xui_db.XUI_DB_PATH", db_path), patch("bot_xui.helpers.XUI_SUB_PATH", "https://x"):
+        assert get_user_sub_url(100, 1) == "https://x/sub/sub100"
+        assert get_user_sub_url(0, 7) == "https://x/sub/subweb7"
+        assert get_user_sub_url(555, 9) == ""
+    # сбрасываем синглтон, чтобы не держать соединение к tmp-файлу
+    xui_db.mirror().close()